@@ -0,0 +1,113 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2018 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Benchmark of the lab checkpoints on a project with many virtual machines.
+
+Usage: python benchmarks/bench_checkpoints.py [VMS] [CONCURRENCY...]
+
+A base image and a private COW for every virtual machine are created in a
+temporary directory, then a checkpoint is created and reset with every
+concurrency level. qemu-img must be in the PATH.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+from twisted.internet import task, defer
+
+from virtualbricks import lab
+
+
+class Disk:
+
+    def __init__(self, path):
+        self.image = object()
+        self.cow = True
+        self.path = path
+
+    def get_cow_path(self):
+        return self.path
+
+
+class VirtualMachine:
+
+    proc = None
+
+    def __init__(self, name, path):
+        self.name = name
+        self.disk = Disk(path)
+
+    def get_type(self):
+        return "Qemu"
+
+    def disks(self):
+        return [self.disk]
+
+
+class Factory:
+
+    def __init__(self, bricks):
+        self.bricks = bricks
+
+
+def create_project(path, vms):
+    base = os.path.join(path, "base.qcow2")
+    subprocess.check_call(["qemu-img", "create", "-q", "-f", "qcow2", base,
+                           "1G"])
+    bricks = []
+    for i in range(vms):
+        cow = os.path.join(path, "vm{0}_hda.cow".format(i))
+        subprocess.check_call(["qemu-img", "create", "-q", "-f", "qcow2",
+                               "-b", base, "-F", "qcow2", cow])
+        bricks.append(VirtualMachine("vm{0}".format(i), cow))
+    return Factory(bricks)
+
+
+@defer.inlineCallbacks
+def run(reactor, vms, levels):
+    path = tempfile.mkdtemp()
+    try:
+        factory = create_project(path, vms)
+        for concurrency in levels:
+            name = "bench{0}".format(concurrency)
+            start = time.time()
+            yield lab.checkpoint(factory, path, name, concurrency)
+            created = time.time()
+            yield lab.reset(factory, path, name, concurrency)
+            done = time.time()
+            print("{0} disks, concurrency {1}: checkpoint {2:.2f}s, "
+                  "reset {3:.2f}s".format(vms, concurrency, created - start,
+                                          done - created))
+    finally:
+        shutil.rmtree(path)
+
+
+def main(argv):
+    vms = int(argv[1]) if len(argv) > 1 else 100
+    levels = [int(arg) for arg in argv[2:]] or [1, 4, 16]
+    task.react(run, (vms, levels))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,125 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2018 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Benchmark of the creation of the private COWs at the cold start of a lab.
+
+Usage: python benchmarks/bench_cow_creation.py [VMS] [CONCURRENCY]
+
+The private COWs of VMS virtual machines are created all together, as when
+all the bricks are started, first running sync(1) after every COW, as
+virtualbricks did in the past, then with the current code, that flushes
+only the new file. qemu-img must be in the PATH. Run it with some dirty
+pages in the page cache (i.e. while copying a big file) to see the cost of
+the global flush.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+from twisted.internet import task, defer, utils
+
+from virtualbricks import settings, project, virtualmachines
+
+
+class VirtualMachine:
+
+    def __init__(self, name, basefolder, base):
+        self.name = name
+        self.config = {"privatehda": True, "snapshot": False,
+                       "cowplace": "", "cowplacehda": ""}
+        self.disk = Disk(self, basefolder, base)
+
+
+class Image:
+
+    def __init__(self, path):
+        self.path = path
+
+
+class Disk(virtualmachines.Disk):
+
+    def __init__(self, vm, basefolder, base):
+        virtualmachines.Disk.__init__(self, vm, "hda")
+        self._basefolder = basefolder
+        self.image = Image(base)
+
+    @property
+    def basefolder(self):
+        return self._basefolder
+
+
+class SyncDisk(Disk):
+    """The old implementation, global sync after every COW."""
+
+    def _sync(self, ret, cowname):
+        out, err, code = ret
+        if code != 0:
+            raise RuntimeError("Cannot create private COW\n%s" % err)
+        return utils.getProcessOutputAndValue("sync", env=os.environ)
+
+    def _create_cow(self, cowname):
+        args = ["create", "-b", self._get_base(), "-f",
+                settings.get("cowfmt"), cowname]
+        exit = utils.getProcessOutputAndValue("qemu-img", args, os.environ)
+        exit.addCallback(self._sync, cowname)
+        exit.addCallback(lambda _: cowname)
+        return exit
+
+
+def cold_start(path, disk_factory, vms, base):
+    disks = [disk_factory(VirtualMachine("vm{0}".format(i), path, base),
+                          path, base) for i in range(vms)]
+    start = time.time()
+    d = defer.gatherResults([disk.get_real_disk_name() for disk in disks])
+    return d.addCallback(lambda _: time.time() - start)
+
+
+@defer.inlineCallbacks
+def run(reactor, vms, concurrency):
+    settings.set("concurrency", concurrency)
+    settings.set("cowfmt", "qcow2")
+    for name, disk_factory in ("sync", SyncDisk), ("fsync", Disk):
+        path = tempfile.mkdtemp()
+        # the COWs are checked against the current project
+        project.manager.current = project.Project(path, project.manager)
+        try:
+            base = os.path.join(path, "base.qcow2")
+            subprocess.check_call(["qemu-img", "create", "-q", "-f", "qcow2",
+                                   base, "1G"])
+            elapsed = yield cold_start(path, disk_factory, vms, base)
+            print("{0}: {1} private COWs in {2:.2f}s".format(name, vms,
+                                                            elapsed))
+        finally:
+            project.manager.current = None
+            shutil.rmtree(path)
+
+
+def main(argv):
+    vms = int(argv[1]) if len(argv) > 1 else 50
+    concurrency = int(argv[2]) if len(argv) > 2 else 4
+    task.react(run, (vms, concurrency))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
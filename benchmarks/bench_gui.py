@@ -0,0 +1,112 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2018 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Benchmark of the time to the first window and of the opening of the
+configuration panels.
+
+Usage: python benchmarks/bench_gui.py [ROUNDS] [--no-reuse]
+
+The main window is built and shown as at startup, then the configuration
+panel of a brick of every type is opened and closed ROUNDS times. The first
+time the panel is built, the next times it is reused, unless --no-reuse is
+given. The qemu executables are discovered, and their capabilities cached
+in the workspace, before the panels are opened. A display is required, i.e.
+run it with xvfb-run. The settings are neither read nor saved.
+"""
+
+from __future__ import print_function
+
+import sys
+import time
+import gettext
+
+import gi
+gi.require_version("Gtk", "3.0")
+from gi.repository import Gtk
+from twisted.internet import gtk3reactor
+gtk3reactor.install()
+
+from twisted.internet import task, defer
+
+
+BRICKS = ("switch", "switchwrapper", "tap", "wire", "netemu", "qemu")
+
+
+def flush():
+    while Gtk.events_pending():
+        Gtk.main_iteration()
+
+
+def open_panel(vbgui, brick):
+    from virtualbricks.gui import interfaces
+
+    controller = interfaces.IConfigController(brick)
+    configframe = vbgui.get_object("configframe")
+    configframe.add(controller.get_view(vbgui))
+    configframe.show()
+    vbgui.get_object("main_notebook").hide()
+    flush()
+    return controller
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+@defer.inlineCallbacks
+def run(reactor, rounds, reuse):
+    gettext.install("virtualbricks")
+    start = time.time()
+    from virtualbricks import settings, qemu
+    from virtualbricks.gui import gui, widgets
+
+    imported = time.time()
+    settings.set("systray", False)
+    settings.set("show_missing", False)
+    factory = gui.VisualFactory(defer.Deferred())
+    vbgui = gui.VBGUI(factory, gui.load_ui(), widgets.LogStore())
+    flush()
+    shown = time.time()
+    print("first window: {0:.3f}s (imports {1:.3f}s)".format(
+        shown - start, imported - start))
+
+    yield qemu.capabilities.discover()
+    for type in BRICKS:
+        brick = factory.new_brick(type, "bench_" + type)
+        times = []
+        for i in range(rounds):
+            opened = time.time()
+            controller = open_panel(vbgui, brick)
+            times.append(time.time() - opened)
+            controller.on_cancel_button_clicked(None, vbgui)
+            if not reuse:
+                gui._panels.clear()
+            flush()
+        print("{0:>14}: first {1:.1f}ms, then {2:.1f}ms".format(
+            type, times[0] * 1000, median(times[1:] or times) * 1000))
+
+
+def main(argv):
+    args = [arg for arg in argv[1:] if not arg.startswith("--")]
+    rounds = int(args[0]) if args else 10
+    task.react(run, (rounds, "--no-reuse" not in argv))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
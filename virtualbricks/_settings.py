@@ -55,6 +55,20 @@ DEFAULT_CONF = {
     "show_missing": True,
     "qemupath": "/usr/bin",
     "vdepath": "/usr/bin",
+    # maximum number of virtual machines or images handled in parallel by the
+    # lab-wide operations
+    "concurrency": 4,
+    # keep one copy of the base images in the content addressed store of the
+    # workspace
+    "imagestore": False,
+    # add to the disk library the images found in the vimages directory of
+    # the workspace, not only the ones of the project
+    "scanimages": False,
+    # the share of the size of the disk reserved in the file system of the
+    # disposable COWs, i.e. 0.5 to start twice the disks that fit in a tmpfs
+    "cowreserve": 1.0,
+    # the number of messages kept by the Messages window
+    "logretention": 5000,
 }
 
 
@@ -79,7 +93,8 @@ class SettingsMeta(type):
 class Settings(six.with_metaclass(SettingsMeta)):
 
     __boolean_values__ = ('kvm', 'ksm', 'python', 'femaleplugs',
-                          'erroronloop', 'systray', 'show_missing')
+                          'erroronloop', 'systray', 'show_missing',
+                          'imagestore', 'scanimages')
     DEFAULT_SECTION = "Main"
     DEFAULT_PROJECT = DEFAULT_PROJECT
     VIRTUALBRICKS_HOME = VIRTUALBRICKS_HOME
@@ -0,0 +1,674 @@
+# -*- test-case-name: virtualbricks.tests.test_archive -*-
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2018 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Streaming writer of the project archives.
+
+An archive is a gzip compressed tar file, as the one created by C{tar cfzh}.
+The tar stream is cut in blocks that are compressed in parallel by a pool of
+threads, every block is a complete gzip member and the members are written
+in order, so the result is a valid gzip file that any gzip reader can read.
+
+The holes of the sparse files are found with C{SEEK_DATA} and C{SEEK_HOLE}
+and are not read nor written: the files are stored as PAX sparse files
+(format 1.0), understood by GNU tar, bsdtar and the tarfile module. The
+sparse files can be disabled to create archives for tar implementations
+that do not know them.
+
+The last member of the archive, C{.checksums}, has the SHA-256 of the data
+stored for every file. The checksums are verified when the archive is
+extracted, together with the CRC of the gzip members.
+
+The extraction is resumable: the files extracted are recorded in a journal
+in the destination directory and, if the extraction of the same archive is
+interrupted and started again, they are not written again. The files moved
+away while the archive was extracted are recorded with L{record_moved}, they
+are not extracted again if they are still where they were moved.
+"""
+
+import os
+import sys
+import time
+import errno
+import stat
+import zlib
+import hashlib
+import tarfile
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import six
+from twisted.internet import threads, reactor
+
+from virtualbricks import settings, errors, log
+
+
+__all__ = ["ParallelGzipWriter", "ArchiveWriter", "ArchiveReader",
+           "data_segments", "create", "extract", "can_resume", "record_moved",
+           "clear_moved"]
+
+logger = log.Logger()
+skip_member = log.Event("Skipping {name}, it is not a regular file")
+missing_image = log.Event("The image {name} is not exported, {path} does not "
+                          "exist")
+resume_extraction = log.Event("Resuming the extraction of {path}, {count} "
+                              "files already extracted")
+
+BLOCK_SIZE = 1024 * 1024
+READ_SIZE = 1024 * 1024
+# the progress is reported every REPORT_SIZE bytes
+REPORT_SIZE = 16 * 1024 * 1024
+COMPRESS_LEVEL = 6
+MANIFEST = ".checksums"
+JOURNAL = ".extracting"
+MOVED = ".moved"
+
+
+def _compress(data, level):
+    # wbits=31: a complete gzip member
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ParallelGzipWriter:
+    """
+    A file-like object that compresses what is written in blocks, in
+    parallel.
+
+    @param fileobj: where the compressed data is written.
+    @param workers: the number of the compression threads.
+    """
+
+    def __init__(self, fileobj, workers, block_size=BLOCK_SIZE,
+                 level=COMPRESS_LEVEL):
+        self.fileobj = fileobj
+        self.block_size = block_size
+        self.level = level
+        self._workers = workers
+        self._pool = ThreadPool(workers)
+        self._buffer = []
+        self._buffered = 0
+        self._pending = []
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.block_size:
+            self._submit(b"".join(self._buffer))
+
+    def _submit(self, data):
+        self._buffer = []
+        self._buffered = 0
+        self._pending.append(self._pool.apply_async(_compress,
+                                                    (data, self.level)))
+        # do not keep in memory more blocks than needed to keep all the
+        # workers busy
+        while len(self._pending) > self._workers * 2:
+            self._write_next()
+
+    def _write_next(self):
+        self.fileobj.write(self._pending.pop(0).get())
+
+    def close(self):
+        try:
+            if self._buffered or not self._pending:
+                self._submit(b"".join(self._buffer))
+            while self._pending:
+                self._write_next()
+            self.fileobj.flush()
+        finally:
+            self.terminate()
+
+    def terminate(self):
+        """Stop the compression threads, the data not written is lost."""
+
+        self._pool.terminate()
+
+
+def data_segments(fd, size):
+    """
+    Return the list of the (offset, length) of the data of a file, the
+    holes are skipped. If the file system does not tell where the holes
+    are, the whole file is data.
+    """
+
+    if not hasattr(os, "SEEK_DATA"):
+        return [(0, size)] if size else []
+    segments = []
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # only a hole until the end of the file
+                break
+            elif e.errno == errno.EINVAL:
+                return [(0, size)] if size else []
+            raise
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        segments.append((start, end - start))
+        offset = end
+    return segments
+
+
+def _padding(size):
+    return b"\x00" * (-size % tarfile.BLOCKSIZE)
+
+
+def _sparse_map(segments, size):
+    # the last entry records the real size if the file ends with a hole
+    if not segments or sum(segments[-1]) < size:
+        segments = segments + [(size, 0)]
+    lines = [str(len(segments))]
+    for offset, length in segments:
+        lines.extend((str(offset), str(length)))
+    data = ("\n".join(lines) + "\n").encode("ascii")
+    return data + _padding(len(data)), segments
+
+
+def _checksum(segments, size):
+    # the checksum of the data as stored, the holes are not read
+    checksum = hashlib.sha256()
+    for offset, length in segments:
+        checksum.update("{0} {1}\n".format(offset, length).encode("ascii"))
+    checksum.update("{0}\n".format(size).encode("ascii"))
+    return checksum
+
+
+class ArchiveWriter:
+    """
+    Write a tar stream of regular files. The symbolic links are followed.
+
+    @param progress: if not C{None}, called in the reactor thread with the
+        number of bytes of data written and the total.
+    """
+
+    def __init__(self, fileobj, sparse=True, progress=None):
+        self.fileobj = fileobj
+        self.sparse = sparse
+        self.progress = progress
+        self.done = 0
+        self.total = 0
+        self.checksums = []
+        self._reported = 0
+
+    def _report(self, force=False):
+        if self.progress is not None and (
+                force or self.done - self._reported >= REPORT_SIZE):
+            self._reported = self.done
+            reactor.callFromThread(self.progress, self.done, self.total)
+
+    def _tarinfo(self, arcname, st):
+        tarinfo = tarfile.TarInfo(arcname)
+        tarinfo.mode = stat.S_IMODE(st.st_mode)
+        tarinfo.mtime = int(st.st_mtime)
+        tarinfo.uid = st.st_uid
+        tarinfo.gid = st.st_gid
+        tarinfo.size = st.st_size
+        return tarinfo
+
+    def _header(self, tarinfo):
+        self.fileobj.write(tarinfo.tobuf(tarfile.PAX_FORMAT))
+
+    def add_files(self, entries):
+        """
+        Add the files to the archive.
+
+        @param entries: a list of (archive name, path) of the files.
+        """
+
+        files = []
+        try:
+            for arcname, path in entries:
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    st = os.fstat(fd)
+                    if self.sparse:
+                        segments = data_segments(fd, st.st_size)
+                    else:
+                        segments = [(0, st.st_size)] if st.st_size else []
+                except:
+                    os.close(fd)
+                    raise
+                files.append((arcname, fd, st, segments))
+                self.total += sum(length for _, length in segments)
+            self._report(True)
+            for arcname, fd, st, segments in files:
+                self._add(arcname, fd, st, segments)
+            self._report(True)
+        finally:
+            for _, fd, _, _ in files:
+                os.close(fd)
+
+    def _add(self, arcname, fd, st, segments):
+        tarinfo = self._tarinfo(arcname, st)
+        if self.sparse and sum(l for _, l in segments) < st.st_size:
+            sparse_map, segments = _sparse_map(segments, st.st_size)
+            dirname, basename = os.path.split(arcname)
+            tarinfo.name = os.path.join(dirname, "GNUSparseFile.0",
+                                        basename)
+            tarinfo.size = len(sparse_map) + sum(l for _, l in segments)
+            tarinfo.pax_headers = {
+                u"GNU.sparse.major": u"1",
+                u"GNU.sparse.minor": u"0",
+                u"GNU.sparse.name": six.text_type(arcname),
+                u"GNU.sparse.realsize": six.text_type(st.st_size),
+            }
+            self._header(tarinfo)
+            self.fileobj.write(sparse_map)
+        else:
+            self._header(tarinfo)
+        checksum = _checksum(segments, st.st_size)
+        for offset, length in segments:
+            self._copy(fd, offset, length, checksum)
+        self.fileobj.write(_padding(tarinfo.size))
+        self.checksums.append((arcname, checksum.hexdigest()))
+
+    def _copy(self, fd, offset, length, checksum):
+        os.lseek(fd, offset, os.SEEK_SET)
+        while length > 0:
+            data = os.read(fd, min(length, READ_SIZE))
+            if not data:
+                # the file was truncated while it was read
+                raise IOError(errno.EIO, "Unexpected end of file")
+            self.fileobj.write(data)
+            checksum.update(data)
+            length -= len(data)
+            self.done += len(data)
+            self._report()
+
+    def _write_manifest(self):
+        lines = ("{0}  {1}\n".format(digest, arcname)
+                 for arcname, digest in self.checksums)
+        data = "".join(lines).encode("utf-8")
+        tarinfo = tarfile.TarInfo(MANIFEST)
+        tarinfo.mode = 0o644
+        tarinfo.mtime = int(time.time())
+        tarinfo.size = len(data)
+        self._header(tarinfo)
+        self.fileobj.write(data + _padding(len(data)))
+
+    def close(self):
+        if self.checksums:
+            self._write_manifest()
+        self.fileobj.write(b"\x00" * (tarfile.BLOCKSIZE * 2))
+        self.fileobj.close()
+
+
+def _open_output(output):
+    if hasattr(output, "write"):
+        return output, False
+    if output == "-":
+        return getattr(sys.stdout, "buffer", sys.stdout), False
+    return open(output, "wb"), True
+
+
+def _create(output, entries, sparse, progress, workers):
+    fileobj, owned = _open_output(output)
+    compressor = ParallelGzipWriter(fileobj, workers)
+    try:
+        writer = ArchiveWriter(compressor, sparse, progress)
+        writer.add_files(entries)
+        writer.close()
+    except:
+        compressor.terminate()
+        if owned:
+            fileobj.close()
+            os.remove(output)
+        raise
+    if owned:
+        fileobj.close()
+
+
+def create(output, files, images=(), sparse=True, progress=None,
+           workers=None):
+    """
+    Create the archive of a project in a thread.
+
+    @param output: the path of the archive, C{"-"} for the standard output
+        or a file-like object, i.e. a pipe.
+    @param files: the files of the project, relative to the project
+        directory.
+    @param images: a list of (name, path) of the images saved in the
+        C{.images} directory of the archive. The images that do not exist
+        are skipped with a warning.
+    @param sparse: if C{False}, the holes of the files are written as zeros.
+    @param progress: called with the bytes written and the total.
+    @param workers: the number of compression threads, by default the
+        number of CPUs.
+    @return: a deferred that fires when the archive is written.
+    """
+
+    if workers is None:
+        workers = _cpu_count()
+    home = settings.VIRTUALBRICKS_HOME
+    entries = [(name, os.path.join(home, name)) for name in files]
+    for name, path in images:
+        if os.path.exists(path):
+            entries.append((".images/" + name, path))
+        else:
+            logger.warn(missing_image, name=name, path=path)
+    return threads.deferToThread(_create, output, entries, sparse, progress,
+                                 workers)
+
+
+def _cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def _parse_manifest(data):
+    manifest = {}
+    for line in data.decode("utf-8").splitlines():
+        digest, _, arcname = line.partition("  ")
+        if arcname:
+            manifest[arcname] = digest
+    return manifest
+
+
+def _safe_name(name):
+    normalized = os.path.normpath(name)
+    if (os.path.isabs(normalized) or normalized == os.pardir or
+            normalized.startswith(os.pardir + os.sep)):
+        raise errors.InvalidArchiveError(
+            "Invalid file name in archive: {0}".format(name))
+    return normalized
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _read_lines(path):
+    try:
+        with open(path) as fp:
+            return fp.read().splitlines()
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return []
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+class _Journal:
+    """
+    The list of the files completely extracted from an archive and of the
+    files moved away since. The entries are valid only if the archive is the
+    same, the journal is cleared otherwise.
+    """
+
+    def __init__(self, path, archive_id, moved_path=None):
+        self.path = path
+        self.moved_path = moved_path
+        self.done = {}
+        self.moved = {}
+        lines = _read_lines(path)
+        if lines and lines[0] == archive_id:
+            for line in lines[1:]:
+                try:
+                    arcname, size, digest = line.split("\t")
+                    self.done[arcname] = (int(size), digest)
+                except ValueError:
+                    # the last line was written partially
+                    break
+        if moved_path is not None:
+            lines = _read_lines(moved_path)
+            if lines and lines[0] == archive_id:
+                for line in lines[1:]:
+                    try:
+                        arcname, size, digest, moved = line.split("\t", 3)
+                        self.moved[arcname] = (int(size), digest, moved)
+                    except ValueError:
+                        break
+            else:
+                _remove_file(moved_path)
+        self._fp = open(path, "w")
+        self._fp.write(archive_id + "\n")
+        for arcname, (size, digest) in self.done.items():
+            self._write(arcname, size, digest)
+
+    def _write(self, arcname, size, digest):
+        self._fp.write("{0}\t{1}\t{2}\n".format(arcname, size, digest))
+        self._fp.flush()
+
+    def lookup(self, arcname, path):
+        """
+        Return the checksum of the file if it was already extracted or
+        C{None}.
+        """
+
+        try:
+            size, digest = self.done[arcname]
+            if os.path.getsize(path) == size:
+                return digest
+        except (KeyError, OSError):
+            pass
+        return None
+
+    def lookup_moved(self, arcname):
+        """
+        Return the path and the checksum of the file if it was extracted
+        and moved away or C{None}.
+        """
+
+        try:
+            size, digest, path = self.moved[arcname]
+            if os.path.getsize(path) == size:
+                return path, digest
+        except (KeyError, OSError):
+            pass
+        return None
+
+    def record(self, arcname, size, digest):
+        self.done[arcname] = (size, digest)
+        self._write(arcname, size, digest)
+
+    def close(self):
+        self._fp.close()
+
+    def remove(self, moved=False):
+        """
+        Remove the journal and, if C{moved} is C{True}, the record of the
+        moved files too.
+        """
+
+        self.close()
+        os.remove(self.path)
+        if moved and self.moved_path is not None:
+            _remove_file(self.moved_path)
+
+
+class ArchiveReader:
+    """
+    Extract the regular files and the directories of a tar file.
+
+    @param on_file: if not C{None}, called in the reactor thread with the
+        name in the archive, the path and the checksum of every file as soon
+        as it is extracted. The checksums are verified only at the end of
+        the archive.
+    """
+
+    def __init__(self, tar, destination, journal=None, on_file=None):
+        self.tar = tar
+        self.destination = destination
+        self.journal = journal
+        self.on_file = on_file
+        self.checksums = {}
+
+    def extract_all(self):
+        manifest = None
+        for member in self.tar:
+            arcname = _safe_name(member.name)
+            path = os.path.join(self.destination, arcname)
+            if arcname == MANIFEST:
+                manifest = _parse_manifest(self.tar.extractfile(member).read())
+            elif member.isdir():
+                _makedirs(path)
+            elif member.isfile():
+                path = self._extract_file(member, arcname, path)
+                if self.on_file is not None:
+                    reactor.callFromThread(self.on_file, arcname, path,
+                                           self.checksums[arcname])
+            else:
+                logger.warn(skip_member, name=member.name)
+        if manifest is not None:
+            self.verify(manifest)
+
+    def _extract_file(self, member, arcname, path):
+        if self.journal is not None:
+            digest = self.journal.lookup(arcname, path)
+            if digest is not None:
+                self.checksums[arcname] = digest
+                return path
+            moved = self.journal.lookup_moved(arcname)
+            if moved is not None:
+                path, self.checksums[arcname] = moved
+                return path
+        _makedirs(os.path.dirname(path))
+        if member.sparse is not None:
+            segments = member.sparse
+        else:
+            segments = [(0, member.size)] if member.size else []
+        checksum = _checksum(segments, member.size)
+        source = self.tar.fileobj
+        source.seek(member.offset_data)
+        with open(path, "wb") as fp:
+            for offset, length in segments:
+                fp.seek(offset)
+                self._copy(source, fp, length, checksum)
+            fp.truncate(member.size)
+        os.chmod(path, (member.mode & 0o777) | stat.S_IWUSR | stat.S_IRUSR)
+        os.utime(path, (member.mtime, member.mtime))
+        digest = checksum.hexdigest()
+        self.checksums[arcname] = digest
+        if self.journal is not None:
+            self.journal.record(arcname, member.size, digest)
+        return path
+
+    def _copy(self, source, target, length, checksum):
+        while length > 0:
+            data = source.read(min(length, READ_SIZE))
+            if not data:
+                raise errors.InvalidArchiveError("Unexpected end of archive")
+            target.write(data)
+            checksum.update(data)
+            length -= len(data)
+
+    def verify(self, manifest):
+        """
+        Compare the checksums of the extracted files with the ones of the
+        archive.
+
+        @raises errors.ChecksumError: if a file is missing or corrupted.
+        """
+
+        for arcname, digest in manifest.items():
+            if self.checksums.get(arcname) != digest:
+                raise errors.ChecksumError(
+                    "Invalid checksum: {0}".format(arcname))
+
+
+def _archive_id(path):
+    st = os.stat(path)
+    return "{0} {1} {2}".format(os.path.abspath(path), st.st_size,
+                                int(st.st_mtime))
+
+
+def _extract(archive, destination, on_file):
+    journal = _Journal(os.path.join(destination, JOURNAL),
+                       _archive_id(archive), os.path.join(destination, MOVED))
+    if journal.done:
+        logger.info(resume_extraction, path=archive, count=len(journal.done))
+    try:
+        try:
+            with tarfile.open(archive, "r:*") as tar:
+                ArchiveReader(tar, destination, journal, on_file).extract_all()
+        except (tarfile.TarError, EOFError) as e:
+            raise errors.InvalidArchiveError(str(e))
+    except errors.ChecksumError:
+        # do not trust anymore the files extracted
+        journal.remove(moved=True)
+        raise
+    except:
+        journal.close()
+        raise
+    journal.remove()
+
+
+def extract(archive, destination, on_file=None):
+    """
+    Extract an archive in a thread. If the extraction of the same archive in
+    the same destination was interrupted, the files already extracted are
+    not written again.
+
+    @param on_file: called with the name in the archive, the path and the
+        checksum of every file extracted. The path of a file moved away by
+        an interrupted extraction, see L{record_moved}, is where it was
+        moved.
+    @return: a deferred that fires when the archive is extracted and the
+        checksums are verified.
+    """
+
+    return threads.deferToThread(_extract, archive, destination, on_file)
+
+
+def can_resume(destination):
+    """
+    Return C{True} if the extraction of an archive in C{destination} was
+    interrupted or some files were moved away.
+    """
+
+    return (os.path.isfile(os.path.join(destination, JOURNAL)) or
+            os.path.isfile(os.path.join(destination, MOVED)))
+
+
+def record_moved(destination, archive, arcname, path, digest):
+    """
+    Record that the file C{arcname} of C{archive}, extracted in
+    C{destination}, was moved in C{path}. If the extraction is resumed, the
+    file is not extracted again while it is in C{path}. The record is kept
+    after the extraction until L{clear_moved} is called.
+
+    @param digest: the checksum of the file in the archive.
+    """
+
+    with open(os.path.join(destination, MOVED), "a") as fp:
+        if fp.tell() == 0:
+            fp.write(_archive_id(archive) + "\n")
+        fp.write("{0}\t{1}\t{2}\t{3}\n".format(
+            arcname, os.path.getsize(path), digest, path))
+
+
+def clear_moved(destination):
+    """Remove the record of the files moved away from C{destination}."""
+
+    _remove_file(os.path.join(destination, MOVED))
@@ -34,7 +34,7 @@ from twisted.conch import manhole
 
 from virtualbricks import errors, settings, configfile, console, project, log
 from virtualbricks import events, link, router, switches, tunnels, tuntaps
-from virtualbricks import virtualmachines, wires
+from virtualbricks import virtualmachines, wires, imagescan, qemu
 from virtualbricks.virtualmachines import is_virtualmachine
 from virtualbricks import observable
 from virtualbricks.tools import is_running
@@ -57,6 +57,8 @@ shut_down = log.Event("Server Shut Down.")
 new_event_ok = log.Event("New event {name} OK")
 uncaught_exception = log.Event("Uncaught exception: {error()}")
 brick_stop = log.Event("Error on brick poweroff")
+scan_images_error = log.Event("Error while looking for the disk images")
+discover_qemu_error = log.Event("Error while probing the qemu executables")
 
 
 def install_brick_types(registry=None):
@@ -581,6 +583,16 @@ class Application:
     def get_namespace(self):
         return {}
 
+    def scan_images(self, factory):
+        d = imagescan.scan(factory)
+        d.addErrback(logger.failure_eb, scan_images_error)
+        return d
+
+    def discover_qemu(self):
+        d = qemu.capabilities.discover()
+        d.addErrback(logger.failure_eb, discover_qemu_error)
+        return d
+
     def run(self, reactor):
         self.install_locale()
         self.install_settings()
@@ -598,6 +610,11 @@ class Application:
             app.fixPdb()
         reactor.addSystemEventTrigger("before", "shutdown", settings.store)
         project.manager.restore_last(factory)
+        self.scan_images(factory)
+        self.discover_qemu()
+        virtualmachines.provisioner.start(factory)
+        reactor.addSystemEventTrigger("before", "shutdown",
+                                      virtualmachines.provisioner.stop)
         reactor.addSystemEventTrigger("before", "shutdown",
                                       project.manager.save_current, factory)
         reactor.addSystemEventTrigger("before", "shutdown", self.logger.stop)
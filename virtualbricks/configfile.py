@@ -25,7 +25,8 @@ import six
 from twisted.python import filepath
 from zope.interface import implementer
 
-from virtualbricks import interfaces, settings, _configparser, log
+from virtualbricks import (interfaces, settings, _configparser, log, copier,
+                           imagescan)
 
 
 if False:  # pyflakes
@@ -52,7 +53,7 @@ backup_restored = log.Event("A backup file for the current project has been "
                             "looking in View->Messages.")
 image_found = log.Event("Found Disk image {name}")
 skip_image = log.Event("Skipping disk image, name '{name}' already in use")
-skip_image_noa = log.Event("Cannot access image file, skipping")
+check_images_error = log.Event("Error while checking the disk images")
 config_dump = log.Event("CONFIG DUMP on {path}")
 open_project = log.Event("Open project at {path}")
 config_save_error = log.Event("Error while saving configuration file")
@@ -67,7 +68,7 @@ log_events = [link_type_error,
               backup_restored,
               image_found,
               skip_image,
-              skip_image_noa,
+              check_images_error,
               config_dump,
               open_project,
               config_save_error]
@@ -76,7 +77,7 @@ log_events = [link_type_error,
 @contextlib.contextmanager
 def backup(original, fbackup):
     try:
-        original.copyTo(fbackup)
+        copier.copy_file(original.path, fbackup.path)
     except OSError as e:
         if e.errno == errno.ENOENT:
             yield
@@ -176,9 +177,8 @@ class ImageBuilder:
         path = dict(section).get("path", "")
         if factory.is_in_use(self.name):
             logger.info(skip_image, name=self.name)
-        elif not os.access(path, os.R_OK):
-            logger.info(skip_image_noa)
         else:
+            # the file is checked in background, see restore_from
             return factory.new_disk_image(self.name, path)
 
 
@@ -349,14 +349,28 @@ class ConfigFile:
             restore_backup(fp, fp.sibling(fp.basename() + "~"))
             logger.info(open_project, path=fp.path)
             with open(fp.path,"rt") as fd:
-                self.restore_from(factory, fd)
+                return self.restore_from(factory, fd)
         else:
-            self.restore_from(factory, str_or_obj)
+            return self.restore_from(factory, str_or_obj)
 
     def restore_from(self, factory, fileobj):
+        """
+        Restore the project. The images that cannot be read are removed from
+        the library in background, see L{imagescan.check_access}.
+
+        @return: a deferred that fires when the images are checked.
+        """
+
+        images = []
         with freeze_notify(factory):
             for item in _configparser.Parser(fileobj):
-                interfaces.IBuilder(item).load_from(factory, item)
+                builder = interfaces.IBuilder(item)
+                result = builder.load_from(factory, item)
+                if isinstance(builder, ImageBuilder) and result is not None:
+                    images.append(result)
+        d = imagescan.check_access(factory, images)
+        d.addErrback(logger.failure_eb, check_images_error)
+        return d
 
 
 _config = ConfigFile()
@@ -382,4 +396,4 @@ def restore(factory, filename=None):
         workspace = settings.get("workspace")
         project = settings.get("current_project")
         filename = os.path.join(workspace, project, ".project")
-    _config.restore(factory, filename)
+    return _config.restore(factory, filename)
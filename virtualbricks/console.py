@@ -24,6 +24,7 @@ from twisted.internet import interfaces, utils
 from twisted.protocols import basic
 from zope.interface import implementer
 from virtualbricks import __version__, bricks, errors, log, settings
+from virtualbricks import imagestore, importer, lab, project, virtualmachines
 import six
 
 logger = log.Logger()
@@ -145,6 +146,21 @@ class VBProtocol(Protocol):
     BRICK_NAME connect NICK Connect BRICK_NAME to a Sock
     BRICK_NAME disconnect   Disconnect BRICK_NAME to a sock
     BRICK_NAME help         Help about parameters of BRICK_NAME
+
+    Project commands --------------------------------------------------
+    project clone NAME      Clone the project with overlays of its COWs
+    project flatten         Make the clone independent of the original
+    project thaw            Make the original project writable again
+    project cowplace [PLACE]    Show or set where the private COWs are
+                            placed: project, tmpfs or a directory
+    project persist VM DEV  Move a disposable COW in the project
+    project checkpoints     List the checkpoints of the project
+    project checkpoint NAME Record the private COWs in the checkpoint NAME
+    project reset NAME      Revert the private COWs to the checkpoint NAME
+    project rmcheckpoint NAME   Remove the checkpoint NAME
+    project import ARCHIVE NAME [overwrite]
+                            Import a project, the images are moved in the
+                            vimages directory while they are extracted
     """
 
     # _is_first = False
@@ -164,6 +180,7 @@ class VBProtocol(Protocol):
         self.sub_protocols["images"] = imgp
         cfgp = ConfigurationProtocol(factory)
         self.sub_protocols["config"] = cfgp
+        self.sub_protocols["project"] = ProjectProtocol(factory)
 
     def connectionMade(self):
         Protocol.connectionMade(self)
@@ -284,6 +301,9 @@ class VBProtocol(Protocol):
     def do_images(self, *args):
         self.sub_protocols["images"].lineReceived(" ".join(args))
 
+    def do_project(self, *args):
+        self.sub_protocols["project"].lineReceived(" ".join(args))
+
     def do_socks(self):
         """List of connections available for bricks"""
         # XXX: if brick is not a switch this raise an exception
@@ -332,6 +352,30 @@ class ImagesProtocol(Protocol):
         for img in self.factory.disk_images:
             self.sendLine("%s, %s" % (img.name, img.path))
 
+    def do_store(self, name):
+        """Move an image in the image store"""
+        image = self.factory.get_image_by_name(name)
+        if image is None:
+            self.sendLine("No such image %s" % name)
+            return
+        d = imagestore.get_store().intern(image)
+        d.addCallback(lambda image: self.sendLine("%s, %s" % (image.name,
+                                                             image.path)))
+        d.addErrback(lambda fail: self.sendLine(fail.getErrorMessage()))
+        return d
+
+    def do_gc(self):
+        """Remove the images of the store not used by any project"""
+
+        def removed(paths):
+            for path in paths:
+                self.sendLine("removed %s" % path)
+
+        d = imagestore.get_store().collect(factory=self.factory)
+        d.addCallbacks(removed, lambda fail: self.sendLine(
+            fail.getErrorMessage()))
+        return d
+
     # def do_files(self):
     #     dirname = settings.get("baseimages")
     #     for image_file in os.listdir(dirname):
@@ -356,6 +400,100 @@ class ImagesProtocol(Protocol):
     #         settings.set("baseimages", base)
 
 
+class ProjectProtocol(Protocol):
+
+    def _error(self, fail):
+        self.sendLine(fail.getErrorMessage())
+
+    def do_clone(self, name):
+        """Clone the current project, the project is frozen"""
+        d = lab.clone(self.factory, project.manager.current, name)
+        d.addCallbacks(lambda prj: self.sendLine("cloned in %s" % prj.name),
+                       self._error)
+        return d
+
+    def do_flatten(self):
+        """Copy in the clone the data of the original project"""
+        d = lab.flatten(self.factory, project.manager.current.path)
+        d.addCallbacks(lambda count: self.sendLine("%d disks flattened" %
+                                                   count), self._error)
+        return d
+
+    def do_thaw(self):
+        """Make the COWs of the current project writable"""
+        try:
+            lab.thaw(project.manager.current.path)
+        except errors.ProjectFrozenError as e:
+            self.sendLine("Clones not flattened: %s" % e)
+
+    def do_checkpoints(self):
+        """List the checkpoints of the current project"""
+        for name in lab.checkpoints(project.manager.current.path):
+            self.sendLine(name)
+
+    def do_checkpoint(self, name):
+        """Record the private COWs of the current project"""
+        d = lab.checkpoint(self.factory, project.manager.current.path, name)
+        d.addCallbacks(lambda count: self.sendLine("%d disks saved in %s" %
+                                                   (count, name)),
+                       self._error)
+        return d
+
+    def do_reset(self, name):
+        """Revert the private COWs of the current project to a checkpoint"""
+        d = lab.reset(self.factory, project.manager.current.path, name)
+        d.addCallbacks(lambda count: self.sendLine("%d disks reset to %s" %
+                                                   (count, name)),
+                       self._error)
+        return d
+
+    def do_rmcheckpoint(self, name):
+        """Remove a checkpoint of the current project"""
+        d = lab.remove_checkpoint(project.manager.current.path, name)
+        d.addErrback(self._error)
+        return d
+
+    def do_cowplace(self, place=None):
+        """Show or set the placement of the private COWs of the project"""
+        prj = project.manager.current
+        if place is None:
+            self.sendLine(prj.get_cow_place() or
+                          virtualmachines.PLACE_PROJECT)
+        elif (place in (virtualmachines.PLACE_PROJECT,
+                        virtualmachines.PLACE_TMPFS) or
+                os.path.isabs(place)):
+            prj.set_cow_place(place)
+        else:
+            self.sendLine("Invalid placement %s" % place)
+
+    def do_persist(self, name, device):
+        """Move a disposable private COW in the project"""
+        brick = self.factory.get_brick_by_name(name)
+        if brick is None or brick.get_type() != "Qemu":
+            self.sendLine("No such virtual machine %s" % name)
+            return
+        disks = dict((disk.device, disk) for disk in brick.disks())
+        if device not in disks:
+            self.sendLine("No such disk %s" % device)
+            return
+        d = brick.persist_disk(disks[device])
+        d.addCallbacks(lambda path: self.sendLine("moved in %s" % path),
+                       self._error)
+        return d
+
+    def do_import(self, archive, name, overwrite=None):
+        """Import a project, the images are moved as soon as extracted"""
+        if overwrite not in (None, "overwrite"):
+            self.sendLine("Invalid argument %s" % overwrite)
+            return
+        store = imagestore.get_store() if imagestore.is_enabled() else None
+        d = importer.import_archive(archive, name, overwrite is not None,
+                                    store=store)
+        d.addCallbacks(lambda prj: self.sendLine("imported in %s" %
+                                                 prj.path), self._error)
+        return d
+
+
 class ConfigurationProtocol(Protocol):
 
     def do_get(self, name):
@@ -0,0 +1,246 @@
+# -*- test-case-name: virtualbricks.tests.test_copier -*-
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2018 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Copy of files and directories.
+
+A file is cloned with the FICLONE ioctl if the file system supports it
+(btrfs, xfs), the copy is then immediate and shares the blocks of the
+original. Otherwise only the data of the file is copied, the holes are
+found with C{SEEK_DATA} and C{SEEK_HOLE} and are kept, with
+C{copy_file_range(2)}, C{sendfile(2)} or, if they are not available,
+C{read(2)} and C{write(2)}.
+
+The files of a directory are copied in parallel in threads.
+"""
+
+import os
+import stat
+import errno
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from twisted.internet import defer, threads, reactor
+
+from virtualbricks import settings
+from virtualbricks.archive import data_segments
+
+
+__all__ = ["copy_file", "copy_tree"]
+
+# _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+CHUNK_SIZE = 8 * 1024 * 1024
+BUFFER_SIZE = 1024 * 1024
+# the progress is reported every REPORT_SIZE bytes
+REPORT_SIZE = 16 * 1024 * 1024
+# the errors that mean that a method is not supported for these files
+UNSUPPORTED = frozenset([errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+                         errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF])
+
+
+def _reflink(src_fd, dst_fd):
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except (IOError, OSError) as e:
+        if e.errno in UNSUPPORTED:
+            return False
+        raise
+
+
+def _copy_file_range(src_fd, dst_fd, offset, count):
+    return os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+
+
+def _sendfile(src_fd, dst_fd, offset, count):
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    return os.sendfile(dst_fd, src_fd, offset, count)
+
+
+def _read_write(src_fd, dst_fd, offset, count):
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    data = os.read(src_fd, min(count, BUFFER_SIZE))
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    written = 0
+    while written < len(data):
+        written += os.write(dst_fd, data[written:])
+    return len(data)
+
+
+def _methods():
+    methods = []
+    if hasattr(os, "copy_file_range"):
+        methods.append(_copy_file_range)
+    if hasattr(os, "sendfile"):
+        methods.append(_sendfile)
+    methods.append(_read_write)
+    return methods
+
+
+def _copy_range(src_fd, dst_fd, offset, length, methods, report):
+    while length > 0:
+        count = min(length, CHUNK_SIZE)
+        try:
+            copied = methods[0](src_fd, dst_fd, offset, count)
+        except OSError as e:
+            if e.errno not in UNSUPPORTED or len(methods) == 1:
+                raise
+            # try again with the next method
+            methods.pop(0)
+            continue
+        if copied == 0:
+            # the file was truncated while it was copied
+            raise IOError(errno.EIO, "Unexpected end of file")
+        offset += copied
+        length -= copied
+        report(copied)
+
+
+def copy_file(source, destination, report=lambda n: None):
+    """
+    Copy a file, the holes of the file are kept. The permissions are
+    copied too.
+
+    @param report: called with the number of bytes copied, every time some
+        data is copied.
+    """
+
+    src_fd = os.open(source, os.O_RDONLY)
+    try:
+        st = os.fstat(src_fd)
+        dst_fd = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         stat.S_IMODE(st.st_mode))
+        try:
+            if st.st_size and _reflink(src_fd, dst_fd):
+                report(st.st_size)
+                return
+            methods = _methods()
+            for offset, length in data_segments(src_fd, st.st_size):
+                _copy_range(src_fd, dst_fd, offset, length, methods, report)
+            os.ftruncate(dst_fd, st.st_size)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+def _list_files(source, destination, ignore):
+    """
+    Create the directories of C{destination} and return the list of the
+    files to copy and their size.
+    """
+
+    if not os.path.isdir(source):
+        raise OSError(errno.ENOENT, "No such file or directory", source)
+    files = []
+    for dirpath, dirnames, filenames in os.walk(source, followlinks=True):
+        relpath = os.path.relpath(dirpath, source)
+        if relpath == os.curdir:
+            relpath = ""
+        target = os.path.join(destination, relpath)
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        if ignore is not None:
+            dirnames[:] = [name for name in dirnames
+                           if not ignore(os.path.join(relpath, name))]
+            filenames = [name for name in filenames
+                         if not ignore(os.path.join(relpath, name))]
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                st = os.stat(path)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    # a broken link
+                    continue
+                raise
+            # the sockets and the fifos are not copied
+            if stat.S_ISREG(st.st_mode):
+                files.append((path, os.path.join(target, filename),
+                              st.st_size))
+    return files
+
+
+class _TreeCopy:
+
+    def __init__(self, concurrency, progress):
+        self.semaphore = defer.DeferredSemaphore(concurrency)
+        self.progress = progress
+        self.done = 0
+        self.total = 0
+
+    def _update(self, copied):
+        self.done += copied
+        self.progress(self.done, self.total)
+
+    def _copy(self, source, destination):
+        pending = [0]
+
+        def report(copied):
+            pending[0] += copied
+            if pending[0] >= REPORT_SIZE:
+                reactor.callFromThread(self._update, pending[0])
+                pending[0] = 0
+
+        copy_file(source, destination, report)
+        if pending[0]:
+            reactor.callFromThread(self._update, pending[0])
+
+    def copy(self, files):
+        self.total = sum(size for _, _, size in files)
+        if self.progress is None:
+            self.progress = lambda done, total: None
+        self.progress(0, self.total)
+        dl = [self.semaphore.run(threads.deferToThread, self._copy, src, dst)
+              for src, dst, _ in files]
+        d = defer.DeferredList(dl, consumeErrors=True)
+        return d.addCallback(self._check)
+
+    def _check(self, results):
+        for success, result in results:
+            if not success:
+                return result
+        return None
+
+
+def copy_tree(source, destination, progress=None, concurrency=None,
+              ignore=None):
+    """
+    Copy the content of the directory C{source} in C{destination}, that is
+    created if it does not exist. The symbolic links are followed.
+
+    @param progress: if not C{None}, called with the bytes copied and the
+        total.
+    @param concurrency: the number of files copied at the same time.
+    @param ignore: if not C{None}, called with the path, relative to
+        C{source}, of every file and directory; if it returns C{True} the
+        file or the directory is not copied.
+    @return: a deferred that fires when all the files are copied or fails
+        with the first error.
+    """
+
+    if concurrency is None:
+        concurrency = int(settings.get("concurrency"))
+    d = threads.deferToThread(_list_files, source, destination, ignore)
+    return d.addCallback(_TreeCopy(concurrency, progress).copy)
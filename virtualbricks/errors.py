@@ -70,10 +70,42 @@ class LockedImageError(Error):
                                                         self.master)
 
 
+class NoSpaceError(Error):
+    """There is not enough free space for a private COW."""
+
+
 class ImageAlreadyInUseError(Error):
     pass
 
 
+class QMPError(Error):
+    """A QMP command returned an error."""
+
+    def __init__(self, error_class, desc):
+        Error.__init__(self, error_class, desc)
+        self.error_class = error_class
+        self.desc = desc
+
+    def __str__(self):
+        return "{0}: {1}".format(self.error_class, self.desc)
+
+
+class QMPNotConnectedError(Error):
+    """The QMP channel of the virtual machine is not connected."""
+
+
+class BlockJobError(Error):
+    """A block job of a running virtual machine failed."""
+
+
+class MigrationError(Error):
+    """The state of a virtual machine cannot be saved or restored."""
+
+
+class DeviceTimeoutError(Error):
+    """The guest did not release a device removed from the virtual machine."""
+
+
 # Project specific errors
 
 class ProjectExistsError(InvalidNameError):
@@ -88,6 +120,14 @@ class InvalidArchiveError(Error):
     """The archive format is not recognized."""
 
 
+class ChecksumError(InvalidArchiveError):
+    """The checksum of a file of an archive does not match."""
+
+
+class ProjectFrozenError(Error):
+    """The project is the base of some clones and cannot be changed."""
+
+
 class BrickRunningError(Error):
     """There is one or more brick that is running."""
 
@@ -82,7 +82,6 @@ advised and possible with gtk-builder-convert.
 
 import os
 import sys
-import errno
 import tempfile
 import functools
 import re
@@ -94,14 +93,15 @@ gi.require_version("Gtk", "3.0")
 gi.require_version("Pango", "1.0")
 from gi.repository import Gtk
 from gi.repository import Gdk
+from gi.repository import GLib
 from gi.repository import Pango
-import twisted
-from twisted.internet import utils, defer, task, error
+from twisted.internet import utils, defer, task
 from twisted.python import filepath
 
 from virtualbricks import __version__
 from virtualbricks import (tools, log, console, settings,
-                           virtualmachines, project, errors)
+                           virtualmachines, project, errors, imageinfo,
+                           imagescan, imagestore, importer)
 from virtualbricks.virtualmachines import is_virtualmachine
 from virtualbricks.tools import dispose
 from virtualbricks.gui import graphics, widgets
@@ -111,15 +111,6 @@ from virtualbricks.errors import NoOptionError
 
 if False:  # pyflakes
     _ = str
-if twisted.__version__ >= '15.0.2':
-    # This is an ugly hack but virtualbricks is not really ready for
-    # Python3
-    def mktempfn():
-        return filepath._secureEnoughString(project.manager.path)
-else:
-    def mktempfn():
-        return filepath._secureEnoughString()
-
 logger = log.Logger()
 bug_send = log.Event("Sending report bug")
 bug_sent = log.Event("Report bug sent succefully")
@@ -133,23 +124,23 @@ invalid_mac = log.Event("MAC address {mac} is not valid, generating "
 not_implemented = log.Event("Not implemented")
 event_created = log.Event("Event created successfully")
 commit_failed = log.Event("Failed to commit image\n{err}")
+commit_vm_failed = log.Event("Failed to commit {disk} of {vm}")
 img_invalid = log.Event("Invalid image")
 base_not_found = log.Event("Base not found (invalid cow?)\nstderr:\n{err}")
 img_combo = log.Event("Setting image for combobox")
+scan_images_error = log.Event("Error while looking for the disk images")
 img_create_err = log.Event("Error on creating image")
 img_create = log.Event("Creating image...")
 img_choose = log.Event("Choose a filename first!")
 img_invalid_type = log.Event("Invalid value for format combo, assuming raw")
 img_invalid_unit = log.Event("Invalid value for unit combo, assuming Mb")
 extract_err = log.Event("Error on import project")
-log_rebase = log.Event("Rebasing {cow} to {basefile}")
-rebase_error = log.Event("Error on rebase")
-image_not_exists = log.Event("Cannot save image to {destination}, file does "
-                             "not exists: {source}")
 invalid_step_assitant = log.Event("Assistant cannot handle step {num}")
 project_extracted = log.Event("Project has beed extracted in {path}")
 removing_temporary_project = log.Event("Remove temporary files in {path}")
 error_on_import_project = log.Event("An error occurred while import project")
+save_as_error = log.Event("Cannot copy the project")
+collect_error = log.Event("Cannot remove the unused images from the store")
 invalid_name = log.Event("Invalid name {name}")
 search_usb = log.Event("Searching USB devices")
 retr_usb = log.Event("Error while retrieving usb devices.")
@@ -267,44 +258,87 @@ class AboutDialog(Window):
         self.window.connect("response", lambda d, r: d.destroy())
 
 
+# the color of the messages in the Messages window, by level
+LOG_COLORS = {"debug": "#a29898", "warn": "#ff9500", "error": "#b8032e",
+              "critical": "#b8032e"}
+
+
 class LoggingWindow(Window):
 
     resource = "logging.ui"
 
-    def __init__(self, textbuffer):
+    def __init__(self, logstore):
         Window.__init__(self)
-        self.textbuffer = textbuffer
+        self.logstore = logstore
         self.__bottom = True
-        textview = self.get_object("textview")
-        textview.set_buffer(textbuffer)
-        self.__insert_text_h = textbuffer.connect(
-            "changed",
-            self.on_textbuffer_changed,
-            textview
-        )
+        self.__matches = widgets.log_filter()
+        logstore.appended.connect(self.__append)
+        logstore.cleared.connect(self.__clear)
         vadjustment = self.get_object("scrolledwindow1").get_vadjustment()
         vadjustment.connect("value-changed", self.on_vadjustment_value_changed)
-        self.scroll_to_end(textview, textbuffer)
+        self.__rebuild()
+
+    def __row(self, line):
+        first = line.text.split("\n", 1)[0]
+        return (line.seq, line.time, line.namespace, first,
+                GLib.markup_escape_text(line.text),
+                LOG_COLORS.get(line.level, None))
+
+    def __append(self, lines):
+        model = self.get_object("lsMessages")
+        for line in lines:
+            if self.__matches(line):
+                model.append(self.__row(line))
+        # drop the rows of the messages that are not kept anymore
+        first = self.logstore.first_seq
+        itr = model.get_iter_first()
+        while itr is not None and model.get_value(itr, 0) < first:
+            if not model.remove(itr):
+                itr = None
+        if self.__bottom:
+            self.scroll_to_end()
 
-    def scroll_to_end(self, textview, textbuffer):
-        textview.scroll_to_mark(textbuffer.get_mark("end"), 0, True, 0, 1)
+    def __clear(self, logstore):
+        self.get_object("lsMessages").clear()
 
-    def on_textbuffer_changed(self, textbuffer, textview):
-        if self.__bottom:
-            self.scroll_to_end(textview, textbuffer)
+    def __rebuild(self):
+        treeview = self.get_object("treeview")
+        model = self.get_object("lsMessages")
+        # the view is detached while the model is filled
+        treeview.set_model(None)
+        model.clear()
+        for line in self.logstore.lines:
+            if self.__matches(line):
+                model.append(self.__row(line))
+        treeview.set_model(model)
+        self.scroll_to_end()
+
+    def scroll_to_end(self):
+        model = self.get_object("lsMessages")
+        count = model.iter_n_children(None)
+        if count:
+            self.get_object("treeview").scroll_to_cell(
+                Gtk.TreePath.new_from_indices([count - 1]), None, False, 0, 0)
 
     def on_vadjustment_value_changed(self, adj):
         self.__bottom = adj.get_value() + adj.get_page_size() == \
                 adj.get_upper()
 
+    def on_filter_changed(self, widget):
+        self.__matches = widgets.log_filter(
+            self.get_object("level_combo").get_active_id() or "debug",
+            self.get_object("namespace_entry").get_text())
+        self.__rebuild()
+
     def on_LoggingWindow_destroy(self, window):
-        self.textbuffer.disconnect(self.__insert_text_h)
+        self.logstore.appended.disconnect(self.__append)
+        self.logstore.cleared.disconnect(self.__clear)
 
     def on_closebutton_clicked(self, button):
         self.window.destroy()
 
     def on_cleanbutton_clicked(self, button):
-        self.textbuffer.set_text("")
+        self.logstore.clear()
 
     def on_savebutton_clicked(self, button):
         chooser = Gtk.FileChooserDialog(
@@ -325,14 +359,14 @@ class LoggingWindow(Window):
         try:
             if response_id == Gtk.ResponseType.OK:
                 with open(dialog.get_filename(), "w") as fp:
-                    fp.write(self.textbuffer.get_property("text"))
+                    fp.write(self.logstore.text())
         finally:
             dialog.destroy()
 
     def on_reportbugbutton_clicked(self, button):
         logger.info(bug_send)
         fd, filename = tempfile.mkstemp()
-        os.write(fd, self.textbuffer.get_property("text"))
+        os.write(fd, self.logstore.text().encode("utf-8"))
         # gtk.link_button_set_uri_hook(None) 	(REMOVED in GTK3)
         exit_d = utils.getProcessOutputAndValue(
             "xdg-email",
@@ -378,8 +412,29 @@ class DisksLibraryDialog(Window):
         self.tvcPath.set_cell_data_func(self.crt2, self.crt2.set_cell_data)
         self.tvcUsed.set_cell_data_func(self.crt3, self._set_used_by, factory)
         self.tvcMaster.set_cell_data_func(self.crt4, self.crt4.set_cell_data)
-        self.tvcCows.set_cell_data_func(self.crt5, self._set_cows, factory)
+        self.tvcCows.set_cell_data_func(self.crt5, self._set_cows)
         self.tvcSize.set_cell_data_func(self.crt6, self.crt6.set_cell_data)
+        imageinfo.cache.index(disk.get_cow_path()
+                              for vm in filter(is_virtualmachine,
+                                               factory.bricks)
+                              for disk in vm.disks() if disk.cow)
+        # the new images appear in the list while they are found
+        d = imagescan.scan(factory, progress=self._scan_progress)
+        d.addErrback(logger.failure_eb, scan_images_error)
+        d.addCallback(self._scan_done)
+
+    def _scan_progress(self, done, total):
+        if self._binding_list is None:
+            # the window is closed
+            return
+        self.pbScan.show()
+        self.pbScan.set_fraction(float(done) / total)
+        self.pbScan.set_text(_("Scanned {0} of {1} disk images").format(
+            done, total))
+
+    def _scan_done(self, _):
+        if self._binding_list is not None:
+            self.pbScan.hide()
 
     def __dispose__(self):
         if self._binding_list is not None:
@@ -397,14 +452,10 @@ class DisksLibraryDialog(Window):
         cell.set_property("text", str(c))
 
     @staticmethod
-    def _set_cows(column, cell, model, itr, factory):
+    def _set_cows(column, cell, model, itr, data=None):
         image = model.get_value(itr, 0)
-        c = 0
-        for vm in filter(is_virtualmachine, factory.bricks):
-            for disk in vm.disks():
-                if disk.image is image and disk.cow:
-                    c += 1
-        cell.set_property("text", str(c))
+        cows = imageinfo.cache.dependents(image.path)
+        cell.set_property("text", str(len(cows)))
 
     def _show_config(self):
         self.pnlList.hide()
@@ -582,13 +633,7 @@ class EditEthernetDialog(BaseEthernetDialog):
         if sock == "_sock":
             logger.error(not_implemented)
         else:
-            if self.plug.configured():
-                self.plug.disconnect()
-            self.plug.connect(sock)
-            if mac:
-                self.plug.mac = mac
-            if model:
-                self.plug.model = model
+            self.brick.replug(self.plug, sock, mac, model)
 
 
 class ConfirmDialog(Window):
@@ -674,38 +719,39 @@ class BrickSelectionDialog(Window):
         self._event = event
         self._action = action
         self._added = set()
-        self.lBricks.set_data_source(bricks)
+        # the two views show the same bricks, only the moved bricks are
+        # checked again
         self.tmfAvl.set_visible_func(self._is_not_added, self._added)
         self.tmfAdd.set_visible_func(self._is_added, self._added)
+        self.tmfAvl.set_data_source(bricks)
+        self.tmfAdd.set_data_source(bricks)
         self.crName1.set_property("formatter", string.Formatter())
         self.crName2.set_property("formatter", string.Formatter())
         widgets.set_cells_data_func(self.tvcAvailables)
         widgets.set_cells_data_func(self.tvcAdded)
-        self.tmfAvl.refilter()
-        self.tmfAdd.refilter()
 
     @staticmethod
-    def _is_not_added(model, itr, added):
-        brick = model.get_value(itr, 0)
-        return brick and brick not in added
+    def _is_not_added(brick, added):
+        return brick not in added
 
     @staticmethod
-    def _is_added(model, itr, added):
-        brick = model.get_value(itr, 0)
-        return brick and brick in added
+    def _is_added(brick, added):
+        return brick in added
+
+    def _refresh(self, brick):
+        self.tmfAvl.refresh(brick)
+        self.tmfAdd.refresh(brick)
 
     def on_add(self, *_):
         for brick in self.tvAvailables.get_selected_values():
             self._added.add(brick)
-        self.tvAvailables.get_model().refilter()
-        self.tvAdded.get_model().refilter()
+            self._refresh(brick)
         return True
 
     def on_remove(self, *_):
         for brick in self.tvAdded.get_selected_values():
             self._added.remove(brick)
-        self.tvAvailables.get_model().refilter()
-        self.tvAdded.get_model().refilter()
+            self._refresh(brick)
         return True
 
     @destroy_on_exit
@@ -817,9 +863,11 @@ class CommitImageDialog(Window):
                       on_yes_arg=pathname).show(self.parent)
 
     def _commit_vm(self, img):
-        logger.warning(not_implemented)
-        # img.VM.commit_disks()
         self.window.destroy()
+        d = img.VM.commit_disk(img, progress=self.progessbar.progress)
+        d.addErrback(logger.failure_eb, commit_vm_failed, disk=img.device,
+                     vm=img.VM.name)
+        self.progessbar.wait_for(d)
 
     def commit_vm(self):
         combobox = self.get_object("disk_combo")
@@ -864,30 +912,21 @@ class CommitImageDialog(Window):
         self.get_object("cow_checkbutton").set_visible(not active)
         self.get_object("msg_label").set_visible(False)
 
-    def _commit_image_show_result(self, codes):
-        out, err, code = codes
-        if code != 0:
-            logger.error(base_not_found, err=err)
-        else:
-            label = self.get_object("msg_label")
-            for line in out.splitlines():
-                if line.startswith("backing file: "):
-                    label.set_text(line)
-                    break
-            else:
-                label.set_text(_("Base not found (invalid cow?)"))
-            label.set_visible(True)
-
     def on_cowpath_filechooser_file_set(self, filechooser):
         if self._set_label_d is not None:
             self._set_label_d.cancel()
         filename = filechooser.get_filename()
-        if os.access(filename, os.R_OK):
-            code = getQemuOutputAndValue("qemu-img", ["info", filename],
-                                         os.environ)
-            code.addCallback(self._commit_image_show_result)
-            self._set_label_d = code
-            return code
+        try:
+            backing_file = imageinfo.cache.get(filename).backing_file
+        except (OSError, IOError) as e:
+            logger.error(base_not_found, err=e.strerror)
+            return
+        label = self.get_object("msg_label")
+        if backing_file:
+            label.set_text("backing file: " + backing_file)
+        else:
+            label.set_text(_("Base not found (invalid cow?)"))
+        label.set_visible(True)
 
     def set_label(self, combobox=None, button=None):
         if self._set_label_d is not None:
@@ -1150,6 +1189,9 @@ class DeleteProjectDialog(_ListProjectAbstract):
     @destroy_on_exit
     def do_action(self, dialog, response_id, name):
         project.manager.get_project(name).delete()
+        if imagestore.is_enabled():
+            d = imagestore.get_store().collect(factory=self.gui.brickfactory)
+            d.addErrback(logger.failure_eb, collect_error)
 
 
 class RenameProjectDialog(SimpleEntryDialog):
@@ -1384,7 +1426,8 @@ class ExportProjectDialog(Window):
         images = []
         if self.include_images:
             images = [(name, fp.path) for name, fp in self.image_files]
-        return export(filename, files, images)
+        return export(filename, files, images,
+                      progress=self.progressbar.progress)
 
     @destroy_on_exit
     def on_confirm_response(self, dialog, response_id, parent, filename):
@@ -1443,15 +1486,6 @@ def iter_model(model, *columns):
         itr = model.iter_next(itr)
 
 
-def complain_on_error(result):
-    out, err, code = result
-    if code != 0:
-        logger.warn(err)
-        raise error.ProcessTerminated(code)
-    logger.info(err)
-    return result
-
-
 def _set_path(column, cell_renderer, model, iter, colid):
     path = model.get_value(iter, colid)
     cell_renderer.set_property("text",  path.path if path else "")
@@ -1471,6 +1505,8 @@ def _set_path_remap(column, cell_renderer, model, iter, colid):
 
 class Freezer:
 
+    _pulse = None
+
     def __init__(self, freeze, unfreeze, parent):
         self.freeze = freeze
         self.unfreeze = unfreeze
@@ -1500,16 +1536,25 @@ class Freezer:
     def start(self):
         self.freeze()
         self.window.show_all()
-        lc = task.LoopingCall(self.progressbar.pulse)
+        lc = self._pulse = task.LoopingCall(self.progressbar.pulse)
         lc.start(0.2, False)
         return lc
 
     def stop(self, passthru, lc):
         self.window.destroy()
         self.unfreeze()
-        lc.stop()
+        if lc.running:
+            lc.stop()
         return passthru
 
+    def progress(self, done, total):
+        """Show the real progress of the operation instead of pulsing."""
+
+        if self._pulse is not None and self._pulse.running:
+            self._pulse.stop()
+        if total:
+            self.progressbar.set_fraction(min(float(done) / total, 1.0))
+
 
 class ProgressBar:
 
@@ -1519,6 +1564,9 @@ class ProgressBar:
     def wait_for(self, something, *args):
         return self.freezer.wait_for(something, *args)
 
+    def progress(self, done, total):
+        self.freezer.progress(done, total)
+
 
 def all_paths_set(model):
     return all(path for (path,) in iter_model(model, 1))
@@ -1526,13 +1574,13 @@ def all_paths_set(model):
 
 class _HumbleImport:
 
-    def step_1(self, dialog, model, path, extract=project.manager.import_prj):
+    def step_1(self, dialog, model, path, extract=importer.extract):
         archive_path = dialog.get_archive_path()
         if archive_path != dialog.archive_path:
             if dialog.project:
                 dialog.project.delete()
             dialog.archive_path = archive_path
-            d = extract(mktempfn(), archive_path)
+            d = extract(importer.staging_name(archive_path), archive_path)
             d.addCallback(self.extract_cb, dialog)
             d.addCallback(self.fill_model_cb, dialog, model, path)
             d.addErrback(self.extract_eb, dialog)
@@ -1610,68 +1658,30 @@ class _HumbleImport:
 
     def apply(self, project, name, factory, overwrite, open, store1, store2):
         entry = project.get_descriptor()
-        imgs = self.get_images(project, entry, store1, store2)
-        deferred = self.rebase_all(project, imgs, entry)
-        deferred.addCallback(self.check_rebase)
-        deferred.addCallback(lambda a: project.rename(name, overwrite))
+        store = imagestore.get_store() if imagestore.is_enabled() else None
+        pipeline = importer.ImportPipeline(project, entry, store=store)
+        saved = set()
+        for image, destination, save in iter_model(store1):
+            if save:
+                saved.add(image)
+                pipeline.move(image, destination.path)
+        for image, path in iter_model(store2):
+            if image not in saved:
+                pipeline.place(image, path.path)
+        deferred = pipeline.wait()
+        deferred.addCallback(lambda _: entry.save(project))
+        deferred.addCallback(lambda _: project.rename(name, overwrite))
         if open:
             deferred.addCallback(pass_through(project.open, factory))
-        deferred.addErrback(pass_through(project.delete))
+        deferred.addErrback(self.rollback, pipeline, project)
+        deferred.addBoth(pass_through(pipeline.release))
         logger.log_failure(deferred, error_on_import_project)
         return deferred
 
-    def get_images(self, project, entry, store1, store2):
-        imagesfp = filepath.FilePath(project.path).child(".images")
-        imgs = self.save_images(store1, imagesfp)
-        self.remap_images(entry, store2, imgs)
-        entry.save(project)
-        return imgs
-
-    def save_images(self, model, source):
-        saved = {}
-        for name, destination, save in iter_model(model):
-            if save:
-                fp = source.child(name)
-                try:
-                    fp.moveTo(destination)
-                except OSError as e:
-                    if e.errno == errno.ENOENT:
-                        logger.error(image_not_exists, source=fp.path,
-                                     destination=destination.path)
-                        continue
-                    else:
-                        raise
-                else:
-                    saved[name] = destination
-        return saved
-
-    def remap_images(self, entry, store, saved):
-        for name, destination in saved.iteritems():
-            entry.remap_image(name, destination.path)
-        for name, path in iter_model(store):
-            entry.remap_image(name, path.path)
-            saved[name] = path
-
-    def rebase_all(self, project, images, entry):
-        lst = []
-        for name, path in images.iteritems():
-            for vmname, dev in entry.device_for_image(name):
-                cow_name = "{0}_{1}.cow".format(vmname, dev)
-                cow = filepath.FilePath(project.path).child(cow_name)
-                if cow.exists():
-                    logger.debug(log_rebase, cow=cow.path, basefile=path.path)
-                    lst.append(self.rebase(path.path, cow.path))
-        return defer.DeferredList(lst)
-
-    def rebase(self, backing_file, cow, run=utils.getProcessOutputAndValue):
-        args = ["rebase", "-u", "-b", backing_file, cow]
-        d = run("qemu-img", args, os.environ)
-        return d.addCallback(complain_on_error)
-
-    def check_rebase(self, result):
-        for success, status in result:
-            if not success:
-                logger.error(rebase_error, log_failure=status)
+    def rollback(self, fail, pipeline, project):
+        d = pipeline.rollback()
+        d.addCallback(lambda _: project.delete())
+        return d.addCallback(lambda _: fail)
 
 
 class ImportDialog(Window):
@@ -1897,8 +1907,9 @@ class SaveAsDialog(Window):
     resource = "saveas.ui"
     home = filepath.FilePath(settings.DEFAULT_HOME)
 
-    def __init__(self, factory, projects):
+    def __init__(self, progressbar, factory, projects):
         Window.__init__(self)
+        self.progressbar = progressbar
         self.factory = factory
         self.model = model = self.get_object("liststore1")
         for prj in projects:
@@ -1930,8 +1941,11 @@ class SaveAsDialog(Window):
     @destroy_on_exit
     def on_response(self, dialog, response_id):
         if response_id == Gtk.ResponseType.OK:
-            project.manager.current.save_as(self.get_project_name(),
-                                            self.factory)
+            d = project.manager.current.save_as(self.get_project_name(),
+                                                self.factory,
+                                                self.progressbar.progress)
+            self.progressbar.wait_for(d)
+            d.addErrback(logger.failure_eb, save_as_error)
 
 
 class RenameDialog(Window):
@@ -2027,6 +2041,7 @@ class SettingsDialog(Window):
         self.etrSudo.set_text(settings.get("sudo"))
         self.cbSystray.set_active(settings.get("systray"))
         self.cbShowMissing.set_active(settings.get("show_missing"))
+        self.cbScanimages.set_active(settings.get("scanimages"))
         # vde
         try:
             self.fcbVdepath.set_current_folder(settings.get('vdepath'))
@@ -2095,6 +2110,7 @@ class SettingsDialog(Window):
             settings.set("sudo", self.etrSudo.get_text())
             settings.set("systray", self.cbSystray.get_active())
             settings.set("show_missing", self.cbShowMissing.get_active())
+            settings.set("scanimages", self.cbScanimages.get_active())
             # vde
             vdepath = self.fcbVdepath.get_current_folder()
             if vdepath is not None:
@@ -19,13 +19,13 @@
 # This module is ported to new GTK3 using PyGObject
 
 import os
-import os.path
-import re
-import shutil
+import math
+import collections
 
-from PIL import Image
+import cairo
 import pygraphviz as pgv
-from gi.repository import GdkPixbuf
+from gi.repository import GLib, Gdk, GdkPixbuf
+from twisted.internet import defer, threads
 
 from virtualbricks.path import get_resource_filename
 from virtualbricks.tools import is_running
@@ -34,10 +34,25 @@ from virtualbricks.tools import is_running
 __all__ = [
     "get_image", "pixbuf_for_brick", "pixbuf_for_brick_at_size",
     "pixbuf_for_brick_type", "pixbuf_for_running_brick",
-    "pixbuf_for_running_brick_at_size", "Node", "Topology",
-    "get_data_filename"
+    "pixbuf_for_running_brick_at_size", "PixbufCache", "pixbuf_cache",
+    "GridIndex", "Layout", "Topology",
+    "get_data_filename", "graph_key", "compute_layout", "get_layout"
 ]
 
+# the number of layouts kept in memory
+CACHE_SIZE = 8
+# the memory used by the icons kept in memory
+PIXBUF_CACHE_BYTES = 8 * 1024 * 1024
+# the size of the cells of the spatial index, in points
+GRID_CELL = 64
+# the distance, in points, at which the pointer is on an edge
+EDGE_TOLERANCE = 4
+MIN_ZOOM = 0.1
+MAX_ZOOM = 4.0
+FONT_SIZE = 9
+BACKGROUND = (1.0, 1.0, 1.0)
+HIGHLIGHT = (0.2, 0.4, 0.9)
+
 
 def get_data_filename(resource):
     return get_resource_filename("virtualbricks.gui", resource)
@@ -58,146 +73,579 @@ def brick_icon(brick):
         return get_data_filename(brick.get_type().lower() + ".png")
 
 
-def saturate_if_stopped(brick, pixbuf):
-    if not is_running(brick):
-        pixbuf.saturate_and_pixelate(pixbuf, 0.0, True)
-    return pixbuf
+def _load_pixbuf(filename, width, height):
+    if width < 0 and height < 0:
+        return GdkPixbuf.Pixbuf.new_from_file(filename)
+    return GdkPixbuf.Pixbuf.new_from_file_at_size(filename, width, height)
+
+
+class PixbufCache:
+    """
+    A LRU cache of the icons of the bricks, shared by the views. An icon is
+    kept by path, modification time, size and state, so that an icon
+    changed on disk is loaded again. The least recently used icons are
+    evicted when the pixbufs use more than C{max_bytes}.
+
+    The pixbufs are shared and must not be modified.
+
+    @ivar hits: the number of icons found in the cache.
+    @ivar misses: the number of icons loaded.
+    @ivar evictions: the number of icons evicted.
+    """
+
+    def __init__(self, max_bytes=PIXBUF_CACHE_BYTES, load=_load_pixbuf):
+        self.max_bytes = max_bytes
+        self.load = load
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._pixbufs = collections.OrderedDict()
+
+    def get(self, filename, width=-1, height=-1, running=True):
+        """
+        Return the icon in C{filename} at the given size, grayed if the
+        brick is not running. A negative size means the size of the image.
+        """
+
+        try:
+            mtime = os.stat(filename).st_mtime
+        except OSError:
+            mtime = None
+        key = filename, mtime, width, height, running
+        pixbuf = self._pixbufs.pop(key, None)
+        if pixbuf is not None:
+            self.hits += 1
+            self._pixbufs[key] = pixbuf
+            return pixbuf
+        self.misses += 1
+        pixbuf = self.load(filename, width, height)
+        if not running:
+            pixbuf.saturate_and_pixelate(pixbuf, 0.0, True)
+        self._pixbufs[key] = pixbuf
+        self.size += _byte_length(pixbuf)
+        # the last icon is kept even if it is bigger than the cache
+        while self.size > self.max_bytes and len(self._pixbufs) > 1:
+            _, evicted = self._pixbufs.popitem(last=False)
+            self.size -= _byte_length(evicted)
+            self.evictions += 1
+        return pixbuf
+
+    def clear(self):
+        self._pixbufs.clear()
+        self.size = 0
+
+    def stats(self):
+        """Return the statistics of the cache as a dict."""
+
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "icons": len(self._pixbufs),
+                "bytes": self.size}
+
+
+def _byte_length(pixbuf):
+    return pixbuf.get_rowstride() * pixbuf.get_height()
+
+
+pixbuf_cache = PixbufCache()
 
 
 def pixbuf_for_brick_at_size(brick, width, height):
-    filename = brick_icon(brick)
-    pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(filename, width, height)
-    return saturate_if_stopped(brick, pixbuf)
+    return pixbuf_cache.get(brick_icon(brick), width, height,
+                            is_running(brick))
 
 
 def pixbuf_for_brick(brick):
-    filename = brick_icon(brick)
-    pixbuf = GdkPixbuf.Pixbuf.new_from_file(filename)
-    return saturate_if_stopped(brick, pixbuf)
+    return pixbuf_cache.get(brick_icon(brick), running=is_running(brick))
 
 
 def pixbuf_for_brick_type(type):
     filename = get_data_filename("%s.png" % type.lower())
     if filename is None:
         return None
-    return GdkPixbuf.Pixbuf.new_from_file(filename)
+    return pixbuf_cache.get(filename)
 
 
 def pixbuf_for_running_brick(brick):
-    return GdkPixbuf.Pixbuf.new_from_file(brick_icon(brick))
+    return pixbuf_cache.get(brick_icon(brick))
 
 
 def pixbuf_for_running_brick_at_size(brick, witdh, height):
-    return GdkPixbuf.Pixbuf.new_from_file_at_size(
-        brick_icon(brick),
-        witdh,
-        height
-    )
-
-
-class Node:
-
-    def __init__(self, topology, name, x, y, thresh=50):
-        self.x = x
-        self.y = y
-        self.thresh = thresh
-        self.name = name
-        self.parent = topology
-
-    def here(self, x, y):
-        return (abs(x + self.parent.x_adj - self.x) < self.thresh and
-                abs(y + self.parent.y_adj - self.y) < self.thresh)
-
-
-class Topology:
-
-    def __init__(self, widget, bricks, scale=1.00, orientation="LR",
-                 tempdir="/tmp"):
-        self.topowidget = widget
-        self.tempdir = tempdir
-        self.topo = pgv.AGraph()
-        self.topo.graph_attr['rankdir'] = orientation
-        self.topo.graph_attr['ranksep'] = '2.0'
-        self.nodes = []
-        self.x_adj = 0.0
-        self.y_adj = 0.0
-
-        # Add nodes
-        sg = self.topo.add_subgraph([], name="switches_rank")
-        sg.graph_attr['rank'] = 'same'
-        for brick in bricks:
-            self.topo.add_node(brick.name)
-            n = self.topo.get_node(brick.name)
-            n.attr['shape'] = 'none'
-            n.attr['fontsize'] = '9'
-            n.attr['image'] = brick_icon(brick)
-
-        for b in bricks:
-            loop = 0
-            for e in b.plugs:
-                if e.sock is not None:
-                    if b.get_type() == 'Tap':
-                        self.topo.add_edge(b.name, e.sock.brick.name)
-                        e = self.topo.get_edge(b.name, e.sock.brick.name)
-                    elif len(b.plugs) == 2:
-                        if loop == 0:
-                            self.topo.add_edge(e.sock.brick.name, b.name)
-                            e = self.topo.get_edge(e.sock.brick.name, b.name)
-                        else:
-                            self.topo.add_edge(b.name, e.sock.brick.name)
-                            e = self.topo.get_edge(b.name, e.sock.brick.name)
-                    elif loop < (len(b.plugs) + 1) / 2:
-                        self.topo.add_edge(e.sock.brick.name, b.name)
-                        e = self.topo.get_edge(e.sock.brick.name, b.name)
+    return pixbuf_cache.get(brick_icon(brick), witdh, height)
+
+
+def _edges(bricks):
+    edges = []
+    for b in bricks:
+        loop = 0
+        for e in b.plugs:
+            if e.sock is not None:
+                if b.get_type() == 'Tap':
+                    edges.append((b.name, e.sock.brick.name))
+                elif len(b.plugs) == 2:
+                    if loop == 0:
+                        edges.append((e.sock.brick.name, b.name))
                     else:
-                        self.topo.add_edge(b.name, e.sock.brick.name)
-                        e = self.topo.get_edge(b.name, e.sock.brick.name)
-                    loop += 1
-                    e.attr['dir'] = 'none'
-                    e.attr['color'] = 'black'
-                    e.attr['name'] = "      "
-                    e.attr['decorate'] = 'true'
-
-        # draw and save
-        self.topo.write(self.get_topo_filename())
-        self.topo.layout('dot')
-        self.topo.draw(self.get_image_filename())
-        self.topo.draw(self.get_plain_filename())
-
-        img = Image.open(self.get_image_filename())
-        x_siz, y_siz = img.size
-        for line in open(self.get_plain_filename()).readlines():
-            arg = re.split(r'\s+', line.rstrip('\n'))
-            if arg[0] == 'graph':
-                if float(arg[2]) != 0 and float(arg[3]) != 0:
-                    x_fact = scale * (x_siz / float(arg[2]))
-                    y_fact = scale * (y_siz / float(arg[3]))
-                else:
-                    x_fact = 1
-                    y_fact = 1
-            elif arg[0] == 'node':
-                if float(arg[2]) != 0 and float(arg[3] != 0):
-                    x = scale * (x_fact * float(arg[2]))
-                    y = scale * (y_siz - y_fact * float(arg[3]))
+                        edges.append((b.name, e.sock.brick.name))
+                elif loop < (len(b.plugs) + 1) / 2:
+                    edges.append((e.sock.brick.name, b.name))
                 else:
-                    x = scale * (x_fact)
-                    y = scale * (y_siz - y_fact)
-                self.nodes.append(Node(self, arg[1], x, y))
-        # Display on the widget
-        if scale < 1.00:
-            img.resize((x_siz * scale, y_siz * scale))
-            img.save(self.get_image_filename())
-
-        self.topowidget.set_from_file(self.get_image_filename())
+                    edges.append((b.name, e.sock.brick.name))
+                loop += 1
+    return edges
+
+
+def graph_key(bricks, orientation):
+    """
+    Return the structure of the topology, the bricks, their icons and their
+    links, and its orientation. Two topologies with the same key have the
+    same layout.
+    """
+
+    nodes = tuple((brick.name, brick_icon(brick)) for brick in bricks)
+    return orientation, nodes, tuple(_edges(bricks))
+
+
+def _build_graph(key):
+    orientation, nodes, edges = key
+    topo = pgv.AGraph()
+    topo.graph_attr['rankdir'] = orientation
+    topo.graph_attr['ranksep'] = '2.0'
+    sg = topo.add_subgraph([], name="switches_rank")
+    sg.graph_attr['rank'] = 'same'
+    for name, icon in nodes:
+        topo.add_node(name)
+        n = topo.get_node(name)
+        n.attr['shape'] = 'none'
+        n.attr['fontsize'] = '9'
+        n.attr['image'] = icon
+    for tail, head in edges:
+        topo.add_edge(tail, head)
+        e = topo.get_edge(tail, head)
+        e.attr['dir'] = 'none'
+        e.attr['color'] = 'black'
+        e.attr['name'] = "      "
+        e.attr['decorate'] = 'true'
+    return topo
+
+
+def _contains(box, x, y):
+    bx, by, bw, bh = box
+    return bx <= x <= bx + bw and by <= y <= by + bh
+
+
+def _intersects(box, other):
+    x, y, w, h = box
+    ox, oy, ow, oh = other
+    return x <= ox + ow and ox <= x + w and y <= oy + oh and oy <= y + h
+
+
+class GridIndex:
+    """
+    A spatial index of boxes on a uniform grid. Every item is kept in the
+    cells its box overlaps, a point is looked up only among the items of its
+    cell.
+
+    @param cell: the size of the cells of the grid.
+    """
+
+    def __init__(self, cell=GRID_CELL):
+        self.cell = float(cell)
+        self._cells = collections.defaultdict(list)
+        self._boxes = {}
+        # the order of insertion, the items are drawn in this order
+        self._order = {}
+
+    def _range(self, box):
+        x, y, w, h = box
+        cell = self.cell
+        for i in range(int(math.floor(x / cell)),
+                       int(math.floor((x + w) / cell)) + 1):
+            for j in range(int(math.floor(y / cell)),
+                           int(math.floor((y + h) / cell)) + 1):
+                yield i, j
+
+    def insert(self, item, box):
+        """Add an item and its box, C{(x, y, width, height)}."""
+
+        self._boxes[item] = box
+        self._order[item] = len(self._order)
+        for cell in self._range(box):
+            self._cells[cell].append(item)
+
+    def box(self, item):
+        return self._boxes[item]
+
+    def at(self, x, y):
+        """Return the items whose box contains the point."""
+
+        cell = (int(math.floor(x / self.cell)),
+                int(math.floor(y / self.cell)))
+        return [item for item in self._cells.get(cell, ())
+                if _contains(self._boxes[item], x, y)]
+
+    def overlapping(self, box):
+        """Return the items whose box overlaps C{box}, in insertion order."""
+
+        found = set()
+        for cell in self._range(box):
+            for item in self._cells.get(cell, ()):
+                if item not in found and _intersects(self._boxes[item], box):
+                    found.add(item)
+        return sorted(found, key=self._order.get)
+
+
+def _bounds(points, margin):
+    xs = [x for x, _ in points]
+    ys = [y for _, y in points]
+    return (min(xs) - margin, min(ys) - margin,
+            max(xs) - min(xs) + 2 * margin, max(ys) - min(ys) + 2 * margin)
+
+
+def _distance(x, y, start, end):
+    (x0, y0), (x1, y1) = start, end
+    dx, dy = x1 - x0, y1 - y0
+    length = dx * dx + dy * dy
+    if length == 0:
+        t = 0.0
+    else:
+        t = max(0.0, min(1.0, ((x - x0) * dx + (y - y0) * dy) / length))
+    return math.hypot(x - x0 - t * dx, y - y0 - t * dy)
+
+
+def _near(points, x, y, tolerance):
+    # the curve lies in the convex hull of its control points, the polygon
+    # of the control points is close enough to the curve
+    return any(_distance(x, y, points[i], points[i + 1]) <= tolerance
+               for i in range(len(points) - 1))
+
+
+class Layout:
+    """
+    The geometry of a topology, in points from the top left corner.
+
+    @ivar width: the width of the drawing.
+    @ivar height: the height of the drawing.
+    @ivar nodes: the boxes of the nodes, C{(x, y, width, height)}, by name.
+    @ivar edges: a list of C{(tail, head, points)}, the points are the
+        control points of the cubic B-spline of the edge.
+    @ivar icons: the icons of the nodes, by name.
+    @ivar index: a L{GridIndex} of the nodes, C{("node", name)}, and of the
+        edges, C{("edge", index)}.
+    """
+
+    def __init__(self, width, height, nodes, edges=(), icons=None):
+        self.width = width
+        self.height = height
+        self.nodes = nodes
+        self.edges = list(edges)
+        if icons is None:
+            icons = {}
+        self.icons = icons
+        self.index = GridIndex()
+        for i, (_, _, points) in enumerate(self.edges):
+            if points:
+                self.index.insert(("edge", i), _bounds(points,
+                                                       EDGE_TOLERANCE))
+        for name, box in sorted(nodes.items()):
+            self.index.insert(("node", name), box)
+
+    def item_at(self, x, y):
+        """
+        Return the item at the point, the nodes are above the edges, or
+        C{None}.
+        """
+
+        edge = None
+        for item in self.index.at(x, y):
+            kind, value = item
+            if kind == "node":
+                return item
+            if edge is None and _near(self.edges[value][2], x, y,
+                                      EDGE_TOLERANCE):
+                edge = item
+        return edge
+
+
+def _spline(pos, llx, ury):
+    points = []
+    # only the first spline of the edge, the end points of the arrows are
+    # not part of it
+    for token in pos.split(";")[0].split():
+        if token.startswith(("s,", "e,")):
+            continue
+        x, y = token.split(",")[:2]
+        points.append((float(x) - llx, ury - float(y)))
+    return points
+
+
+def compute_layout(key):
+    """
+    Lay out the topology with C{dot}. The geometry is read from the
+    attributes of the layout, the coordinates of graphviz, from the bottom
+    left corner, are converted in coordinates from the top left corner.
+
+    It does not use GTK and it can be called in a thread.
+
+    @param key: the structure of the topology, see L{graph_key}.
+    @rtype: L{Layout}
+    """
+
+    topo = _build_graph(key)
+    topo.layout('dot')
+    llx, lly, urx, ury = [float(v) for v in
+                          topo.graph_attr['bb'].split(',')]
+    nodes = {}
+    for node in topo.nodes():
+        x, y = [float(v) for v in node.attr['pos'].split(',')]
+        x, y = x - llx, ury - y
+        # the size of the nodes is in inches
+        w = float(node.attr['width']) * 72
+        h = float(node.attr['height']) * 72
+        nodes[str(node)] = (x - w / 2, y - h / 2, w, h)
+    edges = [(str(edge[0]), str(edge[1]),
+              _spline(edge.attr['pos'] or "", llx, ury))
+             for edge in topo.edges()]
+    return Layout(urx - llx, ury - lly, nodes, edges, dict(key[1]))
+
+
+_layouts = collections.OrderedDict()
+# graphviz is not reentrant, one layout is computed at a time
+_lock = defer.DeferredLock()
+
+
+def _cache(layout, key):
+    _layouts[key] = layout
+    while len(_layouts) > CACHE_SIZE:
+        _layouts.popitem(last=False)
+    return layout
+
+
+def get_layout(key):
+    """
+    Return a deferred that fires with the layout of a topology. The layout
+    is computed in a thread, the last L{CACHE_SIZE} layouts are reused.
+    """
+
+    layout = _layouts.pop(key, None)
+    if layout is not None:
+        return defer.succeed(_cache(layout, key))
+    d = _lock.run(threads.deferToThread, compute_layout, key)
+    return d.addCallback(_cache, key)
+
+
+def _states(bricks):
+    return dict((brick.name, is_running(brick)) for brick in bricks)
 
-    def export(self, filename):
-        shutil.copy(self.get_image_filename(), filename)
 
-    def get_image_filename(self):
-        return os.path.join(self.tempdir, "vde_topology.png")
+class Topology:
+    """
+    The topology of the lab drawn with cairo on a C{Gtk.DrawingArea}.
+
+    The topology is updated with L{update}, the current drawing stays on
+    the widget until the new layout is ready. The layout depends only on
+    the structure of the topology: when only the state of the bricks
+    changes, the layout is reused and only their nodes are drawn again.
+
+    The nodes and the edges are kept in a L{GridIndex}: the item under the
+    pointer is found with L{item_at} and highlighted with L{hover}, and
+    L{draw} draws only the items in the damaged region. The zoom scales the
+    drawing, it does not lay out the topology again.
+    """
+
+    layout = None
+    hovered = None
+    zoom = 1.0
+
+    def __init__(self, widget):
+        self.widget = widget
+        self.states = {}
+        self._request = None
+        self._running = False
+        self._waiters = []
+
+    def update(self, bricks, orientation="LR"):
+        """
+        Draw the topology of C{bricks}. If the topology changes again while
+        the layout is computed, only the last topology is laid out.
+
+        @return: a deferred that fires when the last topology requested is
+            displayed.
+        """
+
+        self._request = graph_key(bricks, orientation), _states(bricks)
+        d = defer.Deferred()
+        self._waiters.append(d)
+        if not self._running:
+            self._next()
+        return d
+
+    def _next(self):
+        key, states = self._request
+        self._request = None
+        self._running = True
+        d = get_layout(key)
+        d.addCallback(self._show, states)
+        d.addBoth(self._done)
+
+    def _done(self, result):
+        self._running = False
+        if self._request is not None:
+            # the result is stale, the topology changed in the meantime
+            self._next()
+            return
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            d.callback(result)
+
+    def _show(self, layout, states):
+        if layout is self.layout:
+            old, self.states = self.states, states
+            for name, running in states.items():
+                if old.get(name) != running and name in layout.nodes:
+                    self._damage(("node", name))
+            return
+        self.layout = layout
+        self.states = states
+        self.hovered = None
+        self._resize()
+        self.widget.queue_draw()
+
+    def _resize(self):
+        self.widget.set_size_request(
+            int(math.ceil(self.layout.width * self.zoom)),
+            int(math.ceil(self.layout.height * self.zoom)))
+
+    def _damage(self, item):
+        x, y, w, h = self.layout.index.box(item)
+        zoom = self.zoom
+        # one more pixel on every side for the antialiasing
+        left = int(math.floor(x * zoom)) - 1
+        top = int(math.floor(y * zoom)) - 1
+        right = int(math.ceil((x + w) * zoom)) + 1
+        bottom = int(math.ceil((y + h) * zoom)) + 1
+        self.widget.queue_draw_area(left, top, right - left, bottom - top)
+
+    def set_zoom(self, zoom):
+        """
+        Scale the drawing, the zoom is kept between L{MIN_ZOOM} and
+        L{MAX_ZOOM}.
+
+        @return: the new zoom.
+        """
+
+        zoom = min(max(zoom, MIN_ZOOM), MAX_ZOOM)
+        if zoom != self.zoom:
+            self.zoom = zoom
+            if self.layout is not None:
+                self._resize()
+                self.widget.queue_draw()
+        return self.zoom
+
+    def item_at(self, x, y):
+        """
+        Return the item at the point of the widget, C{("node", name)} or
+        C{("edge", index)}, or C{None}.
+        """
+
+        if self.layout is None:
+            return None
+        return self.layout.item_at(x / self.zoom, y / self.zoom)
+
+    def brick_at(self, x, y):
+        """Return the name of the brick at the point of the widget."""
+
+        item = self.item_at(x, y)
+        if item is not None and item[0] == "node":
+            return item[1]
+        return None
 
-    def get_plain_filename(self):
-        return os.path.join(self.tempdir, "vde_topology.plain")
+    def hover(self, x=None, y=None):
+        """
+        Highlight the item at the point of the widget, or nothing if the
+        point is not given. Only the old and the new item are drawn again.
+        """
+
+        item = None if x is None else self.item_at(x, y)
+        if item != self.hovered:
+            old, self.hovered = self.hovered, item
+            for damaged in old, item:
+                if damaged is not None:
+                    self._damage(damaged)
+
+    def draw(self, cr):
+        """Draw the damaged region of the widget, the clip of C{cr}."""
+
+        if self.layout is None:
+            return
+        x0, y0, x1, y1 = cr.clip_extents()
+        zoom = self.zoom
+        cr.scale(zoom, zoom)
+        self.paint(cr, (x0 / zoom, y0 / zoom, (x1 - x0) / zoom,
+                        (y1 - y0) / zoom))
+
+    def paint(self, cr, box):
+        """Draw the items that overlap C{box}, in layout coordinates."""
+
+        cr.set_source_rgb(*BACKGROUND)
+        cr.rectangle(*box)
+        cr.fill()
+        items = self.layout.index.overlapping(box)
+        for kind, value in items:
+            if kind == "edge":
+                self._draw_edge(cr, value)
+        for kind, value in items:
+            if kind == "node":
+                self._draw_node(cr, value)
+
+    def _draw_edge(self, cr, index):
+        points = self.layout.edges[index][2]
+        cr.move_to(*points[0])
+        for i in range(1, len(points) - 2, 3):
+            cr.curve_to(*(points[i] + points[i + 1] + points[i + 2]))
+        if self.hovered == ("edge", index):
+            cr.set_source_rgb(*HIGHLIGHT)
+            cr.set_line_width(2.0)
+        else:
+            cr.set_source_rgb(0, 0, 0)
+            cr.set_line_width(1.0)
+        cr.stroke()
+
+    def _icon(self, filename, running):
+        try:
+            return pixbuf_cache.get(filename, running=running)
+        except GLib.Error:
+            return None
+
+    def _draw_node(self, cr, name):
+        x, y, w, h = self.layout.nodes[name]
+        cx, cy = x + w / 2.0, y + h / 2.0
+        if self.hovered == ("node", name):
+            cr.set_source_rgba(*(HIGHLIGHT + (0.3, )))
+            cr.rectangle(x, y, w, h)
+            cr.fill()
+        filename = self.layout.icons.get(name)
+        if filename:
+            pixbuf = self._icon(filename, self.states.get(name, False))
+            if pixbuf is not None:
+                pw, ph = pixbuf.get_width(), pixbuf.get_height()
+                Gdk.cairo_set_source_pixbuf(cr, pixbuf, cx - pw / 2.0,
+                                            cy - ph / 2.0)
+                cr.rectangle(cx - pw / 2.0, cy - ph / 2.0, pw, ph)
+                cr.fill()
+        # the label is centered on the icon, as graphviz draws it
+        cr.set_source_rgb(0, 0, 0)
+        cr.set_font_size(FONT_SIZE)
+        xb, yb, tw, th = cr.text_extents(name)[:4]
+        cr.move_to(cx - tw / 2.0 - xb, cy - th / 2.0 - yb)
+        cr.show_text(name)
 
-    def get_topo_filename(self):
-        return os.path.join(self.tempdir, "vde.dot")
+    def export(self, filename):
+        """Save the drawing of the topology displayed in PNG format."""
+
+        layout = self.layout
+        width = int(math.ceil(layout.width))
+        height = int(math.ceil(layout.height))
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        self.paint(cairo.Context(surface), (0, 0, width, height))
+        surface.write_to_png(filename)
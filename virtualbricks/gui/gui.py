@@ -21,13 +21,13 @@
 import os
 import sys
 import string
+import collections
 import gi
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk
 from gi.repository import Gdk
-from gi.repository import GObject
 
-from twisted.internet import error, defer, task, protocol, reactor
+from twisted.internet import error, defer, protocol, reactor
 from twisted.python import filepath
 from zope.interface import implementer
 
@@ -40,7 +40,8 @@ from virtualbricks.bricks import Brick
 from virtualbricks.events import Event
 from virtualbricks.link import Plug, Sock
 from virtualbricks.virtualmachines import VirtualMachine
-from virtualbricks import tools, settings, project, log, brickfactory, qemu
+from virtualbricks import (tools, settings, project, log, brickfactory, qemu,
+                           lab, imageinfo)
 from virtualbricks.tools import dispose, is_running
 from virtualbricks.gui import graphics, dialogs, widgets, help
 
@@ -55,6 +56,7 @@ drawing_topology = log.Event("drawing topology")
 top_invalid_format = log.Event("Error saving topology: Invalid image format")
 top_write_error = log.Event("Error saving topology: Could not write file")
 top_unknown = log.Event("Error saving topology: Unknown error")
+top_layout_error = log.Event("Cannot draw the topology")
 start_virtualbricks = log.Event("Starting VirtualBricks")
 components_not_found = log.Event(
     "{text}\nThere are some components not "
@@ -78,9 +80,11 @@ event_in_use = log.Event("Cannot rename event: it is in use.")
 proc_signal = log.Event("Sending to process signal {signame}!")
 send_acpi = log.Event("send ACPI {acpievent}")
 proc_restart = log.Event("Restarting process!")
+monitor_error = log.Event("Error on monitor command.")
+hibernate_error = log.Event("Error on hibernating the lab.")
+resume_error = log.Event("Error on resuming the lab.")
 savevm = log.Event("Save snapshot on virtual machine {name}")
-qemu_version_parsing_error = log.Event("Error while parsing qemu version")
-retrieve_qemu_version_error = log.Event("Error while retrieving qemu version.")
+qemu_discovery_error = log.Event("Error while probing the qemu executables")
 usb_access = log.Event("Cannot access /dev/bus/usb. Check user privileges.")
 no_kvm = log.Event("No KVM support found on the system. Check your active "
                    "configuration. KVM will stay disabled.")
@@ -185,7 +189,7 @@ class VMPopupMenu(BrickPopupMenu):
 
         def loadvm(_):
             if self.original.proc is not None:
-                self.original.send("loadvm virtualbricks\n")
+                return self.original.loadvm("virtualbricks")
             else:
                 return self.original.poweron("virtualbricks")
 
@@ -385,9 +389,9 @@ class VMJobMenu(JobMenu):
             return defer.fail(RuntimeError(_("Suspend/Resume not supported on "
                                              "this disk.")))
 
-        if tools.image_type_from_file(path) == tools.ImageFormat.QCOW2:
-            self.original.send("savevm virtualbricks\n")
-            return self.original.poweroff()
+        if imageinfo.cache.get(path).format == tools.ImageFormat.QCOW2:
+            d = self.original.savevm("virtualbricks")
+            return d.addCallback(lambda _: self.original.poweroff())
         else:
             logger.error(s_r_not_supported)
             return defer.fail(RuntimeError(_("Suspend/Resume not supported on "
@@ -399,11 +403,13 @@ class VMJobMenu(JobMenu):
 
     def on_powerdown_activate(self, menuitem):
         logger.info(send_acpi, acpievent="powerdown")
-        self.original.send("system_powerdown\n")
+        d = self.original.monitor_command("system_powerdown")
+        d.addErrback(logger.failure_eb, monitor_error)
 
     def on_reset_activate(self, menuitem):
         logger.info(send_acpi, acpievent="reset")
-        self.original.send("system_reset\n")
+        d = self.original.monitor_command("system_reset")
+        d.addErrback(logger.failure_eb, monitor_error)
 
     def on_term_activate(self, menuitem, gui):
         logger.debug(proc_signal, signame="SIGTERM")
@@ -413,18 +419,109 @@ class VMJobMenu(JobMenu):
 registerAdapter(VMJobMenu, VirtualMachine, IJobMenu)
 
 
+# the number of unused panels kept for every resource, only one panel is
+# shown at a time
+PANEL_POOL_SIZE = 1
+# the panels of the closed configurations, by resource
+_panels = {}
+
+
+class _Panel(object):
+    """
+    The widgets of a reusable configuration panel. The signals of the
+    widgets are forwarded to the controller that is using the panel.
+
+    @ivar ready: C{True} if the widgets that do not depend on the brick
+        are already configured.
+    """
+
+    def __init__(self, builder):
+        self.builder = builder
+        self.owner = None
+        self.ready = False
+
+    def __getattr__(self, name):
+        # called by Gtk.Builder.connect_signals for every handler
+        if name.startswith("_") or not hasattr(self.owner, name):
+            raise AttributeError(name)
+
+        def forward(*args):
+            if self.owner is not None:
+                return getattr(self.owner, name)(*args)
+
+        return forward
+
+
+def _load_builder(resource, domain):
+    builder = Gtk.Builder()
+    builder.set_translation_domain(domain)
+    builder.add_from_file(graphics.get_data_filename(resource))
+    return builder
+
+
 @implementer(IConfigController)
 class ConfigController(object):
+    """
+    The configuration panel of a brick.
+
+    @cvar reusable: if C{True}, the widgets of the panel are not destroyed
+        when the panel is closed but are used by the next controller with
+        the same C{resource}. C{get_config_view} must then call
+        L{init_view} and set every widget from the brick.
+    @cvar view: the name of the widget returned by C{get_config_view},
+        required if the panel is reusable.
+    """
 
     domain = "virtualbricks"
     resource = None
+    reusable = False
+    view = None
+    _panel = None
 
     def __init__(self, original):
         self.original = original
-        self.builder = builder = Gtk.Builder()
-        builder.set_translation_domain(self.domain)
-        builder.add_from_file(graphics.get_data_filename(self.resource))
-        builder.connect_signals(self)
+        if not self.reusable:
+            self.builder = _load_builder(self.resource, self.domain)
+            self.builder.connect_signals(self)
+            return
+        pool = _panels.get(self.resource)
+        if pool:
+            self._panel = pool.pop()
+        else:
+            self._panel = _Panel(_load_builder(self.resource, self.domain))
+            self._panel.owner = self
+            self._panel.builder.connect_signals(self._panel)
+        self._panel.owner = self
+        self.builder = self._panel.builder
+
+    def setup_view(self):
+        """
+        Configure the widgets that do not depend on the brick. It is called
+        only once for every reusable panel, see L{init_view}.
+        """
+
+    def init_view(self):
+        if not self._panel.ready:
+            self.setup_view()
+            self._panel.ready = True
+
+    def release_view(self):
+        """
+        Keep the widgets of a reusable panel for the next controller, the
+        panel is not used anymore by this controller.
+        """
+
+        panel, self._panel = self._panel, None
+        if panel is None or not panel.ready:
+            return
+        view = self.get_object(self.view)
+        parent = view.get_parent()
+        if parent is not None:
+            parent.remove(view)
+        panel.owner = None
+        pool = _panels.setdefault(self.resource, [])
+        if len(pool) < PANEL_POOL_SIZE:
+            pool.append(panel)
 
     def __getattr__(self, name):
         obj = self.builder.get_object(name)
@@ -437,6 +534,7 @@ class ConfigController(object):
 
     def on_ok_button_clicked(self, button, gui):
         self.configure_brick(gui)
+        self.release_view()
         dispose(self)
         gui.curtain_down()
 
@@ -445,6 +543,7 @@ class ConfigController(object):
     #     self.configure_brick(gui)
 
     def on_cancel_button_clicked(self, button, gui):
+        self.release_view()
         dispose(self)
         gui.curtain_down()
 
@@ -530,8 +629,11 @@ registerAdapter(EventConfigController, Event, IConfigController)
 class SwitchConfigController(ConfigController):
 
     resource = "switchconfig.ui"
+    reusable = True
+    view = "table"
 
     def get_config_view(self, gui):
+        self.init_view()
         self.get_object("fstp_checkbutton").set_active(
             self.original.get("fstp"))
         self.get_object("hub_checkbutton").set_active(
@@ -556,8 +658,11 @@ class SwitchConfigController(ConfigController):
 class SwitchWrapperConfigController(ConfigController):
 
     resource = "switchwrapperconfig.ui"
+    reusable = True
+    view = "table1"
 
     def get_config_view(self, gui):
+        self.init_view()
         self.get_object("entry").set_text(self.original.get("path"))
         return self.get_object("table1")
 
@@ -602,8 +707,11 @@ class _PlugMixin(object):
 class TapConfigController(_PlugMixin, ConfigController):
 
     resource = "tapconfig.ui"
+    reusable = True
+    view = "table1"
 
     def get_config_view(self, gui):
+        self.init_view()
         combo = self.get_object("combobox")
         self.configure_sock_combobox(
             combo,
@@ -687,8 +795,11 @@ class CaptureConfigController(_PlugMixin, ConfigController):
 class WireConfigController(_PlugMixin, ConfigController):
 
     resource = "wireconfig.ui"
+    reusable = True
+    view = "vbox"
 
     def get_config_view(self, gui):
+        self.init_view()
         for i, wname in enumerate(("sock0_combobox", "sock1_combobox")):
             combo = self.get_object(wname)
             self.configure_sock_combobox(
@@ -834,6 +945,8 @@ class StateManager:
 class NetemuConfigController(_PlugMixin, ConfigController):
 
     resource = "netemuconfig.ui"
+    reusable = True
+    view = "netemu_config_panel"
     state_manager = None
     help = help.Help()
     config_to_checkbutton_mapping = (
@@ -861,21 +974,12 @@ class NetemuConfigController(_PlugMixin, ConfigController):
         "bandwidth_help_button",
     )
 
-    def get_config_view(self, gui):
+    def setup_view(self):
         go = self.get_object
-        get = self.original.get
-        for pname, wname in self.config_to_checkbutton_mapping:
-            go(wname).set_active(not get(pname))
-        for pname, wname in self.config_to_spinint_mapping:
-            go(wname).set_value(get(pname))
-        for pname, wname in self.config_to_spinfloat_mapping:
-            go(wname).set_value(get(pname))
-
         self.state_manager = manager = StateManager()
         params = ("chanbufsize", "delay", "loss", "bandwidth")
         for param in params:
             checkbutton = go(param + "_checkbutton")
-            checkbutton.set_active(not self.original.get(param + "symm"))
             tooltip = _("Disabled because set symmetric")
             spinbutton = go(param + "r_spinbutton")
             manager.add_checkbutton_active(checkbutton, tooltip, spinbutton)
@@ -884,6 +988,17 @@ class NetemuConfigController(_PlugMixin, ConfigController):
         for button in self.help_buttons:
             go(button).connect("clicked", self.help.on_help_button_clicked)
 
+    def get_config_view(self, gui):
+        self.init_view()
+        go = self.get_object
+        get = self.original.get
+        for pname, wname in self.config_to_checkbutton_mapping:
+            go(wname).set_active(not get(pname))
+        for pname, wname in self.config_to_spinint_mapping:
+            go(wname).set_value(get(pname))
+        for pname, wname in self.config_to_spinfloat_mapping:
+            go(wname).set_value(get(pname))
+
         # setup plugs
         for i, wname in enumerate(("sock0_combobox", "sock1_combobox")):
             combo = self.get_object(wname)
@@ -1053,6 +1168,8 @@ class ImagesBindingList(widgets.ImagesBindingList):
 class QemuConfigController(ConfigController):
 
     resource = "qemuconfig.ui"
+    reusable = True
+    view = "box_vmconfig"
     config_to_widget_mapping = (
         ("snapshot", "snapshot_checkbutton"),
         ("deviceen", "rbDeviceen"),
@@ -1121,31 +1238,32 @@ class QemuConfigController(ConfigController):
         mac_c.set_cell_data_func(mac_cr, _set_mac)
 
     def get_config_view(self, gui):
+        if qemu.capabilities.known():
+            return self._get_config_view(gui)
 
-        def install_qemu_version(version):
-            qemu.parse_and_install(version)
+        def show_config_view(_):
             container = panel.get_parent()
+            if container is None:
+                # the panel was closed meanwhile
+                return
             container.remove(panel)
             container.pack_start(self._get_config_view(gui), True, True, 0)
 
         def close_panel(failure):
-            logger.failure(qemu_version_parsing_error, failure)
+            logger.failure(qemu_discovery_error, failure)
             gui.curtain_down()
 
+        # the first time the executables are probed, the results are kept
         panel = Gtk.Alignment()
         label = Gtk.Label("Loading configuration...")
         panel.add(label)
-        d = getQemuOutput("qemu-system-x86_64", ["-version"])
-        d.addCallbacks(install_qemu_version, logger.failure_eb,
-                       errbackArgs=(retrieve_qemu_version_error, True))
+        d = qemu.capabilities.discover()
+        d.addCallback(show_config_view)
         d.addErrback(close_panel)
         panel.show_all()
         return panel
 
-    def _get_config_view(self, gui):
-        self.gui = gui
-        self.usb_devices = list(self.original.config["usbdevlist"])
-
+    def setup_view(self):
         self.state_manager = StateManager()
         self.state_manager.add_checkbutton_active(
             self.rbDeviceen,
@@ -1186,11 +1304,16 @@ class QemuConfigController(ConfigController):
             self.lblGdbport
         )
 
+        # the checks refer only to the widgets, the panel is used by the
+        # next controllers too
+        cbUsbmode = self.cbUsbmode
+        cbKvm = self.cbKvm
+
         # usb options
         def usb_check():
-            active = self.cbUsbmode.get_active()
+            active = cbUsbmode.get_active()
             if active and not os.access("/dev/bus/usb", os.W_OK):
-                self.cbUsbmode.set_active(False)
+                cbUsbmode.set_active(False)
                 logger.error(usb_access)
                 return False
             return active
@@ -1199,72 +1322,72 @@ class QemuConfigController(ConfigController):
         tooltip = _("USB disabled or /dev/bus/usb not accessible")
         usbstate.add_control(SensitiveControl(self.btnBind, tooltip))
         usbstate.add_prerequisite(usb_check)
-        self.cbUsbmode.connect("toggled", lambda cb: usbstate.check())
+        cbUsbmode.connect("toggled", lambda cb: usbstate.check())
         usbstate.check()
 
         # kvm options
         def _check_kvm():
-            if self.cbKvm.get_active():
+            if cbKvm.get_active():
                 supported = tools.check_kvm()
                 if not supported:
-                    self.cbKvm.set_active(False)
+                    cbKvm.set_active(False)
                     logger.error(no_kvm)
                 return supported
             return False
 
         kvmstate = State()
         kvmstate.add_prerequisite(_check_kvm)
-        self.cbKvm.connect("toggled", lambda cb: kvmstate.check())
+        cbKvm.connect("toggled", lambda cb: kvmstate.check())
         kvmstate.check()
 
+        # cell renderers of the comboboxes
+        self.cbArgv0.set_cell_data_func(self.crf1, self.crf1.set_text)
+        self.cbCpu.set_cell_data_func(self.crf2, self.crf2.set_text)
+        self.cbMachine.set_cell_data_func(self.crf3, self.crf3.set_text)
+        self.cbBoot.set_cell_data_func(self.crf4, self.crf4.set_text)
+        self.cbSound.set_cell_data_func(self.crf5, self.crf5.set_text)
+        self.cbMount.set_cell_data_func(self.crf6, self.crf6.set_text)
+        formatter = ImageFormatter()
+        disks = ((self.cbHda, self.crf7), (self.cbHdb, self.crf8),
+                 (self.cbHdc, self.crf9), (self.cbHdd, self.crf10),
+                 (self.cbFda, self.crf11), (self.cbFdb, self.crf12),
+                 (self.cbMtdblock, self.crf13))
+        for combo, renderer in disks:
+            combo.set_cell_data_func(renderer, renderer.set_text)
+            renderer.set_property("formatter", formatter)
+
+    def _get_config_view(self, gui):
+        self.gui = gui
+        self.usb_devices = list(self.original.config["usbdevlist"])
+        self.init_view()
+
         # argv0/cpu/machine comboboxes
         exes = qemu.get_executables()
         self.lArgv0.set_data_source(map(widgets.ListEntry.from_tuple, exes))
         self.cbArgv0.set_selected_value(self.original.config["argv0"])
-        self.cbArgv0.set_cell_data_func(self.crf1, self.crf1.set_text)
-        self.cbCpu.set_cell_data_func(self.crf2, self.crf2.set_text)
-        self.cbMachine.set_cell_data_func(self.crf3, self.crf3.set_text)
 
         # boot/sound/mount comboboxes
         boots = map(widgets.ListEntry.from_tuple, BOOT_DEVICE)
         self.lBoot.set_data_source(boots)
         self.cbBoot.set_selected_value(self.original.config["boot"])
-        self.cbBoot.set_cell_data_func(self.crf4, self.crf4.set_text)
         sounds = map(widgets.ListEntry.from_tuple, SOUND_DEVICE)
         self.lSound.set_data_source(sounds)
         self.cbSound.set_selected_value(self.original.config["soundhw"])
-        self.cbSound.set_cell_data_func(self.crf5, self.crf5.set_text)
         devices = map(widgets.ListEntry.from_tuple, MOUNT_DEVICE)
         self.lDevice.set_data_source(devices)
         self.cbMount.set_selected_value(self.original.config["device"])
-        self.cbMount.set_cell_data_func(self.crf6, self.crf6.set_text)
 
         # harddisks
         self.__images_list = ImagesBindingList(gui.factory)
-        formatter = ImageFormatter()
         self.lImages.set_data_source(self.__images_list)
         self.cbHda.set_selected_value(self.original.config["hda"].image)
-        self.cbHda.set_cell_data_func(self.crf7, self.crf7.set_text)
-        self.crf7.set_property("formatter", formatter)
         self.cbHdb.set_selected_value(self.original.config["hdb"].image)
-        self.cbHdb.set_cell_data_func(self.crf8, self.crf8.set_text)
-        self.crf8.set_property("formatter", formatter)
         self.cbHdc.set_selected_value(self.original.config["hdc"].image)
-        self.cbHdc.set_cell_data_func(self.crf9, self.crf9.set_text)
-        self.crf9.set_property("formatter", formatter)
         self.cbHdd.set_selected_value(self.original.config["hdd"].image)
-        self.cbHdd.set_cell_data_func(self.crf10, self.crf10.set_text)
-        self.crf10.set_property("formatter", formatter)
         self.cbFda.set_selected_value(self.original.config["fda"].image)
-        self.cbFda.set_cell_data_func(self.crf11, self.crf11.set_text)
-        self.crf11.set_property("formatter", formatter)
         self.cbFdb.set_selected_value(self.original.config["fdb"].image)
-        self.cbFdb.set_cell_data_func(self.crf12, self.crf12.set_text)
-        self.crf12.set_property("formatter", formatter)
         self.cbMtdblock.set_selected_value(
             self.original.config["mtdblock"].image)
-        self.crf13.set_property("formatter", formatter)
-        self.cbMtdblock.set_cell_data_func(self.crf13, self.crf13.set_text)
 
         cfg = self.original.config
         go = self.get_object
@@ -1275,6 +1398,9 @@ class QemuConfigController(ConfigController):
         for pname, wname in self.config_to_filechooser_mapping:
             if cfg[pname]:
                 go(wname).set_filename(cfg[pname])
+            else:
+                # the panel could show the file of another brick
+                go(wname).unselect_all()
         self.setup_netwoks_cards()
         go("cfg_Qemu_keyboard_text").set_text(cfg["keyboard"])
         go("kopt_textbutton").set_text(cfg["kopt"])
@@ -1323,7 +1449,9 @@ class QemuConfigController(ConfigController):
 
     def __dispose__(self):
         if self.__images_list is not None:
-            dispose(self.__images_list)
+            # the model disposes the list and does not use it anymore, the
+            # panel could be reused
+            dispose(self.lImages)
             self.__images_list = None
 
     # signals
@@ -1351,10 +1479,6 @@ class QemuConfigController(ConfigController):
         dialogs.UsbDevWindow.show_dialog(self.gui, self.usb_devices)
 
     def _remove_link(self, link, model):
-        if link.brick.proc and link.hotdel:
-            # XXX: why checking hotdel? is a method it is always true or raise
-            # an exception if it is not defined
-            link.hotdel()
         self.original.remove_plug(link)
         itr = model.get_iter_first()
         while itr:
@@ -1465,12 +1589,16 @@ def state_add_selection(manager, treeview, prerequisite, tooltip, *widgets):
 
 
 BRICKS_TAB, EVENTS_TAB, RUNNING_TAB, TOPOLOGY_TAB, README_TAB = range(5)
+# the zoom of the topology for every step of the mouse wheel
+ZOOM_STEP = 1.25
 
 
 class TopologyMixin(object):
 
     __should_draw_topology = False
     __topology = None
+    # the pointer and the scroll position where the pan started
+    __pan = None
 
     # public interface
 
@@ -1482,12 +1610,6 @@ class TopologyMixin(object):
 
     # callbacks
 
-    def on_topology_h_scrolled(self, adjustment):
-        self.__topology.x_adj = adjustment.get_value()
-
-    def on_topology_v_scrolled(self, adjustment):
-        self.__topology.y_adj = adjustment.get_value()
-
     def on_topology_orientation_toggled(self, togglebutton):
         self._draw_topology()
 
@@ -1525,7 +1647,12 @@ class TopologyMixin(object):
     def on_topology_action(self, widget, event):
         self._draw_topology_if_needed()
         assert self.__topology, "Topology not created"
-        brick = self._get_brick_in(*event.get_coords())
+        if event.button == 2:
+            hadjustment, vadjustment = self.__topology_adjustments()
+            self.__pan = (event.x_root, event.y_root, hadjustment.get_value(),
+                          vadjustment.get_value())
+            return True
+        brick = self._get_brick_in(event.x, event.y)
         if brick:
             if event.button == 3:
                 IMenu(brick, None).popup(event.button, event.time, self)
@@ -1533,6 +1660,41 @@ class TopologyMixin(object):
                 self.startstop_brick(brick)
             return True
 
+    def on_topology_button_released(self, widget, event):
+        if event.button == 2:
+            self.__pan = None
+            return True
+
+    def on_topology_draw(self, widget, cr):
+        self.__topology.draw(cr)
+        return True
+
+    def on_topology_motion(self, widget, event):
+        if self.__pan is not None:
+            x, y, h, v = self.__pan
+            hadjustment, vadjustment = self.__topology_adjustments()
+            hadjustment.set_value(h - (event.x_root - x))
+            vadjustment.set_value(v - (event.y_root - y))
+        else:
+            self.__topology.hover(event.x, event.y)
+
+    def on_topology_leave(self, widget, event):
+        self.__topology.hover()
+
+    def on_topology_scroll(self, widget, event):
+        if not event.state & Gdk.ModifierType.CONTROL_MASK:
+            return False
+        if event.direction == Gdk.ScrollDirection.UP:
+            factor = ZOOM_STEP
+        elif event.direction == Gdk.ScrollDirection.DOWN:
+            factor = 1 / ZOOM_STEP
+        elif event.direction == Gdk.ScrollDirection.SMOOTH:
+            factor = ZOOM_STEP ** -event.get_scroll_deltas()[2]
+        else:
+            return False
+        self._zoom_topology(factor, event.x, event.y)
+        return True
+
     # Notebook callbacks
 
     def on_main_notebook_change_current_page(self, notebook, offset):
@@ -1554,17 +1716,27 @@ class TopologyMixin(object):
 
     def init(self, factory):
         super(TopologyMixin, self).init(factory)
-        topology_scrolled = self.get_object("topology_scrolled")
-        hadjustment = topology_scrolled.get_hadjustment()
-        hadjustment.connect("value-changed", self.on_topology_h_scrolled)
-        vadjustment = topology_scrolled.get_vadjustment()
-        vadjustment.connect("value-changed", self.on_topology_v_scrolled)
+        self.__topology = graphics.Topology(
+            self.get_object("topology_canvas"))
+
+    def __topology_adjustments(self):
+        scrolled = self.get_object("topology_scrolled")
+        return scrolled.get_hadjustment(), scrolled.get_vadjustment()
 
     def _get_brick_in(self, x, y):
         assert self.__topology, "Topology not created"
-        for n in self.__topology.nodes:
-            if n.here(x, y):
-                return self.brickfactory.get_brick_by_name(n.name)
+        name = self.__topology.brick_at(x, y)
+        if name is not None:
+            return self.brickfactory.get_brick_by_name(name)
+
+    def _zoom_topology(self, factor, x, y):
+        old = self.__topology.zoom
+        ratio = self.__topology.set_zoom(old * factor) / old
+        # the point under the pointer stays under the pointer; the bounds
+        # of the adjustments are updated only when the canvas is resized
+        for adjustment, coord in zip(self.__topology_adjustments(), (x, y)):
+            adjustment.set_upper(adjustment.get_upper() * ratio)
+            adjustment.set_value(adjustment.get_value() + coord * (ratio - 1))
 
     def _draw_topology_if_on_page(self, page):
         if page == TOPOLOGY_TAB and self.__should_draw_topology:
@@ -1580,10 +1752,8 @@ class TopologyMixin(object):
             orientation = "TB"
         else:
             orientation = "LR"
-        self.__topology = graphics.Topology(
-            self.get_object('image_topology'),
-            self.brickfactory.bricks, 1.00, orientation,
-            settings.VIRTUALBRICKS_HOME)
+        d = self.__topology.update(self.brickfactory.bricks, orientation)
+        d.addErrback(logger.failure_eb, top_layout_error)
         self.__should_draw_topology = False
 
 
@@ -1677,6 +1847,9 @@ class ProgressBar:
     def wait_for(self, something, *args):
         return self.freezer.wait_for(something, *args)
 
+    def progress(self, done, total):
+        self.freezer.progress(done, total)
+
 
 class _Root(object):
     # This object ensure that super() calls are not forwarded to object.
@@ -1744,12 +1917,6 @@ class EventsBindingList(widgets.AbstractBindingList):
         return iter(self._factory.events)
 
 
-def is_running_filter(model, itr, data):
-    brick = model.get_value(itr, 0)
-    if brick:
-        return is_running(brick)
-
-
 class VBGUI(TopologyMixin, ReadmeMixin, _Root):
     """
     The main GUI object for virtualbricks, containing all the configuration for
@@ -1758,12 +1925,13 @@ class VBGUI(TopologyMixin, ReadmeMixin, _Root):
 
     __bricks_binding_list = None
     __events_binding_list = None
+    __running_binding_list = None
 
-    def __init__(self, factory, builder, textbuffer=None):
+    def __init__(self, factory, builder, logstore=None):
         self.factory = self.brickfactory = factory
         self.builder = builder
         self.config = settings
-        self.messages_buffer = textbuffer
+        self.logstore = logstore
 
         logger.info(start_virtualbricks)
         self.__initialize_components()
@@ -1774,7 +1942,6 @@ class VBGUI(TopologyMixin, ReadmeMixin, _Root):
         if settings.get("systray"):
             self.start_systray()
         self.builder.connect_signals(self)
-        task.LoopingCall(self.lRunning.refilter).start(2)
         self.__state_manager = StateManager()
         state_add_selection(self.__state_manager, self.tvBricks,
                             self.__brick_selected, _("No brick selected"),
@@ -1817,7 +1984,11 @@ class VBGUI(TopologyMixin, ReadmeMixin, _Root):
 
         # jobs tab
         self.tvJobs.set_cells_data_func()
-        self.lRunning.set_visible_func(is_running_filter)
+        # process_started and process_ended notify the change of the brick,
+        # only its row is checked again
+        self.lRunning.set_visible_func(is_running)
+        self.__running_binding_list = BricksBindingList(self.factory)
+        self.lRunning.set_data_source(self.__running_binding_list)
 
     def __complain_on_missing_prerequisites(self):
         qmissing, _ = tools.check_missing_qemu()
@@ -1854,6 +2025,9 @@ class VBGUI(TopologyMixin, ReadmeMixin, _Root):
         if self.__events_binding_list is not None:
             dispose(self.__events_binding_list)
             self.__events_binding_list = None
+        if self.__running_binding_list is not None:
+            dispose(self.__running_binding_list)
+            self.__running_binding_list = None
 
     def __getattr__(self, name):
         obj = self.builder.get_object(name)
@@ -2049,6 +2223,7 @@ class VBGUI(TopologyMixin, ReadmeMixin, _Root):
     def on_menuFileSaveAs_activate(self, menuitem):
         self.on_save()
         dialog = dialogs.SaveAsDialog(
+            ProgressBar(self),
             self.brickfactory,
             (prj.name for prj in project.manager)
         )
@@ -2080,7 +2255,7 @@ class VBGUI(TopologyMixin, ReadmeMixin, _Root):
         return True
 
     def on_menuViewMessages_activate(self, menuitem):
-        dialogs.LoggingWindow(self.messages_buffer).show()
+        dialogs.LoggingWindow(self.logstore).show()
         return True
 
     def on_menuImagesCreate_activate(self, menuitem):
@@ -2126,6 +2301,18 @@ class VBGUI(TopologyMixin, ReadmeMixin, _Root):
             brick.poweroff()
         return True
 
+    def on_btnHibernateAll_clicked(self, toolbutton):
+        d = lab.hibernate(self.brickfactory, project.manager.current.path)
+        d.addErrback(logger.failure_eb, hibernate_error)
+        self.user_wait_deferred(d)
+        return True
+
+    def on_btnResumeAll_clicked(self, toolbutton):
+        d = lab.resume(self.brickfactory, project.manager.current.path)
+        d.addErrback(logger.failure_eb, resume_error)
+        self.user_wait_deferred(d)
+        return True
+
     def __show_config_if_selected(self, treeview):
         brick = treeview.get_selected_value()
         if brick:
@@ -2287,32 +2474,25 @@ def _clear_menu():
 _menu = Gtk.Menu()
 
 
-class List(Gtk.ListStore):
-
-    def __init__(self):
-        Gtk.ListStore.__init__(self, object)
+class List(widgets.ObjectModel):
+    """The list of the socks of the factory, usable as a tree model."""
 
     def __iter__(self):
-        i = self.get_iter_first()
-        while i:
-            yield self.get_value(i, 0)
-            i = self.iter_next(i)
+        return iter(list(self._rows))
+
+    def __len__(self):
+        return len(self._rows)
 
     def append(self, element):
-        Gtk.ListStore.append(self, (element, ))
+        self.add(element)
 
     def remove(self, element):
-        itr = self.get_iter_first()
-        while itr:
-            el = self.get_value(itr, 0)
-            if el is element:
-                return Gtk.ListStore.remove(self, itr)
-            itr = self.iter_next(itr)
-        raise ValueError("%r not in list" % (element, ))
+        if not self.discard(element):
+            raise ValueError("%r not in list" % (element, ))
 
     def __delitem__(self, key):
         if isinstance(key, int):
-            Gtk.ListStore.__delitem__(self, key)
+            self.discard(self._rows[key])
         elif isinstance(key, slice):
             if (key.start in (None, 0) and key.stop in (None, sys.maxsize) and
                     key.step in (1, -1, None)):
@@ -2330,48 +2510,129 @@ class VisualFactory(brickfactory.BrickFactory):
         self.socks = List()
 
 
-@implementer(log.ILogObserver)
-class TextBufferObserver:
+# the errors are collected for this many seconds before they are shown
+ERRORS_WINDOW = 0.5
+# the minimum number of seconds between two error dialogs
+ERRORS_INTERVAL = 5.0
+# the number of similar errors listed in the details of the dialog
+ERRORS_DETAILS = 20
 
-    def __init__(self, textbuffer):
-        textbuffer.create_mark("end", textbuffer.get_end_iter(), False)
-        self.textbuffer = textbuffer
 
-    def __call__(self, event):
-        GObject.idle_add(self.emit, event)
+class ErrorGroup:
+
+    def __init__(self, message):
+        self.message = message
+        self.count = 0
+        self.messages = []
+
+    def add(self, message):
+        self.count += 1
+        if len(self.messages) < ERRORS_DETAILS:
+            self.messages.append(message)
+
+
+def summarize_errors(groups):
+    """
+    Return the text and the details of a dialog that shows the errors of
+    C{groups}, a list of L{ErrorGroup}.
+    """
 
-    def emit(self, event):
-        entry = "{iso8601_time} [{log_namespace}] {msg}\n{traceback}"
-        if "log_failure" in event:
-            event["traceback"] = event["log_failure"].getTraceback()
+    total = sum(group.count for group in groups)
+    if total == 1:
+        return groups[0].message, ""
+    text = _("{0} errors occurred").format(total)
+    details = []
+    for group in groups:
+        if group.count > 1:
+            details.append("{0} (x{1})".format(group.message, group.count))
+            details.extend("    " + message.split("\n", 1)[0]
+                           for message in group.messages[1:])
+            if group.count > len(group.messages):
+                details.append("    ...")
         else:
-            event["traceback"] = ""
-        event["iso8601_time"] = log.format_time(event["log_time"])
-        msg = entry.format(msg=log.formatEvent(event), **event)
-        mark = self.textbuffer.get_mark("end")
-        iter = self.textbuffer.get_iter_at_mark(mark)
-        self.textbuffer.insert_with_tags_by_name(iter, msg,
-                                                 event["log_level"].name)
+            details.append(group.message)
+    return text, "\n".join(details)
 
 
 class MessageDialogObserver:
+    """
+    Show the errors to the user.
+
+    The errors are grouped by their C{log_id} and shown in a single dialog,
+    with their count and the list of the errors, and no more than one
+    dialog every C{ERRORS_INTERVAL} seconds is shown. While a dialog is
+    open, the new errors are kept for the next one. All the errors are in
+    the Messages window anyway.
+    """
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, clock=reactor):
         self.__parent = parent
+        self.clock = clock
+        self.groups = collections.OrderedDict()
+        self.dialog = None
+        self._call = None
+        self._last = None
 
     def set_parent(self, parent):
         self.__parent = parent
 
     def __call__(self, event):
+        message = log.formatEvent(event)
+        key = event.get("log_id", message)
+        if key not in self.groups:
+            self.groups[key] = ErrorGroup(message)
+        self.groups[key].add(message)
+        self._schedule()
+
+    def _schedule(self):
+        if self._call is not None or self.dialog is not None:
+            return
+        delay = ERRORS_WINDOW
+        if self._last is not None:
+            delay = max(delay, self._last + ERRORS_INTERVAL -
+                        self.clock.seconds())
+        self._call = self.clock.callLater(delay, self._flush)
+
+    def _flush(self):
+        self._call = None
+        groups = list(self.groups.values())
+        self.groups.clear()
+        text, details = summarize_errors(groups)
+        self.dialog = self.show(text, details)
+
+    def _closed(self):
+        self.dialog = None
+        self._last = self.clock.seconds()
+        if self.groups:
+            self._schedule()
+
+    def show(self, text, details):
         dialog = Gtk.MessageDialog(
             self.__parent,
             Gtk.DialogFlags.MODAL,
             Gtk.MessageType.ERROR,
             Gtk.ButtonsType.CLOSE
         )
-        dialog.set_property('text', log.formatEvent(event))
-        dialog.connect("response", lambda d, r: d.destroy())
+        dialog.set_property("text", text)
+        if details:
+            dialog.set_property("secondary-text",
+                                _("See the Messages window for the details."))
+            textview = Gtk.TextView(editable=False, cursor_visible=False)
+            textview.get_buffer().set_text(details)
+            scrolled = Gtk.ScrolledWindow(min_content_height=150)
+            scrolled.add(textview)
+            expander = Gtk.Expander(label=_("Details"))
+            expander.add(scrolled)
+            dialog.get_message_area().pack_start(expander, True, True, 0)
+            expander.show_all()
+
+        def response(dialog, response_id):
+            dialog.destroy()
+            self._closed()
+
+        dialog.connect("response", response)
         dialog.show()
+        return dialog
 
 
 def should_show_to_user(event):
@@ -2380,15 +2641,7 @@ def should_show_to_user(event):
     return log.PredicateResult.maybe
 
 
-TEXT_TAGS = [('debug', {'foreground': '#a29898'}),
-             ('info', {}),
-             ('warn', {'foreground': '#ff9500'}),
-             ('error', {'foreground': '#b8032e'})]
-
-
-def AppLoggerFactory(textbuffer):
-
-    observer = TextBufferObserver(textbuffer)
+def AppLoggerFactory(observer):
 
     class AppLogger(brickfactory.AppLogger):
 
@@ -2408,10 +2661,8 @@ class Application(brickfactory.Application):
     factory_factory = VisualFactory
 
     def __init__(self, config):
-        self.textbuffer = Gtk.TextBuffer()
-        for name, attrs in TEXT_TAGS:
-            self.textbuffer.create_tag(name, **attrs)
-        self.logger_factory = AppLoggerFactory(self.textbuffer)
+        self.logstore = widgets.LogStore()
+        self.logger_factory = AppLoggerFactory(self.logstore)
         brickfactory.Application.__init__(self, config)
 
     def get_namespace(self):
@@ -2427,7 +2678,8 @@ class Application(brickfactory.Application):
         logger.publisher.addObserver(observer, False)
         # disable default link_button action
         # gtk.link_button_set_uri_hook(lambda b, s: None)
-        self.gui = VBGUI(factory, builder, self.textbuffer)
+        self.logstore.set_retention(int(settings.get("logretention")))
+        self.gui = VBGUI(factory, builder, self.logstore)
         message_dialog.set_parent(self.gui.wndMain)
 
     def run(self, reactor):
@@ -15,6 +15,9 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import bisect
+import collections
+
 from zope.interface import implementer
 import gi
 gi.require_version("Gtk", "3.0")
@@ -22,7 +25,7 @@ from gi.repository import Gtk
 from gi.repository import GObject
 
 
-from virtualbricks import observable
+from virtualbricks import observable, log
 from virtualbricks.tools import dispose
 from virtualbricks.gui import interfaces, graphics
 
@@ -205,6 +208,364 @@ class List(Gtk.ListStore):
             self._ibinding_list = None
 
 
+class ObjectModel(GObject.Object, Gtk.TreeModel):
+    """
+    A flat model of objects bound directly to a collection, usually an
+    L{interfaces.IBindingList} of the factory.
+
+    The model does not copy the objects in a store: it keeps the visible
+    objects in order and an index from the objects to their rows, so that
+    the row of an object is found without scanning the model and a change
+    of an object emits only the signal of its row. The rows can be sorted
+    with L{set_sort_key} and filtered with L{set_visible_func}; when an
+    object changes only its row is checked again, the model is never
+    filtered again as a whole.
+
+    The model has one column, the object itself.
+    """
+
+    __gtype_name__ = "ObjectModel"
+
+    _ibinding_list = None
+
+    def __init__(self):
+        GObject.Object.__init__(self)
+        self._stamp = 1
+        self._key = None
+        self._visible = None
+        self._visible_args = ()
+        self._seq = 0
+        # all the objects and their sort keys, visible or not
+        self._members = {}
+        # the visible objects and their sort keys, in order
+        self._rows = []
+        self._keys = []
+        # the index of the rows, valid only below self._stale
+        self._positions = {}
+        self._stale = 0
+
+    # the index
+
+    def _sort_key(self, obj, seq):
+        # the sequence number keeps the order of insertion of equal keys
+        if self._key is None:
+            return (seq, )
+        return (self._key(obj), seq)
+
+    def _is_visible(self, obj):
+        if self._visible is None:
+            return True
+        return bool(self._visible(obj, *self._visible_args))
+
+    def _position(self, obj):
+        position = self._positions.get(id(obj))
+        if position is not None and position >= self._stale:
+            # the rows after the last insertion or removal moved
+            rows = self._rows
+            for i in range(self._stale, len(rows)):
+                self._positions[id(rows[i])] = i
+            self._stale = len(rows)
+            position = self._positions[id(obj)]
+        return position
+
+    def _show(self, obj, key):
+        position = bisect.bisect(self._keys, key)
+        self._rows.insert(position, obj)
+        self._keys.insert(position, key)
+        self._positions[id(obj)] = position
+        self._stale = min(self._stale, position)
+        self._stamp += 1
+        self.row_inserted(Gtk.TreePath((position, )), self._iter(position))
+
+    def _hide(self, obj):
+        position = self._position(obj)
+        del self._rows[position]
+        del self._keys[position]
+        del self._positions[id(obj)]
+        self._stale = min(self._stale, position)
+        self._stamp += 1
+        self.row_deleted(Gtk.TreePath((position, )))
+
+    def _rebuild(self):
+        while self._rows:
+            self._hide(self._rows[-1])
+        members = sorted(self._members.values(), key=lambda m: m[1][-1])
+        for obj, key in members:
+            key = self._sort_key(obj, key[-1])
+            self._members[id(obj)] = obj, key
+            if self._is_visible(obj):
+                self._show(obj, key)
+
+    # public interface
+
+    def add(self, obj):
+        key = self._sort_key(obj, self._seq)
+        self._seq += 1
+        self._members[id(obj)] = obj, key
+        if self._is_visible(obj):
+            self._show(obj, key)
+
+    def discard(self, obj):
+        """
+        Remove an object from the model.
+
+        @return: C{True} if the object was in the model.
+        """
+
+        if self._members.pop(id(obj), None) is None:
+            return False
+        if id(obj) in self._positions:
+            self._hide(obj)
+        return True
+
+    def refresh(self, obj):
+        """
+        Check again the order and the visibility of an object that changed.
+        Only the signals of its row are emitted.
+        """
+
+        member = self._members.get(id(obj))
+        if member is None:
+            return
+        key = member[1]
+        new_key = self._sort_key(obj, key[-1])
+        visible = self._is_visible(obj)
+        shown = id(obj) in self._positions
+        if shown and visible and new_key == key:
+            position = self._position(obj)
+            self.row_changed(Gtk.TreePath((position, )),
+                             self._iter(position))
+            return
+        self._members[id(obj)] = obj, new_key
+        if shown:
+            self._hide(obj)
+        if visible:
+            self._show(obj, new_key)
+
+    def get_path_of(self, obj):
+        """Return the path of the row of an object or C{None}."""
+
+        position = self._position(obj)
+        if position is None:
+            return None
+        return Gtk.TreePath((position, ))
+
+    def __contains__(self, obj):
+        return id(obj) in self._members
+
+    def set_sort_key(self, key):
+        """
+        Sort the rows by C{key(obj)}, or in order of insertion if C{key} is
+        C{None}.
+        """
+
+        self._key = key
+        self._rebuild()
+
+    def set_visible_func(self, func, *args):
+        """
+        Show only the objects for which C{func(obj, *args)} is true, or all
+        the objects if C{func} is C{None}.
+        """
+
+        self._visible = func
+        self._visible_args = args
+        self._rebuild()
+
+    def clear(self):
+        while self._rows:
+            self._hide(self._rows[-1])
+        self._members.clear()
+
+    def set_data_source(self, lst):
+        dispose(self)
+        self.clear()
+        for item in lst:
+            self.add(item)
+        if interfaces.IBindingList.providedBy(lst):
+            self._ibinding_list = lst
+            lst.added.connect(self.on_add)
+            lst.removed.connect(self.on_remove)
+            lst.changed.connect(self.on_changed)
+
+    def on_add(self, value):
+        self.add(value)
+
+    def on_remove(self, value):
+        self.discard(value)
+
+    def on_changed(self, value):
+        self.refresh(value)
+
+    def __dispose__(self):
+        if self._ibinding_list is not None:
+            dispose(self._ibinding_list)
+            self._ibinding_list = None
+
+    # Gtk.TreeModel interface
+
+    def _iter(self, position):
+        itr = Gtk.TreeIter()
+        itr.stamp = self._stamp
+        # a NULL user_data is not a valid iter
+        itr.user_data = position + 1
+        return itr
+
+    def do_get_flags(self):
+        return Gtk.TreeModelFlags.LIST_ONLY
+
+    def do_get_n_columns(self):
+        return 1
+
+    def do_get_column_type(self, index):
+        return GObject.TYPE_PYOBJECT
+
+    def do_get_iter(self, path):
+        indices = path.get_indices()
+        if len(indices) == 1 and 0 <= indices[0] < len(self._rows):
+            return True, self._iter(indices[0])
+        return False, None
+
+    def do_get_path(self, itr):
+        return Gtk.TreePath((itr.user_data - 1, ))
+
+    def do_get_value(self, itr, column):
+        return self._rows[itr.user_data - 1]
+
+    def do_iter_next(self, itr):
+        position = itr.user_data
+        if position < len(self._rows):
+            itr.user_data = position + 1
+            return True
+        return False
+
+    def do_iter_previous(self, itr):
+        position = itr.user_data - 1
+        if position > 0:
+            itr.user_data = position
+            return True
+        return False
+
+    def do_iter_children(self, parent):
+        if parent is None and self._rows:
+            return True, self._iter(0)
+        return False, None
+
+    def do_iter_has_child(self, itr):
+        return False
+
+    def do_iter_n_children(self, itr):
+        if itr is None:
+            return len(self._rows)
+        return 0
+
+    def do_iter_nth_child(self, parent, n):
+        if parent is None and 0 <= n < len(self._rows):
+            return True, self._iter(n)
+        return False, None
+
+    def do_iter_parent(self, child):
+        return False, None
+
+
+LogLine = collections.namedtuple("LogLine",
+                                 "seq time level namespace text")
+LOG_LEVELS = ("debug", "info", "warn", "error", "critical")
+# the number of messages kept if the setting is not loaded
+LOG_RETENTION = 5000
+
+
+@implementer(log.ILogObserver)
+class LogStore:
+    """
+    The messages of the session, shown in the Messages window.
+
+    The messages are kept in a ring buffer, the oldest are dropped when
+    there are more than C{retention} messages. The events are not handled
+    one by one: they are queued and formatted in the main loop by a single
+    idle callback, the views are notified once with all the new lines.
+
+    @ivar appended: notified with the list of the new L{LogLine}s.
+    @ivar cleared: notified when the messages are removed.
+    """
+
+    def __init__(self, retention=LOG_RETENTION, schedule=GObject.idle_add):
+        self.lines = collections.deque(maxlen=retention)
+        # the events queued between two flushes, the older events would be
+        # dropped anyway
+        self._events = collections.deque(maxlen=retention)
+        self._scheduled = False
+        self._schedule = schedule
+        self._seq = 0
+        self._observable = observable.Observable("appended", "cleared")
+        self.appended = observable.Event(self._observable, "appended")
+        self.cleared = observable.Event(self._observable, "cleared")
+
+    @property
+    def first_seq(self):
+        """The sequence number of the oldest message kept."""
+
+        if self.lines:
+            return self.lines[0].seq
+        return self._seq + 1
+
+    def set_retention(self, retention):
+        self.lines = collections.deque(self.lines, maxlen=retention)
+        self._events = collections.deque(self._events, maxlen=retention)
+
+    def __call__(self, event):
+        # it can be called from any thread
+        self._events.append(event)
+        if not self._scheduled:
+            self._scheduled = True
+            self._schedule(self.flush)
+
+    def flush(self):
+        self._scheduled = False
+        lines = []
+        while self._events:
+            lines.append(self._format(self._events.popleft()))
+        if lines:
+            self.lines.extend(lines)
+            self._observable.notify("appended", lines)
+        # the idle callback is not called again
+        return False
+
+    def _format(self, event):
+        text = log.formatEvent(event)
+        if "log_failure" in event:
+            text += "\n" + event["log_failure"].getTraceback()
+        self._seq += 1
+        return LogLine(self._seq, log.format_time(event["log_time"]),
+                       event["log_level"].name, event.get("log_namespace", ""),
+                       text.rstrip("\n"))
+
+    def clear(self):
+        self.lines.clear()
+        self._observable.notify("cleared", self)
+
+    def text(self):
+        """Return all the messages kept as text."""
+
+        return "".join("{0.time} [{0.namespace}] {0.text}\n".format(line)
+                       for line in self.lines)
+
+
+def log_filter(level="debug", namespace=""):
+    """
+    Return a predicate that matches the L{LogLine}s of at least C{level}
+    and whose namespace contains C{namespace}.
+    """
+
+    minimum = LOG_LEVELS.index(level)
+
+    def matches(line):
+        return (LOG_LEVELS.index(line.level) >= minimum and
+                namespace in line.namespace)
+
+    return matches
+
+
 @implementer(interfaces.IBindingList)
 class AbstractBindingList:
 
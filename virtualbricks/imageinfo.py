@@ -0,0 +1,290 @@
+# -*- test-case-name: virtualbricks.tests.test_imageinfo -*-
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2018 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Metadata of the disk images.
+
+The header of an image is parsed only once, the result is kept until the
+file changes, that is until its device, inode, modification time or size
+change. The file is checked with a single stat(2) every time the metadata
+are requested, so the refresh is lazy and does not need any notification
+from the file system.
+
+The cache keeps also a reverse index from the base images to the COWs that
+depend on them.
+"""
+
+import os
+import struct
+
+from virtualbricks.tools import ImageFormat
+
+
+__all__ = ["ImageInfo", "ImageCache", "read_info", "cache"]
+
+
+# Enough to read the headers of all the known formats, the UML COW header
+# is the largest.
+HEADER_SIZE = 2048
+QCOW_MAGIC = b"QFI\xfb"
+QED_MAGIC = b"QED\x00"
+COW_MAGIC = b"OOOM"
+VMDK_MAGIC = b"KDMV"
+VPC_MAGIC = b"conectix"
+VDI_SIGNATURE = 0xbeda107f
+
+
+class ImageInfo:
+    """
+    The metadata of a disk image.
+
+    @ivar format: the format of the image, one of L{ImageFormat}.
+    @ivar virtual_size: the size of the disk seen by the guest, in bytes.
+    @ivar size: the size of the file.
+    @ivar allocated_size: the space really used on the disk by the file.
+    @ivar backing_file: the backing file as written in the header or
+        C{None} if the image has not backing file.
+    """
+
+    def __init__(self, path, format, virtual_size, size, allocated_size,
+                 backing_file=None):
+        self.path = path
+        self.format = format
+        self.virtual_size = virtual_size
+        self.size = size
+        self.allocated_size = allocated_size
+        self.backing_file = backing_file
+
+    @property
+    def backing_path(self):
+        """The absolute path of the backing file or C{None}."""
+
+        if self.backing_file:
+            return os.path.normpath(os.path.join(os.path.dirname(self.path),
+                                                 self.backing_file))
+        return None
+
+    def __repr__(self):
+        return "<ImageInfo {0.path} {0.format.name}>".format(self)
+
+
+def _string(data, offset, size):
+    value = data[offset:offset + size].rstrip(b"\x00")
+    if not isinstance(value, str):
+        value = value.decode("utf-8", "replace")
+    return value
+
+
+def _read_backing_file(fp, offset, size):
+    if offset == 0 or size == 0:
+        return None
+    fp.seek(offset)
+    return _string(fp.read(size), 0, size)
+
+
+def _parse_qcow(fp, header):
+    version, offset, size, _, virtual_size = struct.unpack_from(">IQIIQ",
+                                                                header, 4)
+    if version == 1:
+        image_format = ImageFormat.QCOW
+    elif version in (2, 3):
+        image_format = ImageFormat.QCOW2
+    else:
+        return ImageFormat.UNKNOWN, None, None
+    return image_format, virtual_size, _read_backing_file(fp, offset, size)
+
+
+def _parse_qed(fp, header):
+    virtual_size, offset, size = struct.unpack_from("<QII", header, 48)
+    return ImageFormat.QED, virtual_size, _read_backing_file(fp, offset, size)
+
+
+def _parse_cow(fp, header):
+    virtual_size, = struct.unpack_from(">Q", header, 1036)
+    return ImageFormat.COW, virtual_size, _string(header, 8, 1024) or None
+
+
+def _parse_vmdk(fp, header):
+    sectors, = struct.unpack_from("<Q", header, 12)
+    return ImageFormat.VMDK, sectors * 512, None
+
+
+def _parse_vpc(fp, header):
+    virtual_size, = struct.unpack_from(">Q", header, 48)
+    return ImageFormat.VPC, virtual_size, None
+
+
+def _parse_vdi(fp, header):
+    virtual_size, = struct.unpack_from("<Q", header, 368)
+    return ImageFormat.VDI, virtual_size, None
+
+
+_PARSERS = ((QCOW_MAGIC, _parse_qcow), (QED_MAGIC, _parse_qed),
+            (COW_MAGIC, _parse_cow), (VMDK_MAGIC, _parse_vmdk),
+            (VPC_MAGIC, _parse_vpc))
+
+
+def _parse(fp, size):
+    header = fp.read(HEADER_SIZE)
+    header += b"\x00" * (HEADER_SIZE - len(header))
+    for magic, parse in _PARSERS:
+        if header.startswith(magic):
+            return parse(fp, header)
+    if struct.unpack_from("<I", header, 64)[0] == VDI_SIGNATURE:
+        return _parse_vdi(fp, header)
+    return ImageFormat.RAW, size, None
+
+
+def read_info(path, st=None):
+    """
+    Parse the header of an image.
+
+    @param path: the path of the image.
+    @param st: the result of C{os.stat(path)}, if already known.
+    @rtype: L{ImageInfo}
+    @raise OSError: if the image cannot be read.
+    """
+
+    if st is None:
+        st = os.stat(path)
+    with open(path, "rb") as fp:
+        image_format, virtual_size, backing_file = _parse(fp, st.st_size)
+    return ImageInfo(path, image_format, virtual_size, st.st_size,
+                     getattr(st, "st_blocks", 0) * 512 or st.st_size,
+                     backing_file)
+
+
+def _key(st):
+    return st.st_dev, st.st_ino, st.st_mtime, st.st_size
+
+
+class ImageCache:
+    """
+    Cache of the metadata of the images, keyed by the absolute path of the
+    image and validated with the device, the inode, the modification time
+    and the size of the file.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        # base image -> set of the images backed by it
+        self._dependents = {}
+
+    def get(self, path):
+        """
+        Return the metadata of an image, the header is parsed again only if
+        the file changed.
+
+        @rtype: L{ImageInfo}
+        @raise OSError: if the image cannot be read.
+        """
+
+        path = os.path.abspath(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.invalidate(path)
+            raise
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] == _key(st):
+            return entry[1]
+        return self.update(read_info(path, st), st)
+
+    def update(self, info, st):
+        """
+        Store the metadata of an image read elsewhere, i.e. in a thread.
+
+        @param info: the metadata of the image.
+        @type info: L{ImageInfo}
+        @param st: the result of the stat(2) done before reading C{info}.
+        """
+
+        path = os.path.abspath(info.path)
+        self.invalidate(path)
+        self._entries[path] = _key(st), info
+        if info.backing_path is not None:
+            self._dependents.setdefault(info.backing_path, set()).add(path)
+        return info
+
+    def invalidate(self, path):
+        """Forget the metadata of an image."""
+
+        path = os.path.abspath(path)
+        entry = self._entries.pop(path, None)
+        if entry is not None and entry[1].backing_path is not None:
+            dependents = self._dependents.get(entry[1].backing_path, ())
+            dependents.discard(path)
+            if not dependents:
+                self._dependents.pop(entry[1].backing_path, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._dependents.clear()
+
+    def index(self, paths):
+        """
+        Read the metadata of many images so that L{dependents} knows them.
+        The images that cannot be read are ignored.
+        """
+
+        for path in paths:
+            try:
+                self.get(path)
+            except (OSError, IOError):
+                pass
+
+    def chain(self, path):
+        """
+        Return the list of the images in the backing chain of C{path}, the
+        first is C{path} itself. The chain stops at the first missing file
+        and at the loops.
+        """
+
+        chain = []
+        path = os.path.abspath(path)
+        while path is not None and path not in chain:
+            chain.append(path)
+            try:
+                path = self.get(path).backing_path
+            except (OSError, IOError):
+                break
+        return chain
+
+    def depth(self, path):
+        """Return the number of backing files below C{path}."""
+
+        return len(self.chain(path)) - 1
+
+    def dependents(self, base):
+        """
+        Return the sorted list of the known images whose backing file is
+        C{base}. Only the images already read are returned, see L{index}.
+        """
+
+        base = os.path.abspath(base)
+        dependents = []
+        for path in list(self._dependents.get(base, ())):
+            try:
+                if self.get(path).backing_path == base:
+                    dependents.append(path)
+            except (OSError, IOError):
+                pass
+        return sorted(dependents)
+
+
+cache = ImageCache()
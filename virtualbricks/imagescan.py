@@ -0,0 +1,229 @@
+# -*- test-case-name: virtualbricks.tests.test_imagescan -*-
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2018 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Background scan of the directories of the disk images.
+
+The directories are walked and the headers of the images are read in
+threads, at most C{concurrency} files are read at the same time. The images
+found are added to the disk library as soon as their header is read, so the
+reactor never waits for the file system, that can be slow when the images
+are on NFS.
+
+The C{vimages} directory of the workspace is shared by all the projects. Its
+images are always indexed, their headers are read in the cache of
+L{virtualbricks.imageinfo}, but they are added to the library of the
+project only if the C{scanimages} option is set.
+
+The images of a project are checked in the same way when the project is
+opened, see L{check_access}.
+"""
+
+import os
+
+from twisted.internet import defer, threads
+
+from virtualbricks import settings, log, errors, imageinfo
+from virtualbricks.tools import ImageFormat
+
+
+__all__ = ["scan", "check_access", "ImageScanner"]
+
+logger = log.Logger()
+scan_error = log.Event("Cannot read the disk image {path}: {error}")
+scan_progress = log.Event("Scanned {done} of {total} disk images")
+image_skipped = log.Event("Skipping disk image {path}: {reason}")
+image_not_readable = log.Event("Cannot access image file {path} of {name}")
+
+# Files that live together with the images but are not images
+IGNORED_SUFFIXES = (".vbdescr", ".cow", ".state")
+
+
+def _is_candidate(filename):
+    return not (filename.startswith(".") or
+                filename.endswith(IGNORED_SUFFIXES) or ".back-" in filename)
+
+
+def _walk(directories):
+    found = []
+    for directory in directories:
+        for dirpath, dirnames, filenames in os.walk(directory):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            for filename in sorted(filter(_is_candidate, filenames)):
+                found.append(os.path.join(dirpath, filename))
+    return found
+
+
+def _read(path):
+    st = os.stat(path)
+    return st, imageinfo.read_info(path, st)
+
+
+def _is_image(info):
+    if info.format == ImageFormat.UNKNOWN:
+        return False
+    # a raw image is any file, accept only the ones that can be a disk
+    return info.format != ImageFormat.RAW or (
+        info.size > 0 and info.size % 512 == 0)
+
+
+class ImageScanner:
+    """
+    Find the disk images in a set of directories and add them to the
+    library of the factory.
+
+    @param progress: if not C{None}, called with the number of files read
+        and the total number of files after every file.
+    @param add: if C{False} the images are only indexed, they are not added
+        to the library.
+    """
+
+    def __init__(self, factory, concurrency=None, progress=None,
+                 read=_read, walk=_walk, add=True):
+        if concurrency is None:
+            concurrency = int(settings.get("concurrency"))
+        self.factory = factory
+        self.progress = progress
+        self.add = add
+        self._semaphore = defer.DeferredSemaphore(concurrency)
+        self._read = read
+        self._walk = walk
+        self.done = 0
+        self.total = 0
+
+    def scan(self, directories):
+        """
+        Scan the directories.
+
+        @return: a deferred that fires with the list of the images added to
+            the library or, if they are only indexed, with their paths.
+        """
+
+        d = threads.deferToThread(self._walk, directories)
+        d.addCallback(self._read_all)
+        return d
+
+    def _read_all(self, paths):
+        known = set(image.path for image in self.factory.disk_images)
+        paths = [path for path in paths if os.path.abspath(path) not in known]
+        self.total = len(paths)
+        dl = [self._semaphore.run(self._read_one, path) for path in paths]
+        d = defer.gatherResults(dl)
+        d.addCallback(lambda images: [image for image in images if image])
+        return d
+
+    def _read_one(self, path):
+        d = threads.deferToThread(self._read, path)
+        d.addCallbacks(self._add_image, self._read_failed,
+                       callbackArgs=(path, ), errbackArgs=(path, ))
+        d.addBoth(self._step)
+        return d
+
+    def _read_failed(self, fail, path):
+        fail.trap(EnvironmentError)
+        logger.warn(scan_error, path=path, error=fail.getErrorMessage())
+
+    def _add_image(self, result, path):
+        st, info = result
+        imageinfo.cache.update(info, st)
+        if not _is_image(info):
+            return None
+        if not self.add:
+            return path
+        name = os.path.basename(path)
+        try:
+            return self.factory.new_disk_image(name, path)
+        except (errors.InvalidNameError, errors.NameAlreadyInUseError,
+                errors.ImageAlreadyInUseError) as e:
+            logger.debug(image_skipped, path=path, reason=str(e))
+            return None
+
+    def _step(self, image):
+        self.done += 1
+        if self.progress is not None:
+            self.progress(self.done, self.total)
+        return image
+
+
+def _log_progress(done, total):
+    logger.debug(scan_progress, done=done, total=total)
+
+
+def default_directories():
+    """The directories of the images shared by all the projects."""
+
+    return [os.path.join(settings.get("workspace"), "vimages")]
+
+
+def scan(factory, directories=None, concurrency=None,
+         progress=_log_progress):
+    """
+    Add to the library of the factory the images found in the directories,
+    by default the C{vimages} directory of the workspace. The images of
+    C{vimages} are only indexed if the C{scanimages} option is not set.
+
+    @param progress: called with the number of files read and the total
+        number of files.
+    @return: a deferred that fires with the list of the new images or of
+        the paths of the images indexed.
+    """
+
+    add = True
+    if directories is None:
+        directories = default_directories()
+        add = settings.get("scanimages")
+    scanner = ImageScanner(factory, concurrency, progress, add=add)
+    return scanner.scan(directories)
+
+
+def _is_used(factory, image):
+    return any(disk.image is image for brick in factory.bricks
+               if brick.get_type() == "Qemu" for disk in brick.disks())
+
+
+def check_access(factory, images, concurrency=None):
+    """
+    Check in threads, at most C{concurrency} at the same time, that the
+    files of the images can be read. The images that cannot be read are
+    removed from the library of the factory, unless a virtual machine uses
+    them.
+
+    @return: a deferred that fires with the list of the images that cannot
+        be read.
+    """
+
+    if concurrency is None:
+        concurrency = int(settings.get("concurrency"))
+    semaphore = defer.DeferredSemaphore(concurrency)
+
+    def checked(readable, image):
+        if readable:
+            return None
+        logger.info(image_not_readable, path=image.path, name=image.name)
+        if image in factory.disk_images and not _is_used(factory, image):
+            factory.remove_disk_image(image)
+        return image
+
+    dl = []
+    for image in images:
+        d = semaphore.run(threads.deferToThread, os.access, image.path,
+                          os.R_OK)
+        dl.append(d.addCallback(checked, image))
+    d = defer.gatherResults(dl)
+    d.addCallback(lambda images: [image for image in images if image])
+    return d
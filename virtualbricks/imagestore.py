@@ -0,0 +1,388 @@
+# -*- test-case-name: virtualbricks.tests.test_imagestore -*-
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2018 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Content addressed store of the base images.
+
+The store keeps one read-only copy of every base image, named after the
+hash of its content, in the C{.imagestore} directory of the workspace. The
+images interned in the store are referenced by all the projects with the
+path of their copy, so the same image imported in many projects takes the
+space of one. The copies not referenced anymore by any project are removed
+by L{ImageStore.collect}. The images added by an import still in progress
+are pinned, see L{ImageStore.add}, and they are not removed until the
+imported project is saved.
+
+The store is used only if the C{imagestore} option is set.
+
+The store has an index of the checksums of the images extracted from the
+project archives, see L{virtualbricks.archive}: an image already in the
+store is found by its checksum when it is imported again, without hashing
+it.
+
+The hash of an image is the SHA-256 of the list of the SHA-256 of its
+chunks, followed by the size of the file. The chunks are hashed in parallel
+in threads, so that big images are hashed at the speed of the disk.
+"""
+
+import os
+import errno
+import stat
+import hashlib
+import tempfile
+import threading
+import collections
+
+from twisted.internet import defer, threads
+
+from virtualbricks import settings, log, project, imageinfo, copier
+
+
+__all__ = ["ImageStore", "hash_file", "get_store", "is_enabled"]
+
+logger = log.Logger()
+image_interned = log.Event("Disk image {path} stored as {digest}")
+image_collected = log.Event("Removing unused disk image {digest} from the "
+                            "store")
+project_unreadable = log.Event("Cannot read the images of the project "
+                               "{name}, the store is not cleaned")
+index_error = log.Event("Cannot update the index of the image store {path}")
+
+CHUNK_SIZE = 64 * 1024 * 1024
+BUFFER_SIZE = 1024 * 1024
+READONLY = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+
+# the paths of the pinned images, shared by all the stores, collect runs in
+# a thread
+_pinned = collections.Counter()
+_pin_lock = threading.Lock()
+
+
+def _hash_chunk(path, offset, size):
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        fp.seek(offset)
+        while size > 0:
+            data = fp.read(min(size, BUFFER_SIZE))
+            if not data:
+                break
+            digest.update(data)
+            size -= len(data)
+    return digest.digest()
+
+
+def _tree_digest(chunks, size):
+    digest = hashlib.sha256()
+    for chunk in chunks:
+        digest.update(chunk)
+    digest.update(str(size).encode("ascii"))
+    return digest.hexdigest()
+
+
+def hash_file(path, concurrency=None, chunk_size=CHUNK_SIZE):
+    """
+    Hash a file, at most C{concurrency} chunks are hashed at the same time.
+
+    @return: a deferred that fires with the hexadecimal digest of the file.
+    """
+
+    if concurrency is None:
+        concurrency = int(settings.get("concurrency"))
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return defer.fail()
+    semaphore = defer.DeferredSemaphore(concurrency)
+    dl = [semaphore.run(threads.deferToThread, _hash_chunk, path, offset,
+                        chunk_size)
+          for offset in range(0, size, chunk_size)]
+    d = defer.gatherResults(dl, consumeErrors=True)
+    d.addErrback(lambda fail: fail.value.subFailure)
+    d.addCallback(_tree_digest, size)
+    return d
+
+
+def _move(source, destination):
+    try:
+        os.rename(source, destination)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        copier.copy_file(source, destination)
+        os.remove(source)
+
+
+class ImageStore:
+
+    def __init__(self, path):
+        self.path = path
+        # checksum -> digest
+        self._index = None
+
+    @property
+    def objects(self):
+        return os.path.join(self.path, "objects")
+
+    @property
+    def index_path(self):
+        return os.path.join(self.path, "index")
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest)
+
+    def lookup(self, digest):
+        """Return the path of the image with the given hash or C{None}."""
+
+        path = self.object_path(digest)
+        if os.path.isfile(path):
+            return path
+        return None
+
+    def _load_index(self):
+        self._index = {}
+        try:
+            with open(self.index_path) as fp:
+                for line in fp:
+                    checksum, _, digest = line.rstrip("\n").partition(" ")
+                    if digest:
+                        self._index[checksum] = digest
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def find(self, checksum, pin=False):
+        """
+        Return the path of the image with the given checksum of the archives
+        or C{None}.
+
+        @param pin: if C{True} the image found is pinned.
+        """
+
+        if self._index is None:
+            self._load_index()
+        digest = self._index.get(checksum)
+        if digest is None:
+            return None
+        return self._lookup_pinned(digest, pin)
+
+    def _lookup_pinned(self, digest, pin):
+        if not pin:
+            return self.lookup(digest)
+        # pin before looking, collect removes the images only if they are
+        # not pinned
+        with _pin_lock:
+            _pinned[self.object_path(digest)] += 1
+            path = self.lookup(digest)
+            if path is None:
+                self._unpin(self.object_path(digest))
+            return path
+
+    def pin(self, path):
+        """Do not remove the image in C{path} until it is unpinned."""
+
+        with _pin_lock:
+            _pinned[path] += 1
+
+    def unpin(self, path):
+        with _pin_lock:
+            self._unpin(path)
+
+    def _unpin(self, path):
+        _pinned[path] -= 1
+        if _pinned[path] <= 0:
+            del _pinned[path]
+
+    def _record(self, path, checksum):
+        digest = os.path.basename(path)
+        if self._index.get(checksum) == digest:
+            return path
+        self._index[checksum] = digest
+        try:
+            with open(self.index_path, "a") as fp:
+                fp.write("{0} {1}\n".format(checksum, digest))
+        except IOError:
+            logger.failure(index_error, path=self.path)
+        return path
+
+    def contains(self, path):
+        """Return C{True} if the path is an image of the store."""
+
+        return os.path.dirname(os.path.abspath(path)) == self.objects
+
+    def add(self, path, move=False, checksum=None, pin=False):
+        """
+        Add an image to the store. If the store has already an image with
+        the same content, the file is not copied.
+
+        @param move: if C{True} the file is moved in the store, or removed
+            if its content is already in the store.
+        @param checksum: the checksum of the file in the archive it was
+            extracted from, if known. If the checksum is in the index the
+            file is not hashed.
+        @param pin: if C{True} the image is pinned, it is not removed by
+            L{collect} until it is unpinned with L{unpin}. The images added
+            by an import are pinned until the project is saved.
+        @return: a deferred that fires with the path of the image in the
+            store.
+        """
+
+        if self.contains(path):
+            path = os.path.abspath(path)
+            if pin:
+                self.pin(path)
+            return defer.succeed(path)
+        if checksum is not None:
+            destination = self.find(checksum, pin)
+            if destination is not None:
+                if move:
+                    os.remove(path)
+                return defer.succeed(destination)
+        d = hash_file(path)
+        d.addCallback(self._store, path, move, pin)
+        if checksum is not None:
+            d.addCallback(self._record, checksum)
+        return d
+
+    def _store(self, digest, path, move, pin):
+        destination = self._lookup_pinned(digest, pin)
+        if destination is not None:
+            if move:
+                os.remove(path)
+            return destination
+        if pin:
+            self.pin(self.object_path(digest))
+        d = threads.deferToThread(self._copy, digest, path, move)
+        if pin:
+            d.addErrback(self._unpin_eb, self.object_path(digest))
+        return d
+
+    def _unpin_eb(self, failure, path):
+        self.unpin(path)
+        return failure
+
+    def _copy(self, digest, path, move):
+        try:
+            os.makedirs(self.objects)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, tmp = tempfile.mkstemp(prefix=".", dir=self.objects)
+        os.close(fd)
+        try:
+            if move:
+                _move(path, tmp)
+            else:
+                copier.copy_file(path, tmp)
+            os.chmod(tmp, READONLY)
+            destination = self.object_path(digest)
+            os.rename(tmp, destination)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        logger.info(image_interned, path=path, digest=digest)
+        return destination
+
+    def intern(self, image, move=False):
+        """
+        Add the file of an image of the library to the store and make the
+        image refer to the copy in the store.
+
+        @type image: L{virtualbricks.virtualmachines.Image}
+        @return: a deferred that fires with the image.
+        """
+
+        def set_path(path):
+            image.path = path
+            return image
+
+        return self.add(image.path, move).addCallback(set_path)
+
+    def _references(self, manager, library):
+        references = set(library)
+        # the cache is private, this runs in a thread
+        cache = imageinfo.ImageCache()
+        for prj in manager:
+            try:
+                images = prj.get_descriptor().get_images()
+                references.update(section.get("path", "")
+                                  for _, section in images)
+                # the COWs refer to the images even if the images were
+                # removed from the library
+                cache.index(fp.path for fp in prj.files()
+                            if fp.path.endswith(".cow"))
+            except EnvironmentError:
+                logger.warn(project_unreadable, name=prj.name)
+                return None
+        for obj in self.list():
+            if cache.dependents(obj):
+                references.add(obj)
+        return references
+
+    def list(self):
+        """Return the paths of all the images in the store."""
+
+        try:
+            names = os.listdir(self.objects)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return []
+            raise
+        return sorted(self.object_path(name) for name in names
+                      if not name.startswith("."))
+
+    def collect(self, manager=None, factory=None):
+        """
+        Remove, in a thread, the images that are not used by any project.
+        The images of the library of C{factory}, if given, are used too.
+
+        @return: a deferred that fires with the list of the removed images.
+        """
+
+        if manager is None:
+            manager = project.manager
+        library = []
+        if factory is not None:
+            library = [image.path for image in factory.disk_images]
+        return threads.deferToThread(self._collect, list(manager), library)
+
+    def _collect(self, projects, library):
+        references = self._references(projects, library)
+        if references is None:
+            return []
+        removed = []
+        for path in self.list():
+            if path not in references:
+                with _pin_lock:
+                    if _pinned[path]:
+                        continue
+                    logger.info(image_collected,
+                                digest=os.path.basename(path))
+                    os.remove(path)
+                removed.append(path)
+        return removed
+
+
+def is_enabled():
+    return settings.get("imagestore")
+
+
+def get_store():
+    """Return the store of the current workspace."""
+
+    return ImageStore(os.path.join(settings.get("workspace"), ".imagestore"))
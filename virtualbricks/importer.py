@@ -0,0 +1,358 @@
+# -*- test-case-name: virtualbricks.tests.test_importer -*-
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2018 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Staged import of the projects.
+
+A project is imported in three stages: the archive is extracted in a
+staging project, the images are moved to their destination and the COWs
+are rebased on the new paths of their images. The stages overlap: the
+images are moved as soon as they are extracted, if their destination is
+already known, and the COWs of an image are rebased as soon as the image is
+in place. At most C{concurrency} moves and C{concurrency} rebases run at
+the same time.
+
+The staging project of an archive has always the same name, so that an
+interrupted import can be resumed, see L{virtualbricks.archive}. The images
+already moved are recorded in the staging project and they are not
+extracted again.
+"""
+
+import os
+import errno
+import hashlib
+
+from twisted.internet import defer, threads, utils, error
+
+from virtualbricks import settings, log, imageinfo, project, copier
+from virtualbricks import archive as vbarchive
+
+
+__all__ = ["ImportPipeline", "relocate", "staging_name", "extract",
+           "import_archive"]
+
+logger = log.Logger()
+move_image = log.Event("Moving image {name} to {destination}")
+rebase_cow = log.Event("Rebasing {cow} to {basefile}")
+rebase_error = log.Event("Error on rebase")
+rollback_error = log.Event("Cannot move back {source} to {destination}")
+image_not_exists = log.Event("Cannot save image to {destination}, file does "
+                             "not exists: {source}")
+
+
+def _complain_on_error(result):
+    out, err, code = result
+    if code != 0:
+        logger.warn(err)
+        raise error.ProcessTerminated(code)
+    return result
+
+
+def relocate(source, destination):
+    """
+    Move a file. If the destination is on another file system, the file is
+    copied in a temporary file that is renamed only when it is complete.
+    """
+
+    try:
+        os.makedirs(os.path.dirname(destination))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    try:
+        os.rename(source, destination)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    tmp = destination + ".part"
+    try:
+        copier.copy_file(source, tmp)
+        if os.path.getsize(tmp) != os.path.getsize(source):
+            raise IOError(errno.EIO, "Incomplete copy of {0}".format(source))
+        os.rename(tmp, destination)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    os.remove(source)
+
+
+def staging_name(archive):
+    """Return the name of the staging project of an archive."""
+
+    digest = hashlib.sha1(os.path.abspath(archive).encode("utf-8"))
+    return ".import-" + digest.hexdigest()[:16]
+
+
+def extract(name, archive, manager=None, on_file=None):
+    """
+    Extract an archive in the staging project C{name}. If the extraction
+    was interrupted, it is resumed, if the staging project was left by
+    another import, it is replaced.
+
+    @return: a deferred that fires with the staging project.
+    """
+
+    if manager is None:
+        manager = project.manager
+    staging = manager.get_project(name)
+    if staging.exists() and not vbarchive.can_resume(staging.path):
+        staging.delete()
+    return manager.import_prj(name, archive, resume=True, on_file=on_file)
+
+
+class ImportPipeline:
+    """
+    Move the images of an extracted project and rebase its COWs.
+
+    @param entry: the descriptor of the project. If C{None}, the images are
+        moved but not remapped and the COWs are rebased only when the
+        descriptor is given with L{set_entry}.
+    @param store: if not C{None}, the images are moved in this
+        L{virtualbricks.imagestore.ImageStore} instead of their destination.
+        The images are pinned in the store until L{release} is called.
+    @param on_moved: if not C{None}, called with the name, the new path and
+        the checksum of every image moved.
+    """
+
+    def __init__(self, project, entry=None, concurrency=None, store=None,
+                 run=utils.getProcessOutputAndValue, on_moved=None):
+        if concurrency is None:
+            concurrency = int(settings.get("concurrency"))
+        self.project = project
+        self.entry = entry
+        self.store = store
+        self.run = run
+        self.on_moved = on_moved
+        self.images = {}
+        self._moves = defer.DeferredSemaphore(concurrency)
+        self._rebases = defer.DeferredSemaphore(concurrency)
+        self._deferreds = []
+        self._moved = []
+        self._pinned = []
+        self._rebased = set()
+        self._failure = None
+
+    def source(self, name):
+        return os.path.join(self.project.path, ".images", name)
+
+    def move(self, name, destination, checksum=None):
+        """
+        Move the extracted image C{name} to C{destination} and rebase its
+        COWs.
+
+        @param checksum: the checksum of the image in the archive, the image
+            is not hashed if the store has already an image with the same
+            checksum.
+        """
+
+        source = self.source(name)
+        if not os.path.exists(source):
+            logger.error(image_not_exists, source=source,
+                         destination=destination)
+            return
+        logger.debug(move_image, name=name, destination=destination)
+        if self.store is not None:
+            d = self._moves.run(self.store.add, source, move=True,
+                                checksum=checksum, pin=True)
+        else:
+            d = self._moves.run(threads.deferToThread, relocate, source,
+                                destination)
+            d.addCallback(lambda _: destination)
+        d.addCallback(self._moved_cb, name, source)
+        if self.on_moved is not None:
+            d.addCallback(lambda path: self.on_moved(name, path, checksum))
+        self._deferreds.append(d)
+
+    def _moved_cb(self, destination, name, source):
+        if self.store is None:
+            self._moved.append((source, destination))
+        else:
+            self._pinned.append(destination)
+        self.place(name, destination)
+        return destination
+
+    def adopt(self, name, path):
+        """
+        The image C{name} was already moved in C{path} by an interrupted
+        import, rebase its COWs.
+        """
+
+        if self.store is not None:
+            self.store.pin(path)
+        self._moved_cb(path, name, self.source(name))
+
+    def place(self, name, path):
+        """The image C{name} is in C{path}, rebase its COWs."""
+
+        self.images[name] = path
+        if self.entry is not None:
+            self.entry.remap_image(name, path)
+            self._rebase_cows(name, path)
+
+    def set_entry(self, entry):
+        """Set the descriptor of the project and rebase the COWs."""
+
+        self.entry = entry
+        for name, path in list(self.images.items()):
+            self.place(name, path)
+
+    def _rebase_cows(self, name, path):
+        for vmname, dev in self.entry.device_for_image(name):
+            cow = os.path.join(self.project.path,
+                               "{0}_{1}.cow".format(vmname, dev))
+            if cow in self._rebased or not os.path.exists(cow):
+                continue
+            self._rebased.add(cow)
+            if not self._backed_by(cow, path):
+                logger.debug(rebase_cow, cow=cow, basefile=path)
+                d = self._rebases.run(self.rebase, path, cow)
+                d.addErrback(logger.failure_eb, rebase_error)
+                self._deferreds.append(d)
+
+    def _backed_by(self, cow, backing_file):
+        try:
+            return imageinfo.cache.get(cow).backing_file == backing_file
+        except (OSError, IOError):
+            return False
+
+    def rebase(self, backing_file, cow):
+        args = ["rebase", "-u", "-b", backing_file, cow]
+        d = self.run("qemu-img", args, os.environ)
+        d.addCallback(_complain_on_error)
+        d.addCallback(lambda _: imageinfo.cache.invalidate(cow))
+        return d
+
+    def wait(self):
+        """
+        Wait for the moves and the rebases started, included the ones
+        started while waiting.
+
+        @return: a deferred that fires with a dict of the images and their
+            new paths or fails with the first error of the moves.
+        """
+
+        deferreds, self._deferreds = self._deferreds, []
+        d = defer.DeferredList(deferreds, consumeErrors=True)
+        return d.addCallback(self._check)
+
+    def _check(self, results):
+        for success, result in results:
+            if not success and self._failure is None:
+                self._failure = result
+        if self._deferreds:
+            return self.wait()
+        if self._failure is not None:
+            return self._failure
+        return self.images
+
+    def rollback(self):
+        """Move back the images moved to their destination."""
+
+        moved, self._moved = self._moved, []
+        dl = []
+        for source, destination in moved:
+            d = threads.deferToThread(relocate, destination, source)
+            d.addErrback(logger.failure_eb, rollback_error, source=destination,
+                         destination=source)
+            dl.append(d)
+        return defer.DeferredList(dl)
+
+    def release(self):
+        """
+        Unpin the images moved in the store. Call it when the project is
+        saved or the import failed.
+        """
+
+        pinned, self._pinned = self._pinned, []
+        for path in pinned:
+            self.store.unpin(path)
+
+
+def _default_destination(name):
+    vimages = os.path.join(settings.get("workspace"), "vimages")
+    path = os.path.join(vimages, name)
+    root, ext = os.path.splitext(path)
+    count = 1
+    while os.path.exists(path):
+        path = "{0}.{1}{2}".format(root, count, ext)
+        count += 1
+    return path
+
+
+def import_archive(archive, name, overwrite=False, destination=None,
+                   manager=None, concurrency=None, store=None):
+    """
+    Import a project without user interaction. Every image is moved as
+    soon as it is extracted.
+
+    @param destination: a function that returns the destination of an
+        image given its name, by default the images are moved in the
+        C{vimages} directory of the workspace.
+    @return: a deferred that fires with the project.
+    """
+
+    if manager is None:
+        manager = project.manager
+    if destination is None:
+        destination = _default_destination
+    staging = manager.get_project(staging_name(archive))
+
+    def on_moved(name, path, checksum):
+        # an interrupted import does not extract the image again
+        vbarchive.record_moved(staging.path, archive,
+                               os.path.join(".images", name), path, checksum)
+
+    pipeline = ImportPipeline(staging, concurrency=concurrency, store=store,
+                              on_moved=on_moved)
+
+    def on_file(arcname, path, checksum):
+        dirname, basename = os.path.split(arcname)
+        if dirname == ".images":
+            if path != pipeline.source(basename):
+                pipeline.adopt(basename, path)
+            else:
+                pipeline.move(basename, destination(basename), checksum)
+
+    def extracted(prj):
+        entry = prj.get_descriptor()
+        pipeline.set_entry(entry)
+        return pipeline.wait().addCallback(save, prj, entry)
+
+    def save(images, prj, entry):
+        entry.save(prj)
+        vbarchive.clear_moved(prj.path)
+        prj.rename(name, overwrite)
+        return prj
+
+    def rollback(fail):
+        d = pipeline.wait()
+        d.addBoth(lambda _: pipeline.rollback())
+        d.addCallback(lambda _: fail)
+        return d
+
+    def release(result):
+        pipeline.release()
+        return result
+
+    d = extract(staging.name, archive, manager, on_file)
+    d.addCallback(extracted)
+    d.addErrback(rollback)
+    d.addBoth(release)
+    return d
@@ -0,0 +1,667 @@
+# -*- test-case-name: virtualbricks.tests.test_lab -*-
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2018 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Operations on all the bricks of a project.
+
+A lab is hibernated saving the state of every running virtual machine in a
+file and stopping all the bricks, it is resumed restarting the bricks and
+restoring the virtual machines from their state without booting the guests
+again. The states and the list of the running bricks are kept in the
+C{.hibernate} directory of the project.
+
+A checkpoint records the content of all the private COWs of the project,
+the lab can be reset to a checkpoint at any time while the virtual machines
+are powered off. Checkpoints are described in the C{.checkpoints} directory
+of the project.
+
+A clone is a new project whose private COWs are overlays of the COWs of
+another project, see L{clone}.
+"""
+
+import os
+import stat
+import errno
+import shutil
+
+from twisted.internet import defer, utils, error
+
+from virtualbricks import settings, log, errors, imageinfo, copier, project
+from virtualbricks._spawn import getQemuOutputAndValue
+from virtualbricks.virtualmachines import is_virtualmachine, scratch_folder
+
+
+__all__ = ["hibernate", "resume", "is_hibernated", "checkpoint", "reset",
+           "checkpoints", "remove_checkpoint", "clone", "clones", "flatten",
+           "thaw"]
+
+logger = log.Logger()
+hibernate_lab = log.Event("Hibernating {count} virtual machines")
+resume_lab = log.Event("Resuming {count} bricks")
+save_failed = log.Event("Cannot save the state of {vm}")
+restore_failed = log.Event("Cannot restore the state of {vm}, booting it")
+start_failed = log.Event("Cannot start {brick}")
+stop_failed = log.Event("Cannot stop {brick}")
+lab_not_stopped = log.Event("The state of some virtual machines was not "
+                            "saved, the lab is left running")
+create_checkpoint = log.Event("Creating checkpoint {name} of {count} disks")
+reset_checkpoint = log.Event("Resetting {count} disks to checkpoint {name}")
+remove_checkpoint_error = log.Event("Cannot remove the incomplete checkpoint "
+                                    "{name}")
+disk_error = log.Event("Error on {path}:\n{err}")
+clone_lab = log.Event("Cloning {count} disks of {source} in {name}")
+flatten_lab = log.Event("Flattening {count} disks")
+
+STATE_DIR = ".hibernate"
+MANIFEST = "running"
+CHECKPOINTS_DIR = ".checkpoints"
+DISKS = "disks"
+QCOW2_MAGIC = b"QFI\xfb"
+
+
+def _concurrency(concurrency):
+    if concurrency is None:
+        return int(settings.get("concurrency"))
+    return concurrency
+
+
+def state_dir(path):
+    return os.path.join(path, STATE_DIR)
+
+
+def state_path(path, vm):
+    return os.path.join(state_dir(path), vm.name + ".state")
+
+
+def is_hibernated(path):
+    return os.path.exists(os.path.join(state_dir(path), MANIFEST))
+
+
+def _write_manifest(path, bricks):
+    with open(os.path.join(state_dir(path), MANIFEST), "w") as fp:
+        for brick in bricks:
+            fp.write(brick.name + "\n")
+
+
+def _read_manifest(path):
+    try:
+        with open(os.path.join(state_dir(path), MANIFEST)) as fp:
+            return [line.strip() for line in fp if line.strip()]
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return []
+        raise
+
+
+def _remove(filename):
+    try:
+        os.remove(filename)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _can_save(brick):
+    # with -snapshot the disks are discarded at exit, their state too
+    return is_virtualmachine(brick) and not brick.config["snapshot"]
+
+
+def hibernate(factory, path, concurrency=None):
+    """
+    Save the state of all the running virtual machines and stop the lab.
+
+    At most C{concurrency} states are saved at the same time. If the state of
+    a virtual machine cannot be saved, the virtual machine and the rest of
+    the lab are left running, the virtual machines saved can be restored
+    anyway with L{resume}.
+
+    @param path: the path of the project.
+    @return: a deferred that fires with the list of the virtual machines
+        saved.
+    """
+
+    running = [brick for brick in factory.bricks if brick.proc is not None]
+    vms = [brick for brick in running if _can_save(brick)]
+    if not os.path.isdir(state_dir(path)):
+        os.makedirs(state_dir(path))
+    _write_manifest(path, running)
+    logger.info(hibernate_lab, count=len(vms))
+    semaphore = defer.DeferredSemaphore(_concurrency(concurrency))
+
+    def save(vm):
+        d = vm.wait_qmp()
+        d.addCallback(lambda _: vm.save_state(state_path(path, vm)))
+        return d
+
+    def saved(results):
+        failed = False
+        for vm, (success, value) in zip(vms, results):
+            if not success:
+                failed = True
+                logger.failure(save_failed, value, vm=vm.name)
+                _remove(state_path(path, vm))
+        if failed:
+            logger.warn(lab_not_stopped)
+            return [vm for vm in vms if vm.proc is None]
+        return stop_all(factory).addCallback(lambda _: vms)
+
+    d = defer.DeferredList([semaphore.run(save, vm) for vm in vms],
+                           consumeErrors=True)
+    d.addCallback(saved)
+    return d
+
+
+def stop_all(factory):
+    """Power off all the running bricks."""
+
+    deferreds = []
+    for brick in factory.bricks:
+        if brick.proc is not None:
+            d = brick.poweroff()
+            d.addErrback(logger.failure_eb, stop_failed, brick=brick.name)
+            deferreds.append(d)
+    return defer.DeferredList(deferreds)
+
+
+def resume(factory, path, concurrency=None):
+    """
+    Restart the bricks of a hibernated lab.
+
+    The bricks without a saved state, switches, wires and the like, are
+    started first, each brick starts the bricks it is connected to. Then the
+    virtual machines are restored, at most C{concurrency} at the same time.
+    A virtual machine whose state cannot be restored is booted.
+
+    @param path: the path of the project.
+    @return: a deferred that fires with the list of the bricks started.
+    """
+
+    bricks = [factory.get_brick_by_name(name) for name in
+              _read_manifest(path)]
+    bricks = [brick for brick in bricks if brick is not None]
+    vms = [brick for brick in bricks
+           if _can_save(brick) and os.path.exists(state_path(path, brick))]
+    others = [brick for brick in bricks if brick not in vms]
+    logger.info(resume_lab, count=len(bricks))
+    semaphore = defer.DeferredSemaphore(_concurrency(concurrency))
+
+    def start(brick):
+        d = brick.poweron()
+        d.addErrback(logger.failure_eb, start_failed, brick=brick.name)
+        return d
+
+    def boot(failure, vm):
+        logger.failure(restore_failed, failure, vm=vm.name)
+        return start(vm)
+
+    def remove_state(passthru, vm):
+        # a state is valid only once, the disks change after the restore
+        _remove(state_path(path, vm))
+        return passthru
+
+    def restore(vm):
+        d = vm.restore_state(state_path(path, vm))
+        d.addErrback(boot, vm)
+        d.addBoth(remove_state, vm)
+        return d
+
+    def restore_vms(_):
+        return defer.DeferredList([semaphore.run(restore, vm) for vm in vms])
+
+    def done(_):
+        _remove(os.path.join(state_dir(path), MANIFEST))
+        return bricks
+
+    d = defer.DeferredList([start(brick) for brick in others])
+    d.addCallback(restore_vms)
+    d.addCallback(done)
+    return d
+
+
+# Checkpoints
+#
+# A COW in qcow2 format is saved with an internal snapshot, any other format
+# is copied next to the description of the checkpoint, sharing the blocks if
+# the file system supports reflinks. A COW that does not exist is recorded
+# too: resetting the checkpoint removes it and the virtual machine creates a
+# new one, empty, at the next boot.
+
+SNAPSHOT, COPY, ABSENT = "snapshot", "copy", "absent"
+
+
+def checkpoint_dir(path, name):
+    if not name or name != os.path.basename(name) or name.startswith("."):
+        raise errors.InvalidNameError(name)
+    return os.path.join(path, CHECKPOINTS_DIR, name)
+
+
+def _check_not_frozen(path):
+    # the COWs of a frozen project are the backing files of its clones
+    if project.is_frozen(path):
+        raise errors.ProjectFrozenError(os.path.basename(path))
+
+
+def checkpoints(path):
+    """Return the names of the checkpoints of the project."""
+
+    try:
+        names = os.listdir(os.path.join(path, CHECKPOINTS_DIR))
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return []
+        raise
+    return sorted(name for name in names if os.path.exists(
+        os.path.join(path, CHECKPOINTS_DIR, name, DISKS)))
+
+
+def _private_cows(factory):
+    cows = []
+    for brick in factory.bricks:
+        if is_virtualmachine(brick):
+            for disk in brick.disks():
+                if disk.image is not None and disk.cow:
+                    if brick.proc is not None:
+                        raise errors.BrickRunningError(brick.name)
+                    cows.append(disk.get_cow_path())
+    return cows
+
+
+def _is_qcow2(filename):
+    with open(filename, "rb") as fp:
+        return fp.read(len(QCOW2_MAGIC)) == QCOW2_MAGIC
+
+
+def _check_exit(result, filename):
+    out, err, code = result
+    if code != 0:
+        logger.error(disk_error, path=filename, err=err)
+        raise error.ProcessTerminated(code)
+
+
+def _qemu_img(args, filename):
+    d = getQemuOutputAndValue("qemu-img", args, os.environ)
+    return d.addCallback(_check_exit, filename)
+
+
+def _copy(source, destination):
+    args = ["--reflink=auto", "--sparse=always", source, destination]
+    d = utils.getProcessOutputAndValue("cp", args, os.environ)
+    return d.addCallback(_check_exit, destination)
+
+
+def _copy_name(directory, filename):
+    return os.path.join(directory, os.path.basename(filename))
+
+
+def _run_all(function, items, concurrency):
+    """
+    Call C{function} on every item, at most C{concurrency} at the same time.
+    Fail with the first error after all the calls are finished.
+    """
+
+    semaphore = defer.DeferredSemaphore(_concurrency(concurrency))
+
+    def check(results):
+        for success, value in results:
+            if not success:
+                return value
+        return [value for _, value in results]
+
+    d = defer.DeferredList([semaphore.run(function, *item) for item in items],
+                           consumeErrors=True)
+    return d.addCallback(check)
+
+
+def checkpoint(factory, path, name, concurrency=None):
+    """
+    Create the checkpoint C{name} of all the private COWs of the project. The
+    virtual machines that use them must be powered off. If a disk cannot be
+    saved, the disks already saved are removed from the checkpoint and the
+    checkpoint is removed. The checkpoints of a frozen project cannot be
+    changed, the deferred fails with L{errors.ProjectFrozenError}.
+
+    @param path: the path of the project.
+    @return: a deferred that fires with the number of disks saved.
+    """
+
+    directory = checkpoint_dir(path, name)
+    if os.path.exists(directory):
+        return defer.fail(errors.NameAlreadyInUseError(name))
+    try:
+        _check_not_frozen(path)
+        cows = _private_cows(factory)
+    except (errors.BrickRunningError, errors.ProjectFrozenError):
+        return defer.fail()
+    os.makedirs(directory)
+    logger.info(create_checkpoint, name=name, count=len(cows))
+
+    def save(cow):
+        if not os.path.exists(cow):
+            return defer.succeed((ABSENT, cow))
+        elif _is_qcow2(cow):
+            d = _qemu_img(["snapshot", "-c", name, cow], cow)
+            return d.addCallback(lambda _: (SNAPSHOT, cow))
+        else:
+            d = _copy(cow, _copy_name(directory, cow))
+            return d.addCallback(lambda _: (COPY, cow))
+
+    saved = []
+
+    def saved_cb(disk):
+        saved.append(disk)
+        return disk
+
+    def save_cow(cow):
+        return save(cow).addCallback(saved_cb)
+
+    def write_disks(disks):
+        # the checkpoint exists only if all the disks are saved
+        with open(os.path.join(directory, DISKS), "w") as fp:
+            for method, cow in disks:
+                fp.write("{0} {1}\n".format(method, _disk_name(path, cow)))
+        return len(disks)
+
+    def rollback(fail):
+        write_disks(saved)
+        d = remove_checkpoint(path, name, concurrency)
+        d.addErrback(logger.failure_eb, remove_checkpoint_error, name=name)
+        return d.addCallback(lambda _: fail)
+
+    d = _run_all(save_cow, [(cow, ) for cow in cows], concurrency)
+    d.addCallbacks(write_disks, rollback)
+    return d
+
+
+def _disk_name(path, cow):
+    # the COWs in the project are recorded by name, the checkpoints are
+    # copied with the project and must refer to the COWs of the copy
+    if os.path.dirname(os.path.abspath(cow)) == os.path.abspath(path):
+        return os.path.basename(cow)
+    return cow
+
+
+def _is_own_scratch(path, cow):
+    # the scratch folders are named after the path of the project, the
+    # disks of the checkpoints copied from another project are skipped
+    folder = os.path.basename(scratch_folder("", os.path.abspath(path)))
+    return os.path.basename(os.path.dirname(cow)) == folder
+
+
+def _read_disks(path, directory):
+    disks = []
+    with open(os.path.join(directory, DISKS)) as fp:
+        for line in fp:
+            if line.strip():
+                method, cow = line.rstrip("\n").split(" ", 1)
+                if os.path.isabs(cow) and not _is_own_scratch(path, cow):
+                    continue
+                disks.append((method, os.path.join(path, cow)))
+    return disks
+
+
+def reset(factory, path, name, concurrency=None):
+    """
+    Revert all the private COWs recorded in the checkpoint C{name}. The
+    virtual machines that use them must be powered off and the project must
+    not be frozen.
+
+    @param path: the path of the project.
+    @return: a deferred that fires with the number of disks reverted.
+    """
+
+    directory = checkpoint_dir(path, name)
+    try:
+        _check_not_frozen(path)
+        _private_cows(factory)
+        disks = _read_disks(path, directory)
+    except (errors.BrickRunningError, errors.ProjectFrozenError):
+        return defer.fail()
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return defer.fail(errors.InvalidNameError(name))
+        raise
+    logger.info(reset_checkpoint, name=name, count=len(disks))
+
+    def revert(method, cow):
+        if method == SNAPSHOT:
+            return _qemu_img(["snapshot", "-a", name, cow], cow)
+        elif method == COPY:
+            return _copy(_copy_name(directory, cow), cow)
+        else:
+            _remove(cow)
+            return defer.succeed(None)
+
+    d = _run_all(revert, disks, concurrency)
+    d.addCallback(len)
+    return d
+
+
+def remove_checkpoint(path, name, concurrency=None):
+    """
+    Remove the checkpoint C{name} and the internal snapshots of the disks.
+    The project must not be frozen.
+
+    @param path: the path of the project.
+    @return: a deferred that fires when the checkpoint is removed.
+    """
+
+    directory = checkpoint_dir(path, name)
+    try:
+        _check_not_frozen(path)
+        disks = _read_disks(path, directory)
+    except errors.ProjectFrozenError:
+        return defer.fail()
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return defer.fail(errors.InvalidNameError(name))
+        raise
+
+    def delete(method, cow):
+        if method == SNAPSHOT and os.path.exists(cow):
+            d = _qemu_img(["snapshot", "-d", name, cow], cow)
+            # a missing snapshot must not keep the checkpoint alive
+            return d.addErrback(lambda _: None)
+        return defer.succeed(None)
+
+    d = _run_all(delete, disks, concurrency)
+    d.addCallback(lambda _: shutil.rmtree(directory))
+    return d
+
+
+# Clones
+#
+# The private COWs of a clone are empty qcow2 overlays backed by the COWs of
+# the original project, so a clone is created in the same time whatever the
+# size of the COWs. The original project is frozen: its COWs are made
+# read-only and its virtual machines do not start, any change would corrupt
+# the clones. The clones are listed in the project.FROZEN file of the
+# original. A clone is flattened copying in its COWs the data of the
+# original ones, the COWs are rebased on the images of the virtual machines
+# and the clone does not depend anymore on the original project.
+
+def clones(path):
+    """Return the paths of the clones of the project in C{path}."""
+
+    try:
+        with open(os.path.join(path, project.FROZEN)) as fp:
+            return [line.rstrip("\n") for line in fp if line.strip()]
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return []
+        raise
+
+
+def _write_clones(path, paths):
+    with open(os.path.join(path, project.FROZEN), "w") as fp:
+        for clone_path in paths:
+            fp.write(clone_path + "\n")
+
+
+def _set_writable(filename, writable):
+    mode = stat.S_IMODE(os.stat(filename).st_mode)
+    if writable:
+        mode |= stat.S_IWUSR
+    else:
+        mode &= ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+    os.chmod(filename, mode)
+
+
+def _project_cows(path):
+    return [os.path.join(path, name) for name in sorted(os.listdir(path))
+            if name.endswith(".cow")]
+
+
+def _overlay(cow, directory):
+    fmt = imageinfo.cache.get(cow).format.name.lower()
+    target = _copy_name(directory, cow)
+    args = ["create", "-f", "qcow2", "-F", fmt, "-b", os.path.abspath(cow),
+            target]
+    return _qemu_img(args, target)
+
+
+def clone(factory, prj, name, concurrency=None, manager=None):
+    """
+    Create the project C{name} as a clone of C{prj}, the current project,
+    and freeze C{prj}. The files of the project are copied but the private
+    COWs, the new COWs are created, at most C{concurrency} at the same time,
+    as overlays of the COWs of C{prj}. The virtual machines must be powered
+    off.
+
+    @type prj: L{virtualbricks.project.Project}
+    @return: a deferred that fires with the new project.
+    """
+
+    if manager is None:
+        manager = project.manager
+    try:
+        cows = [cow for cow in _private_cows(factory) if os.path.exists(cow)]
+        new = manager.get_project(name)
+        new.create()
+    except (errors.BrickRunningError, errors.ProjectExistsError):
+        return defer.fail()
+    prj.save(factory)
+    logger.info(clone_lab, count=len(cows), source=prj.name, name=name)
+    skip = set(os.path.basename(cow) for cow in cows)
+
+    def ignore(path):
+        # the checkpoints are internal snapshots of the original COWs
+        return (path in skip or path in (project.FROZEN, CHECKPOINTS_DIR) or
+                ".cow.back-" in path)
+
+    def freeze(_):
+        _write_clones(prj.path, clones(prj.path) + [new.path])
+        for cow in cows:
+            _set_writable(cow, False)
+        return _run_all(_overlay, [(cow, new.path) for cow in cows],
+                        concurrency)
+
+    def failed(fail):
+        new.delete()
+        others = [path for path in clones(prj.path) if path != new.path]
+        if others:
+            _write_clones(prj.path, others)
+        elif project.is_frozen(prj.path):
+            thaw(prj.path)
+        return fail
+
+    d = copier.copy_tree(prj.path, new.path, concurrency=concurrency,
+                         ignore=ignore)
+    d.addCallback(freeze)
+    d.addCallbacks(lambda _: new, failed)
+    return d
+
+
+def _flat_base(cow):
+    # the first image of the chain that is not in a frozen project
+    for path in imageinfo.cache.chain(cow)[1:]:
+        if not project.is_frozen(os.path.dirname(path)):
+            return path
+    return None
+
+
+def flatten(factory, path, concurrency=None):
+    """
+    Make the clone in C{path} independent of the original project. The data
+    of the original COWs is copied in the COWs of the clone, at most
+    C{concurrency} at the same time, and the COWs are rebased on the images
+    of the virtual machines. The virtual machines must be powered off.
+
+    The original project is still frozen, see L{thaw}.
+
+    @return: a deferred that fires with the number of disks flattened.
+    """
+
+    try:
+        _private_cows(factory)
+    except errors.BrickRunningError:
+        return defer.fail()
+    cows = []
+    for cow in _project_cows(path):
+        backing = imageinfo.cache.get(cow).backing_path
+        if backing and project.is_frozen(os.path.dirname(backing)):
+            cows.append(cow)
+    logger.info(flatten_lab, count=len(cows))
+
+    def rebase(cow):
+        base = _flat_base(cow)
+        if base is None:
+            # the original COW had not a backing file
+            args = ["rebase", "-f", "qcow2", "-b", "", cow]
+        else:
+            fmt = imageinfo.cache.get(base).format.name.lower()
+            args = ["rebase", "-f", "qcow2", "-b", base, "-F", fmt, cow]
+        d = _qemu_img(args, cow)
+        d.addCallback(lambda _: imageinfo.cache.invalidate(cow))
+        return d
+
+    d = _run_all(rebase, [(cow, ) for cow in cows], concurrency)
+    d.addCallback(len)
+    return d
+
+
+def _depends_on(clone_path, path):
+    path = os.path.abspath(path)
+    try:
+        cows = _project_cows(clone_path)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return False
+        raise
+    for cow in cows:
+        for image in imageinfo.cache.chain(cow)[1:]:
+            if os.path.dirname(image) == path:
+                return True
+    return False
+
+
+def thaw(path):
+    """
+    Make the COWs of the project in C{path} writable again. The clones must
+    be flattened or removed before.
+
+    @raise ProjectFrozenError: if some clones still depend on the project.
+    """
+
+    dependents = [clone_path for clone_path in clones(path)
+                  if _depends_on(clone_path, path)]
+    if dependents:
+        raise errors.ProjectFrozenError(", ".join(
+            os.path.basename(clone_path) for clone_path in dependents))
+    for cow in _project_cows(path):
+        _set_writable(cow, True)
+    _remove(os.path.join(path, project.FROZEN))
@@ -17,6 +17,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import os
+import stat
 import errno
 import itertools
 import re
@@ -26,7 +27,8 @@ from twisted.internet import utils, error, defer
 from twisted.python import filepath
 
 from virtualbricks import (settings, configfile, log, errors, _configparser,
-                           tools)
+                           copier)
+from virtualbricks import archive as vbarchive
 
 
 logger = log.Logger()
@@ -49,6 +51,29 @@ include_images = log.Event("Including the following images to the project: "
 save_images = log.Event("Move virtual machine's images")
 DEFAULT_PROJECT_RE = re.compile(r"^{0}(?:_\d+)?$".format(
     settings.DEFAULT_PROJECT))
+# the clones of a frozen project, see virtualbricks.lab.clone
+FROZEN = ".frozen"
+# the default placement of the private COWs, see virtualbricks.virtualmachines
+COW_PLACE = ".cowplace"
+
+
+def is_frozen(path):
+    """
+    Return C{True} if the project in C{path} is the base of some clones, its
+    private COWs must not be changed.
+    """
+
+    return os.path.exists(os.path.join(path, FROZEN))
+
+
+def _make_cows_writable(path):
+    # the COWs of a frozen project are read-only, the ones of its copies are
+    # not frozen
+    for name in os.listdir(path):
+        if name.endswith(".cow"):
+            filename = os.path.join(path, name)
+            mode = stat.S_IMODE(os.stat(filename).st_mode)
+            os.chmod(filename, mode | stat.S_IWUSR)
 
 
 def _complain_on_error(result):
@@ -103,6 +128,23 @@ class BsdTgz(Tgz):
     exe_c = exe_x = "bsdtar"
 
 
+class StreamTgz(BsdTgz):
+    """
+    Create and extract the archives without external processes, the images
+    are compressed in parallel and their holes are not stored.
+    """
+
+    def create(self, pathname, files, images=(), sparse=True, progress=None):
+        logger.info(create_archive, path=pathname)
+        if images:
+            logger.info(include_images, images=images)
+        return vbarchive.create(pathname, files, images, sparse, progress)
+
+    def extract(self, pathname, destination, on_file=None):
+        logger.info(extract_archive, path=destination)
+        return vbarchive.extract(pathname, destination, on_file)
+
+
 class ProjectEntry:
 
     def __init__(self, sections, links):
@@ -178,7 +220,7 @@ class ProjectEntry:
             fileobj.write("{0}\n".format("|".join(link)))
 
     def save(self, project):
-        with project._project.open("w") as fp:
+        with open(project._project.path, "w") as fp:
             self.dump(fp)
 
 
@@ -193,6 +235,7 @@ class Project:
 
     _description = None
     _description_modified = False
+    _cow_place = None
 
     def __init__(self, path, manager):
         if isinstance(path, six.string_types):
@@ -294,16 +337,34 @@ class Project:
             self._path.child("README").setContent((self._description).encode("utf-8"))
             self._description_modified = False
 
-    def save_as(self, name, factory):
+    def save_as(self, name, factory, progress=None):
+        """
+        Save the project and copy it with a new name.
+
+        @param progress: if not C{None}, called with the bytes copied and the
+            total.
+        @return: a deferred that fires with the new project.
+        """
+
         if name == self.name:
-            return
+            return defer.succeed(None)
         self.save(factory)
         prj = self._manager.get_project(name)
         prj.create()
         dst = filepath.FilePath(prj.path)
         dst.remove()
-        tools.copyTo(self._path, dst)
-        return prj
+        # the copy is not the base of the clones of this project
+        d = copier.copy_tree(self.path, prj.path, progress,
+                             ignore=lambda path: path == FROZEN)
+        if is_frozen(self.path):
+            d.addCallback(lambda _: _make_cows_writable(prj.path))
+
+        def remove(fail):
+            prj.delete()
+            return fail
+
+        d.addCallbacks(lambda _: prj, remove)
+        return d
 
     copy = save_as
 
@@ -335,11 +396,32 @@ class Project:
         self._description = text
         self._description_modified = True
 
+    def get_cow_place(self):
+        """
+        Return the default placement of the private COWs of the virtual
+        machines of the project or an empty string if the COWs are in the
+        project directory.
+        """
+
+        if self._cow_place is None:
+            try:
+                content = self._path.child(COW_PLACE).getContent()
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                content = b""
+            self._cow_place = content.decode("utf-8").strip()
+        return self._cow_place
+
+    def set_cow_place(self, place):
+        self._path.child(COW_PLACE).setContent(place.encode("utf-8"))
+        self._cow_place = place
+
     def files(self):
         return (fp for fp in self._path.walk() if fp.isfile())
 
     def get_descriptor(self):
-        with self._project.open() as fp:
+        with open(self._project.path) as fp:
             return ProjectEntry.from_fileobj(fp)
 
     def images(self):
@@ -367,7 +449,7 @@ class Project:
 
 class ProjectManager:
 
-    archive = BsdTgz()
+    archive = StreamTgz()
     current = None
     project_factory = Project
 
@@ -394,21 +476,52 @@ class ProjectManager:
 
     def __iter__(self):
         for path in self._path.children():
-            if path.child(".project").isfile():
+            # the hidden directories are the projects being imported
+            if (not path.basename().startswith(".") and
+                    path.child(".project").isfile()):
                 yield self.project_factory(path, self)
 
-    def import_prj(self, name, vbppath):
+    def import_prj(self, name, vbppath, resume=False, on_file=None):
+        """
+        Extract an archive in a new project.
+
+        @param resume: if C{True} and the extraction of the archive in the
+            project was interrupted, continue it instead of failing because
+            the project already exists.
+        @param on_file: called with the name in the archive, the path and
+            the checksum of every file as soon as it is extracted.
+        """
+
         project = self.get_project(name)
         try:
             project.create()
+        except errors.ProjectExistsError as e:
+            if not (resume and vbarchive.can_resume(project.path)):
+                return defer.fail(e)
         except Exception as e:
             return defer.fail(e)
         logger.debug(extract_project)
-        deferred = self.archive.extract(vbppath, project.path)
+        if on_file is None:
+            deferred = self.archive.extract(vbppath, project.path)
+        else:
+            deferred = self.archive.extract(vbppath, project.path,
+                                            on_file=on_file)
         return deferred.addCallback(lambda _: project)
 
-    def export(self, output, files, images=()):
-        return self.archive.create(output, files, images)
+    def export(self, output, files, images=(), sparse=True, progress=None):
+        """
+        Export the current project.
+
+        @param output: the path of the archive, C{"-"} for the standard
+            output or a file-like object.
+        @param sparse: if C{False} the holes of the images are stored as
+            zeros, for the tar programs that do not know the sparse files.
+        @param progress: if not C{None}, called with the bytes written and
+            the total.
+        """
+
+        return self.archive.create(output, files, images, sparse=sparse,
+                                   progress=progress)
 
     def save_current(self, factory):
         if self.current:
@@ -1,3 +1,4 @@
+# -*- test-case-name: virtualbricks.tests.test_qemu -*-
 # Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
 # Copyright (C) 2018 Virtualbricks team
 
@@ -15,14 +16,55 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-from virtualbricks import _qemu
+"""
+Capabilities of the installed qemu.
 
+Every C{qemu-system-*} executable in the C{qemupath} directory is probed
+once with C{-version}, C{-machine help}, C{-cpu help} and C{-device help},
+the executables are probed in parallel. The results are kept in the
+workspace, keyed by the path of the executable and validated with its
+modification time, so an executable is probed again only when it changes.
+Once discovered, the capabilities are served synchronously.
+
+The static specs of L{virtualbricks._qemu} are used for the executables
+that are not discovered.
+"""
+
+import os
+import re
+import json
+import errno
+
+from twisted.internet import defer, utils
+from twisted.python import failure
+
+from virtualbricks import settings, log, _qemu
+
+
+__all__ = ["Capabilities", "CapabilityDatabase", "capabilities",
+           "get_executables", "get_cpus", "get_machines", "get_devices"]
+
+logger = log.Logger()
+probe_error = log.Event("Cannot probe {executable}")
+cache_read_error = log.Event("Cannot read the qemu capabilities from "
+                             "{filename}")
+cache_write_error = log.Event("Cannot save the qemu capabilities in "
+                              "{filename}")
+
+PREFIX = "qemu-system-"
+CACHE_NAME = ".qemu-capabilities.json"
+PROBES = (["-version"], ["-machine", "help"], ["-cpu", "help"],
+          ["-device", "help"])
+# the tags that precede the name of the cpu in the output of -cpu help
+CPU_TAGS = frozenset(["x86", "PowerPC", "Sparc", "s390"])
+DEVICE_RE = re.compile(r'^name "(?P<name>[^"]+)"(?:.*\bdesc "(?P<desc>.*)")?')
 
 _version = None
 
 
 def _get_version():
-    return _version
+    # the specs of the most recent version are better than nothing
+    return _version or _qemu.SUPPORTED_QEMU_VERSIONS[0]
 
 
 def install(version):
@@ -36,27 +78,345 @@ def parse_and_install(string):
     install(supported_version)
 
 
+def parse_machines(output):
+    """Parse the output of C{-machine help}."""
+
+    machines = []
+    for line in output.splitlines():
+        parts = line.split(None, 1)
+        if not parts or line.endswith(":"):
+            continue
+        if len(parts) == 1:
+            parts.append(parts[0])
+        machines.append((parts[0], parts[1].strip()))
+    return machines
+
+
+def parse_cpus(output):
+    """
+    Parse the output of C{-cpu help}. The list ends at the first blank line,
+    the flags of the cpus follow.
+    """
+
+    cpus = []
+    for line in output.splitlines():
+        parts = line.split()
+        if not parts:
+            if cpus:
+                break
+            continue
+        if line.endswith(":"):
+            continue
+        if len(parts) > 1 and parts[0] in CPU_TAGS:
+            del parts[0]
+        name = parts[0].strip("[]'")
+        cpus.append((name, " ".join(parts[1:]) or name))
+    return cpus
+
+
+def parse_devices(output):
+    """
+    Parse the output of C{-device help}.
+
+    @return: a dict of the categories of devices and the list of their
+        devices.
+    """
+
+    devices = {}
+    category = ""
+    for line in output.splitlines():
+        match = DEVICE_RE.match(line)
+        if match is not None:
+            name = match.group("name")
+            devices.setdefault(category, []).append(
+                (name, match.group("desc") or name))
+        elif line.endswith(":"):
+            category = line[:-1].strip()
+    return devices
+
+
+class Capabilities:
+    """
+    The capabilities of a qemu executable.
+
+    @ivar machines: the list of the machines and their descriptions.
+    @ivar cpus: the list of the cpus and their descriptions.
+    @ivar devices: the dict of the categories of devices and the list of
+        the devices and their descriptions.
+    """
+
+    def __init__(self, executable, version, machines=(), cpus=(),
+                 devices=None):
+        self.executable = executable
+        self.version = version
+        self.machines = [tuple(machine) for machine in machines]
+        self.cpus = [tuple(cpu) for cpu in cpus]
+        self.devices = dict((category, [tuple(device) for device in lst])
+                            for category, lst in (devices or {}).items())
+
+    @property
+    def name(self):
+        return os.path.basename(self.executable)
+
+    @property
+    def arch(self):
+        return self.name[len(PREFIX):]
+
+    @classmethod
+    def parse(cls, executable, version, machines, cpus, devices):
+        """Build the capabilities from the output of the probes."""
+
+        return cls(executable, _qemu.parse_qemu_version(version),
+                   parse_machines(machines), parse_cpus(cpus),
+                   parse_devices(devices))
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["executable"], data["version"], data["machines"],
+                   data["cpus"], data["devices"])
+
+    def to_dict(self):
+        return {"executable": self.executable, "version": self.version,
+                "machines": self.machines, "cpus": self.cpus,
+                "devices": self.devices}
+
+    def __repr__(self):
+        return "<Capabilities {0} {1}>".format(self.name, self.version)
+
+
+def _check_output(result):
+    out, err, code = result
+    if code != 0:
+        # i.e. some executables do not support -cpu help
+        return ""
+    return out.decode("utf-8", "replace")
+
+
+class CapabilityDatabase:
+    """
+    The capabilities of the qemu executables, persisted in C{filename}.
+
+    @param filename: the file of the cache, by default
+        C{.qemu-capabilities.json} in the workspace.
+    """
+
+    def __init__(self, filename=None, run=utils.getProcessOutputAndValue):
+        self.filename = filename
+        self.run = run
+        # path -> (mtime, capabilities)
+        self._entries = {}
+        self._loaded = False
+        self._waiting = []
+
+    def _cache_file(self):
+        if self.filename is not None:
+            return self.filename
+        return os.path.join(settings.get("workspace"), CACHE_NAME)
+
+    def load(self):
+        """Read the capabilities saved by a previous session."""
+
+        self._loaded = True
+        filename = self._cache_file()
+        try:
+            with open(filename) as fp:
+                data = json.load(fp)
+            entries = dict((path, (entry["mtime"],
+                                   Capabilities.from_dict(entry)))
+                           for path, entry in data.items())
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                logger.warn(cache_read_error, filename=filename)
+            return
+        except (ValueError, KeyError, TypeError, AttributeError):
+            logger.warn(cache_read_error, filename=filename)
+            return
+        self._entries.update(entries)
+
+    def save(self):
+        filename = self._cache_file()
+        data = {}
+        for path, (mtime, caps) in self._entries.items():
+            data[path] = dict(caps.to_dict(), mtime=mtime)
+        tmp = filename + ".tmp"
+        try:
+            with open(tmp, "w") as fp:
+                json.dump(data, fp)
+            os.rename(tmp, filename)
+        except (IOError, OSError):
+            logger.failure(cache_write_error, filename=filename)
+
+    def get(self, path):
+        """
+        Return the capabilities of an executable or C{None} if it was not
+        probed or it changed since.
+        """
+
+        if not self._loaded:
+            self.load()
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+        return None
+
+    def executables(self, directory=None):
+        """Return the paths of the qemu executables of C{directory}."""
+
+        if directory is None:
+            directory = settings.get("qemupath")
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return []
+        paths = (os.path.join(directory, name) for name in sorted(names)
+                 if name.startswith(PREFIX))
+        return [path for path in paths
+                if os.path.isfile(path) and os.access(path, os.X_OK)]
+
+    def known(self, directory=None):
+        """
+        Return the capabilities of the executables of C{directory} that are
+        already discovered. This is a cheap synchronous call.
+        """
+
+        caps = (self.get(path) for path in self.executables(directory))
+        return [cap for cap in caps if cap is not None]
+
+    def lookup(self, name, directory=None):
+        """
+        Return the capabilities of the executable C{name} or C{None} if it
+        is not known.
+        """
+
+        if directory is None:
+            directory = settings.get("qemupath")
+        return self.get(os.path.join(directory, name))
+
+    def probe(self, path):
+        """
+        Probe an executable, unless its capabilities are already known.
+
+        @return: a deferred that fires with the L{Capabilities}.
+        """
+
+        caps = self.get(path)
+        if caps is not None:
+            return defer.succeed(caps)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return defer.fail()
+        dl = [self.run(path, args, os.environ).addCallback(_check_output)
+              for args in PROBES]
+        d = defer.gatherResults(dl, consumeErrors=True)
+        d.addCallback(lambda outputs: Capabilities.parse(path, *outputs))
+        d.addCallback(self._probed, path, mtime)
+        return d
+
+    def _probed(self, caps, path, mtime):
+        self._entries[path] = mtime, caps
+        return caps
+
+    def discover(self, directory=None, concurrency=None):
+        """
+        Probe all the executables of C{directory} that changed since the
+        last time and save the results. If a discovery is already running,
+        wait for it.
+
+        @return: a deferred that fires with the list of the L{Capabilities}
+            of the executables of C{directory}.
+        """
+
+        d = defer.Deferred()
+        self._waiting.append(d)
+        if len(self._waiting) == 1:
+            self._discover(directory, concurrency).addBoth(self._discovered)
+        return d
+
+    def _discover(self, directory, concurrency):
+        if concurrency is None:
+            concurrency = int(settings.get("concurrency"))
+        if not self._loaded:
+            self.load()
+        semaphore = defer.DeferredSemaphore(concurrency)
+        paths = self.executables(directory)
+        stale = [path for path in paths if self.get(path) is None]
+        dl = []
+        for path in stale:
+            d = semaphore.run(self.probe, path)
+            d.addErrback(logger.failure_eb, probe_error, executable=path)
+            dl.append(d)
+        d = defer.DeferredList(dl)
+        d.addCallback(self._save, stale)
+        d.addCallback(lambda _: self.known(directory))
+        return d
+
+    def _save(self, _, stale):
+        removed = [path for path in self._entries if not os.path.exists(path)]
+        for path in removed:
+            del self._entries[path]
+        if stale or removed:
+            self.save()
+
+    def _discovered(self, result):
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def clear(self):
+        self._entries.clear()
+
+
+capabilities = CapabilityDatabase()
+
+
 def get_executables(version=None):
     if version is None:
+        known = capabilities.known()
+        if known:
+            return [(caps.name, caps.arch) for caps in known]
         version = _get_version()
-    if version is None:
-        raise TypeError("Invalid qemu version")
     return _qemu.load_spec(version)['binaries']
 
 
 def get_cpus(architecture, version=None):
     if version is None:
+        caps = capabilities.lookup(architecture)
+        if caps is not None:
+            return caps.cpus
         version = _get_version()
-    if version is None:
-        raise TypeError("Invalid qemu version")
     cpus = _qemu.load_spec(version)['cpus']
     return cpus[architecture]
 
 
 def get_machines(architecture, version=None):
     if version is None:
+        caps = capabilities.lookup(architecture)
+        if caps is not None:
+            return caps.machines
         version = _get_version()
-    if version is None:
-        raise TypeError("Invalid qemu version")
     machines = _qemu.load_spec(version)['machines']
     return machines[architecture]
+
+
+def get_devices(architecture, category=None):
+    """
+    Return the devices supported by an executable, of all the categories or
+    only of C{category}, i.e. C{"Network devices"}. The devices are not in
+    the static specs, so the list is empty if the executable is not
+    discovered.
+    """
+
+    caps = capabilities.lookup(architecture)
+    if caps is None:
+        return []
+    if category is not None:
+        return caps.devices.get(category, [])
+    return [device for devices in caps.devices.values() for device in devices]
@@ -0,0 +1,328 @@
+# -*- test-case-name: virtualbricks.tests.test_qmp -*-
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2018 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Asynchronous client for the QEMU Machine Protocol (QMP).
+
+QMP is a JSON based protocol. Every message is a JSON object terminated by a
+new line. After the connection the server sends a greeting, the client must
+negotiate the capabilities before issuing any other command. Commands are
+tagged with an id so that they can be pipelined, the server replies with a
+C{return} or an C{error} object with the same id. Asynchronous events are
+delivered with an C{event} object.
+"""
+
+import json
+import itertools
+
+from twisted.internet import defer, endpoints, error, task
+from twisted.protocols import basic
+
+from virtualbricks import errors, log
+
+
+__all__ = ["QMPProtocol", "BlockJob", "connect"]
+
+logger = log.Logger()
+greeting_received = log.Event("QMP greeting received: {version}")
+invalid_message = log.Event("Invalid QMP message: {line}")
+unknown_reply = log.Event("QMP reply with unknown id {id}")
+connection_retry = log.Event("Cannot connect to QMP socket {path}, retrying.")
+block_job_ready = log.Event("Block job {job_id} is ready")
+block_job_io_error = log.Event("I/O error on block job {job_id}: {action}")
+query_block_jobs_error = log.Event("Cannot query the progress of {job_id}")
+
+
+def _format_version(greeting):
+    try:
+        version = greeting["version"]["qemu"]
+        return "{major}.{minor}.{micro}".format(**version)
+    except (KeyError, TypeError):
+        return "unknown"
+
+
+class QMPProtocol(basic.LineOnlyReceiver):
+    """
+    A QMP client.
+
+    The handler is notified of the asynchronous events through its
+    C{qmp_event_received(name, data, timestamp)} method and of the end of the
+    connection through C{qmp_connection_lost(reason)}.
+
+    @ivar ready: a deferred that fires with the QMP greeting when the
+        capabilities negotiation is complete.
+    """
+
+    delimiter = b"\n"
+    MAX_LENGTH = 1 << 20
+    greeting = None
+
+    def __init__(self, handler=None):
+        self.handler = handler
+        self.ready = defer.Deferred()
+        self._negotiated = False
+        self._ids = itertools.count()
+        self._pending = {}
+        self._queue = []
+
+    # Public interface
+
+    def execute(self, command, arguments=None):
+        """
+        Execute a QMP command.
+
+        Commands issued before the capabilities negotiation are queued and
+        sent as soon as the negotiation is complete. Commands are not
+        serialized: many commands can be in flight at the same time.
+
+        @param command: the name of the command.
+        @type command: C{str}
+        @param arguments: the arguments of the command.
+        @type arguments: C{dict} or C{None}
+        @return: a deferred that fires with the value returned by the
+            command or fails with L{errors.QMPError}.
+        """
+
+        cmd_id = "vb-{0}".format(next(self._ids))
+        message = {"execute": command, "id": cmd_id}
+        if arguments:
+            message["arguments"] = arguments
+        d = self._pending[cmd_id] = defer.Deferred()
+        if self._negotiated:
+            self._send(message)
+        else:
+            self._queue.append(message)
+        return d
+
+    def human_monitor_command(self, command_line):
+        """
+        Execute a command of the human monitor through QMP.
+
+        Some commands (i.e. C{savevm} and C{loadvm} in older QEMU versions)
+        are available only in the human monitor. Their output is returned as
+        is, an output starting with C{Error} is considered a failure.
+        """
+
+        def check_output(output):
+            if output.lstrip().startswith("Error"):
+                raise errors.QMPError("GenericError", output.strip())
+            return output
+
+        d = self.execute("human-monitor-command",
+                         {"command-line": command_line})
+        return d.addCallback(check_output)
+
+    # Protocol interface
+
+    def lineReceived(self, line):
+        try:
+            message = json.loads(line.decode("utf-8"))
+        except ValueError:
+            logger.warn(invalid_message, line=line)
+            return
+        if not isinstance(message, dict):
+            logger.warn(invalid_message, line=line)
+        elif "QMP" in message:
+            self.greeting_received(message["QMP"])
+        elif "event" in message:
+            self.event_received(message["event"], message.get("data", {}),
+                                message.get("timestamp"))
+        elif "return" in message or "error" in message:
+            self.reply_received(message)
+        else:
+            logger.warn(invalid_message, line=line)
+
+    def lineLengthExceeded(self, line):
+        logger.warn(invalid_message, line=line[:80] + b"...")
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        pending, self._pending = self._pending, {}
+        del self._queue[:]
+        for d in pending.values():
+            d.errback(reason)
+        if not self.ready.called:
+            self.ready.errback(reason)
+        if self.handler is not None:
+            self.handler.qmp_connection_lost(reason)
+
+    # Internal interface
+
+    def _send(self, message):
+        self.sendLine(json.dumps(message).encode("utf-8"))
+
+    def greeting_received(self, greeting):
+        logger.debug(greeting_received,
+                     version=lambda: _format_version(greeting))
+        self.greeting = greeting
+        d = self._pending["capabilities"] = defer.Deferred()
+        self._send({"execute": "qmp_capabilities", "id": "capabilities"})
+        d.addCallbacks(self._negotiation_done, self._negotiation_failed)
+
+    def _negotiation_done(self, _):
+        self._negotiated = True
+        queue, self._queue = self._queue, []
+        for message in queue:
+            self._send(message)
+        self.ready.callback(self.greeting)
+
+    def _negotiation_failed(self, failure):
+        self.ready.errback(failure)
+        self.transport.loseConnection()
+
+    def reply_received(self, message):
+        try:
+            d = self._pending.pop(message.get("id"))
+        except KeyError:
+            logger.warn(unknown_reply, id=message.get("id"))
+            return
+        if "error" in message:
+            err = message["error"]
+            d.errback(errors.QMPError(err.get("class", "GenericError"),
+                                      err.get("desc", "")))
+        else:
+            d.callback(message["return"])
+
+    def event_received(self, name, data, timestamp):
+        if self.handler is not None:
+            self.handler.qmp_event_received(name, data, timestamp)
+
+
+class BlockJob:
+    """
+    Follow a block job started on a QMP server.
+
+    The job is driven by the C{BLOCK_JOB_*} events that the owner of the
+    connection forwards to L{event_received}. Jobs that never end on their
+    own, like an active commit, send C{BLOCK_JOB_READY} when the data are
+    synchronized: the job is then completed, pivoting to the new image, or,
+    if C{pivot} is false, cancelled so that the current image stays in use.
+
+    @ivar done: a deferred that fires when the job is finished or fails with
+        L{errors.BlockJobError}.
+    """
+
+    def __init__(self, execute, job_id, pivot=True, progress=None):
+        self.execute = execute
+        self.job_id = job_id
+        self.pivot = pivot
+        self.progress = progress
+        self.ready = False
+        self.done = defer.Deferred()
+        self._poller = None
+
+    def poll(self, interval=1.0, clock=None):
+        """
+        Query the progress of the job every C{interval} seconds and report
+        it to the C{progress} callable as C{(offset, length)}.
+        """
+
+        if self.progress is None or self.done.called:
+            return
+        self._poller = task.LoopingCall(self._query)
+        if clock is not None:
+            self._poller.clock = clock
+        self._poller.start(interval)
+
+    def _query(self):
+
+        def report(jobs):
+            for job in jobs:
+                if job.get("device") == self.job_id:
+                    self._report(job)
+
+        d = self.execute("query-block-jobs")
+        d.addCallback(report)
+        d.addErrback(logger.failure_eb, query_block_jobs_error,
+                     job_id=self.job_id)
+        return d
+
+    def _report(self, data):
+        if self.progress is not None and "len" in data:
+            self.progress(data.get("offset", 0), data["len"])
+
+    def event_received(self, name, data):
+        self._report(data)
+        if name == "BLOCK_JOB_READY":
+            logger.debug(block_job_ready, job_id=self.job_id)
+            self.ready = True
+            command = "block-job-complete" if self.pivot else \
+                "block-job-cancel"
+            d = self.execute(command, {"device": self.job_id})
+            d.addErrback(self.fail)
+        elif name == "BLOCK_JOB_COMPLETED":
+            if "error" in data:
+                self.fail(errors.BlockJobError(self.job_id, data["error"]))
+            else:
+                self.finish(data)
+        elif name == "BLOCK_JOB_CANCELLED":
+            # a ready job, cancelled to keep the current image, is done
+            if self.ready and not self.pivot:
+                self.finish(data)
+            else:
+                self.fail(errors.BlockJobError(self.job_id, "cancelled"))
+        elif name == "BLOCK_JOB_ERROR":
+            logger.warn(block_job_io_error, job_id=self.job_id,
+                        action=data.get("action"))
+
+    def _stop_polling(self):
+        if self._poller is not None and self._poller.running:
+            self._poller.stop()
+
+    def finish(self, result):
+        self._stop_polling()
+        if not self.done.called:
+            self.done.callback(result)
+
+    def fail(self, reason):
+        self._stop_polling()
+        if not self.done.called:
+            self.done.errback(reason)
+
+
+def connect(reactor, path, handler, retries=10, delay=0.2):
+    """
+    Connect to the QMP unix socket at C{path}.
+
+    QEMU creates the socket after it is started so the connection is retried
+    C{retries} times, waiting C{delay} seconds between each attempt.
+
+    @return: a deferred that fires with a L{QMPProtocol} instance when the
+        capabilities negotiation is complete.
+    """
+
+    endpoint = endpoints.UNIXClientEndpoint(reactor, path)
+
+    def negotiate(protocol):
+        return protocol.ready.addCallback(lambda _: protocol)
+
+    def retry(failure, attempt):
+        failure.trap(error.ConnectError)
+        if attempt >= retries:
+            return failure
+        logger.debug(connection_retry, path=path)
+        d = task.deferLater(reactor, delay, attempt_connection, attempt + 1)
+        return d
+
+    def attempt_connection(attempt):
+        d = endpoints.connectProtocol(endpoint, QMPProtocol(handler))
+        d.addCallback(negotiate)
+        d.addErrback(retry, attempt)
+        return d
+
+    return attempt_connection(0)
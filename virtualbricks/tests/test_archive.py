@@ -0,0 +1,318 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2018 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import io
+import gzip
+import tarfile
+
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.python import log
+
+from virtualbricks import archive, settings, errors
+from virtualbricks.tests import LoggingObserver
+
+
+MiB = 1024 * 1024
+
+
+class TestParallelGzipWriter(unittest.TestCase):
+
+    def test_blocks(self):
+        """The blocks are written in order as gzip members."""
+
+        output = io.BytesIO()
+        writer = archive.ParallelGzipWriter(output, 3, block_size=100)
+        data = os.urandom(1000) + b"\x00" * 10000
+        for i in range(0, len(data), 70):
+            writer.write(data[i:i + 70])
+        writer.close()
+        output.seek(0)
+        self.assertEqual(gzip.GzipFile(fileobj=output).read(), data)
+
+    def test_empty(self):
+        output = io.BytesIO()
+        archive.ParallelGzipWriter(output, 2).close()
+        output.seek(0)
+        self.assertEqual(gzip.GzipFile(fileobj=output).read(), b"")
+
+
+def _sparse_file(path, size, chunks):
+    with open(path, "wb") as fp:
+        fp.truncate(size)
+        for offset, data in chunks:
+            fp.seek(offset)
+            fp.write(data)
+
+
+class TestCreate(unittest.TestCase):
+
+    def setUp(self):
+        self.home = os.path.abspath(self.mktemp())
+        os.mkdir(self.home)
+        self.patch(settings, "VIRTUALBRICKS_HOME", self.home)
+        with open(os.path.join(self.home, ".project"), "w") as fp:
+            fp.write("[Image:debian]\npath=/images/debian.img\n")
+        self.image = os.path.join(self.home, "debian.img")
+        self.data = os.urandom(4096)
+        _sparse_file(self.image, 8 * MiB, [(4 * MiB, self.data)])
+
+    def expected_image(self):
+        return b"\x00" * (4 * MiB) + self.data + b"\x00" * (4 * MiB - 4096)
+
+    @defer.inlineCallbacks
+    def test_create(self):
+        output = os.path.join(self.home, "test.vbp")
+        progress = []
+        yield archive.create(output, [".project"], [("debian", self.image)],
+                             progress=lambda *a: progress.append(a),
+                             workers=2)
+        with tarfile.open(output, "r:gz") as tar:
+            self.assertEqual(tar.getnames(), [".project", ".images/debian",
+                                              ".checksums"])
+            self.assertEqual(tar.extractfile(".project").read(),
+                             b"[Image:debian]\npath=/images/debian.img\n")
+            image = tar.getmember(".images/debian")
+            self.assertEqual(image.size, 8 * MiB)
+            self.assertEqual(tar.extractfile(image).read(),
+                             self.expected_image())
+        self.assertEqual(progress[-1][0], progress[-1][1])
+
+    @defer.inlineCallbacks
+    def test_sparse(self):
+        """Only the data of the sparse files is stored."""
+
+        fd = os.open(self.image, os.O_RDONLY)
+        try:
+            segments = archive.data_segments(fd, 8 * MiB)
+        finally:
+            os.close(fd)
+        if segments == [(0, 8 * MiB)]:
+            raise unittest.SkipTest("The file system does not report holes")
+        output = os.path.join(self.home, "test.vbp")
+        yield archive.create(output, [], [("debian", self.image)], workers=2)
+        with gzip.open(output) as fp:
+            self.assertTrue(len(fp.read()) < MiB)
+        with tarfile.open(output, "r:gz") as tar:
+            self.assertTrue(tar.getmember(".images/debian").issparse())
+
+    @defer.inlineCallbacks
+    def test_not_sparse(self):
+        """The holes are written as zeros if sparse is False."""
+
+        output = io.BytesIO()
+        yield archive.create(output, [], [("debian", self.image)],
+                             sparse=False, workers=2)
+        output.seek(0)
+        with tarfile.open(fileobj=output, mode="r:gz") as tar:
+            image = tar.getmember(".images/debian")
+            self.assertFalse(image.issparse())
+            self.assertEqual(tar.extractfile(image).read(),
+                             self.expected_image())
+
+    @defer.inlineCallbacks
+    def test_missing_images(self):
+        """The images that do not exist are skipped with a warning."""
+
+        observer = LoggingObserver()
+        log.addObserver(observer.emit)
+        self.addCleanup(log.removeObserver, observer.emit)
+        output = io.BytesIO()
+        yield archive.create(output, [".project"],
+                             [("missing", "/nonexistent/image")], workers=1)
+        output.seek(0)
+        with tarfile.open(fileobj=output, mode="r:gz") as tar:
+            self.assertEqual(tar.getnames(), [".project", ".checksums"])
+        warnings = [event for event in observer.msgs
+                    if event.get("log_format") ==
+                    archive.missing_image.log_format]
+        self.assertEqual(len(warnings), 1)
+        self.assertEqual(warnings[0]["name"], "missing")
+        self.assertEqual(warnings[0]["log_level"].name, "warn")
+
+    def test_error(self):
+        """The partial archive is removed on error."""
+
+        output = os.path.join(self.home, "test.vbp")
+        d = archive.create(output, ["missing"], workers=1)
+
+        def check(_):
+            self.assertFalse(os.path.exists(output))
+
+        return self.assertFailure(d, OSError).addCallback(check)
+
+
+class TestExtract(unittest.TestCase):
+
+    def setUp(self):
+        self.home = os.path.abspath(self.mktemp())
+        os.mkdir(self.home)
+        self.patch(settings, "VIRTUALBRICKS_HOME", self.home)
+        with open(os.path.join(self.home, ".project"), "w") as fp:
+            fp.write("[Image:debian]\npath=/images/debian.img\n")
+        self.image = os.path.join(self.home, "debian.img")
+        self.data = os.urandom(4096)
+        _sparse_file(self.image, 8 * MiB, [(4 * MiB, self.data)])
+        self.archive = os.path.join(self.home, "test.vbp")
+        self.destination = os.path.abspath(self.mktemp())
+        os.mkdir(self.destination)
+
+    def create(self, **kwds):
+        return archive.create(self.archive, [".project"],
+                              [("debian", self.image)], workers=2, **kwds)
+
+    def read(self, name):
+        with open(os.path.join(self.destination, name), "rb") as fp:
+            return fp.read()
+
+    def assert_extracted(self):
+        self.assertEqual(self.read(".project"),
+                         b"[Image:debian]\npath=/images/debian.img\n")
+        with open(self.image, "rb") as fp:
+            self.assertEqual(self.read(".images/debian"), fp.read())
+        self.assertFalse(os.path.exists(os.path.join(self.destination,
+                                                     archive.MANIFEST)))
+        self.assertFalse(archive.can_resume(self.destination))
+
+    @defer.inlineCallbacks
+    def test_extract(self):
+        yield self.create()
+        files = []
+        yield archive.extract(self.archive, self.destination,
+                              lambda *args: files.append(args))
+        self.assert_extracted()
+        self.assertEqual([args[:2] for args in files], [
+            (".project", os.path.join(self.destination, ".project")),
+            (".images/debian",
+             os.path.join(self.destination, ".images/debian"))])
+        with tarfile.open(self.archive) as tar:
+            manifest = archive._parse_manifest(
+                tar.extractfile(archive.MANIFEST).read())
+        self.assertEqual(files[1][2], manifest[".images/debian"])
+
+    @defer.inlineCallbacks
+    def test_extract_not_sparse(self):
+        yield self.create(sparse=False)
+        yield archive.extract(self.archive, self.destination)
+        self.assert_extracted()
+
+    def test_extract_tar(self):
+        """The archives without checksums are extracted too."""
+
+        with tarfile.open(self.archive, "w:gz") as tar:
+            tar.add(os.path.join(self.home, ".project"), ".project")
+        d = archive.extract(self.archive, self.destination)
+        return d.addCallback(lambda _: self.assertEqual(
+            self.read(".project"),
+            b"[Image:debian]\npath=/images/debian.img\n"))
+
+    @defer.inlineCallbacks
+    def test_resume(self):
+        """The files already extracted are not written again."""
+
+        yield self.create()
+        yield archive.extract(self.archive, self.destination)
+        image = os.path.join(self.destination, ".images/debian")
+        with open(os.path.join(self.destination, archive.JOURNAL), "w") as fp:
+            fp.write(archive._archive_id(self.archive) + "\n")
+            fp.write(".images/debian\t{0}\t{1}\n".format(
+                8 * MiB, self.checksum()))
+        os.remove(os.path.join(self.destination, ".project"))
+        st = os.stat(image)
+        self.assertTrue(archive.can_resume(self.destination))
+        yield archive.extract(self.archive, self.destination)
+        self.assert_extracted()
+        self.assertEqual(os.stat(image).st_ino, st.st_ino)
+
+    @defer.inlineCallbacks
+    def test_resume_moved(self):
+        """The files moved away are not extracted again."""
+
+        yield self.create()
+        yield archive.extract(self.archive, self.destination)
+        moved = os.path.join(self.home, "debian.img.moved")
+        os.rename(os.path.join(self.destination, ".images/debian"), moved)
+        archive.record_moved(self.destination, self.archive,
+                             ".images/debian", moved, self.checksum())
+        self.assertTrue(archive.can_resume(self.destination))
+        files = []
+        yield archive.extract(self.archive, self.destination,
+                              lambda *args: files.append(args))
+        self.assertEqual(files[1], (".images/debian", moved,
+                                    self.checksum()))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.destination, ".images/debian")))
+        # the record is kept until the import is completed
+        self.assertTrue(archive.can_resume(self.destination))
+        archive.clear_moved(self.destination)
+        self.assertFalse(archive.can_resume(self.destination))
+
+    @defer.inlineCallbacks
+    def test_moved_other_archive(self):
+        """The files moved away from another archive are ignored."""
+
+        yield self.create()
+        with open(os.path.join(self.destination, archive.MOVED), "w") as fp:
+            fp.write("/other.vbp 10 10\n.project\t37\t0000\t/other\n")
+        yield archive.extract(self.archive, self.destination)
+        self.assert_extracted()
+
+    def checksum(self):
+        with tarfile.open(self.archive, "r:gz") as tar:
+            manifest = tar.extractfile(archive.MANIFEST).read()
+        return archive._parse_manifest(manifest)[".images/debian"]
+
+    @defer.inlineCallbacks
+    def test_journal_other_archive(self):
+        """The journal of another archive is ignored."""
+
+        yield self.create()
+        with open(os.path.join(self.destination, archive.JOURNAL), "w") as fp:
+            fp.write("/other.vbp 10 10\n.project\t37\t0000\n")
+        with open(os.path.join(self.destination, ".project"), "w") as fp:
+            fp.write("x" * 37)
+        yield archive.extract(self.archive, self.destination)
+        self.assert_extracted()
+
+    @defer.inlineCallbacks
+    def test_checksum_error(self):
+        yield self.create()
+        self.patch(archive, "_parse_manifest",
+                   lambda data: {".project": "0" * 64})
+        d = archive.extract(self.archive, self.destination)
+        yield self.assertFailure(d, errors.ChecksumError)
+        self.assertFalse(archive.can_resume(self.destination))
+
+    @defer.inlineCallbacks
+    def test_interrupted(self):
+        """The journal is kept if the archive is truncated."""
+
+        yield self.create(sparse=False)
+        with open(self.archive, "rb") as fp:
+            data = fp.read()
+        with open(self.archive, "wb") as fp:
+            fp.write(data[:len(data) // 2])
+        d = archive.extract(self.archive, self.destination)
+        yield self.assertFailure(d, errors.InvalidArchiveError, IOError)
+        self.assertTrue(archive.can_resume(self.destination))
+
+    def test_unsafe_name(self):
+        with tarfile.open(self.archive, "w:gz") as tar:
+            tar.add(os.path.join(self.home, ".project"), "../.project")
+        d = archive.extract(self.archive, self.destination)
+        return self.assertFailure(d, errors.InvalidArchiveError)
@@ -82,7 +82,7 @@ class TestConfigFile(unittest.TestCase):
              configfile.cannot_save_backup, configfile.project_saved,
              configfile.cannot_restore_backup, configfile.backup_restored,
              configfile.image_found, configfile.skip_image,
-             configfile.skip_image_noa, configfile.config_dump,
+             configfile.check_images_error, configfile.config_dump,
              configfile.open_project, configfile.config_save_error])
 
     def test_restore_backup_does_not_exists(self):
@@ -15,14 +15,17 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import os
 import six
 import textwrap
 
 from zope.interface import implementer
 from twisted.python import components
-from twisted.internet import interfaces
+from twisted.internet import interfaces, defer
+from twisted.test import proto_helpers
 
-from virtualbricks import console
+from virtualbricks import (console, settings, project, archive, imageinfo,
+                           lab)
 from virtualbricks.tests import unittest, stubs
 
 
@@ -101,3 +104,95 @@ class TestProtocol(unittest.TestCase):
         self.parse("help")
         self.assertEqual(self.stdout.getvalue(),
                          textwrap.dedent(console.VBProtocol.__doc__) + "\n")
+
+
+class TestProjectProtocol(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = stubs.FactoryStub()
+        self.protocol = console.ProjectProtocol(self.factory)
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def get_lines(self):
+        lines = self.transport.value().decode().splitlines()
+        self.transport.clear()
+        return lines
+
+    @defer.inlineCallbacks
+    def test_import(self):
+        """
+        The project is imported and its images are moved in the vimages
+        directory of the workspace.
+        """
+
+        workspace = os.path.abspath(self.mktemp())
+        home = os.path.join(workspace, "home")
+        os.makedirs(home)
+        self.patch(settings, "VIRTUALBRICKS_HOME", home)
+        self.patch(imageinfo, "cache", imageinfo.ImageCache())
+        options = {"workspace": workspace, "imagestore": False,
+                   "concurrency": 2}
+        self.patch(settings, "get", options.get)
+        manager = project.ProjectManager(workspace)
+        self.patch(project, "manager", manager)
+        with open(os.path.join(home, ".project"), "w") as fp:
+            fp.write("[Image:debian]\npath = /images/debian.img\n\n")
+        with open(os.path.join(home, "debian.img"), "wb") as fp:
+            fp.write(b"debian")
+        filename = os.path.join(workspace, "test.vbp")
+        yield archive.create(filename, [".project"],
+                             [("debian", os.path.join(home, "debian.img"))],
+                             workers=1)
+        yield self.protocol.do_import(filename, "test")
+        prj = manager.get_project("test")
+        self.assertEqual(self.get_lines(), ["imported in %s" % prj.path])
+        vimage = os.path.join(workspace, "vimages", "debian")
+        entry = prj.get_descriptor()
+        self.assertEqual(entry.sections[("Image", "debian")]["path"], vimage)
+        with open(vimage, "rb") as fp:
+            self.assertEqual(fp.read(), b"debian")
+
+    def test_import_invalid_argument(self):
+        self.protocol.lineReceived("import test.vbp test force")
+        self.assertEqual(self.get_lines(), ["Invalid argument force"])
+
+    def open_project(self):
+        manager = project.ProjectManager(os.path.abspath(self.mktemp()))
+        self.patch(project, "manager", manager)
+        prj = manager.current = manager.get_project("test")
+        prj.create()
+        return prj
+
+    def test_checkpoint(self):
+        prj = self.open_project()
+        self.protocol.lineReceived("checkpoint base")
+        self.protocol.lineReceived("checkpoints")
+        self.assertEqual(self.get_lines(), ["0 disks saved in base", "base"])
+        self.assertEqual(lab.checkpoints(prj.path), ["base"])
+
+    def test_checkpoint_exists(self):
+        self.open_project()
+        self.protocol.lineReceived("checkpoint base")
+        self.get_lines()
+        self.protocol.lineReceived("checkpoint base")
+        self.assertEqual(self.get_lines(),
+                         ["Normalized name base already in use"])
+
+    def test_reset(self):
+        self.open_project()
+        self.protocol.lineReceived("checkpoint base")
+        self.get_lines()
+        self.protocol.lineReceived("reset base")
+        self.assertEqual(self.get_lines(), ["0 disks reset to base"])
+
+    def test_reset_unknown(self):
+        self.open_project()
+        self.protocol.lineReceived("reset base")
+        self.assertEqual(self.get_lines(), ["base"])
+
+    def test_remove_checkpoint(self):
+        prj = self.open_project()
+        self.protocol.lineReceived("checkpoint base")
+        self.protocol.lineReceived("rmcheckpoint base")
+        self.assertEqual(lab.checkpoints(prj.path), [])
@@ -0,0 +1,160 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2018 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import errno
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from virtualbricks import copier
+
+
+MiB = 1024 * 1024
+
+
+def _sparse_file(path, size, chunks):
+    with open(path, "wb") as fp:
+        fp.truncate(size)
+        for offset, data in chunks:
+            fp.seek(offset)
+            fp.write(data)
+
+
+def _content(path):
+    with open(path, "rb") as fp:
+        return fp.read()
+
+
+def _unsupported(*args):
+    raise OSError(errno.ENOSYS, "Function not implemented")
+
+
+class TestCopyFile(unittest.TestCase):
+
+    def setUp(self):
+        self.source = self.mktemp()
+        self.destination = self.mktemp()
+        self.data = os.urandom(4096)
+        _sparse_file(self.source, 8 * MiB, [(0, self.data),
+                                            (4 * MiB, self.data)])
+        os.chmod(self.source, 0o640)
+
+    def assert_copied(self):
+        self.assertEqual(_content(self.destination), _content(self.source))
+        self.assertEqual(os.stat(self.destination).st_mode & 0o777, 0o640)
+
+    def test_copy(self):
+        copied = []
+        copier.copy_file(self.source, self.destination, copied.append)
+        self.assert_copied()
+        self.assertTrue(sum(copied) <= 8 * MiB)
+
+    def test_sparse(self):
+        """The holes are not copied."""
+
+        self.patch(copier, "_reflink", lambda src, dst: False)
+        copier.copy_file(self.source, self.destination)
+        self.assert_copied()
+        st_source = os.stat(self.source)
+        if st_source.st_blocks * 512 >= st_source.st_size:
+            raise unittest.SkipTest("The file system does not support holes")
+        self.assertTrue(os.stat(self.destination).st_blocks * 512 < MiB)
+
+    def test_fallback(self):
+        """If a method is not supported the next one is used."""
+
+        self.patch(copier, "_reflink", lambda src, dst: False)
+        self.patch(copier, "_copy_file_range", _unsupported)
+        self.patch(copier, "_sendfile", _unsupported)
+        copier.copy_file(self.source, self.destination)
+        self.assert_copied()
+
+    def test_read_write(self):
+        self.patch(copier, "_reflink", lambda src, dst: False)
+        self.patch(copier, "_methods", lambda: [copier._read_write])
+        copier.copy_file(self.source, self.destination)
+        self.assert_copied()
+
+    def test_empty(self):
+        with open(self.source, "wb"):
+            pass
+        copier.copy_file(self.source, self.destination)
+        self.assertEqual(_content(self.destination), b"")
+
+    def test_missing(self):
+        self.assertRaises(OSError, copier.copy_file, self.mktemp(),
+                          self.destination)
+
+
+class TestCopyTree(unittest.TestCase):
+
+    def setUp(self):
+        self.source = os.path.abspath(self.mktemp())
+        os.makedirs(os.path.join(self.source, "dir"))
+        with open(os.path.join(self.source, ".project"), "w") as fp:
+            fp.write("[Switch:sw]\n")
+        _sparse_file(os.path.join(self.source, "dir", "vm_hda.cow"), 2 * MiB,
+                     [(MiB, b"cow")])
+        self.destination = os.path.abspath(self.mktemp())
+
+    @defer.inlineCallbacks
+    def test_copy_tree(self):
+        progress = []
+        yield copier.copy_tree(self.source, self.destination,
+                               lambda *args: progress.append(args), 2)
+        for name in ".project", os.path.join("dir", "vm_hda.cow"):
+            self.assertEqual(_content(os.path.join(self.destination, name)),
+                             _content(os.path.join(self.source, name)))
+        total = 2 * MiB + len("[Switch:sw]\n")
+        self.assertEqual(progress[0], (0, total))
+        self.assertTrue(progress[-1][0] <= total)
+
+    @defer.inlineCallbacks
+    def test_ignore(self):
+        ignored = []
+
+        def ignore(path):
+            ignored.append(path)
+            return path == os.path.join("dir", "vm_hda.cow")
+
+        yield copier.copy_tree(self.source, self.destination, concurrency=2,
+                               ignore=ignore)
+        self.assertEqual(sorted(ignored), [".project", "dir",
+                                           os.path.join("dir", "vm_hda.cow")])
+        self.assertEqual(os.listdir(os.path.join(self.destination, "dir")),
+                         [])
+
+    def test_missing(self):
+        d = copier.copy_tree(self.mktemp(), self.destination)
+        return self.assertFailure(d, OSError)
+
+    @defer.inlineCallbacks
+    def test_error(self):
+        """The first error is returned after all the copies are done."""
+
+        def copy_file(source, destination, report):
+            if source.endswith(".project"):
+                raise IOError(errno.EIO, "Input/output error")
+            copy_file_(source, destination, report)
+
+        copy_file_ = copier.copy_file
+        self.patch(copier, "copy_file", copy_file)
+        d = copier.copy_tree(self.source, self.destination, concurrency=2)
+        yield self.assertFailure(d, IOError)
+        self.assertTrue(os.path.exists(os.path.join(self.destination, "dir",
+                                                    "vm_hda.cow")))
@@ -92,6 +92,12 @@ class ExportProjectDialog(WindowStub, dialogs.ExportProjectDialog):
 
     pass
 
+
+class ProgressBarStub:
+
+    def progress(self, done, total):
+        pass
+
 MODEL = {
     (0, 1, Gtk.STOCK_DIRECTORY, "root", None): {
         (0, 1, Gtk.STOCK_DIRECTORY, "A", None): {
@@ -130,7 +136,8 @@ class TestExportDialog(GtkTestCase):
 
     def setUp(self):
         self.prjpath = filepath.FilePath(self.mktemp())
-        self.dialog = ExportProjectDialog(None, self.prjpath, [])
+        self.dialog = ExportProjectDialog(ProgressBarStub(), self.prjpath,
+                                          [])
 
     def toggle(self, path, model):
         self.dialog.on_selected_cellrenderer_toggled(None, path, model)
@@ -224,7 +231,7 @@ class TestExportDialog(GtkTestCase):
         ancestor = filepath.FilePath("/")
         self.dialog.export(model, ancestor, "test.tgz", self.export)
 
-    def export(self, filename, files, images):
+    def export(self, filename, files, images, progress=None):
         for name in files:
             self.assertIsInstance(name, str)
         for name, path in images:
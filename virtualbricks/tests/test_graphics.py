@@ -16,7 +16,10 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import os
-from virtualbricks.tests import unittest, stubs
+
+from twisted.internet import defer
+
+from virtualbricks.tests import unittest, stubs, successResultOf
 from virtualbricks.gui import graphics
 import virtualbricks.gui
 
@@ -41,3 +44,252 @@ class TestGraphics(unittest.TestCase):
     def test_brick_icon(self):
         self.assertEqual(graphics.brick_icon(self.brick),
                          GUI_PATH + "/data/stub.png")
+
+
+class TestLayoutCache(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = stubs.FactoryStub()
+        self.bricks = [stubs.BrickStub(self.factory, "a"),
+                       stubs.BrickStub(self.factory, "b")]
+        self.computed = []
+        self.patch(graphics, "_layouts", graphics.collections.OrderedDict())
+        self.patch(graphics, "compute_layout", self.compute_layout)
+
+    def compute_layout(self, key):
+        self.computed.append(key)
+        return graphics.Layout(0, 0, {})
+
+    def test_graph_key(self):
+        key = graphics.graph_key(self.bricks, "LR")
+        self.assertEqual(key, graphics.graph_key(self.bricks, "LR"))
+        self.assertNotEqual(key, graphics.graph_key(self.bricks, "TB"))
+        self.assertNotEqual(key, graphics.graph_key(self.bricks[:1], "LR"))
+
+    @defer.inlineCallbacks
+    def test_cached(self):
+        """The layout of the same topology is computed once."""
+
+        lr = graphics.graph_key(self.bricks, "LR")
+        tb = graphics.graph_key(self.bricks, "TB")
+        layout = yield graphics.get_layout(lr)
+        yield graphics.get_layout(tb)
+        self.assertIs(successResultOf(self, graphics.get_layout(lr)), layout)
+        self.assertEqual(self.computed, [lr, tb])
+
+    @defer.inlineCallbacks
+    def test_cache_size(self):
+        for i in range(graphics.CACHE_SIZE + 1):
+            yield graphics.get_layout(("LR", ("brick{0}".format(i), ), ()))
+        yield graphics.get_layout(("LR", ("brick0", ), ()))
+        self.assertEqual(len(self.computed), graphics.CACHE_SIZE + 2)
+
+
+class IconStub:
+
+    def __init__(self, filename, width, height):
+        self.filename = filename
+        self.saturated = False
+
+    def get_rowstride(self):
+        return 40
+
+    def get_height(self):
+        return 10
+
+    def saturate_and_pixelate(self, dest, saturation, pixelate):
+        self.saturated = True
+
+
+class TestPixbufCache(unittest.TestCase):
+
+    def setUp(self):
+        self.icon = self.mktemp()
+        with open(self.icon, "wb"):
+            pass
+        self.cache = graphics.PixbufCache(1000, IconStub)
+
+    def test_hit(self):
+        pixbuf = self.cache.get(self.icon, 48, 48)
+        self.assertIs(self.cache.get(self.icon, 48, 48), pixbuf)
+        self.assertFalse(pixbuf.saturated)
+        self.assertEqual(self.cache.stats(), {"hits": 1, "misses": 1,
+                                              "evictions": 0, "icons": 1,
+                                              "bytes": 400})
+
+    def test_key(self):
+        """The size and the state of the brick are part of the key."""
+
+        pixbuf = self.cache.get(self.icon, 48, 48)
+        self.assertIsNot(self.cache.get(self.icon), pixbuf)
+        stopped = self.cache.get(self.icon, 48, 48, running=False)
+        self.assertIsNot(stopped, pixbuf)
+        self.assertTrue(stopped.saturated)
+        self.assertEqual(self.cache.misses, 3)
+
+    def test_modified(self):
+        """An icon changed on disk is loaded again."""
+
+        pixbuf = self.cache.get(self.icon)
+        os.utime(self.icon, (0, 0))
+        self.assertIsNot(self.cache.get(self.icon), pixbuf)
+
+    def test_eviction(self):
+        """The least recently used icons are evicted."""
+
+        first = self.cache.get(self.icon, 1, 1)
+        self.cache.get(self.icon, 2, 2)
+        self.cache.get(self.icon, 1, 1)
+        self.cache.get(self.icon, 3, 3)
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertEqual(self.cache.stats()["bytes"], 800)
+        self.assertIs(self.cache.get(self.icon, 1, 1), first)
+        self.assertEqual(self.cache.misses, 3)
+
+
+class TestGridIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = graphics.GridIndex(10)
+        self.index.insert("a", (0, 0, 5, 5))
+        self.index.insert("b", (8, 8, 25, 4))
+        self.index.insert("c", (100, 100, 10, 10))
+
+    def test_at(self):
+        self.assertEqual(self.index.at(2, 2), ["a"])
+        self.assertEqual(self.index.at(30, 10), ["b"])
+        self.assertEqual(self.index.at(6, 6), [])
+        self.assertEqual(self.index.at(-50, -50), [])
+
+    def test_overlapping(self):
+        """The items are returned once, in insertion order."""
+
+        self.assertEqual(self.index.overlapping((0, 0, 50, 50)), ["a", "b"])
+        self.assertEqual(self.index.overlapping((90, 90, 20, 20)), ["c"])
+        self.assertEqual(self.index.overlapping((40, 40, 20, 20)), [])
+
+
+def _layout():
+    nodes = {"a": (0, 0, 20, 20), "b": (100, 0, 20, 20)}
+    edges = [("a", "b", [(20, 10), (40, 10), (80, 10), (100, 10)])]
+    return graphics.Layout(120, 20, nodes, edges, {"a": "", "b": ""})
+
+
+class TestLayout(unittest.TestCase):
+
+    def test_item_at(self):
+        layout = _layout()
+        self.assertEqual(layout.item_at(10, 10), ("node", "a"))
+        self.assertEqual(layout.item_at(50, 12), ("edge", 0))
+        self.assertIs(layout.item_at(50, 30), None)
+
+    def test_node_above_edge(self):
+        self.assertEqual(_layout().item_at(101, 10), ("node", "b"))
+
+    def test_spline(self):
+        points = graphics._spline("e,9,9 10,20 30,40 50,60 70,80", 10, 100)
+        self.assertEqual(points, [(0, 80), (20, 60), (40, 40), (60, 20)])
+
+
+class CanvasStub:
+
+    size = None
+
+    def __init__(self):
+        self.damaged = []
+        self.redrawn = 0
+
+    def set_size_request(self, width, height):
+        self.size = (width, height)
+
+    def queue_draw(self):
+        self.redrawn += 1
+
+    def queue_draw_area(self, x, y, width, height):
+        self.damaged.append((x, y, width, height))
+
+
+class TestTopology(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = stubs.FactoryStub()
+        self.bricks = [stubs.BrickStub(self.factory, "a")]
+        self.layouts = []
+        self.patch(graphics, "get_layout", self.get_layout)
+        self.widget = CanvasStub()
+        self.topology = graphics.Topology(self.widget)
+
+    def get_layout(self, key):
+        d = defer.Deferred()
+        self.layouts.append((key, d))
+        return d
+
+    def show(self, layout=None):
+        if layout is None:
+            layout = _layout()
+        d = self.topology.update(self.bricks)
+        self.layouts[-1][1].callback(layout)
+        successResultOf(self, d)
+        return layout
+
+    def test_keep_drawing(self):
+        """The current drawing stays until the new layout is ready."""
+
+        d = self.topology.update(self.bricks)
+        self.assertEqual(self.widget.redrawn, 0)
+        self.layouts[0][1].callback(_layout())
+        successResultOf(self, d)
+        self.assertEqual(self.widget.redrawn, 1)
+        self.assertEqual(self.widget.size, (120, 20))
+        self.assertEqual(self.topology.brick_at(10, 10), "a")
+
+    def test_last_topology(self):
+        """Only the last topology requested is laid out."""
+
+        d1 = self.topology.update(self.bricks)
+        self.topology.update(self.bricks, "TB")
+        d3 = self.topology.update(self.bricks + [
+            stubs.BrickStub(self.factory, "b")])
+        self.assertEqual(len(self.layouts), 1)
+        self.layouts[0][1].callback(_layout())
+        self.assertEqual(len(self.layouts), 2)
+        self.assertEqual(len(self.layouts[1][0][1]), 2)
+        self.assertNoResult(d1)
+        self.layouts[1][1].callback(_layout())
+        successResultOf(self, d1)
+        successResultOf(self, d3)
+
+    def test_state_changed(self):
+        """Only the bricks whose state changed are drawn again."""
+
+        layout = self.show()
+        self.topology.states["a"] = True
+        self.show(layout)
+        self.assertEqual(self.widget.redrawn, 1)
+        self.assertEqual(self.widget.damaged, [(-1, -1, 22, 22)])
+
+    def test_hover(self):
+        """Only the old and the new item under the pointer are drawn."""
+
+        self.show()
+        self.topology.hover(10, 10)
+        self.assertEqual(self.topology.hovered, ("node", "a"))
+        self.topology.hover(12, 12)
+        self.assertEqual(len(self.widget.damaged), 1)
+        self.topology.hover(110, 10)
+        self.assertEqual(self.widget.damaged, [(-1, -1, 22, 22),
+                                               (-1, -1, 22, 22),
+                                               (99, -1, 22, 22)])
+        self.topology.hover()
+        self.assertIs(self.topology.hovered, None)
+
+    def test_zoom(self):
+        """The zoom does not lay out the topology again."""
+
+        self.show()
+        self.assertEqual(self.topology.set_zoom(2), 2)
+        self.assertEqual(len(self.layouts), 1)
+        self.assertEqual(self.widget.size, (240, 40))
+        self.assertEqual(self.topology.brick_at(30, 30), "a")
+        self.assertEqual(self.topology.brick_at(220, 20), "b")
+        self.assertEqual(self.topology.set_zoom(100), graphics.MAX_ZOOM)
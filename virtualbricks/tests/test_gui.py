@@ -16,12 +16,13 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 from twisted.trial import unittest
+from twisted.internet import task
 
 import gi
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk
 
-from virtualbricks import project, _settings
+from virtualbricks import project, _settings, log
 from virtualbricks.gui import gui, interfaces
 from virtualbricks.tests import stubs
 
@@ -306,6 +307,50 @@ class TestSwitchWrapperController(TestController):
         self.assert_parameter_equal("path", self.PATH)
 
 
+class TestReusablePanel(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = stubs.Factory()
+        self.gui = DumbGui(self.factory)
+        self.addCleanup(gui._panels.clear)
+
+    def controller(self, name, path):
+        from virtualbricks.switches import SwitchWrapper
+        brick = SwitchWrapper(self.factory, name)
+        brick.set({"path": path})
+        controller = interfaces.IConfigController(brick)
+        controller.get_config_view(self.gui)
+        return controller
+
+    def test_reuse(self):
+        """The widgets of a closed panel are used by the next controller."""
+
+        first = self.controller("first", "/foo")
+        view = first.get_object("table1")
+        first.release_view()
+        second = self.controller("second", "/bar")
+        self.assertIs(second.get_object("table1"), view)
+        self.assertEqual(second.get_object("entry").get_text(), "/bar")
+
+    def test_signals(self):
+        """The signals are handled by the controller that uses the panel."""
+
+        first = self.controller("first", "/foo")
+        first.release_view()
+        second = self.controller("second", "/bar")
+        panel = second._panel
+        self.assertIs(panel.owner, second)
+        self.assertRaises(AttributeError, getattr, panel, "not_a_handler")
+
+    def test_in_use(self):
+        """A panel that is not released is not shared."""
+
+        first = self.controller("first", "/foo")
+        second = self.controller("second", "/bar")
+        self.assertIsNot(second.get_object("table1"),
+                         first.get_object("table1"))
+
+
 class TestTapController(TestController):
 
     def get_brick(self):
@@ -392,3 +437,65 @@ class TestCaptureController(TestController):
         self.assert_parameter_equal("iface", "")
         self.fail("TODO")
     test_config.todo = "Implement test utility for the plugmixin"
+
+
+class MessageDialogObserverStub(gui.MessageDialogObserver):
+
+    def __init__(self, clock):
+        gui.MessageDialogObserver.__init__(self, clock=clock)
+        self.shown = []
+
+    def show(self, text, details):
+        self.shown.append((text, details))
+        return object()
+
+
+def error_event(text, log_id=1):
+    return {"log_format": text, "log_id": log_id, "log_level":
+            log.LogLevel.error, "log_time": 0}
+
+
+class TestMessageDialogObserver(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.observer = MessageDialogObserverStub(self.clock)
+
+    def test_single_error(self):
+        self.observer(error_event("error"))
+        self.assertEqual(self.observer.shown, [])
+        self.clock.advance(gui.ERRORS_WINDOW)
+        self.assertEqual(self.observer.shown, [("error", "")])
+
+    def test_aggregate(self):
+        """The errors of a short window are shown in a single dialog."""
+
+        for i in range(200):
+            self.observer(error_event("vm {0} failed".format(i)))
+        self.observer(error_event("switch died", 2))
+        self.clock.advance(gui.ERRORS_WINDOW)
+        self.assertEqual(len(self.observer.shown), 1)
+        text, details = self.observer.shown[0]
+        self.assertEqual(text, "201 errors occurred")
+        lines = details.splitlines()
+        self.assertEqual(lines[0], "vm 0 failed (x200)")
+        self.assertEqual(lines[1], "    vm 1 failed")
+        self.assertEqual(lines[gui.ERRORS_DETAILS], "    ...")
+        self.assertEqual(lines[-1], "switch died")
+
+    def test_rate_limit(self):
+        """
+        No dialog is shown while another is open and for a while after it
+        is closed.
+        """
+
+        self.observer(error_event("first"))
+        self.clock.advance(gui.ERRORS_WINDOW)
+        self.observer(error_event("second"))
+        self.clock.advance(gui.ERRORS_INTERVAL)
+        self.assertEqual(len(self.observer.shown), 1)
+        self.observer._closed()
+        self.clock.advance(gui.ERRORS_INTERVAL - 1)
+        self.assertEqual(len(self.observer.shown), 1)
+        self.clock.advance(1)
+        self.assertEqual(self.observer.shown[1], ("second", ""))
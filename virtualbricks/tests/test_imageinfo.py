@@ -0,0 +1,188 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2018 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import struct
+
+from twisted.trial import unittest
+
+from virtualbricks import imageinfo
+from virtualbricks.tools import ImageFormat
+
+
+GiB = 1 << 30
+
+
+def qcow2(backing_file=b"", size=GiB, version=3):
+    offset = 512 if backing_file else 0
+    header = struct.pack(">4sIQIIQ", imageinfo.QCOW_MAGIC, version, offset,
+                         len(backing_file), 16, size)
+    if backing_file:
+        header = header.ljust(offset, b"\x00") + backing_file
+    return header
+
+
+def qed(backing_file=b"", size=GiB):
+    offset = 512 if backing_file else 0
+    header = imageinfo.QED_MAGIC + b"\x00" * 44
+    header += struct.pack("<QII", size, offset, len(backing_file))
+    if backing_file:
+        header = header.ljust(offset, b"\x00") + backing_file
+    return header
+
+
+def cow(backing_file, size=GiB):
+    return (struct.pack(">4sI", imageinfo.COW_MAGIC, 2) +
+            backing_file.ljust(1024, b"\x00") + struct.pack(">IQ", 0, size))
+
+
+class TestReadInfo(unittest.TestCase):
+
+    def create(self, content, name=None):
+        if name is None:
+            name = self.mktemp()
+            os.mkdir(name)
+            name = os.path.join(name, "image")
+        with open(name, "wb") as fp:
+            fp.write(content)
+        return name
+
+    def test_qcow2(self):
+        info = imageinfo.read_info(self.create(qcow2()))
+        self.assertEqual(info.format, ImageFormat.QCOW2)
+        self.assertEqual(info.virtual_size, GiB)
+        self.assertIs(info.backing_file, None)
+        self.assertIs(info.backing_path, None)
+
+    def test_qcow2_backing_file(self):
+        path = self.create(qcow2(b"/images/base.img", version=2))
+        info = imageinfo.read_info(path)
+        self.assertEqual(info.format, ImageFormat.QCOW2)
+        self.assertEqual(info.backing_file, "/images/base.img")
+        self.assertEqual(info.backing_path, "/images/base.img")
+
+    def test_qcow(self):
+        info = imageinfo.read_info(self.create(qcow2(version=1)))
+        self.assertEqual(info.format, ImageFormat.QCOW)
+
+    def test_relative_backing_file(self):
+        """Relative backing files are relative to the image."""
+
+        path = self.create(qcow2(b"base.img"))
+        info = imageinfo.read_info(path)
+        self.assertEqual(info.backing_file, "base.img")
+        self.assertEqual(info.backing_path,
+                         os.path.join(os.path.dirname(path), "base.img"))
+
+    def test_qed(self):
+        info = imageinfo.read_info(self.create(qed(b"/base.img", 2 * GiB)))
+        self.assertEqual(info.format, ImageFormat.QED)
+        self.assertEqual(info.virtual_size, 2 * GiB)
+        self.assertEqual(info.backing_file, "/base.img")
+
+    def test_cow(self):
+        info = imageinfo.read_info(self.create(cow(b"/base.img")))
+        self.assertEqual(info.format, ImageFormat.COW)
+        self.assertEqual(info.virtual_size, GiB)
+        self.assertEqual(info.backing_file, "/base.img")
+
+    def test_vdi(self):
+        header = (b"\x00" * 64 + struct.pack("<I", imageinfo.VDI_SIGNATURE))
+        header = header.ljust(368, b"\x00") + struct.pack("<Q", GiB)
+        info = imageinfo.read_info(self.create(header))
+        self.assertEqual(info.format, ImageFormat.VDI)
+        self.assertEqual(info.virtual_size, GiB)
+
+    def test_raw(self):
+        info = imageinfo.read_info(self.create(b"x" * 4096))
+        self.assertEqual(info.format, ImageFormat.RAW)
+        self.assertEqual(info.virtual_size, 4096)
+        self.assertEqual(info.size, 4096)
+
+    def test_missing(self):
+        self.assertRaises(OSError, imageinfo.read_info, self.mktemp())
+
+
+class TestImageCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = imageinfo.ImageCache()
+        self.path = os.path.abspath(self.mktemp())
+        os.mkdir(self.path)
+        self.reads = []
+        read_info = imageinfo.read_info
+
+        def counted_read_info(path, st=None):
+            self.reads.append(path)
+            return read_info(path, st)
+
+        self.patch(imageinfo, "read_info", counted_read_info)
+
+    def create(self, name, content):
+        filename = os.path.join(self.path, name)
+        with open(filename, "wb") as fp:
+            fp.write(content)
+        return filename
+
+    def test_cached(self):
+        """The header is parsed only once while the file does not change."""
+
+        path = self.create("base.img", qcow2())
+        info = self.cache.get(path)
+        self.assertIs(self.cache.get(path), info)
+        self.assertEqual(self.reads, [path])
+
+    def test_changed(self):
+        path = self.create("cow", qcow2(b"/base1.img"))
+        self.assertEqual(self.cache.get(path).backing_file, "/base1.img")
+        self.create("cow", qcow2(b"/base2.img"))
+        os.utime(path, (0, 0))
+        self.assertEqual(self.cache.get(path).backing_file, "/base2.img")
+        self.assertEqual(self.reads, [path, path])
+
+    def test_removed(self):
+        path = self.create("cow", qcow2(b"/base.img"))
+        self.cache.get(path)
+        os.remove(path)
+        self.assertRaises(OSError, self.cache.get, path)
+        self.assertEqual(self.cache.dependents("/base.img"), [])
+
+    def test_chain(self):
+        base = self.create("base.img", b"raw")
+        middle = self.create("middle.img", qcow2(b"base.img"))
+        top = self.create("top.img", qcow2(middle.encode("ascii")))
+        self.assertEqual(self.cache.chain(top), [top, middle, base])
+        self.assertEqual(self.cache.depth(top), 2)
+        self.assertEqual(self.cache.depth(base), 0)
+
+    def test_chain_loop(self):
+        path = self.create("loop.img", qcow2(b"loop.img"))
+        self.assertEqual(self.cache.chain(path), [path])
+
+    def test_dependents(self):
+        """The COWs read by the cache are indexed by their base image."""
+
+        base = self.create("base.img", b"raw")
+        cows = [self.create("vm{0}_hda.cow".format(i), qcow2(b"base.img"))
+                for i in range(3)]
+        other = self.create("other.cow", qcow2(b"/other.img"))
+        self.cache.index(cows + [other, os.path.join(self.path, "missing")])
+        self.assertEqual(self.cache.dependents(base), cows)
+        self.create("vm0_hda.cow", qcow2(b"/rebased.img"))
+        os.utime(cows[0], (0, 0))
+        self.assertEqual(self.cache.dependents(base), cows[1:])
+        self.assertEqual(self.cache.dependents("/rebased.img"), [cows[0]])
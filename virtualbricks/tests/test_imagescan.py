@@ -0,0 +1,196 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2018 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import threading
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from virtualbricks import imagescan, imageinfo
+from virtualbricks.tools import ImageFormat
+from virtualbricks.tests import stubs, test_imageinfo
+
+
+class TestImageScanner(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = stubs.FactoryStub()
+        self.path = os.path.abspath(self.mktemp())
+        os.mkdir(self.path)
+        self.patch(imageinfo, "cache", imageinfo.ImageCache())
+
+    def create(self, name, content):
+        filename = os.path.join(self.path, name)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, "wb") as fp:
+            fp.write(content)
+        return filename
+
+    @defer.inlineCallbacks
+    def test_scan(self):
+        """The images found are added to the library."""
+
+        debian = self.create("debian.qcow2", test_imageinfo.qcow2())
+        raw = self.create("nfs/raw.img", b"\x00" * 1024)
+        self.create("debian.qcow2.vbdescr", b"Debian")
+        self.create("vm_hda.cow", test_imageinfo.qcow2(b"debian.qcow2"))
+        self.create("notes.txt", b"not an image")
+        self.create(".hidden.img", b"\x00" * 512)
+        progress = []
+        scanner = imagescan.ImageScanner(self.factory, 2,
+                                         lambda *a: progress.append(a))
+        images = yield scanner.scan([self.path])
+        self.assertEqual(sorted(image.path for image in images),
+                         [debian, raw])
+        self.assertEqual(sorted(self.factory.disk_images, key=str),
+                         sorted(images, key=str))
+        self.assertEqual(progress, [(1, 3), (2, 3), (3, 3)])
+        # the headers read are cached
+        self.patch(imageinfo, "read_info", None)
+        self.assertEqual(imageinfo.cache.get(debian).format,
+                         ImageFormat.QCOW2)
+
+    @defer.inlineCallbacks
+    def test_known_images(self):
+        """The images already in the library are not read again."""
+
+        path = self.create("debian.qcow2", test_imageinfo.qcow2())
+        self.factory.new_disk_image("debian", path)
+        scanner = imagescan.ImageScanner(self.factory, 2)
+        images = yield scanner.scan([self.path])
+        self.assertEqual(images, [])
+        self.assertEqual(scanner.total, 0)
+
+    @defer.inlineCallbacks
+    def test_name_in_use(self):
+        self.factory.new_disk_image("debian.img", "/other/debian.img")
+        self.create("debian.img", b"\x00" * 512)
+        images = yield imagescan.scan(self.factory, [self.path], 2)
+        self.assertEqual(images, [])
+        self.assertEqual(len(self.factory.disk_images), 1)
+
+    @defer.inlineCallbacks
+    def test_workspace_index(self):
+        """
+        The images of the workspace are indexed but they are not added to
+        the library unless the scanimages option is set.
+        """
+
+        path = self.create("vimages/debian.img", b"\x00" * 512)
+        options = {"workspace": self.path, "scanimages": False,
+                   "concurrency": 2}
+        self.patch(imagescan.settings, "get", options.get)
+        progress = []
+        paths = yield imagescan.scan(self.factory,
+                                     progress=lambda *a: progress.append(a))
+        self.assertEqual(paths, [path])
+        self.assertEqual(progress, [(1, 1)])
+        self.assertEqual(self.factory.disk_images, [])
+        self.assertEqual(imageinfo.cache.get(path).format, ImageFormat.RAW)
+
+    @defer.inlineCallbacks
+    def test_workspace(self):
+        path = self.create("vimages/debian.img", b"\x00" * 512)
+        options = {"workspace": self.path, "scanimages": True,
+                   "concurrency": 2}
+        self.patch(imagescan.settings, "get", options.get)
+        images = yield imagescan.scan(self.factory)
+        self.assertEqual([image.path for image in images], [path])
+
+    @defer.inlineCallbacks
+    def test_read_error(self):
+        """The files that cannot be read are skipped."""
+
+        def read(path):
+            raise OSError(13, "Permission denied")
+
+        self.create("debian.img", b"\x00" * 512)
+        scanner = imagescan.ImageScanner(self.factory, 2, read=read)
+        images = yield scanner.scan([self.path])
+        self.assertEqual(images, [])
+        self.assertEqual(scanner.done, 1)
+
+    @defer.inlineCallbacks
+    def test_concurrency(self):
+        """At most concurrency files are read at the same time."""
+
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def read(path):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            try:
+                return imagescan._read(path)
+            finally:
+                with lock:
+                    running[0] -= 1
+
+        for i in range(10):
+            self.create("image{0}.img".format(i), b"\x00" * 512)
+        scanner = imagescan.ImageScanner(self.factory, 2, read=read)
+        images = yield scanner.scan([self.path])
+        self.assertEqual(len(images), 10)
+        self.assertTrue(running[1] <= 2)
+
+    def test_does_not_block(self):
+        """The scan runs in threads, the reactor is not blocked."""
+
+        walked = threading.Event()
+
+        def walk(directories):
+            walked.wait()
+            return []
+
+        scanner = imagescan.ImageScanner(self.factory, 2, walk=walk)
+        d = scanner.scan([self.path])
+        self.assertNoResult(d)
+        walked.set()
+        return d
+
+
+class TestCheckAccess(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = stubs.FactoryStub()
+        self.path = os.path.abspath(self.mktemp())
+        os.mkdir(self.path)
+
+    @defer.inlineCallbacks
+    def test_check_access(self):
+        """
+        The images that cannot be read are removed from the library unless
+        they are used.
+        """
+
+        path = os.path.join(self.path, "debian.img")
+        with open(path, "wb"):
+            pass
+        readable = self.factory.new_disk_image("debian", path)
+        missing = self.factory.new_disk_image(
+            "missing", os.path.join(self.path, "missing.img"))
+        used = self.factory.new_disk_image(
+            "used", os.path.join(self.path, "used.img"))
+        vm = self.factory.new_brick("vm", "vm")
+        vm.set_image("hda", used)
+        images = yield imagescan.check_access(
+            self.factory, [readable, missing, used], 2)
+        self.assertEqual(images, [missing, used])
+        self.assertEqual(self.factory.disk_images, [readable, used])
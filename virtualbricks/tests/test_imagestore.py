@@ -0,0 +1,241 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2018 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import stat
+
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.python import filepath
+
+from virtualbricks import imagestore, imageinfo, virtualmachines
+from virtualbricks.tests import test_imageinfo
+
+
+class DescriptorStub:
+
+    def __init__(self, images):
+        self.images = images
+
+    def get_images(self):
+        return [(("Image", name), {"path": path})
+                for name, path in self.images.items()]
+
+
+class ProjectStub:
+
+    def __init__(self, name, path, images):
+        self.name = name
+        self.path = path
+        self.images = images
+
+    def get_descriptor(self):
+        return DescriptorStub(self.images)
+
+    def files(self):
+        return (fp for fp in filepath.FilePath(self.path).walk()
+                if fp.isfile())
+
+
+class FactoryStub:
+
+    def __init__(self, images=()):
+        self.disk_images = list(images)
+
+
+class TestHashFile(unittest.TestCase):
+
+    def create(self, content):
+        path = self.mktemp()
+        with open(path, "wb") as fp:
+            fp.write(content)
+        return path
+
+    @defer.inlineCallbacks
+    def test_same_content(self):
+        content = os.urandom(1000)
+        digest1 = yield imagestore.hash_file(self.create(content), 2, 64)
+        digest2 = yield imagestore.hash_file(self.create(content), 4, 64)
+        self.assertEqual(digest1, digest2)
+        self.assertEqual(len(digest1), 64)
+
+    @defer.inlineCallbacks
+    def test_different_content(self):
+        digest1 = yield imagestore.hash_file(self.create(b"a" * 100), 2, 64)
+        digest2 = yield imagestore.hash_file(self.create(b"a" * 99 + b"b"),
+                                             2, 64)
+        self.assertNotEqual(digest1, digest2)
+
+    @defer.inlineCallbacks
+    def test_size(self):
+        """Files with the same chunks but different sizes differ."""
+
+        digest1 = yield imagestore.hash_file(self.create(b""), 2, 64)
+        digest2 = yield imagestore.hash_file(self.create(b"\x00" * 64), 2, 64)
+        self.assertNotEqual(digest1, digest2)
+
+    def test_missing(self):
+        d = imagestore.hash_file(self.mktemp(), 2)
+        return self.assertFailure(d, OSError)
+
+
+class TestImageStore(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.abspath(self.mktemp())
+        os.mkdir(self.path)
+        self.store = imagestore.ImageStore(os.path.join(self.path, "store"))
+        self.patch(imageinfo, "cache", imageinfo.ImageCache())
+
+    def create(self, name, content):
+        path = os.path.join(self.path, name)
+        with open(path, "wb") as fp:
+            fp.write(content)
+        return path
+
+    @defer.inlineCallbacks
+    def test_add(self):
+        source = self.create("debian.img", b"debian")
+        path = yield self.store.add(source)
+        self.assertTrue(self.store.contains(path))
+        self.assertEqual(self.store.list(), [path])
+        with open(path, "rb") as fp:
+            self.assertEqual(fp.read(), b"debian")
+        self.assertFalse(os.stat(path).st_mode & stat.S_IWUSR)
+        self.assertTrue(os.path.exists(source))
+        self.assertEqual(self.store.lookup(os.path.basename(path)), path)
+
+    @defer.inlineCallbacks
+    def test_deduplicate(self):
+        """The same content is stored once."""
+
+        path1 = yield self.store.add(self.create("debian.img", b"debian"))
+        source = self.create("copy.img", b"debian")
+        path2 = yield self.store.add(source, move=True)
+        self.assertEqual(path1, path2)
+        self.assertEqual(self.store.list(), [path1])
+        self.assertFalse(os.path.exists(source))
+
+    @defer.inlineCallbacks
+    def test_move(self):
+        source = self.create("debian.img", b"debian")
+        yield self.store.add(source, move=True)
+        self.assertFalse(os.path.exists(source))
+
+    @defer.inlineCallbacks
+    def test_add_stored(self):
+        path = yield self.store.add(self.create("debian.img", b"debian"))
+        self.assertEqual((yield self.store.add(path)), path)
+
+    @defer.inlineCallbacks
+    def test_intern(self):
+        image = virtualmachines.Image("debian",
+                                      self.create("debian.img", b"debian"))
+        yield self.store.intern(image)
+        self.assertEqual(self.store.list(), [image.path])
+
+    @defer.inlineCallbacks
+    def test_collect(self):
+        """The images not referenced by any project are removed."""
+
+        used = yield self.store.add(self.create("used.img", b"used"))
+        library = yield self.store.add(self.create("library.img", b"lib"))
+        backing = yield self.store.add(self.create("backing.img", b"back"))
+        unused = yield self.store.add(self.create("unused.img", b"unused"))
+        prjpath = os.path.join(self.path, "project")
+        os.mkdir(prjpath)
+        with open(os.path.join(prjpath, "vm_hda.cow"), "wb") as fp:
+            fp.write(test_imageinfo.qcow2(backing.encode("utf-8")))
+        manager = [ProjectStub("project", prjpath, {"used": used})]
+        factory = FactoryStub([virtualmachines.Image("lib", library)])
+        removed = yield self.store.collect(manager, factory)
+        self.assertEqual(removed, [unused])
+        self.assertEqual(self.store.list(), sorted([used, library, backing]))
+
+    @defer.inlineCallbacks
+    def test_collect_pinned(self):
+        """
+        The images added by an import in progress are pinned, they are not
+        removed until they are unpinned.
+        """
+
+        path = yield self.store.add(self.create("debian.img", b"debian"),
+                                    pin=True)
+        copy = yield self.store.add(self.create("copy.img", b"debian"),
+                                    pin=True)
+        self.assertEqual(copy, path)
+        self.assertEqual((yield self.store.collect([])), [])
+        self.store.unpin(path)
+        self.assertEqual((yield self.store.collect([])), [])
+        self.store.unpin(path)
+        self.assertEqual((yield self.store.collect([])), [path])
+
+    @defer.inlineCallbacks
+    def test_find_pinned(self):
+        """The images found by their checksum are pinned too."""
+
+        path = yield self.store.add(self.create("debian.img", b"debian"),
+                                    checksum="c1")
+        self.assertEqual(self.store.find("c1", pin=True), path)
+        self.assertEqual((yield self.store.collect([])), [])
+        self.store.unpin(path)
+        self.assertEqual((yield self.store.collect([])), [path])
+
+    @defer.inlineCallbacks
+    def test_collect_unreadable_project(self):
+        """Nothing is removed if a project cannot be read."""
+
+        path = yield self.store.add(self.create("unused.img", b"unused"))
+        project = ProjectStub("broken", self.path, {})
+
+        def get_descriptor():
+            raise IOError(2, "No such file or directory")
+
+        project.get_descriptor = get_descriptor
+        removed = yield self.store.collect([project])
+        self.assertEqual(removed, [])
+        self.assertEqual(self.store.list(), [path])
+
+    @defer.inlineCallbacks
+    def test_find_checksum(self):
+        """An image added with its checksum is found without hashing."""
+
+        path = yield self.store.add(self.create("debian.img", b"debian"),
+                                    checksum="c1")
+        self.assertEqual(self.store.find("c1"), path)
+        self.assertIs(self.store.find("c2"), None)
+        self.patch(imagestore, "hash_file", lambda path: defer.fail(
+            AssertionError("hashed")))
+        source = self.create("copy.img", b"debian")
+        self.assertEqual((yield self.store.add(source, True, "c1")), path)
+        self.assertFalse(os.path.exists(source))
+
+    @defer.inlineCallbacks
+    def test_index_persisted(self):
+        path = yield self.store.add(self.create("debian.img", b"debian"),
+                                    checksum="c1")
+        store = imagestore.ImageStore(self.store.path)
+        self.assertEqual(store.find("c1"), path)
+
+    @defer.inlineCallbacks
+    def test_find_collected(self):
+        """The checksums of the removed images are not found."""
+
+        yield self.store.add(self.create("debian.img", b"debian"),
+                             checksum="c1")
+        yield self.store.collect([])
+        self.assertIs(self.store.find("c1"), None)
@@ -0,0 +1,342 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2018 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from virtualbricks import (importer, project, archive, imageinfo, settings,
+                           errors, imagestore)
+from virtualbricks.tests import test_imageinfo
+
+
+PROJECT = """[Image:debian]
+path = /images/debian.img
+
+[Qemu:vm]
+hda = debian
+privatehda = *
+"""
+
+
+class RunStub:
+
+    def __init__(self):
+        self.calls = []
+        self.deferreds = []
+
+    def __call__(self, exe, args, env):
+        self.calls.append((exe, args))
+        d = defer.Deferred()
+        self.deferreds.append(d)
+        return d
+
+    def fire(self):
+        deferreds, self.deferreds = self.deferreds, []
+        for d in deferreds:
+            d.callback(("", "", 0))
+
+
+class StoreStub:
+
+    def __init__(self, path):
+        self.path = path
+        self.pinned = []
+
+    def add(self, path, move=False, checksum=None, pin=False):
+        destination = os.path.join(self.path, "digest")
+        os.rename(path, destination)
+        if pin:
+            self.pinned.append(destination)
+        return defer.succeed(destination)
+
+    def pin(self, path):
+        self.pinned.append(path)
+
+    def unpin(self, path):
+        self.pinned.remove(path)
+
+
+class TestImportPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(imageinfo, "cache", imageinfo.ImageCache())
+        self.manager = project.ProjectManager(self.mktemp())
+        self.project = self.manager.get_project("staging")
+        self.project.create()
+        with open(os.path.join(self.project.path, ".project"), "w") as fp:
+            fp.write(PROJECT)
+        self.entry = self.project.get_descriptor()
+        os.mkdir(os.path.join(self.project.path, ".images"))
+        self.source = os.path.join(self.project.path, ".images", "debian")
+        with open(self.source, "wb") as fp:
+            fp.write(b"debian")
+        self.cow = os.path.join(self.project.path, "vm_hda.cow")
+        with open(self.cow, "wb") as fp:
+            fp.write(test_imageinfo.qcow2(b"/images/debian.img"))
+        self.destination = os.path.abspath(os.path.join(self.mktemp(),
+                                                        "debian.img"))
+        self.run = RunStub()
+        self.pipeline = importer.ImportPipeline(self.project, self.entry, 2,
+                                                run=self.run)
+
+    @defer.inlineCallbacks
+    def test_move(self):
+        """The COWs are rebased after the image is moved."""
+
+        self.pipeline.move("debian", self.destination)
+        d = self.pipeline.wait()
+        while not self.run.calls:
+            yield importer.threads.deferToThread(lambda: None)
+        self.assertEqual(self.run.calls, [
+            ("qemu-img", ["rebase", "-u", "-b", self.destination, self.cow])])
+        self.assertNoResult(d)
+        self.run.fire()
+        images = yield d
+        self.assertEqual(images, {"debian": self.destination})
+        self.assertFalse(os.path.exists(self.source))
+        with open(self.destination, "rb") as fp:
+            self.assertEqual(fp.read(), b"debian")
+        self.assertEqual(self.entry.sections[("Image", "debian")]["path"],
+                         self.destination)
+
+    def test_place(self):
+        """A mapped image is not moved."""
+
+        self.pipeline.place("debian", "/vimages/debian.img")
+        self.assertEqual(len(self.run.calls), 1)
+        self.run.fire()
+        d = self.pipeline.wait()
+        self.assertEqual(self.successResultOf(d),
+                         {"debian": "/vimages/debian.img"})
+        self.assertTrue(os.path.exists(self.source))
+
+    def test_already_backed(self):
+        """The COW is not rebased if it uses already the image."""
+
+        self.pipeline.place("debian", "/images/debian.img")
+        self.assertEqual(self.run.calls, [])
+
+    def test_bounded_rebases(self):
+        for i in range(4):
+            vm = "[Qemu:vm{0}]\nhda = debian\n".format(i)
+            with open(os.path.join(self.project.path, ".project"),
+                      "a") as fp:
+                fp.write(vm)
+            with open(os.path.join(self.project.path,
+                                   "vm{0}_hda.cow".format(i)), "wb") as fp:
+                fp.write(test_imageinfo.qcow2(b"/images/debian.img"))
+        self.pipeline.set_entry(self.project.get_descriptor())
+        self.pipeline.place("debian", "/vimages/debian.img")
+        self.assertEqual(len(self.run.calls), 2)
+        d = self.pipeline.wait()
+        while self.run.deferreds:
+            self.run.fire()
+        self.successResultOf(d)
+        self.assertEqual(len(self.run.calls), 5)
+
+    def test_entry_later(self):
+        """Without the descriptor the COWs are rebased later."""
+
+        pipeline = importer.ImportPipeline(self.project, None, 2,
+                                           run=self.run)
+        pipeline.place("debian", "/vimages/debian.img")
+        self.assertEqual(self.run.calls, [])
+        pipeline.set_entry(self.entry)
+        self.assertEqual(len(self.run.calls), 1)
+
+    def test_missing_image(self):
+        self.pipeline.move("ubuntu", self.destination)
+        self.assertEqual(self.successResultOf(self.pipeline.wait()), {})
+
+    @defer.inlineCallbacks
+    def test_store(self):
+        store = os.path.abspath(self.mktemp())
+        os.mkdir(store)
+        stub = StoreStub(store)
+        pipeline = importer.ImportPipeline(self.project, self.entry, 2,
+                                           stub, self.run)
+        pipeline.move("debian", self.destination)
+        self.run.fire()
+        images = yield pipeline.wait()
+        self.assertEqual(images, {"debian": os.path.join(store, "digest")})
+        self.assertFalse(os.path.exists(self.destination))
+        # the images are pinned until the project is saved
+        self.assertEqual(stub.pinned, [os.path.join(store, "digest")])
+        pipeline.release()
+        self.assertEqual(stub.pinned, [])
+
+    @defer.inlineCallbacks
+    def test_rollback(self):
+        self.pipeline.move("debian", self.destination)
+        d = self.pipeline.wait()
+        while not self.run.calls:
+            yield importer.threads.deferToThread(lambda: None)
+        self.run.fire()
+        yield d
+        yield self.pipeline.rollback()
+        self.assertTrue(os.path.exists(self.source))
+        self.assertFalse(os.path.exists(self.destination))
+
+    def test_move_error(self):
+        """The first error of the moves is returned."""
+
+        os.makedirs(self.destination)
+        with open(os.path.join(self.destination, "file"), "w"):
+            pass
+        self.pipeline.move("debian", self.destination)
+        return self.assertFailure(self.pipeline.wait(), OSError)
+
+
+class TestRelocate(unittest.TestCase):
+
+    def test_other_file_system(self):
+        """The file is copied if it cannot be renamed."""
+
+        source = self.mktemp()
+        with open(source, "wb") as fp:
+            fp.write(b"debian")
+        destination = os.path.join(self.mktemp(), "debian.img")
+
+        def rename(src, dst, rename=os.rename):
+            if src == source:
+                raise OSError(importer.errno.EXDEV, "Cross-device link")
+            rename(src, dst)
+
+        self.patch(importer.os, "rename", rename)
+        importer.relocate(source, destination)
+        self.assertFalse(os.path.exists(source))
+        self.assertFalse(os.path.exists(destination + ".part"))
+        with open(destination, "rb") as fp:
+            self.assertEqual(fp.read(), b"debian")
+
+
+class TestImportArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.home = os.path.abspath(self.mktemp())
+        os.mkdir(self.home)
+        self.patch(settings, "VIRTUALBRICKS_HOME", self.home)
+        self.patch(imageinfo, "cache", imageinfo.ImageCache())
+        with open(os.path.join(self.home, ".project"), "w") as fp:
+            fp.write("[Image:debian]\npath = /images/debian.img\n\n")
+        self.image = os.path.join(self.home, "debian.img")
+        with open(self.image, "wb") as fp:
+            fp.write(b"debian")
+        self.archive = os.path.join(self.home, "test.vbp")
+        self.manager = project.ProjectManager(self.mktemp())
+        self.vimages = os.path.abspath(self.mktemp())
+
+    def destination(self, name):
+        return os.path.join(self.vimages, name)
+
+    @defer.inlineCallbacks
+    def test_import(self):
+        yield archive.create(self.archive, [".project"],
+                             [("debian", self.image)], workers=1)
+        prj = yield importer.import_archive(self.archive, "test", False,
+                                            self.destination, self.manager, 2)
+        self.assertEqual(prj.name, "test")
+        self.assertEqual(list(self.manager), [prj])
+        entry = prj.get_descriptor()
+        self.assertEqual(entry.sections[("Image", "debian")]["path"],
+                         self.destination("debian"))
+        with open(self.destination("debian"), "rb") as fp:
+            self.assertEqual(fp.read(), b"debian")
+        self.assertEqual(prj.images(), [])
+
+    @defer.inlineCallbacks
+    def test_resume_moved(self):
+        """
+        The images moved by an interrupted import are not extracted again.
+        """
+
+        yield archive.create(self.archive, [".project"],
+                             [("debian", self.image)], workers=1)
+        staging = self.manager.get_project(
+            importer.staging_name(self.archive))
+        staging.create()
+        files = []
+        yield archive.extract(self.archive, staging.path,
+                              lambda *args: files.append(args))
+        os.mkdir(self.vimages)
+        moved = self.destination("debian")
+        os.rename(os.path.join(staging.path, ".images", "debian"), moved)
+        archive.record_moved(staging.path, self.archive, ".images/debian",
+                             moved, files[1][2])
+        st = os.stat(moved)
+        prj = yield importer.import_archive(self.archive, "test", False,
+                                            self.destination, self.manager, 2)
+        entry = prj.get_descriptor()
+        self.assertEqual(entry.sections[("Image", "debian")]["path"], moved)
+        self.assertEqual(os.listdir(self.vimages), ["debian"])
+        self.assertEqual(os.stat(moved).st_ino, st.st_ino)
+        self.assertFalse(archive.can_resume(prj.path))
+
+    @defer.inlineCallbacks
+    def test_import_exists(self):
+        """The moved images are moved back if the import fails."""
+
+        yield archive.create(self.archive, [".project"],
+                             [("debian", self.image)], workers=1)
+        self.manager.get_project("test").create()
+        d = importer.import_archive(self.archive, "test", False,
+                                    self.destination, self.manager, 2)
+        yield self.assertFailure(d, errors.ProjectExistsError)
+        self.assertFalse(os.path.exists(self.destination("debian")))
+        staging = self.manager.get_project(
+            importer.staging_name(self.archive))
+        self.assertEqual(staging.images(), ["debian"])
+
+    @defer.inlineCallbacks
+    def test_stale_staging(self):
+        """A staging project left by a completed extraction is replaced."""
+
+        staging = self.manager.get_project(
+            importer.staging_name(self.archive))
+        staging.create()
+        with open(os.path.join(staging.path, "stale"), "w"):
+            pass
+        yield archive.create(self.archive, [".project"], workers=1)
+        yield importer.extract(staging.name, self.archive, self.manager)
+        self.assertFalse(os.path.exists(os.path.join(staging.path, "stale")))
+
+    @defer.inlineCallbacks
+    def test_import_stored(self):
+        """
+        An image already in the store is found by its checksum, it is not
+        hashed again.
+        """
+
+        store = imagestore.ImageStore(os.path.abspath(self.mktemp()))
+        yield archive.create(self.archive, [".project"],
+                             [("debian", self.image)], workers=1)
+        first = yield importer.import_archive(
+            self.archive, "first", manager=self.manager, concurrency=2,
+            store=store)
+        self.patch(imagestore, "hash_file", lambda path: defer.fail(
+            AssertionError("hashed")))
+        second = yield importer.import_archive(
+            self.archive, "second", manager=self.manager, concurrency=2,
+            store=store)
+        path = first.get_descriptor().sections[("Image", "debian")]["path"]
+        self.assertTrue(store.contains(path))
+        self.assertFalse(imagestore._pinned)
+        self.assertEqual(
+            second.get_descriptor().sections[("Image", "debian")]["path"],
+            path)
@@ -0,0 +1,460 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2018 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import stat
+import shutil
+
+from twisted.trial import unittest
+from twisted.internet import defer, error
+
+from virtualbricks import lab, errors, project, imageinfo
+from virtualbricks.tests import (successResultOf, failureResultOf,
+                                 test_imageinfo)
+
+
+class BrickStub:
+
+    type = "Switch"
+    proc = None
+
+    def __init__(self, name, log):
+        self.name = name
+        self.log = log
+        self.config = {"snapshot": False}
+
+    def get_type(self):
+        return self.type
+
+    def poweron(self):
+        self.log.append(("poweron", self.name))
+        self.proc = object()
+        return defer.succeed(self)
+
+    def poweroff(self):
+        self.log.append(("poweroff", self.name))
+        self.proc = None
+        return defer.succeed((self, None))
+
+
+class VMStub(BrickStub):
+
+    type = "Qemu"
+
+    def __init__(self, name, log):
+        BrickStub.__init__(self, name, log)
+        self.pending = []
+
+    def wait_qmp(self):
+        return defer.succeed(None)
+
+    def save_state(self, path):
+        self.log.append(("save", self.name))
+        d = defer.Deferred()
+        self.pending.append(d)
+
+        def saved(_):
+            with open(path, "w") as fp:
+                fp.write("state")
+            self.proc = None
+
+        return d.addCallback(saved)
+
+    def restore_state(self, path):
+        self.log.append(("restore", self.name))
+        self.proc = object()
+        return defer.succeed(self)
+
+
+class DiskStub:
+
+    def __init__(self, path, cow=True):
+        self.image = object()
+        self.cow = cow
+        self.path = path
+
+    def get_cow_path(self):
+        return self.path
+
+
+class FactoryStub:
+
+    def __init__(self, bricks):
+        self.bricks = bricks
+
+    def get_brick_by_name(self, name):
+        for brick in self.bricks:
+            if brick.name == name:
+                return brick
+
+
+class TestHibernate(unittest.TestCase):
+
+    def setUp(self):
+        self.log = []
+        self.path = self.mktemp()
+        os.mkdir(self.path)
+        self.switch = BrickStub("switch", self.log)
+        self.switch.proc = object()
+        self.vms = [VMStub("vm{0}".format(i), self.log) for i in range(3)]
+        for vm in self.vms:
+            vm.proc = object()
+        self.factory = FactoryStub([self.switch] + self.vms)
+
+    def save_all(self):
+        for vm in self.vms:
+            for d in vm.pending:
+                if not d.called:
+                    d.callback(None)
+
+    def test_concurrency(self):
+        """At most concurrency states are saved at the same time."""
+
+        d = lab.hibernate(self.factory, self.path, concurrency=2)
+        self.assertEqual(self.log, [("save", "vm0"), ("save", "vm1")])
+        self.vms[0].pending[0].callback(None)
+        self.assertEqual(self.log[-1], ("save", "vm2"))
+        self.save_all()
+        self.assertEqual(successResultOf(self, d), self.vms)
+        self.assertEqual(self.log[-1], ("poweroff", "switch"))
+        self.assertTrue(lab.is_hibernated(self.path))
+
+    def test_save_failed(self):
+        """If a state is not saved the lab is left running."""
+
+        d = lab.hibernate(self.factory, self.path, concurrency=3)
+        self.vms[1].pending[0].errback(errors.MigrationError("failed"))
+        self.save_all()
+        self.assertEqual(successResultOf(self, d),
+                         [self.vms[0], self.vms[2]])
+        self.assertIsNot(self.switch.proc, None)
+        self.assertFalse(os.path.exists(lab.state_path(self.path,
+                                                       self.vms[1])))
+        self.flushLoggedErrors(errors.MigrationError)
+
+    def test_snapshot_mode(self):
+        """Virtual machines in snapshot mode are stopped without a state."""
+
+        self.vms[2].config["snapshot"] = True
+        d = lab.hibernate(self.factory, self.path, concurrency=3)
+        self.save_all()
+        self.assertEqual(successResultOf(self, d), self.vms[:2])
+        self.assertIn(("poweroff", "vm2"), self.log)
+
+    def test_resume(self):
+        """The bricks without a state are started before the others."""
+
+        d = lab.hibernate(self.factory, self.path, concurrency=3)
+        self.save_all()
+        successResultOf(self, d)
+        del self.log[:]
+        d = lab.resume(self.factory, self.path, concurrency=3)
+        self.assertEqual(successResultOf(self, d),
+                         [self.switch] + self.vms)
+        self.assertEqual(self.log, [("poweron", "switch"),
+                                    ("restore", "vm0"),
+                                    ("restore", "vm1"),
+                                    ("restore", "vm2")])
+        self.assertFalse(lab.is_hibernated(self.path))
+        self.assertFalse(os.path.exists(lab.state_path(self.path,
+                                                       self.vms[0])))
+
+    def test_resume_boot_on_error(self):
+        d = lab.hibernate(self.factory, self.path, concurrency=3)
+        self.save_all()
+        successResultOf(self, d)
+        self.vms[0].restore_state = lambda path: defer.fail(
+            errors.MigrationError("invalid state"))
+        del self.log[:]
+        successResultOf(self, lab.resume(self.factory, self.path))
+        self.assertIn(("poweron", "vm0"), self.log)
+        self.flushLoggedErrors(errors.MigrationError)
+
+    def test_resume_not_hibernated(self):
+        self.assertEqual(successResultOf(self, lab.resume(self.factory,
+                                                          self.path)), [])
+
+
+class TestCheckpoints(unittest.TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        os.mkdir(self.path)
+        self.commands = []
+        self.patch(lab, "_qemu_img", self.qemu_img)
+        self.patch(lab, "_copy", self.copy)
+        self.qcow2 = self.create("vm1_hda.cow", lab.QCOW2_MAGIC + b"data")
+        self.cow = self.create("vm1_hdb.cow", b"OOOMdata")
+        self.absent = os.path.join(self.path, "vm2_hda.cow")
+        vm1 = VMStub("vm1", [])
+        vm1.disks = lambda: [DiskStub(self.qcow2), DiskStub(self.cow),
+                             DiskStub("/nonexistent/base", False)]
+        self.vm2 = VMStub("vm2", [])
+        self.vm2.disks = lambda: [DiskStub(self.absent)]
+        self.factory = FactoryStub([BrickStub("switch", []), vm1, self.vm2])
+
+    def create(self, name, content):
+        filename = os.path.join(self.path, name)
+        with open(filename, "wb") as fp:
+            fp.write(content)
+        return filename
+
+    def qemu_img(self, args, filename):
+        self.commands.append(["qemu-img"] + args)
+        return defer.succeed(None)
+
+    def copy(self, source, destination):
+        self.commands.append(["cp", source, destination])
+        return defer.succeed(None)
+
+    def test_checkpoint(self):
+        d = lab.checkpoint(self.factory, self.path, "base")
+        self.assertEqual(successResultOf(self, d), 3)
+        directory = lab.checkpoint_dir(self.path, "base")
+        self.assertEqual(self.commands, [
+            ["qemu-img", "snapshot", "-c", "base", self.qcow2],
+            ["cp", self.cow, os.path.join(directory, "vm1_hdb.cow")]])
+        self.assertEqual(lab.checkpoints(self.path), ["base"])
+
+    def test_checkpoint_running(self):
+        """Checkpoints are created only with the virtual machines off."""
+
+        self.vm2.proc = object()
+        d = lab.checkpoint(self.factory, self.path, "base")
+        failureResultOf(self, d, errors.BrickRunningError)
+        self.assertEqual(lab.checkpoints(self.path), [])
+
+    def test_checkpoint_exists(self):
+        successResultOf(self, lab.checkpoint(self.factory, self.path, "base"))
+        failureResultOf(self, lab.checkpoint(self.factory, self.path, "base"),
+                        errors.NameAlreadyInUseError)
+
+    def test_invalid_name(self):
+        self.assertRaises(errors.InvalidNameError, lab.checkpoint,
+                          self.factory, self.path, "../base")
+
+    def test_checkpoint_error(self):
+        """The checkpoint is not recorded if a disk is not saved."""
+
+        self.patch(lab, "_copy", lambda *a: defer.fail(
+            error.ProcessTerminated(1)))
+        d = lab.checkpoint(self.factory, self.path, "base")
+        failureResultOf(self, d, error.ProcessTerminated)
+        self.assertEqual(lab.checkpoints(self.path), [])
+
+    def test_checkpoint_error_rollback(self):
+        """
+        The snapshots already taken are removed if a disk is not saved and
+        the name can be used again.
+        """
+
+        self.patch(lab, "_copy", lambda *a: defer.fail(
+            error.ProcessTerminated(1)))
+        d = lab.checkpoint(self.factory, self.path, "base")
+        failureResultOf(self, d, error.ProcessTerminated)
+        self.assertEqual(self.commands, [
+            ["qemu-img", "snapshot", "-c", "base", self.qcow2],
+            ["qemu-img", "snapshot", "-d", "base", self.qcow2]])
+        self.assertFalse(os.path.exists(lab.checkpoint_dir(self.path,
+                                                           "base")))
+        self.patch(lab, "_copy", self.copy)
+        d = lab.checkpoint(self.factory, self.path, "base")
+        self.assertEqual(successResultOf(self, d), 3)
+
+    def test_reset(self):
+        successResultOf(self, lab.checkpoint(self.factory, self.path, "base"))
+        del self.commands[:]
+        self.create("vm2_hda.cow", b"changes")
+        d = lab.reset(self.factory, self.path, "base")
+        self.assertEqual(successResultOf(self, d), 3)
+        directory = lab.checkpoint_dir(self.path, "base")
+        self.assertEqual(self.commands, [
+            ["qemu-img", "snapshot", "-a", "base", self.qcow2],
+            ["cp", os.path.join(directory, "vm1_hdb.cow"), self.cow]])
+        self.assertFalse(os.path.exists(self.absent))
+
+    def test_reset_copy(self):
+        """
+        The checkpoints copied with the project reset the COWs of the copy.
+        """
+
+        successResultOf(self, lab.checkpoint(self.factory, self.path, "base"))
+        del self.commands[:]
+        copy = self.mktemp()
+        shutil.copytree(self.path, copy)
+        vm = VMStub("vm1", [])
+        qcow2 = os.path.join(copy, "vm1_hda.cow")
+        vm.disks = lambda: [DiskStub(qcow2)]
+        d = lab.reset(FactoryStub([vm]), copy, "base")
+        self.assertEqual(successResultOf(self, d), 3)
+        self.assertEqual(self.commands, [
+            ["qemu-img", "snapshot", "-a", "base", qcow2],
+            ["cp", os.path.join(lab.checkpoint_dir(copy, "base"),
+                                "vm1_hdb.cow"),
+             os.path.join(copy, "vm1_hdb.cow")]])
+
+    def test_reset_unknown(self):
+        failureResultOf(self, lab.reset(self.factory, self.path, "base"),
+                        errors.InvalidNameError)
+
+    def test_reset_concurrency(self):
+        successResultOf(self, lab.checkpoint(self.factory, self.path, "base"))
+        pending = []
+
+        def qemu_img(args, filename):
+            pending.append(defer.Deferred())
+            return pending[-1]
+
+        self.patch(lab, "_qemu_img", qemu_img)
+        self.patch(lab, "_copy", qemu_img)
+        d = lab.reset(self.factory, self.path, "base", concurrency=1)
+        self.assertEqual(len(pending), 1)
+        pending[0].callback(None)
+        self.assertEqual(len(pending), 2)
+        pending[1].callback(None)
+        successResultOf(self, d)
+
+    def test_remove_checkpoint(self):
+        successResultOf(self, lab.checkpoint(self.factory, self.path, "base"))
+        del self.commands[:]
+        successResultOf(self, lab.remove_checkpoint(self.path, "base"))
+        self.assertEqual(self.commands, [
+            ["qemu-img", "snapshot", "-d", "base", self.qcow2]])
+        self.assertEqual(lab.checkpoints(self.path), [])
+
+
+class ProjectStub:
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+
+    def save(self, factory):
+        pass
+
+
+class TestClones(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(imageinfo, "cache", imageinfo.ImageCache())
+        self.manager = project.ProjectManager(os.path.abspath(self.mktemp()))
+        self.prj = ProjectStub(os.path.join(self.manager.path, "lab"))
+        os.makedirs(os.path.join(self.prj.path, lab.CHECKPOINTS_DIR))
+        self.base = os.path.join(self.manager.path, "base.img")
+        with open(self.base, "wb") as fp:
+            fp.write(b"\x00" * 512)
+        self.cow = os.path.join(self.prj.path, "vm_hda.cow")
+        with open(self.cow, "wb") as fp:
+            fp.write(test_imageinfo.qcow2(self.base.encode("utf-8")))
+        with open(os.path.join(self.prj.path, ".project"), "w") as fp:
+            fp.write("[Qemu:vm]\n")
+        with open(self.cow + ".back-2018-01-01_00-00-00", "w"):
+            pass
+        self.vm = VMStub("vm", [])
+        self.vm.disks = lambda: [DiskStub(self.cow)]
+        self.factory = FactoryStub([self.vm])
+        self.commands = []
+        self.patch(lab, "_qemu_img", self.qemu_img)
+
+    def qemu_img(self, args, filename):
+        self.commands.append(["qemu-img"] + args)
+        if args[0] == "create":
+            with open(args[-1], "wb") as fp:
+                fp.write(test_imageinfo.qcow2(args[-2].encode("utf-8")))
+        return defer.succeed(None)
+
+    def clone(self):
+        return lab.clone(self.factory, self.prj, "clone", 2, self.manager)
+
+    def writable(self, filename):
+        return bool(os.stat(filename).st_mode & stat.S_IWUSR)
+
+    @defer.inlineCallbacks
+    def test_clone(self):
+        """The COWs of the clone are overlays of the original COWs."""
+
+        new = yield self.clone()
+        target = os.path.join(new.path, "vm_hda.cow")
+        self.assertEqual(self.commands, [
+            ["qemu-img", "create", "-f", "qcow2", "-F", "qcow2", "-b",
+             self.cow, target]])
+        self.assertEqual(sorted(os.listdir(new.path)),
+                         [".project", "vm_hda.cow"])
+        self.assertTrue(project.is_frozen(self.prj.path))
+        self.assertEqual(lab.clones(self.prj.path), [new.path])
+        self.assertFalse(self.writable(self.cow))
+
+    def test_clone_running(self):
+        self.vm.proc = object()
+        failureResultOf(self, self.clone(), errors.BrickRunningError)
+        self.assertFalse(self.manager.get_project("clone").exists())
+
+    @defer.inlineCallbacks
+    def test_clone_error(self):
+        """The clone is removed and the original thawed on errors."""
+
+        self.patch(lab, "_qemu_img", lambda *a: defer.fail(
+            error.ProcessTerminated(1)))
+        yield self.assertFailure(self.clone(), error.ProcessTerminated)
+        self.assertFalse(self.manager.get_project("clone").exists())
+        self.assertFalse(project.is_frozen(self.prj.path))
+        self.assertTrue(self.writable(self.cow))
+
+    @defer.inlineCallbacks
+    def test_flatten(self):
+        """The COWs of the clone are rebased on the image."""
+
+        new = yield self.clone()
+        del self.commands[:]
+        target = os.path.join(new.path, "vm_hda.cow")
+        self.vm.disks = lambda: [DiskStub(target)]
+        count = yield lab.flatten(self.factory, new.path)
+        self.assertEqual(count, 1)
+        self.assertEqual(self.commands, [
+            ["qemu-img", "rebase", "-f", "qcow2", "-b", self.base, "-F",
+             "raw", target]])
+
+    @defer.inlineCallbacks
+    def test_frozen_checkpoints(self):
+        """The checkpoints of a frozen project cannot be used."""
+
+        successResultOf(self, lab.checkpoint(self.factory, self.prj.path,
+                                             "base"))
+        yield self.clone()
+        del self.commands[:]
+        failureResultOf(self, lab.checkpoint(self.factory, self.prj.path,
+                                             "new"),
+                        errors.ProjectFrozenError)
+        failureResultOf(self, lab.reset(self.factory, self.prj.path, "base"),
+                        errors.ProjectFrozenError)
+        failureResultOf(self, lab.remove_checkpoint(self.prj.path, "base"),
+                        errors.ProjectFrozenError)
+        self.assertEqual(self.commands, [])
+        self.assertEqual(lab.checkpoints(self.prj.path), ["base"])
+
+    @defer.inlineCallbacks
+    def test_thaw(self):
+        """The original is thawed only when no clone depends on it."""
+
+        new = yield self.clone()
+        self.assertRaises(errors.ProjectFrozenError, lab.thaw, self.prj.path)
+        # the effect of flatten
+        with open(os.path.join(new.path, "vm_hda.cow"), "wb") as fp:
+            fp.write(test_imageinfo.qcow2(self.base.encode("utf-8")))
+        lab.thaw(self.prj.path)
+        self.assertFalse(project.is_frozen(self.prj.path))
+        self.assertTrue(self.writable(self.cow))
@@ -216,9 +216,34 @@ class TestProject(unittest.TestCase):
         manager = project.ProjectManager(self.mktemp())
         prj = manager.get_project(NAME)
         prj.create()
-        new = prj.save_as(NEW_PROJET_NAME, Factory())
-        self.assertTrue(FilePath(new.path).exists())
-        self.assertNotEqual(prj.path, new.path)
+        FilePath(prj.path).child("vm_hda.cow").setContent(b"cow")
+
+        def check(new):
+            self.assertTrue(FilePath(new.path).exists())
+            self.assertNotEqual(prj.path, new.path)
+            self.assertEqual(FilePath(new.path).child("vm_hda.cow")
+                             .getContent(), b"cow")
+
+        return prj.save_as(NEW_PROJET_NAME, Factory()).addCallback(check)
+
+    def test_save_as_frozen(self):
+        """The COWs of the copy of a frozen project are writable."""
+
+        manager = project.ProjectManager(self.mktemp())
+        prj = manager.get_project(NAME)
+        prj.create()
+        cow = FilePath(prj.path).child("vm_hda.cow")
+        cow.setContent(b"cow")
+        cow.chmod(0o444)
+        FilePath(prj.path).child(project.FROZEN).setContent(b"clone\n")
+
+        def check(new):
+            self.assertFalse(project.is_frozen(new.path))
+            copy = FilePath(new.path).child("vm_hda.cow")
+            self.assertTrue(copy.getPermissions().user.write)
+            self.assertFalse(cow.getPermissions().user.write)
+
+        return prj.save_as("copy", Factory()).addCallback(check)
 
     def test_rename(self):
         """Rename a project."""
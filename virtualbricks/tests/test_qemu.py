@@ -0,0 +1,186 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2018 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from virtualbricks import qemu
+
+
+VERSION = b"QEMU emulator version 8.2.2 (Debian 1:8.2.2+ds-0ubuntu1)\n"
+MACHINES = b"""\
+Supported machines are:
+microvm              microvm (i386)
+pc                   Standard PC (i440FX + PIIX, 1996) (alias of pc-i440fx-8.2)
+q35                  Standard PC (Q35 + ICH9, 2009) (alias of pc-q35-8.2)
+none                 empty machine
+"""
+CPUS = b"""\
+Available CPUs:
+x86 486                   (alias configured by machine type)
+x86 Broadwell             Intel Core Processor (Broadwell)
+x86 qemu64                QEMU Virtual CPU version 2.5+
+
+Recognized CPUID flags:
+  3dnow 3dnowext 3dnowprefetch abm ace2 acpi adx aes amd-no-ssb
+"""
+DEVICES = b"""\
+Controller/Bridge/Hub devices:
+name "i82801b11-bridge", bus PCI
+
+Network devices:
+name "e1000", bus PCI, alias "e1000-82540em", desc "Intel Gigabit Ethernet"
+name "virtio-net-pci", bus PCI, alias "virtio-net"
+"""
+OUTPUTS = {"-version": VERSION, "-machine": MACHINES, "-cpu": CPUS,
+           "-device": DEVICES}
+
+
+class TestParsers(unittest.TestCase):
+
+    def test_machines(self):
+        machines = qemu.parse_machines(MACHINES.decode())
+        self.assertEqual(machines[0], ("microvm", "microvm (i386)"))
+        self.assertEqual([name for name, _ in machines],
+                         ["microvm", "pc", "q35", "none"])
+
+    def test_cpus(self):
+        """The cpu flags are not cpus."""
+
+        cpus = qemu.parse_cpus(CPUS.decode())
+        self.assertEqual(cpus, [
+            ("486", "(alias configured by machine type)"),
+            ("Broadwell", "Intel Core Processor (Broadwell)"),
+            ("qemu64", "QEMU Virtual CPU version 2.5+")])
+
+    def test_cpus_without_description(self):
+        cpus = qemu.parse_cpus("Available CPUs:\n  a64fx\n  cortex-a53\n")
+        self.assertEqual(cpus, [("a64fx", "a64fx"),
+                                ("cortex-a53", "cortex-a53")])
+
+    def test_devices(self):
+        devices = qemu.parse_devices(DEVICES.decode())
+        self.assertEqual(devices["Network devices"], [
+            ("e1000", "Intel Gigabit Ethernet"),
+            ("virtio-net-pci", "virtio-net-pci")])
+        self.assertEqual(devices["Controller/Bridge/Hub devices"],
+                         [("i82801b11-bridge", "i82801b11-bridge")])
+
+
+class TestCapabilityDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = self.mktemp()
+        os.mkdir(self.directory)
+        self.x86 = self.executable("qemu-system-x86_64")
+        self.executable("qemu-img")
+        self.filename = self.mktemp()
+        self.calls = []
+        self.db = self.database()
+
+    def executable(self, name):
+        path = os.path.join(self.directory, name)
+        with open(path, "w"):
+            pass
+        os.chmod(path, 0o755)
+        return path
+
+    def database(self):
+        return qemu.CapabilityDatabase(self.filename, self.spawn)
+
+    def spawn(self, path, args, env):
+        self.calls.append((path, args[0]))
+        return defer.succeed((OUTPUTS[args[0]], b"", 0))
+
+    def discover(self, db=None):
+        return (db or self.db).discover(self.directory, 2)
+
+    def test_discover(self):
+        caps = self.successResultOf(self.discover())
+        self.assertEqual(len(caps), 1)
+        self.assertEqual(caps[0].name, "qemu-system-x86_64")
+        self.assertEqual(caps[0].arch, "x86_64")
+        self.assertEqual(caps[0].version, "8.2.2")
+        self.assertEqual(len(self.calls), len(qemu.PROBES))
+        self.assertIs(self.db.lookup("qemu-system-x86_64", self.directory),
+                      caps[0])
+
+    def test_probed_once(self):
+        """The executables are probed only if they changed."""
+
+        self.successResultOf(self.discover())
+        self.successResultOf(self.discover())
+        self.assertEqual(len(self.calls), len(qemu.PROBES))
+        os.utime(self.x86, (0, 0))
+        self.successResultOf(self.discover())
+        self.assertEqual(len(self.calls), 2 * len(qemu.PROBES))
+
+    def test_persisted(self):
+        """The capabilities are read from the cache by another session."""
+
+        self.successResultOf(self.discover())
+        db = self.database()
+        caps = db.known(self.directory)
+        self.assertEqual(len(caps), 1)
+        self.assertEqual(caps[0].cpus[1],
+                         ("Broadwell", "Intel Core Processor (Broadwell)"))
+        self.successResultOf(self.discover(db))
+        self.assertEqual(len(self.calls), len(qemu.PROBES))
+
+    def test_corrupted_cache(self):
+        with open(self.filename, "w") as fp:
+            fp.write("{")
+        self.assertEqual(self.db.known(self.directory), [])
+
+    def test_probe_error(self):
+        """An executable that does not answer -version is skipped."""
+
+        self.spawn = lambda path, args, env: defer.succeed((b"", b"", 1))
+        self.db = self.database()
+        self.assertEqual(self.successResultOf(self.discover()), [])
+        self.flushLoggedErrors(ValueError)
+
+    def test_coalesce(self):
+        """A discovery waits for the one already running."""
+
+        pending = []
+
+        def spawn(path, args, env):
+            pending.append(defer.Deferred())
+            return pending[-1]
+
+        self.spawn = spawn
+        self.db = self.database()
+        d1 = self.discover()
+        d2 = self.discover()
+        self.assertEqual(len(pending), len(qemu.PROBES))
+        for d, args in zip(pending, qemu.PROBES):
+            d.callback((OUTPUTS[args[0]], b"", 0))
+        self.assertEqual(len(self.successResultOf(d1)), 1)
+        self.assertEqual(len(self.successResultOf(d2)), 1)
+
+    def test_served_synchronously(self):
+        self.patch(qemu, "capabilities", self.db)
+        self.successResultOf(self.discover())
+        self.patch(qemu.settings, "get", lambda name: self.directory)
+        self.assertEqual(qemu.get_executables(),
+                         [("qemu-system-x86_64", "x86_64")])
+        self.assertEqual(qemu.get_machines("qemu-system-x86_64")[1][0], "pc")
+        self.assertEqual(qemu.get_devices("qemu-system-x86_64",
+                                          "Network devices")[0][0], "e1000")
@@ -0,0 +1,348 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2018 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import json
+
+from twisted.trial import unittest
+from twisted.internet import reactor, protocol, defer, error, task
+from twisted.protocols import basic
+from twisted.test import proto_helpers
+
+from virtualbricks import qmp, errors
+from virtualbricks.tests import successResultOf, failureResultOf
+
+
+GREETING = {"QMP": {"version": {"qemu": {"major": 8, "minor": 2,
+                                         "micro": 0},
+                                "package": ""},
+                    "capabilities": []}}
+
+
+class HandlerStub:
+
+    def __init__(self):
+        self.events = []
+        self.lost = []
+
+    def qmp_event_received(self, name, data, timestamp):
+        self.events.append((name, data))
+
+    def qmp_connection_lost(self, reason):
+        self.lost.append(reason)
+
+
+class QMPServerStub(basic.LineOnlyReceiver):
+    """
+    A fake QMP server.
+
+    Replies to the commands using the C{commands} mapping of the factory, a
+    command can be a value, which is returned as is, a callable, that is
+    called with the arguments of the command, or an instance of
+    L{errors.QMPError}, which is returned as an error. Unknown commands
+    return a C{CommandNotFound} error.
+    """
+
+    delimiter = b"\n"
+
+    def connectionMade(self):
+        self.factory.clients.append(self)
+        self.send(GREETING)
+
+    def send(self, message):
+        self.transport.write(json.dumps(message).encode("utf-8") + b"\r\n")
+
+    def send_event(self, name, data=None):
+        self.send({"event": name, "data": data or {},
+                   "timestamp": {"seconds": 0, "microseconds": 0}})
+
+    def lineReceived(self, line):
+        message = json.loads(line.decode("utf-8"))
+        command = message["execute"]
+        self.factory.received.append((command, message.get("arguments")))
+        reply = {}
+        if "id" in message:
+            reply["id"] = message["id"]
+        if command == "qmp_capabilities":
+            reply["return"] = {}
+        elif command not in self.factory.commands:
+            reply["error"] = {"class": "CommandNotFound",
+                              "desc": "The command {0} has not been "
+                                      "found".format(command)}
+        else:
+            result = self.factory.commands[command]
+            if callable(result):
+                result = result(message.get("arguments", {}))
+            if isinstance(result, errors.QMPError):
+                reply["error"] = {"class": result.error_class,
+                                  "desc": result.desc}
+            else:
+                reply["return"] = result
+        self.send(reply)
+
+
+class QMPServerFactoryStub(protocol.ServerFactory):
+
+    protocol = QMPServerStub
+
+    def __init__(self, commands=None):
+        self.commands = commands or {}
+        self.clients = []
+        self.received = []
+
+
+def listen_qmp(testcase, commands=None):
+    """Start a fake QMP server on a unix socket, return (path, factory)."""
+
+    path = testcase.mktemp()
+    factory = QMPServerFactoryStub(commands)
+    port = reactor.listenUNIX(path, factory)
+    testcase.addCleanup(port.stopListening)
+    return path, factory
+
+
+def disconnect_all(factory):
+    for client in factory.clients:
+        client.transport.loseConnection()
+
+
+class TestQMPProtocol(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = HandlerStub()
+        self.protocol = qmp.QMPProtocol(self.handler)
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def receive(self, message):
+        self.protocol.dataReceived(json.dumps(message).encode("utf-8") +
+                                   b"\r\n")
+
+    def sent(self):
+        value = self.transport.value()
+        self.transport.clear()
+        return [json.loads(line.decode("utf-8"))
+                for line in value.splitlines()]
+
+    def negotiate(self):
+        self.receive(GREETING)
+        self.receive({"return": {}, "id": "capabilities"})
+        self.transport.clear()
+
+    def test_negotiation(self):
+        """After the greeting the capabilities are negotiated."""
+
+        self.assertFalse(self.protocol.ready.called)
+        self.receive(GREETING)
+        self.assertEqual(self.sent(), [{"execute": "qmp_capabilities",
+                                        "id": "capabilities"}])
+        self.receive({"return": {}, "id": "capabilities"})
+        self.assertEqual(successResultOf(self, self.protocol.ready),
+                         GREETING["QMP"])
+
+    def test_queue_flushed_after_negotiation(self):
+        d = self.protocol.execute("query-status")
+        self.receive(GREETING)
+        self.transport.clear()
+        self.receive({"return": {}, "id": "capabilities"})
+        [message] = self.sent()
+        self.assertEqual(message["execute"], "query-status")
+        self.receive({"return": {"status": "running"}, "id": message["id"]})
+        self.assertEqual(successResultOf(self, d), {"status": "running"})
+
+    def test_pipeline(self):
+        """Many commands can be in flight, replies are matched by id."""
+
+        self.negotiate()
+        d1 = self.protocol.execute("query-status")
+        d2 = self.protocol.execute("query-name")
+        m1, m2 = self.sent()
+        self.assertNotEqual(m1["id"], m2["id"])
+        self.receive({"return": {"name": "vm"}, "id": m2["id"]})
+        self.assertEqual(successResultOf(self, d2), {"name": "vm"})
+        self.assertFalse(d1.called)
+        self.receive({"return": {"status": "paused"}, "id": m1["id"]})
+        self.assertEqual(successResultOf(self, d1), {"status": "paused"})
+
+    def test_arguments(self):
+        self.negotiate()
+        self.protocol.execute("device_del", {"id": "vx0"})
+        [message] = self.sent()
+        self.assertEqual(message["arguments"], {"id": "vx0"})
+
+    def test_error(self):
+        self.negotiate()
+        d = self.protocol.execute("device_del", {"id": "vx0"})
+        [message] = self.sent()
+        self.receive({"error": {"class": "DeviceNotFound",
+                                "desc": "Device 'vx0' not found"},
+                      "id": message["id"]})
+        err = failureResultOf(self, d, errors.QMPError).value
+        self.assertEqual(err.error_class, "DeviceNotFound")
+        self.assertEqual(err.desc, "Device 'vx0' not found")
+
+    def test_human_monitor_command_error(self):
+        self.negotiate()
+        d = self.protocol.human_monitor_command("savevm test")
+        [message] = self.sent()
+        self.assertEqual(message["arguments"], {"command-line": "savevm test"})
+        self.receive({"return": "Error: no block device can store vmstate\r\n",
+                      "id": message["id"]})
+        failureResultOf(self, d, errors.QMPError)
+
+    def test_event(self):
+        self.negotiate()
+        self.receive({"event": "SHUTDOWN", "data": {"guest": True},
+                      "timestamp": {"seconds": 1, "microseconds": 0}})
+        self.assertEqual(self.handler.events, [("SHUTDOWN", {"guest": True})])
+
+    def test_event_without_data(self):
+        self.negotiate()
+        self.receive({"event": "STOP",
+                      "timestamp": {"seconds": 1, "microseconds": 0}})
+        self.assertEqual(self.handler.events, [("STOP", {})])
+
+    def test_invalid_message(self):
+        self.negotiate()
+        self.protocol.dataReceived(b"not json\r\n")
+        self.receive({"return": {}, "id": "unknown"})
+        self.assertTrue(self.transport.connected)
+
+    def test_connection_lost(self):
+        """Pending commands fail when the connection is lost."""
+
+        self.negotiate()
+        d = self.protocol.execute("query-status")
+        self.protocol.connectionLost(error.ConnectionDone())
+        failureResultOf(self, d, error.ConnectionDone)
+        self.assertEqual(len(self.handler.lost), 1)
+
+    def test_connection_lost_before_negotiation(self):
+        self.protocol.connectionLost(error.ConnectionDone())
+        failureResultOf(self, self.protocol.ready, error.ConnectionDone)
+
+
+class TestBlockJob(unittest.TestCase):
+
+    def setUp(self):
+        self.commands = []
+        self.jobs = [{"device": "commit-hda", "offset": 512, "len": 1024}]
+        self.progress = []
+        self.job = qmp.BlockJob(self.execute, "commit-hda", pivot=False,
+                                progress=lambda *a: self.progress.append(a))
+
+    def execute(self, command, arguments=None):
+        self.commands.append((command, arguments))
+        if command == "query-block-jobs":
+            return defer.succeed(self.jobs)
+        return defer.succeed({})
+
+    def test_poll(self):
+        clock = task.Clock()
+        self.job.poll(1.0, clock)
+        self.assertEqual(self.progress, [(512, 1024)])
+        self.jobs[0]["offset"] = 1024
+        clock.advance(1.0)
+        self.assertEqual(self.progress, [(512, 1024), (1024, 1024)])
+        self.job.event_received("BLOCK_JOB_COMPLETED",
+                                {"device": "commit-hda", "offset": 1024,
+                                 "len": 1024})
+        successResultOf(self, self.job.done)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_ready_cancel(self):
+        """A ready job is cancelled to keep the active image."""
+
+        self.job.event_received("BLOCK_JOB_READY", {"device": "commit-hda",
+                                                    "len": 1, "offset": 1})
+        self.assertEqual(self.commands, [("block-job-cancel",
+                                          {"device": "commit-hda"})])
+        self.job.event_received("BLOCK_JOB_CANCELLED",
+                                {"device": "commit-hda"})
+        successResultOf(self, self.job.done)
+
+    def test_ready_pivot(self):
+        self.job.pivot = True
+        self.job.event_received("BLOCK_JOB_READY", {"device": "commit-hda"})
+        self.assertEqual(self.commands, [("block-job-complete",
+                                          {"device": "commit-hda"})])
+
+    def test_cancelled(self):
+        self.job.event_received("BLOCK_JOB_CANCELLED",
+                                {"device": "commit-hda"})
+        failureResultOf(self, self.job.done, errors.BlockJobError)
+
+    def test_completed_with_error(self):
+        self.job.event_received("BLOCK_JOB_COMPLETED",
+                                {"device": "commit-hda",
+                                 "error": "No space left on device"})
+        failureResultOf(self, self.job.done, errors.BlockJobError)
+
+
+class TestConnect(unittest.TestCase):
+
+    def test_connect(self):
+        path, factory = listen_qmp(self, {"query-status": {"status":
+                                                           "running"}})
+        handler = HandlerStub()
+
+        def execute(protocol):
+            self.addCleanup(disconnect_all, factory)
+            return protocol.execute("query-status")
+
+        d = qmp.connect(reactor, path, handler)
+        d.addCallback(execute)
+        d.addCallback(self.assertEqual, {"status": "running"})
+        return d
+
+    def test_events(self):
+        path, factory = listen_qmp(self)
+        handler = HandlerStub()
+        done = defer.Deferred()
+        handler.qmp_event_received = lambda *args: done.callback(args[:2])
+
+        def send_event(protocol):
+            self.addCleanup(disconnect_all, factory)
+            factory.clients[0].send_event("BLOCK_JOB_COMPLETED",
+                                          {"device": "hda"})
+            return done
+
+        d = qmp.connect(reactor, path, handler)
+        d.addCallback(send_event)
+        d.addCallback(self.assertEqual, ("BLOCK_JOB_COMPLETED",
+                                         {"device": "hda"}))
+        return d
+
+    def test_connect_retry(self):
+        """Connection is retried until the socket is available."""
+
+        path = self.mktemp()
+        factory = QMPServerFactoryStub()
+
+        def listen():
+            port = reactor.listenUNIX(path, factory)
+            self.addCleanup(port.stopListening)
+            self.addCleanup(disconnect_all, factory)
+
+        reactor.callLater(0.05, listen)
+        d = qmp.connect(reactor, path, HandlerStub(), retries=20, delay=0.02)
+        d.addCallback(self.assertIsInstance, qmp.QMPProtocol)
+        return d
+
+    def test_connect_fail(self):
+        d = qmp.connect(reactor, self.mktemp(), HandlerStub(), retries=1,
+                        delay=0.01)
+        return self.assertFailure(d, error.ConnectError)
@@ -21,12 +21,14 @@ import copy
 import six
 
 from twisted.trial import unittest
-from twisted.internet import defer
+from twisted.internet import defer, task, error
+from twisted.python import failure
 
 from virtualbricks import (link, virtualmachines as vm, errors, settings,
-                           configfile, tools)
-from virtualbricks.tests import (stubs, test_link, successResultOf,
-                                 failureResultOf, TEST_DATA_PATH)
+                           configfile, tools, bricks, project, imageinfo)
+from virtualbricks.tests import (stubs, test_link, test_qmp, successResultOf,
+                                 failureResultOf, TEST_DATA_PATH,
+                                 test_imageinfo)
 
 
 def disks(vm):
@@ -158,6 +160,698 @@ class TestVirtualMachine(unittest.TestCase):
         self.assertEqual(_image.acquired, _image.released)
 
 
+class TestVirtualMachineQMP(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = stubs.FactoryStub()
+        self.vm = stubs.VirtualMachineStub(self.factory, "vm")
+        self.vm.proc = bricks.FakeProcess(self.vm)
+
+    def connect(self, commands=None):
+        path, self.server = test_qmp.listen_qmp(self, commands)
+        self.vm.qmp_path = lambda: path
+        self.addCleanup(test_qmp.disconnect_all, self.server)
+        return self.vm.connect_qmp()
+
+    def test_args(self):
+        """The virtual machine exposes a QMP socket."""
+
+        self.vm.qmp_path = lambda: "/tmp/vm.qmp"
+        args = successResultOf(self, self.vm.args())
+        i = args.index("-qmp")
+        self.assertEqual(args[i + 1], "unix:/tmp/vm.qmp,server,nowait")
+
+    def test_not_connected(self):
+        failureResultOf(self, self.vm.qmp_execute("query-status"),
+                        errors.QMPNotConnectedError)
+
+    def test_monitor_command_fallback(self):
+        """Without QMP the command is written to the human monitor."""
+
+        self.assertIs(successResultOf(self,
+                                      self.vm.monitor_command("system_reset")),
+                      None)
+        self.assertEqual(self.vm.sended, ["system_reset\n"])
+
+    def test_execute(self):
+
+        def execute(protocol):
+            self.assertIs(self.vm.qmp, protocol)
+            return self.vm.qmp_execute("query-status")
+
+        d = self.connect({"query-status": {"status": "running"}})
+        d.addCallback(execute)
+        d.addCallback(self.assertEqual, {"status": "running"})
+        return d
+
+    def test_poweroff(self):
+        """The powerdown is requested through QMP when it is available."""
+
+        def poweroff(_):
+            self.vm._exited_d = defer.Deferred()
+            self.vm.poweroff()
+            return self.vm.qmp.execute("query-status")
+
+        def check(_):
+            self.assertEqual(self.server.received[1:],
+                             [("system_powerdown", None),
+                              ("query-status", None)])
+            self.assertEqual(self.vm.sended, [])
+
+        d = self.connect({"system_powerdown": {}, "query-status": {}})
+        d.addCallback(poweroff)
+        d.addCallback(check)
+        return d
+
+    def test_events(self):
+        """QMP events are delivered to the observers of the brick."""
+
+        events = []
+        received = defer.Deferred()
+
+        def observer(args):
+            events.append(args)
+            received.callback(None)
+
+        self.vm.qmp_event.connect(observer)
+
+        def send_event(_):
+            self.server.clients[0].send_event("STOP")
+            return received
+
+        d = self.connect()
+        d.addCallback(send_event)
+        d.addCallback(lambda _: self.assertEqual(events,
+                                                 [(self.vm, "STOP", {})]))
+        return d
+
+
+class MonitorStub:
+
+    def __init__(self):
+        self.commands = []
+        self.errors = {}
+
+    def __call__(self, command, arguments=None, command_line=None):
+        self.commands.append((command, arguments))
+        if command in self.errors:
+            return defer.fail(errors.QMPError(self.errors[command], ""))
+        return defer.succeed({})
+
+
+class TestHotplug(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = stubs.FactoryStub()
+        self.vm = stubs.VirtualMachineStub(self.factory, "vm")
+        self.plug = self.vm.add_plug(vm.hostonly_sock, "00:11:22:33:44:55")
+        successResultOf(self, self.vm.args())
+        self.vm.proc = bricks.FakeProcess(self.vm)
+        self.vm.monitor_command = self.monitor = MonitorStub()
+
+    def test_boot_ids(self):
+        self.assertEqual(self.plug.netdev_id, "vx0")
+        self.assertEqual(self.vm._netdev_counter, 1)
+
+    def test_add_plug(self):
+        """A new plug is added to the running virtual machine."""
+
+        plug = self.vm.add_plug(vm.hostonly_sock, "00:11:22:33:44:66",
+                                "e1000")
+        self.assertEqual(plug.netdev_id, "vx1")
+        self.assertEqual(self.monitor.commands, [
+            ("netdev_add", {"type": "user", "id": "vx1"}),
+            ("device_add", {"driver": "e1000", "mac": "00:11:22:33:44:66",
+                            "id": "vx1", "netdev": "vx1"})])
+        self.assertEqual(self.vm.plugs, [self.plug, plug])
+
+    def test_add_plug_not_running(self):
+        self.vm.proc = None
+        self.vm.add_plug(vm.hostonly_sock)
+        self.assertEqual(self.monitor.commands, [])
+
+    def test_add_plug_error(self):
+        """If the card cannot be added the brick is reverted."""
+
+        self.monitor.errors["device_add"] = "GenericError"
+        plug = self.vm.add_plug(vm.hostonly_sock)
+        self.assertEqual(self.monitor.commands[-1],
+                         ("netdev_del", {"id": "vx1"}))
+        self.assertEqual(self.vm.plugs, [self.plug])
+        self.assertNotIn(plug, vm.hostonly_sock.plugs)
+        self.flushLoggedErrors(errors.QMPError)
+
+    def test_remove_plug(self):
+        self.vm.remove_plug(self.plug)
+        self.assertEqual(self.monitor.commands, [
+            ("device_del", {"id": "vx0"}),
+            ("netdev_del", {"id": "vx0"})])
+        self.assertEqual(self.vm.plugs, [])
+
+    def test_remove_plug_waits_device_deleted(self):
+        """The backend is removed only when the guest released the card."""
+
+        self.vm.qmp = QMPStub()
+        d = self.vm.hotunplug(self.plug)
+        self.assertEqual(self.monitor.commands,
+                         [("device_del", {"id": "vx0"})])
+        self.assertNoResult(d)
+        self.vm.qmp_event_received("DEVICE_DELETED", {"device": "vx0"}, None)
+        self.assertEqual(self.monitor.commands[-1],
+                         ("netdev_del", {"id": "vx0"}))
+        successResultOf(self, d)
+
+    def test_replug_waits_device_deleted(self):
+        """The card is added again only when the old one is deleted."""
+
+        self.vm.qmp = QMPStub()
+        brick = stubs.StubBrick(self.factory, "switch")
+        sock = vm.VMSock(self.factory.new_sock(brick, "switch_sock"))
+        sock.path = "/tmp/switch[]"
+        self.vm.replug(self.plug, sock)
+        self.assertEqual(self.monitor.commands,
+                         [("device_del", {"id": "vx0"})])
+        self.vm.qmp_event_received("DEVICE_DELETED", {"device": "vx0"}, None)
+        self.assertEqual([command for command, _ in self.monitor.commands],
+                         ["device_del", "netdev_del", "netdev_add",
+                          "device_add"])
+
+    def test_remove_plug_error_discards_waiter(self):
+        """The event is not waited if the card cannot be removed."""
+
+        self.vm.qmp = QMPStub()
+        self.monitor.errors["device_del"] = "DeviceNotFound"
+        d = self.vm.hotunplug(self.plug)
+        failureResultOf(self, d, errors.QMPError)
+        self.assertEqual(self.vm._event_waiters, [])
+
+    def test_remove_plug_timeout(self):
+        """The removal fails if the guest does not release the card."""
+
+        self.vm.qmp = QMPStub()
+        clock = task.Clock()
+        d = self.vm.hotunplug(self.plug, clock=clock)
+        clock.advance(vm.DEVICE_TIMEOUT)
+        failureResultOf(self, d, errors.DeviceTimeoutError)
+        self.assertEqual(self.vm._event_waiters, [])
+        self.assertNotIn(("netdev_del", {"id": "vx0"}), self.monitor.commands)
+
+    def test_remove_plug_exited(self):
+        """A card is removed if the virtual machine exits meanwhile."""
+
+        self.vm.qmp = QMPStub()
+        self.vm.remove_plug(self.plug)
+        self.vm.qmp_connection_lost(failure.Failure(error.ConnectionDone()))
+        self.assertEqual(self.vm.plugs, [])
+        self.assertEqual(self.monitor.commands,
+                         [("device_del", {"id": "vx0"})])
+
+    def test_remove_plug_error(self):
+        plug = self.vm.add_plug(vm.hostonly_sock)
+        self.monitor.errors["device_del"] = "DeviceNotFound"
+        self.vm.remove_plug(self.plug)
+        self.assertEqual(self.vm.plugs, [self.plug, plug])
+        self.flushLoggedErrors(errors.QMPError)
+
+    def test_ids_are_stable(self):
+        """Removing a card does not change the ids of the others."""
+
+        plug1 = self.vm.add_plug(vm.hostonly_sock)
+        self.vm.remove_plug(self.plug)
+        plug2 = self.vm.add_plug(vm.hostonly_sock)
+        self.assertEqual(plug1.netdev_id, "vx1")
+        self.assertEqual(plug2.netdev_id, "vx2")
+
+    def test_replug(self):
+        """A plug connected to another sock keeps its id."""
+
+        brick = stubs.StubBrick(self.factory, "switch")
+        sock = vm.VMSock(self.factory.new_sock(brick, "switch_sock"))
+        sock.path = "/tmp/switch[]"
+        self.vm.replug(self.plug, sock)
+        self.assertIs(self.plug.sock, sock)
+        self.assertEqual(self.monitor.commands[2:], [
+            ("netdev_add", {"type": "vde", "id": "vx0",
+                            "sock": "/tmp/switch"}),
+            ("device_add", {"driver": "rtl8139", "mac": "00:11:22:33:44:55",
+                            "id": "vx0", "netdev": "vx0"})])
+
+    def test_replug_error(self):
+        brick = stubs.StubBrick(self.factory, "switch")
+        sock = vm.VMSock(self.factory.new_sock(brick, "switch_sock"))
+        self.monitor.errors["device_del"] = "GenericError"
+        self.vm.replug(self.plug, sock, "00:11:22:33:44:66")
+        self.assertIs(self.plug.sock, vm.hostonly_sock)
+        self.assertEqual(self.plug.mac, "00:11:22:33:44:55")
+        self.flushLoggedErrors(errors.QMPError)
+
+
+class QMPStub:
+
+    def __init__(self, results=None):
+        self.commands = []
+        self.results = results or {}
+
+    def execute(self, command, arguments=None):
+        self.commands.append((command, arguments))
+        result = self.results.get(command, {})
+        if isinstance(result, errors.QMPError):
+            return defer.fail(result)
+        return defer.succeed(result)
+
+    def human_monitor_command(self, command_line):
+        return self.execute("human-monitor-command",
+                            {"command-line": command_line})
+
+
+class TestDiskHotplug(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = stubs.FactoryStub()
+        self.vm = stubs.VirtualMachineStub(self.factory, "vm")
+        self.image = vm.Image("test", "/tmp/test.img")
+
+    def start(self):
+        successResultOf(self, self.vm.args())
+        self.vm.proc = bricks.FakeProcess(self.vm)
+        self.vm.monitor_command = self.monitor = MonitorStub()
+        self.vm.human_monitor_command = lambda line: self.monitor(
+            "human-monitor-command", {"command-line": line})
+
+    def test_boot_drive_ids(self):
+        self.vm.set_image("hda", self.image)
+        self.vm.set_image("hdc", vm.Image("test2", "/tmp/test2.img"))
+        successResultOf(self, self.vm.args())
+        self.assertEqual(self.vm.config["hda"].drive_id, "ide0-hd0")
+        self.assertEqual(self.vm.config["hdb"].drive_id, None)
+        self.assertEqual(self.vm.config["hdc"].drive_id, "ide1-hd0")
+        self.vm.config["use_virtio"] = True
+        successResultOf(self, self.vm.args())
+        self.assertEqual(self.vm.config["hda"].drive_id, "virtio0")
+        self.assertEqual(self.vm.config["hdc"].drive_id, "virtio1")
+
+    def test_attach(self):
+        """A new image is attached to the running virtual machine."""
+
+        self.start()
+        self.vm.set_image("hdb", self.image)
+        disk = self.vm.config["hdb"]
+        self.assertEqual(self.monitor.commands, [
+            ("human-monitor-command", {"command-line": "drive_add 0 if=none,"
+                                       "id=vb-hdb,file=/tmp/test.img"}),
+            ("device_add", {"driver": "virtio-blk-pci", "drive": "vb-hdb",
+                            "id": "vb-hdb"})])
+        self.assertTrue(disk.hotplugged)
+        self.assertEqual(disk.drive_id, "vb-hdb")
+        self.assertIs(self.image.master, disk)
+
+    def test_attach_error(self):
+        self.start()
+        self.monitor.errors["device_add"] = "GenericError"
+        self.vm.set_image("hdb", self.image)
+        self.assertEqual(self.monitor.commands[-1],
+                         ("human-monitor-command",
+                          {"command-line": "drive_del vb-hdb"}))
+        self.assertFalse(self.vm.config["hdb"].hotplugged)
+        self.assertIs(self.image.master, None)
+        self.flushLoggedErrors(errors.QMPError)
+
+    def test_detach(self):
+        self.start()
+        self.vm.set_image("hdb", self.image)
+        del self.monitor.commands[:]
+        self.vm.set_image("hdb", None)
+        self.assertEqual(self.monitor.commands,
+                         [("device_del", {"id": "vb-hdb"})])
+        self.assertFalse(self.vm.config["hdb"].hotplugged)
+        self.assertIs(self.image.master, None)
+
+    def test_detach_waits_device_deleted(self):
+        self.start()
+        self.vm.set_image("hdb", self.image)
+        self.vm.qmp = QMPStub()
+        disk = self.vm.config["hdb"]
+        d = self.vm.detach_disk(disk)
+        self.assertNoResult(d)
+        self.vm.qmp_event_received("DEVICE_DELETED", {"device": "vb-hdb"},
+                                   None)
+        successResultOf(self, d)
+        self.assertIs(disk.drive_id, None)
+
+    def test_detach_timeout(self):
+        """The disk is kept if the guest does not release it."""
+
+        self.start()
+        self.vm.set_image("hdb", self.image)
+        self.vm.qmp = QMPStub()
+        disk = self.vm.config["hdb"]
+        clock = task.Clock()
+        d = self.vm.detach_disk(disk, clock=clock)
+        clock.advance(vm.DEVICE_TIMEOUT)
+        failureResultOf(self, d, errors.DeviceTimeoutError)
+        self.assertEqual(self.vm._event_waiters, [])
+        self.assertEqual(disk.drive_id, "vb-hdb")
+
+    def test_boot_disk(self):
+        """Disks defined at boot are changed at the next boot."""
+
+        self.vm.set_image("hda", self.image)
+        self.start()
+        self.vm.set_image("hda", vm.Image("test2", "/tmp/test2.img"))
+        self.assertEqual(self.monitor.commands, [])
+        self.assertEqual(self.vm.config["hda"].image.name, "test2")
+
+
+class TestCommitDisk(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = stubs.FactoryStub()
+        self.vm = stubs.VirtualMachineStub(self.factory, "vm")
+        self.vm.config["hda"].image = vm.Image("test", "/tmp/test.img")
+        self.vm.config["privatehda"] = True
+        self.vm._assign_drive_ids()
+        self.vm.proc = bricks.FakeProcess(self.vm)
+        self.disk = self.vm.config["hda"]
+
+    def test_not_cow(self):
+        self.vm.config["privatehda"] = False
+        failureResultOf(self, self.vm.commit_disk(self.disk),
+                        errors.InvalidActionError)
+
+    def test_commit_monitor(self):
+        """Without QMP the commit command of the monitor is used."""
+
+        successResultOf(self, self.vm.commit_disk(self.disk))
+        self.assertEqual(self.vm.sended, ["commit ide0-hd0\n"])
+
+    def test_commit(self):
+        """The COW is committed with a block job and it is kept in use."""
+
+        qmp = self.vm.qmp = QMPStub()
+        progress = []
+        d = self.vm.commit_disk(self.disk, lambda *a: progress.append(a))
+        self.assertEqual(qmp.commands[0], ("block-commit",
+                                           {"device": "ide0-hd0",
+                                            "job-id": "commit-hda"}))
+        self.vm.qmp_event_received("BLOCK_JOB_READY",
+                                   {"device": "commit-hda", "offset": 10,
+                                    "len": 10}, None)
+        self.assertIn(("block-job-cancel", {"device": "commit-hda"}),
+                      qmp.commands)
+        self.assertNoResult(d)
+        self.vm.qmp_event_received("BLOCK_JOB_COMPLETED",
+                                   {"device": "commit-hda", "offset": 10,
+                                    "len": 10}, None)
+        successResultOf(self, d)
+        self.assertIn((10, 10), progress)
+        self.assertEqual(self.vm._block_jobs, {})
+
+    def test_commit_connection_lost(self):
+        self.vm.qmp = QMPStub()
+        d = self.vm.commit_disk(self.disk)
+        self.vm.qmp_connection_lost(errors.QMPNotConnectedError())
+        failureResultOf(self, d, errors.QMPNotConnectedError)
+
+
+class TestSavedState(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = stubs.FactoryStub()
+        self.vm = stubs.VirtualMachineStub(self.factory, "vm")
+
+    def test_args_incoming(self):
+        self.vm._incoming = "/tmp/vm state"
+        args = successResultOf(self, self.vm.args())
+        self.assertEqual(args[-2:], ["-incoming", "exec:cat '/tmp/vm state'"])
+
+    def test_save_state(self):
+        """The guest is stopped, its state is saved and QEMU terminated."""
+
+        self.vm.proc = bricks.FakeProcess(self.vm)
+        self.vm._exited_d = exited = defer.Deferred()
+        qmp = self.vm.qmp = QMPStub({"query-migrate": {"status":
+                                                       "completed"}})
+        d = self.vm.save_state("/tmp/vm.state")
+        self.assertEqual(qmp.commands, [
+            ("stop", None),
+            ("migrate", {"uri": "exec:cat > /tmp/vm.state"}),
+            ("query-migrate", None),
+            ("quit", None)])
+        self.assertNoResult(d)
+        exited.callback((self.vm, None))
+        successResultOf(self, d)
+
+    def test_save_state_failed(self):
+        """If the state is not saved the guest is resumed."""
+
+        self.vm.proc = bricks.FakeProcess(self.vm)
+        qmp = self.vm.qmp = QMPStub({"query-migrate": {"status": "failed"}})
+        d = self.vm.save_state("/tmp/vm.state")
+        failureResultOf(self, d, errors.MigrationError)
+        self.assertEqual(qmp.commands[-1], ("cont", None))
+
+    def test_save_state_timeout(self):
+        """The migration is cancelled if it does not end in time."""
+
+        self.vm.proc = bricks.FakeProcess(self.vm)
+        qmp = self.vm.qmp = QMPStub({"query-migrate": {"status": "setup"}})
+        clock = task.Clock()
+        d = self.vm.save_state("/tmp/vm.state", 1, clock)
+        self.assertNoResult(d)
+        clock.pump([1] * vm.MIGRATION_TIMEOUT)
+        failureResultOf(self, d, errors.MigrationError)
+        self.assertEqual(qmp.commands[-2:], [("migrate_cancel", None),
+                                             ("cont", None)])
+
+    def test_restore_state_timeout(self):
+        """The wait for an incoming migration without status ends."""
+
+        qmp = QMPStub()
+
+        def poweron():
+            self.vm.proc = bricks.FakeProcess(self.vm)
+            self.vm.qmp = qmp
+            return defer.succeed(self.vm)
+
+        self.vm.poweron = poweron
+        clock = task.Clock()
+        d = self.vm.restore_state("/tmp/vm.state", 1, clock)
+        clock.pump([1] * vm.MIGRATION_TIMEOUT)
+        failureResultOf(self, d, errors.MigrationError)
+        self.assertNotIn(("cont", None), qmp.commands)
+
+    def test_save_state_not_connected(self):
+        failureResultOf(self, self.vm.save_state("/tmp/vm.state"),
+                        errors.QMPNotConnectedError)
+
+    def test_restore_state(self):
+        qmp = QMPStub({"query-migrate": {"status": "completed"}})
+        incoming = []
+
+        def poweron():
+            incoming.append(self.vm._incoming)
+            self.vm.proc = bricks.FakeProcess(self.vm)
+            self.vm.qmp = qmp
+            return defer.succeed(self.vm)
+
+        self.vm.poweron = poweron
+        d = self.vm.restore_state("/tmp/vm.state")
+        self.assertIs(successResultOf(self, d), self.vm)
+        self.assertEqual(incoming, ["/tmp/vm.state"])
+        self.assertIs(self.vm._incoming, None)
+
+    def test_restore_state_resume(self):
+        """
+        The guest was stopped when its state was saved, it is resumed after
+        the migration.
+        """
+
+        qmp = QMPStub({"query-migrate": {"status": "completed"}})
+
+        def poweron():
+            self.vm.proc = bricks.FakeProcess(self.vm)
+            self.vm.qmp = qmp
+            return defer.succeed(self.vm)
+
+        self.vm.poweron = poweron
+        successResultOf(self, self.vm.restore_state("/tmp/vm.state"))
+        self.assertEqual(qmp.commands, [("query-migrate", None),
+                                        ("cont", None)])
+
+    def test_restore_state_running(self):
+        self.vm.proc = bricks.FakeProcess(self.vm)
+        failureResultOf(self, self.vm.restore_state("/tmp/vm.state"),
+                        errors.MigrationError)
+
+
+class TestCowPlace(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(imageinfo, "cache", imageinfo.ImageCache())
+        self.prj = project.Project(os.path.abspath(self.mktemp()), None)
+        self.prj.create()
+        self.patch(project.manager, "current", self.prj)
+        self.scratch = os.path.abspath(self.mktemp())
+        self.factory = stubs.FactoryStub()
+        self.vm = stubs.VirtualMachineStub(self.factory, "vm")
+        self.vm.config["privatehda"] = True
+        self.disk = self.vm.config["hda"]
+        self.disk.image = vm.Image("test", "/tmp/test.img")
+
+    def create_cow(self):
+        os.makedirs(self.disk.basefolder)
+        cowname = self.disk.get_cow_path()
+        with open(cowname, "w") as fp:
+            fp.write("cow")
+        return cowname
+
+    def test_project(self):
+        self.assertFalse(self.disk.is_scratch())
+        self.assertEqual(self.disk.basefolder, self.prj.path)
+
+    def test_vm_place(self):
+        """The placement of the virtual machine wins over the project."""
+
+        self.prj.set_cow_place(vm.PLACE_TMPFS)
+        self.vm.config["cowplace"] = self.scratch
+        self.assertTrue(self.disk.is_scratch())
+        self.assertEqual(self.disk.basefolder,
+                         vm.scratch_folder(self.scratch, self.prj.path))
+        self.assertTrue(self.disk.basefolder.startswith(self.scratch))
+
+    def test_project_place(self):
+        self.prj.set_cow_place(vm.PLACE_TMPFS)
+        self.assertEqual(project.Project(self.prj.path, None).get_cow_place(),
+                         vm.PLACE_TMPFS)
+        self.assertTrue(self.disk.basefolder.startswith(vm.TMPFS))
+
+    def test_no_space(self):
+        base = self.mktemp()
+        with open(base, "wb") as fp:
+            fp.write(test_imageinfo.qcow2(size=1024 * 1024))
+        self.disk.image = vm.Image("test", base)
+        self.vm.config["cowplace"] = self.scratch
+        self.patch(vm, "free_space", lambda path: 1024)
+        failureResultOf(self, self.disk._get_cow_name(), errors.NoSpaceError)
+
+    def scratch_disks(self):
+        self.patch(vm, "_reservations", {})
+        base = self.mktemp()
+        with open(base, "wb") as fp:
+            fp.write(test_imageinfo.qcow2(size=1024 * 1024))
+        self.disk.image = vm.Image("test", base)
+        self.vm.config["cowplace"] = self.scratch
+        self.vm.config["privatehdb"] = True
+        other = self.vm.config["hdb"]
+        other.image = vm.Image("test", base)
+        os.makedirs(self.disk.basefolder)
+        return self.disk, other
+
+    def test_reserve_space(self):
+        """
+        The space promised to the disposable COWs started together is not
+        available to the next ones.
+        """
+
+        self.patch(vm, "free_space", lambda path: 1536 * 1024)
+        disk, other = self.scratch_disks()
+        disk._check_capacity(disk.get_cow_path())
+        self.assertRaises(errors.NoSpaceError, other._check_capacity,
+                          other.get_cow_path())
+        disk.remove_scratch()
+        other._check_capacity(other.get_cow_path())
+
+    def test_reserve_share(self):
+        """Only a share of the size of the disks can be reserved."""
+
+        self.patch(vm, "free_space", lambda path: 1024 * 1024)
+        settings.set("cowreserve", 0.5)
+        self.addCleanup(settings.set, "cowreserve", 1.0)
+        disk, other = self.scratch_disks()
+        disk._check_capacity(disk.get_cow_path())
+        other._check_capacity(other.get_cow_path())
+        self.assertEqual(vm._reservations[other.get_cow_path()][1],
+                         512 * 1024)
+
+    def test_remove_on_poweroff(self):
+        self.vm.config["cowplace"] = self.scratch
+        cowname = self.create_cow()
+        self.vm._exited_d = defer.Deferred()
+        self.vm.process_ended(None, None)
+        self.assertFalse(os.path.exists(cowname))
+
+    def test_keep_saved_state(self):
+        """The COWs are kept if the state of the guest is saved."""
+
+        self.vm.config["cowplace"] = self.scratch
+        cowname = self.create_cow()
+        self.vm._keep_scratch = True
+        self.vm._exited_d = defer.Deferred()
+        self.vm.process_ended(None, None)
+        self.assertTrue(os.path.exists(cowname))
+
+    @defer.inlineCallbacks
+    def test_persist(self):
+        self.vm.config["cowplace"] = self.scratch
+        cowname = self.create_cow()
+        path = yield self.vm.persist_disk(self.disk)
+        self.assertEqual(path, os.path.join(self.prj.path, "vm_hda.cow"))
+        self.assertFalse(os.path.exists(cowname))
+        self.assertEqual(self.disk.get_cow_path(), path)
+        with open(path) as fp:
+            self.assertEqual(fp.read(), "cow")
+
+    @defer.inlineCallbacks
+    def test_persist_one_disk(self):
+        """The other disks of the virtual machine remain disposable."""
+
+        self.vm.config["cowplace"] = self.scratch
+        self.vm.config["privatehdb"] = True
+        other = self.vm.config["hdb"]
+        other.image = vm.Image("test2", "/tmp/test2.img")
+        self.create_cow()
+        othername = other.get_cow_path()
+        with open(othername, "w") as fp:
+            fp.write("cow")
+        yield self.vm.persist_disk(self.disk)
+        self.assertFalse(self.disk.is_scratch())
+        self.assertTrue(other.is_scratch())
+        self.assertEqual(other.get_cow_path(), othername)
+        self.vm._exited_d = defer.Deferred()
+        self.vm.process_ended(None, None)
+        self.assertFalse(os.path.exists(othername))
+        self.assertTrue(os.path.exists(self.disk.get_cow_path()))
+
+    def test_persist_running(self):
+        """The COW of a running virtual machine is mirrored."""
+
+        self.vm.config["cowplace"] = self.scratch
+        cowname = self.create_cow()
+        with open(cowname, "wb") as fp:
+            fp.write(test_imageinfo.qcow2(b"/tmp/test.img"))
+        self.vm._assign_drive_ids()
+        self.vm.proc = bricks.FakeProcess(self.vm)
+        qmp = self.vm.qmp = QMPStub()
+        d = self.vm.persist_disk(self.disk)
+        target = os.path.join(self.prj.path, "vm_hda.cow")
+        self.assertEqual(qmp.commands[0], ("drive-mirror", {
+            "device": "ide0-hd0", "job-id": "persist-hda", "target": target,
+            "format": "qcow2", "sync": "top", "mode": "absolute-paths"}))
+        self.vm.qmp_event_received("BLOCK_JOB_READY",
+                                   {"device": "persist-hda"}, None)
+        self.assertIn(("block-job-complete", {"device": "persist-hda"}),
+                      qmp.commands)
+        self.vm.qmp_event_received("BLOCK_JOB_COMPLETED",
+                                   {"device": "persist-hda"}, None)
+        self.assertEqual(successResultOf(self, d), target)
+        self.assertFalse(os.path.exists(cowname))
+        self.assertFalse(self.disk.is_scratch())
+
+    def test_persist_not_scratch(self):
+        failureResultOf(self, self.vm.persist_disk(self.disk),
+                        errors.InvalidActionError)
+
+
 class TestVMPlug(test_link.TestPlug):
 
     @staticmethod
@@ -249,10 +943,21 @@ class FULL:
         return False
 
 
+class ImageCacheStub:
+
+    def __init__(self, backing_file):
+        self.backing_file = backing_file
+
+    def get(self, path):
+        return self
+
+    def chain(self, path):
+        return [path, self.backing_file]
+
+
 class DiskStub(vm.Disk):
 
     _basefolder = None
-    sync_cmd = "false"
 
     def get_basefolder(self):
         if self._basefolder is not None:
@@ -295,15 +1000,51 @@ class TestDisk(unittest.TestCase):
             self.fail("_create_cow did not failed while it had to")
 
         def eb(failure):
-            failure.trap(RuntimeError)
-            failure.value.args[0].startswith("sync failed")
+            failure.trap(OSError)
+
+        d = self.disk._sync(("", "", 0), "/nonexistent/cow")
+        return d.addCallbacks(cb, eb)
 
-        return self.disk._sync(("", "", 0)).addCallbacks(cb, eb)
+    def test_sync(self):
+        """Only the new COW is flushed to the disk."""
+
+        synced = []
+        self.patch(tools, "fsync", synced.append)
+        d = self.disk._sync(("", "", 0), "/tmp/cow")
+        return d.addCallback(lambda _: self.assertEqual(synced, ["/tmp/cow"]))
+
+    def test_create_cow_concurrency(self):
+        """Only concurrency COWs are created at the same time."""
+
+        pending = []
+
+        def getQemuOutputAndValue(*args):
+            pending.append(defer.Deferred())
+            return pending[-1]
+
+        self.patch(vm, "abspath_qemu", lambda *a, **k: "qemu-img")
+        self.patch(vm, "getQemuOutputAndValue", getQemuOutputAndValue)
+        self.patch(self.disk, "_sync", lambda ret, cowname: None)
+        settings.set("concurrency", 2)
+        self.addCleanup(settings.set, "concurrency", 4)
+        self.disk.image = ImageStub()
+        cownames = [self.mktemp() for i in range(3)]
+        for cowname in cownames:
+            open(cowname, "w").close()
+        results = [self.disk._create_cow(cowname) for cowname in cownames]
+        self.assertEqual(len(pending), 2)
+        pending[0].callback(("", "", 0))
+        self.assertEqual(successResultOf(self, results[0]), cownames[0])
+        self.assertEqual(len(pending), 3)
+        for d in pending[1:]:
+            d.callback(("", "", 0))
+        self.assertEqual([successResultOf(self, d) for d in results[1:]],
+                         cownames[1:])
 
     def test_check_base(self):
         err = self.assertRaises(IOError, self.disk._check_base, "/montypython")
         self.assertEqual(err.errno, errno.ENOENT)
-        self.patch(tools, "get_backing_file", lambda _: NULL())
+        self.patch(imageinfo, "cache", ImageCacheStub(NULL()))
         self.disk._create_cow = lambda _: defer.succeed(None)
         self.disk.image = ImageStub()
         cowname = self.mktemp()
@@ -312,7 +1053,7 @@ class TestDisk(unittest.TestCase):
         result = []
         self.disk._check_base(cowname).addCallback(result.append)
         self.assertEqual(result, [cowname])
-        self.patch(tools, "get_backing_file", lambda _: FULL())
+        self.patch(imageinfo, "cache", ImageCacheStub(FULL()))
         del result[:]
         cowname = self.mktemp()
         fp = open(cowname, "w")
@@ -320,6 +1061,29 @@ class TestDisk(unittest.TestCase):
         self.disk._check_base(cowname).addCallback(result.append)
         self.assertEqual(result, [cowname])
 
+    def test_check_base_clone(self):
+        """The COW of a clone is backed by the COW of the original."""
+
+        self.patch(imageinfo, "cache", ImageCacheStub("/prj/vm_hda.cow"))
+        self.patch(imageinfo.cache, "chain", lambda path: [
+            path, "/prj/vm_hda.cow", os.path.abspath("/vimages/base.img")])
+        self.disk.image = ImageStub()
+        self.disk._get_base = lambda: "/vimages/base.img"
+        cowname = self.mktemp()
+        self.assertEqual(successResultOf(self, self.disk._check_base(cowname)),
+                         cowname)
+
+    def test_get_cow_name_frozen(self):
+        """The private COWs of a frozen project are not used."""
+
+        self.disk.basefolder = basefolder = self.mktemp()
+        os.mkdir(basefolder)
+        open(os.path.join(basefolder, project.FROZEN), "w").close()
+        self.patch(project.manager, "current", project.Project(basefolder,
+                                                               None))
+        failureResultOf(self, self.disk._get_cow_name(),
+                        errors.ProjectFrozenError)
+
     def test_get_cow_name(self):
         self.disk.basefolder = "/nonono/"
         err = self.assertRaises(OSError, self.disk._get_cow_name)
@@ -379,6 +1143,41 @@ class TestDisk(unittest.TestCase):
         self.vm.config["private" + self.disk.device] = True
         failureResultOf(self, self.disk.get_real_disk_name(), IOError)
 
+    def test_prepare_cow_shared(self):
+        """Concurrent requests of the private COW share the same result."""
+
+        pending = []
+
+        def get_cow_name():
+            pending.append(defer.Deferred())
+            return pending[-1]
+
+        self.disk._get_cow_name = get_cow_name
+        self.disk.image = ImageStub()
+        self.vm.config["privatehda"] = True
+        d1 = self.disk.get_real_disk_name()
+        d2 = self.disk.get_real_disk_name()
+        self.assertEqual(len(pending), 1)
+        pending[0].callback("cow")
+        self.assertEqual(successResultOf(self, d1), "cow")
+        self.assertEqual(successResultOf(self, d2), "cow")
+        self.disk.get_real_disk_name()
+        self.assertEqual(len(pending), 2)
+
+    def test_prepare_cow_error(self):
+        """Any error preparing the COW is reported and not kept."""
+
+        def get_cow_name():
+            raise AttributeError("current")
+
+        self.disk._get_cow_name = get_cow_name
+        self.disk.image = ImageStub()
+        self.vm.config["privatehda"] = True
+        failureResultOf(self, self.disk.get_real_disk_name(), AttributeError)
+        self.disk._get_cow_name = lambda: defer.succeed("cow")
+        self.assertEqual(successResultOf(self, self.disk.get_real_disk_name()),
+                         "cow")
+
     def test_deepcopy(self):
         disk = copy.deepcopy(self.disk)
         self.assertIsNot(disk, self.disk)
@@ -416,6 +1215,64 @@ class TestDisk(unittest.TestCase):
         self.disk.release()
 
 
+class TestCowProvisioner(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.provisioner = vm.CowProvisioner(self.clock)
+        self.patch(vm, "provisioner", self.provisioner)
+        self.patch(project.manager, "current", Object())
+        self.factory = stubs.FactoryStub()
+        self.vm = self.factory.new_brick("vm", "test_vm")
+        self.vm.config["privatehda"] = True
+        self.prepared = []
+        self.disk = self.vm.config["hda"]
+        self.disk.get_real_disk_name = self.get_real_disk_name
+
+    def get_real_disk_name(self):
+        self.prepared.append(self.disk.device)
+        return defer.succeed("cow")
+
+    def test_not_started(self):
+        self.vm.set_image("hda", vm.Image("test", "/vmimage"))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_set_image(self):
+        """The private COW is prepared shortly after the image is set."""
+
+        self.provisioner.start(self.factory)
+        self.vm.set_image("hda", vm.Image("test", "/vmimage"))
+        self.vm.set_image("hda", vm.Image("test2", "/vmimage2"))
+        self.assertEqual(self.prepared, [])
+        self.clock.advance(self.provisioner.delay)
+        self.assertEqual(self.prepared, ["hda"])
+
+    def test_start(self):
+        self.vm.set_image("hda", vm.Image("test", "/vmimage"))
+        self.provisioner.start(self.factory)
+        self.clock.advance(self.provisioner.delay)
+        self.assertEqual(self.prepared, ["hda"])
+
+    def test_skip(self):
+        """Running virtual machines and removed bricks are skipped."""
+
+        self.provisioner.start(self.factory)
+        self.vm.set_image("hda", vm.Image("test", "/vmimage"))
+        self.vm.proc = object()
+        self.clock.advance(self.provisioner.delay)
+        self.vm.proc = None
+        self.vm.set_image("hda", vm.Image("test2", "/vmimage2"))
+        self.factory.bricks.remove(self.vm)
+        self.clock.advance(self.provisioner.delay)
+        self.assertEqual(self.prepared, [])
+
+    def test_stop(self):
+        self.provisioner.start(self.factory)
+        self.vm.set_image("hda", vm.Image("test", "/vmimage"))
+        self.provisioner.stop()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
 class TestImage(unittest.TestCase):
 
     def test_acquire(self):
@@ -0,0 +1,227 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2018 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from virtualbricks import log
+from virtualbricks.tools import is_running
+from virtualbricks.gui import widgets, gui
+from virtualbricks.tests import stubs
+
+
+class Item:
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return "<Item {0}>".format(self.name)
+
+
+class BindingListStub(widgets.AbstractBindingList):
+
+    def __init__(self, items):
+        widgets.AbstractBindingList.__init__(self, None)
+        self.items = items
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+class TestObjectModel(unittest.TestCase):
+
+    def setUp(self):
+        self.model = widgets.ObjectModel()
+        self.signals = []
+        self.model.connect("row-inserted", self.on_row, "inserted")
+        self.model.connect("row-changed", self.on_row, "changed")
+        self.model.connect("row-deleted", self.on_row_deleted)
+        self.items = [Item(name) for name in "dbca"]
+
+    def on_row(self, model, path, itr, signal):
+        self.signals.append((signal, path.get_indices()[0]))
+
+    def on_row_deleted(self, model, path):
+        self.signals.append(("deleted", path.get_indices()[0]))
+
+    def values(self):
+        return [self.model.get_value(self.model.get_iter((i, )), 0)
+                for i in range(self.model.iter_n_children(None))]
+
+    def assert_index(self):
+        for i, item in enumerate(self.values()):
+            self.assertEqual(self.model.get_path_of(item).get_indices(), [i])
+
+    def test_binding_list(self):
+        """The signals of the binding list change only their rows."""
+
+        lst = BindingListStub(self.items[:3])
+        self.model.set_data_source(lst)
+        self.assertEqual(self.values(), self.items[:3])
+        del self.signals[:]
+        lst._on_added(self.items[3])
+        lst._on_changed(self.items[1])
+        lst._on_removed(self.items[0])
+        self.assertEqual(self.signals, [("inserted", 3), ("changed", 1),
+                                        ("deleted", 0)])
+        self.assertEqual(self.values(), self.items[1:])
+        self.assert_index()
+
+    def test_index(self):
+        """The index follows the rows moved by insertions and removals."""
+
+        for item in self.items:
+            self.model.add(item)
+        self.model.discard(self.items[1])
+        self.model.discard(self.items[0])
+        self.model.add(self.items[0])
+        self.assertEqual(self.values(), self.items[2:] + self.items[:1])
+        self.assert_index()
+        self.assertIs(self.model.get_path_of(self.items[1]), None)
+
+    def test_sort(self):
+        self.model.set_sort_key(lambda item: item.name)
+        for item in self.items:
+            self.model.add(item)
+        self.assertEqual([item.name for item in self.values()], list("abcd"))
+        del self.signals[:]
+        self.items[0].name = "0"
+        self.model.refresh(self.items[0])
+        self.assertEqual(self.signals, [("deleted", 3), ("inserted", 0)])
+        self.assertEqual([item.name for item in self.values()], list("0abc"))
+        self.assert_index()
+
+    def test_filter(self):
+        """Only the row of the object is checked again."""
+
+        hidden = set([self.items[1]])
+        self.model.set_visible_func(lambda item, h: item not in h, hidden)
+        for item in self.items:
+            self.model.add(item)
+        self.assertEqual(len(self.values()), 3)
+        del self.signals[:]
+        hidden.add(self.items[2])
+        self.model.refresh(self.items[2])
+        hidden.remove(self.items[1])
+        self.model.refresh(self.items[1])
+        self.assertEqual(self.signals, [("deleted", 1), ("inserted", 1)])
+        self.assertEqual(self.values(), [self.items[0], self.items[1],
+                                         self.items[3]])
+        self.assertTrue(self.items[2] in self.model)
+        self.assert_index()
+
+
+class TestRunningModel(unittest.TestCase):
+
+    def test_process_transitions(self):
+        """The running view follows the start and the end of the process."""
+
+        factory = stubs.FactoryStub()
+        brick = factory.new_brick("stub", "a")
+        factory.new_brick("stub", "b")
+        model = widgets.ObjectModel()
+        model.set_visible_func(is_running)
+        model.set_data_source(gui.BricksBindingList(factory))
+        self.assertEqual(model.iter_n_children(None), 0)
+        brick.proc = stubs.ProcessTransportStub()
+        brick._started_d = defer.Deferred()
+        brick.process_started(brick.proc)
+        self.assertEqual(model.iter_n_children(None), 1)
+        self.assertEqual(model.get_path_of(brick).get_indices(), [0])
+        brick._exited_d = defer.Deferred()
+        brick.process_ended(brick.proc, None)
+        self.assertEqual(model.iter_n_children(None), 0)
+
+
+class TestList(unittest.TestCase):
+
+    def test_list(self):
+        lst = gui.List()
+        items = [Item("a"), Item("b")]
+        for item in items:
+            lst.append(item)
+        self.assertEqual(list(lst), items)
+        lst.remove(items[0])
+        self.assertEqual(list(lst), items[1:])
+        self.assertRaises(ValueError, lst.remove, items[0])
+        del lst[:]
+        self.assertEqual(len(lst), 0)
+
+
+def log_event(text, level=log.LogLevel.info, namespace="test"):
+    return {"log_format": text, "log_level": level,
+            "log_namespace": namespace, "log_time": 0}
+
+
+class TestLogStore(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduled = []
+        self.store = widgets.LogStore(3, self.scheduled.append)
+        self.appended = []
+        self.store.appended.connect(self.appended.append)
+
+    def test_coalesce(self):
+        """Many events are formatted by a single idle callback."""
+
+        for i in range(3):
+            self.store(log_event("message {0}".format(i)))
+        self.assertEqual(self.scheduled, [self.store.flush])
+        self.assertFalse(self.store.flush())
+        self.assertEqual(len(self.appended), 1)
+        self.assertEqual([line.text for line in self.appended[0]],
+                         ["message 0", "message 1", "message 2"])
+        self.store(log_event("message 3"))
+        self.assertEqual(len(self.scheduled), 2)
+
+    def test_retention(self):
+        """Only the last messages are kept."""
+
+        for i in range(5):
+            self.store(log_event("message {0}".format(i)))
+        self.store.flush()
+        self.assertEqual([line.text for line in self.store.lines],
+                         ["message 2", "message 3", "message 4"])
+        # the events dropped before the flush are not even formatted
+        self.assertEqual(self.store.first_seq, 1)
+        self.store.set_retention(1)
+        self.assertEqual(self.store.first_seq, 3)
+        self.assertEqual(self.store.text(), "{0} [test] message 4\n".format(
+            log.format_time(0)))
+
+    def test_clear(self):
+        cleared = []
+        self.store.cleared.connect(cleared.append)
+        self.store(log_event("message"))
+        self.store.flush()
+        self.store.clear()
+        self.assertEqual(cleared, [self.store])
+        self.assertEqual(len(self.store.lines), 0)
+        self.assertEqual(self.store.first_seq, 2)
+
+    def test_filter(self):
+        self.store(log_event("a", log.LogLevel.debug, "virtualbricks.qemu"))
+        self.store(log_event("b", log.LogLevel.warn, "virtualbricks.gui"))
+        self.store(log_event("c", log.LogLevel.error, "virtualbricks.qemu"))
+        self.store.flush()
+        matches = widgets.log_filter("warn", "qemu")
+        self.assertEqual([line.text for line in self.store.lines
+                          if matches(line)], ["c"])
+        matches = widgets.log_filter()
+        self.assertEqual(len([line for line in self.store.lines
+                              if matches(line)]), 3)
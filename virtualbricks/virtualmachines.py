@@ -18,15 +18,17 @@
 
 import os
 import errno
+import hashlib
 import re
 import datetime
 import shutil
 import itertools
 
-from twisted.internet import utils, defer
+from six.moves import shlex_quote
+from twisted.internet import defer, reactor, task, threads, error
 
 from virtualbricks import (errors, tools, settings, bricks, log, project,
-                           observable)
+                           observable, qmp, imageinfo, importer)
 from virtualbricks._spawn import getQemuOutputAndValue, abspath_qemu
 
 
@@ -43,6 +45,37 @@ update_usb = log.Event("update_usbdevlist: old {old} - new {new}")
 own_err = log.Event("plug {plug} does not belong to {brick}")
 acquire_lock = log.Event("Aquiring disk locks")
 release_lock = log.Event("Releasing disk locks")
+qmp_connected = log.Event("QMP channel of {vm} connected")
+qmp_connection_error = log.Event("Cannot connect to the QMP socket of {vm}")
+qmp_event = log.Event("QMP event {name} received from {vm}")
+monitor_error = log.Event("Monitor command {command} failed on {vm}")
+hotplug_error = log.Event("Cannot change the network cards of the running "
+                          "virtual machine {vm}, changes reverted")
+disk_pending = log.Event("{disk} of the running virtual machine {vm} cannot "
+                         "be changed, the new image will be used at the next "
+                         "boot")
+provision_error = log.Event("Cannot prepare the private COW of {disk} of "
+                            "{vm}")
+state_saved = log.Event("State of {vm} saved in {path}")
+state_restored = log.Event("State of {vm} restored from {path}")
+disk_hotplug_error = log.Event("Cannot change {disk} of the running virtual "
+                               "machine {vm}")
+remove_scratch_cow = log.Event("Removing the disposable COW {path}")
+remove_scratch_cow_error = log.Event("Cannot remove the disposable COW {path}")
+persist_cow = log.Event("Moving the private COW of {disk} of {vm} in the "
+                        "project")
+
+# The placements of the private COWs: the project directory, the tmpfs in
+# /dev/shm or any other directory. The COWs outside the project directory are
+# disposable, they are removed when the virtual machine is powered off.
+PLACE_PROJECT = "project"
+PLACE_TMPFS = "tmpfs"
+TMPFS = "/dev/shm"
+# seconds the guest has to release a device removed from a running virtual
+# machine
+DEVICE_TIMEOUT = 30
+# seconds a state has to be saved or restored
+MIGRATION_TIMEOUT = 600
 
 
 class UsbDevice:
@@ -106,6 +139,8 @@ class Wrapper:
 
 class VMPlug(Wrapper):
 
+    netdev_id = None
+
     def __init__(self, plug):
         Wrapper.__init__(self, plug)
         self.model = "rtl8139"
@@ -114,6 +149,8 @@ class VMPlug(Wrapper):
 
 class VMSock(Wrapper):
 
+    netdev_id = None
+
     def __init__(self, sock):
         Wrapper.__init__(self, sock)
         self.model = "rtl8139"
@@ -183,11 +220,10 @@ class Image:
         if self._description is None:
             try:
                 with open(self._description_file()) as fp:
-                    return fp.read()
+                    self._description = fp.read()
             except IOError:
                 return ""
-        else:
-            return self._description
+        return self._description
 
     description = property(get_description, set_description)
 
@@ -203,10 +239,20 @@ class Image:
     def basename(self):
         return os.path.basename(self.path)
 
+    def get_info(self):
+        """
+        Return the metadata of the image, see L{imageinfo.ImageInfo}.
+
+        @raise OSError: if the image cannot be read.
+        """
+
+        return imageinfo.cache.get(self.path)
+
     def get_size(self):
-        if not self.exists():
+        try:
+            size = self.get_info().size
+        except (OSError, IOError):
             return "0"
-        size = os.path.getsize(self.path)
         if size > 1000000:
             return str(size / 1000000)
         else:
@@ -256,17 +302,111 @@ def move(src, dst):
             raise
 
 
+# Names given by QEMU to the drives defined with the legacy options (-hda,
+# -fda, etc.).
+LEGACY_DRIVE_IDS = {"hda": "ide0-hd0", "hdb": "ide0-hd1", "hdc": "ide1-hd0",
+                    "hdd": "ide1-hd1", "fda": "floppy0", "fdb": "floppy1",
+                    "mtdblock": "mtd0"}
+
+
+_cow_semaphore = None
+
+
+def _run_limited(function, *args):
+    """
+    Run C{function}, at most C{concurrency} functions are running at the same
+    time. Used to prepare the private COWs of many virtual machines started
+    together.
+    """
+
+    global _cow_semaphore
+    limit = int(settings.get("concurrency"))
+    if _cow_semaphore is None or _cow_semaphore.limit != limit:
+        _cow_semaphore = defer.DeferredSemaphore(limit)
+    return _cow_semaphore.run(function, *args)
+
+
+def scratch_folder(place, path):
+    """
+    Return the directory of the private COWs of the project in C{path} when
+    they are placed in C{place}, L{PLACE_TMPFS} or a directory.
+    """
+
+    if place == PLACE_TMPFS:
+        place = TMPFS
+    digest = hashlib.sha1(path.encode("utf-8")).hexdigest()[:8]
+    return os.path.join(os.path.expanduser(place),
+                        "virtualbricks-{0}".format(os.getuid()),
+                        "{0}-{1}".format(os.path.basename(path), digest))
+
+
+def free_space(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+# the space promised to the disposable COWs: path -> (device of the file
+# system, size the COW may grow up to)
+_reservations = {}
+
+
+def _reserved(device, exclude):
+    """
+    Return the space promised to the disposable COWs on C{device}, but for
+    C{exclude}, and not allocated yet.
+    """
+
+    total = 0
+    for path, (dev, size) in _reservations.items():
+        if dev != device or path == exclude:
+            continue
+        try:
+            size -= imageinfo.cache.get(path).allocated_size
+        except (OSError, IOError):
+            # the COW is not created yet
+            pass
+        total += max(size, 0)
+    return total
+
+
+def _unreserve(path):
+    _reservations.pop(path, None)
+
+
 class Disk:
 
-    sync_cmd = "sync"
     image = None
+    _waiters = None
+    # the id of the drive in the running virtual machine, if any
+    drive_id = None
+    hotplugged = False
 
     @property
     def cow(self):
         return self.VM.config["private" + self.device]
 
+    @property
+    def place(self):
+        """
+        The placement of the private COW, the one of the disk, the one of
+        the virtual machine or, if not set, the one of the project.
+        """
+
+        place = (self.VM.config["cowplace" + self.device] or
+                 self.VM.config["cowplace"])
+        if not place and project.manager.current is not None:
+            place = project.manager.current.get_cow_place()
+        return place or PLACE_PROJECT
+
+    def is_scratch(self):
+        """Return C{True} if the private COW is disposable."""
+
+        return self.place != PLACE_PROJECT
+
     @property
     def basefolder(self):
+        if self.is_scratch():
+            return scratch_folder(self.place, project.manager.current.path)
         return project.manager.current.path
 
     @property
@@ -296,6 +436,8 @@ class Disk:
 
     def set_image(self, image):
         self.image = image
+        if image is not None:
+            self.provision()
 
     def acquire(self):
         if self.image and not self.cow and not self.readonly():
@@ -308,38 +450,37 @@ class Disk:
     def _get_base(self):
         return self.image.path
 
-    def _sync(self, ret):
-
-        def complain_on_error(ret):
-            out, err, code = ret
-            if code != 0:
-                raise RuntimeError("sync failed\n%s" % err)
-
+    def _sync(self, ret, cowname):
         out, err, code = ret
         if code != 0:
             raise RuntimeError("Cannot create private COW\n%s" % err)
-
-        exit = utils.getProcessOutputAndValue(self.sync_cmd, env=os.environ)
-        exit.addCallback(complain_on_error)
-        return exit
+        # only the new file must be persisted, fsync can block for a while
+        return threads.deferToThread(tools.fsync, cowname)
 
     def _create_cow(self, cowname):
         if abspath_qemu('qemu-img', return_relative=False) is None:
             msg = _("qemu-img not found! I can't create a new image.")
             return defer.fail(errors.BadConfigError(msg))
 
+        def create():
+            exit = getQemuOutputAndValue("qemu-img", args, os.environ)
+            exit.addCallback(self._sync, cowname)
+            return exit
+
         logger.info(new_cow, base=self._get_base())
         args = ["create", "-b", self._get_base(), "-f",
                 settings.get("cowfmt"), cowname]
-        exit = getQemuOutputAndValue("qemu-img", args, os.environ)
-        exit.addCallback(self._sync)
-        exit.addCallback(lambda _: cowname)
-        return exit
+        d = _run_limited(create)
+        d.addCallback(lambda _: cowname)
+        return d
 
     def _check_base(self, cowname):
-        with open(cowname) as fp:
-            backing_file = tools.get_backing_file(fp)
-        if backing_file == self._get_base():
+        # the header is parsed again only if the COW changed
+        backing_file = imageinfo.cache.get(cowname).backing_file
+        # the COWs of a clone are backed by the COWs of the original project
+        if (backing_file == self._get_base() or
+                os.path.abspath(self._get_base()) in
+                imageinfo.cache.chain(cowname)[2:]):
             return defer.succeed(cowname)
         else:
             dt = datetime.datetime.now()
@@ -349,16 +490,55 @@ class Disk:
             move(cowname, cowback)
             return self._create_cow(cowname).addCallback(lambda _: cowname)
 
+    def _check_capacity(self, cowname):
+        # in the worst case the COW grows up to the size of the disk, a
+        # smaller share can be promised to fit large disks in a small tmpfs
+        size = int(imageinfo.cache.get(self._get_base()).virtual_size *
+                   float(settings.get("cowreserve")))
+        needed = size
+        try:
+            needed -= imageinfo.cache.get(cowname).allocated_size
+        except (OSError, IOError):
+            pass
+        # the COWs of the virtual machines started together share the space
+        device = os.stat(self.basefolder).st_dev
+        available = free_space(self.basefolder) - _reserved(device, cowname)
+        if available < needed:
+            raise errors.NoSpaceError(
+                "{0} bytes are needed in {1}, {2} are available".format(
+                    needed, self.basefolder, available))
+        _reservations[cowname] = device, size
+
     def _get_cow_name(self):
+        current = project.manager.current
+        if (current is not None and project.is_frozen(current.path) and
+                not self.readonly()):
+            return defer.fail(errors.ProjectFrozenError(current.name))
         try:
             os.makedirs(self.basefolder)
         except OSError as e:
             if e.errno != errno.EEXIST:
                 raise
         cowname = self.get_cow_path()
+        if not self.is_scratch():
+            return self._open_cow(cowname)
+        try:
+            self._check_capacity(cowname)
+        except errors.NoSpaceError:
+            return defer.fail()
+
+        def unreserve(failure):
+            # the promised space is not used if the COW cannot be opened
+            _unreserve(cowname)
+            return failure
+
+        return defer.maybeDeferred(self._open_cow, cowname).addErrback(
+            unreserve)
+
+    def _open_cow(self, cowname):
         try:
             return self._check_base(cowname)
-        except IOError as e:
+        except (IOError, OSError) as e:
             if e.errno == errno.ENOENT:
                 return self._create_cow(cowname)
             else:
@@ -368,24 +548,62 @@ class Disk:
         return os.path.join(self.basefolder, "%s_%s.cow" % (self.vm_name,
                                                             self.device))
 
+    def _prepare_cow(self):
+        """
+        Return a deferred that fires with the path of a valid private COW.
+        The calls made while the COW is prepared share the same result.
+        """
+
+        d = defer.Deferred()
+        if self._waiters is not None:
+            self._waiters.append(d)
+            return d
+        self._waiters = [d]
+        # any error must reach the waiters, or the next calls wait forever
+        prepared = defer.maybeDeferred(self._get_cow_name)
+        prepared.addBoth(self._cow_prepared)
+        return d
+
+    def _cow_prepared(self, result):
+        waiters, self._waiters = self._waiters, None
+        for d in waiters:
+            d.callback(result)
+
     def get_real_disk_name(self):
         if self.image is None:
             # XXX: this should be really an error
             return defer.succeed("")
         elif self.cow:
-            try:
-                return self._get_cow_name()
-            except (OSError, IOError) as e:
-                return defer.fail(e)
+            return self._prepare_cow()
         else:
             return defer.succeed(self.image.path)
 
+    def remove_scratch(self):
+        """Remove the private COW if it is disposable."""
+
+        if self.image is None or not self.cow or not self.is_scratch():
+            return
+        path = self.get_cow_path()
+        _unreserve(path)
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                logger.exception(remove_scratch_cow_error, path=path)
+        else:
+            logger.info(remove_scratch_cow, path=path)
+            imageinfo.cache.invalidate(path)
+
+    def provision(self):
+        """Prepare the private COW, if needed, in background."""
+
+        provisioner.schedule(self)
+
     def readonly(self):
         return self.VM.config["snapshot"]
 
     def __deepcopy__(self, memo):
         new = type(self)(self.VM, self.device)
-        new.sync_cmd = self.sync_cmd
         if self.image is not None:
             new.set_image(self.image)
         return new
@@ -396,6 +614,75 @@ class Disk:
                     self=self, readonly=self.readonly())
 
 
+def _ignore_frozen(fail):
+    # the COWs of a frozen project are prepared when they are used again
+    fail.trap(errors.ProjectFrozenError)
+
+
+class CowProvisioner:
+    """
+    Prepare the private COWs in background, shortly after an image is
+    assigned to a disk, so that the power-on of the virtual machine finds
+    them ready and validated.
+
+    The provisioner does nothing until it is started, so that the bricks can
+    be created, i.e. in the tests, without touching the file system.
+    """
+
+    delay = 1.0
+    running = False
+    _call = None
+
+    def __init__(self, reactor=reactor):
+        self.reactor = reactor
+        self._pending = []
+
+    def start(self, factory):
+        """Start the provisioner and prepare the COWs of all the bricks."""
+
+        self.running = True
+        for brick in factory.bricks:
+            if is_virtualmachine(brick):
+                for disk in brick.disks():
+                    if disk.image is not None:
+                        self.schedule(disk)
+
+    def stop(self):
+        self.running = False
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        del self._pending[:]
+
+    def schedule(self, disk):
+        if not self.running:
+            return
+        if disk not in self._pending:
+            self._pending.append(disk)
+        if self._call is None:
+            self._call = self.reactor.callLater(self.delay, self.provision)
+
+    def provision(self):
+        self._call = None
+        pending, self._pending = self._pending, []
+        return defer.DeferredList([self._provision(disk) for disk in pending])
+
+    def _provision(self, disk):
+        vm = disk.VM
+        # the disk may belong to a project that is not open anymore
+        if (disk.image is None or not disk.cow or vm.proc is not None or
+                vm not in vm.factory.bricks or project.manager.current is None):
+            return defer.succeed(None)
+        d = disk.get_real_disk_name()
+        d.addErrback(_ignore_frozen)
+        d.addErrback(logger.failure_eb, provision_error, disk=disk.device,
+                     vm=vm.name)
+        return d
+
+
+provisioner = CowProvisioner()
+
+
 VM_COMMAND_BUILDER = {
         "#argv0": "argv0",
         "#M": "machine",
@@ -571,6 +858,19 @@ class VirtualMachineConfig(bricks.Config):
                   "mtdblock": Device("mtdblock"),
                   "privatemtdblock": bricks.Boolean(False),
 
+                  # placement of the private COWs, empty for the one of the
+                  # project
+                  "cowplace": bricks.String(""),
+                  # placement of the private COW of a disk, empty for the one
+                  # of the virtual machine
+                  "cowplacehda": bricks.String(""),
+                  "cowplacehdb": bricks.String(""),
+                  "cowplacehdc": bricks.String(""),
+                  "cowplacehdd": bricks.String(""),
+                  "cowplacefda": bricks.String(""),
+                  "cowplacefdb": bricks.String(""),
+                  "cowplacemtdblock": bricks.String(""),
+
                   # system and machine
                   "argv0": bricks.String("qemu-system-i386"),
                   "cpu": bricks.String(""),
@@ -622,6 +922,16 @@ class VirtualMachineConfig(bricks.Config):
                   "loadvm": bricks.String("")}
 
 
+def _format_options(options):
+    """
+    Format a list of (name, value) pairs as a QEMU command line option. The
+    value of the first pair is the driver and it is written without its name.
+    """
+
+    (_, driver), rest = options[0], options[1:]
+    return ",".join([driver] + ["{0}={1}".format(n, v) for n, v in rest])
+
+
 def _get_nick(link):
     if hasattr(link, "sock"):
         return str(getattr(link.sock, "nickname", "None"))
@@ -636,12 +946,22 @@ class VirtualMachine(bricks.Brick):
     config_factory = VirtualMachineConfig
     process_protocol = bricks.Process
     default_arg0 = 'qemu-system-x86_64'
+    qmp = None
+    _netdev_counter = 0
+    _incoming = None
+    # the disposable COWs are kept if the state of the guest is saved
+    _keep_scratch = False
 
     def __init__(self, factory, name):
         bricks.Brick.__init__(self, factory, name)
         self._observable.add_event("image-changed")
         self.image_changed = observable.Event(self._observable,
                                               "image-changed")
+        self._observable.add_event("qmp-event")
+        self.qmp_event = observable.Event(self._observable, "qmp-event")
+        self._event_waiters = []
+        self._qmp_waiters = []
+        self._block_jobs = {}
         self.config["name"] = name
         for dev in "hda", "hdb", "hdc", "hdd", "fda", "fdb", "mtdblock":
             self.config[dev] = Disk(self, dev)
@@ -670,7 +990,9 @@ class VirtualMachine(bricks.Brick):
             return defer.succeed((self, self._last_status))
         elif not any((kill, term)):
             self.logger.info(powerdown, vm=self)
-            self.send("system_powerdown\n")
+            d = self.monitor_command("system_powerdown")
+            d.addErrback(self.logger.failure_eb, monitor_error,
+                         command="system_powerdown", vm=self)
             return self._exited_d
         if term:
             return bricks.Brick.poweroff(self)
@@ -687,10 +1009,245 @@ class VirtualMachine(bricks.Brick):
     def update_usbdevlist(self, dev):
         self.logger.debug(update_usb, old=self.config["usbdevlist"], new=dev)
         for device in set(dev) - set(self.config["usbdevlist"]):
-            self.send("usb_add host:{0}\n".format(device))
+            vendorid, _, productid = str(device).partition(":")
+            arguments = {"driver": "usb-host",
+                         "id": "usb-{0}-{1}".format(vendorid, productid),
+                         "vendorid": int(vendorid, 16),
+                         "productid": int(productid, 16)}
+            d = self.monitor_command("device_add", arguments,
+                                     "usb_add host:{0}".format(device))
+            d.addErrback(self.logger.failure_eb, monitor_error,
+                         command="device_add", vm=self)
         # FIXME: Don't know how to remove old devices, due to the ugly syntax
         # of usb_del command.
 
+    # QMP
+
+    def qmp_path(self):
+        return "%s/%s.qmp" % (settings.VIRTUALBRICKS_HOME, self.name)
+
+    def process_ended(self, proc, status):
+        if not self._keep_scratch:
+            for disk in self.disks():
+                disk.remove_scratch()
+        self._keep_scratch = False
+        bricks.Brick.process_ended(self, proc, status)
+
+    def process_started(self, proc):
+        # start the connection first so that the callbacks of poweron can
+        # wait for it
+        self.connect_qmp()
+        bricks.Brick.process_started(self, proc)
+
+    def connect_qmp(self, reactor=reactor):
+        """
+        Connect to the QMP socket of the running virtual machine.
+
+        @return: a deferred that fires with the L{qmp.QMPProtocol} instance
+            or with C{None} if the connection failed.
+        """
+
+        def connected(protocol):
+            if self.proc is None:
+                protocol.transport.loseConnection()
+            else:
+                self.logger.info(qmp_connected, vm=self)
+                self.qmp = protocol
+            return protocol
+
+        def notify_waiters(result):
+            waiters, self._qmp_waiters = self._qmp_waiters, []
+            for waiter in waiters:
+                waiter.callback(self.qmp)
+            return result
+
+        d = qmp.connect(reactor, self.qmp_path(), self)
+        d.addCallback(connected)
+        d.addErrback(self.logger.failure_eb, qmp_connection_error, vm=self)
+        d.addCallback(notify_waiters)
+        return d
+
+    def wait_qmp(self):
+        """
+        Wait for the connection of the QMP channel of the running virtual
+        machine.
+
+        @return: a deferred that fires with the L{qmp.QMPProtocol} instance
+            or with C{None} if the channel is not available.
+        """
+
+        if self.qmp is not None or self.proc is None:
+            return defer.succeed(self.qmp)
+        d = defer.Deferred()
+        self._qmp_waiters.append(d)
+        return d
+
+    def qmp_event_received(self, name, data, timestamp):
+        self.logger.debug(qmp_event, name=name, vm=self)
+        if name.startswith("BLOCK_JOB_") and data.get("device") in \
+                self._block_jobs:
+            self._block_jobs[data["device"]].event_received(name, data)
+        self._fire_waiters(name, data)
+        self._observable.notify("qmp-event", (self, name, data))
+
+    def qmp_connection_lost(self, reason):
+        self.qmp = None
+        waiters, self._event_waiters = self._event_waiters, []
+        for _, _, d in waiters:
+            d.errback(reason)
+        for job in list(self._block_jobs.values()):
+            job.fail(reason)
+
+    def qmp_execute(self, command, arguments=None):
+        """
+        Execute a QMP command.
+
+        @return: a deferred that fires with the structured result of the
+            command. It fails with L{errors.QMPNotConnectedError} if the QMP
+            channel is not available.
+        """
+
+        if self.qmp is None:
+            return defer.fail(errors.QMPNotConnectedError(self.name))
+        return self.qmp.execute(command, arguments)
+
+    def monitor_command(self, command, arguments=None, command_line=None):
+        """
+        Execute a command through QMP if available, otherwise write the
+        equivalent command line to the human monitor. In the latter case the
+        result is not known and the deferred fires with C{None}.
+        """
+
+        if self.qmp is not None:
+            return self.qmp.execute(command, arguments)
+        if command_line is None:
+            command_line = command
+        self.send(command_line + "\n")
+        return defer.succeed(None)
+
+    def human_monitor_command(self, command_line):
+        """
+        Execute a command of the human monitor, through QMP if available so
+        that errors are reported.
+        """
+
+        if self.qmp is not None:
+            return self.qmp.human_monitor_command(command_line)
+        self.send(command_line + "\n")
+        return defer.succeed(None)
+
+    def savevm(self, tag):
+        """Save the state of the virtual machine in the snapshot C{tag}."""
+
+        self._keep_scratch = True
+        return self.human_monitor_command("savevm " + tag)
+
+    def loadvm(self, tag):
+        """Restore the state of the virtual machine from the snapshot C{tag}."""
+
+        return self.human_monitor_command("loadvm " + tag)
+
+    # Saved state
+
+    def _wait_migration(self, interval=0.1, clock=reactor,
+                        timeout=MIGRATION_TIMEOUT):
+        """
+        Wait for the end of the migration, outgoing or incoming. If the
+        migration does not end in C{timeout} seconds, it is cancelled and
+        the deferred fails with L{errors.MigrationError}.
+        """
+
+        deadline = clock.seconds() + timeout
+
+        def check(info):
+            status = info.get("status")
+            if status == "completed":
+                return info
+            elif status in ("failed", "cancelled"):
+                raise errors.MigrationError(info.get("error-desc", status))
+            elif clock.seconds() >= deadline:
+                return cancel(status)
+            return task.deferLater(clock, interval, poll)
+
+        def cancel(status):
+            def timed_out(_):
+                raise errors.MigrationError(
+                    "migration not completed in {0} seconds, status: "
+                    "{1}".format(timeout, status))
+
+            d = self.qmp_execute("migrate_cancel")
+            d.addErrback(self.logger.failure_eb, monitor_error,
+                         command="migrate_cancel", vm=self)
+            return d.addCallback(timed_out)
+
+        def poll():
+            return self.qmp_execute("query-migrate").addCallback(check)
+
+        return poll()
+
+    def save_state(self, path, interval=0.1, clock=reactor):
+        """
+        Save the state of the running virtual machine in C{path} and
+        terminate it. The guest is stopped first so that the state is
+        consistent with the disks, if the state cannot be saved the guest is
+        resumed.
+
+        @return: a deferred that fires when the process is terminated.
+        """
+
+        if self.qmp is None:
+            return defer.fail(errors.QMPNotConnectedError(self.name))
+        exited = self._exited_d
+        uri = "exec:cat > " + shlex_quote(path)
+
+        def quit(_):
+            self.logger.info(state_saved, vm=self, path=path)
+            self._keep_scratch = True
+            self.qmp_execute("quit").addErrback(lambda _: None)
+            return exited
+
+        def resume(failure):
+            d = self.qmp_execute("cont")
+            d.addErrback(self.logger.failure_eb, monitor_error,
+                         command="cont", vm=self)
+            return d.addCallback(lambda _: failure)
+
+        d = self.qmp_execute("stop")
+        d.addCallback(lambda _: self.qmp_execute("migrate", {"uri": uri}))
+        d.addCallback(lambda _: self._wait_migration(interval, clock))
+        d.addCallbacks(quit, resume)
+        return d
+
+    def restore_state(self, path, interval=0.1, clock=reactor):
+        """
+        Start the virtual machine restoring the state saved in C{path} by
+        L{save_state}.
+
+        @return: a deferred that fires when the guest is running again.
+        """
+
+        def clear_incoming(passthru):
+            self._incoming = None
+            return passthru
+
+        def restored(_):
+            self.logger.info(state_restored, vm=self, path=path)
+            return self
+
+        if self.proc is not None:
+            return defer.fail(errors.MigrationError(
+                "{0} is already running".format(self.name)))
+        self._incoming = path
+        d = self.poweron()
+        d.addBoth(clear_incoming)
+        d.addCallback(lambda _: self.wait_qmp())
+        d.addCallback(lambda _: self._wait_migration(interval, clock))
+        # the guest was stopped before the state was saved, the incoming
+        # migration leaves it paused
+        d.addCallback(lambda _: self.qmp_execute("cont"))
+        d.addCallback(restored)
+        return d
+
     def configured(self):
         # return all([p.configured() for p in self.plugs])
         for p in self.plugs:
@@ -706,6 +1263,7 @@ class VirtualMachine(bricks.Brick):
         return abspath_qemu(arg0)
 
     def args(self):
+        self._assign_drive_ids()
         d = defer.gatherResults([disk.args() for disk in self.disks()])
         d.addCallback(self.__args)
         return d
@@ -757,22 +1315,14 @@ class VirtualMachine(bricks.Brick):
         if not self.plugs and not self.socks:
             res.extend(["-net", "none"])
         else:
-            for i, link in enumerate(itertools.chain(self.plugs, self.socks)):
-                res.append("-device")
-                res.append("{1.model},mac={1.mac},id=vx{0},netdev=vx{0}".format(
-                    i, link))
-                if link.sock and link.sock.mode == "hostonly":
-                    res.extend(("-netdev", "user,id=vx{0}".format(i)))
-                elif link.mode == "vde":
-                    res.append("-netdev")
-                    res.append("vde,id=vx{0},sock={1}".format(
-                        i, link.sock.path.rstrip('[]')))
-                elif link.mode == "sock":
-                    res.append("-netdev")
-                    res.append("vde,id=vx{0},sock={1}".format(
-                        i, link.path))
-                else:
-                    res.extend(["-netdev", "user"])
+            links = list(itertools.chain(self.plugs, self.socks))
+            for i, link in enumerate(links):
+                link.netdev_id = "vx{0}".format(i)
+                res.extend(["-device",
+                            _format_options(self._device_options(link)),
+                            "-netdev",
+                            _format_options(self._netdev_options(link))])
+            self._netdev_counter = len(links)
 
         if self.config["cdromen"] and self.config["cdrom"]:
                 res.extend(["-cdrom", self.config["cdrom"]])
@@ -794,9 +1344,165 @@ class VirtualMachine(bricks.Brick):
                     "socket,id=mon,path=%s,server,nowait" %
                     self.console(),
                     "-mon", "chardev=mon_cons", "-chardev",
-                    "stdio,id=mon_cons,signal=off"])
+                    "stdio,id=mon_cons,signal=off",
+                    "-qmp", "unix:%s,server,nowait" % self.qmp_path()])
+        if self._incoming:
+            res.extend(["-incoming", "exec:cat " + shlex_quote(self._incoming)])
         return res
 
+    # Network cards
+
+    def _device_options(self, link):
+        return [("driver", link.model), ("mac", link.mac),
+                ("id", link.netdev_id), ("netdev", link.netdev_id)]
+
+    def _netdev_options(self, link):
+        sock = getattr(link, "sock", None)
+        if sock and sock.mode == "hostonly":
+            return [("type", "user"), ("id", link.netdev_id)]
+        elif link.mode == "vde":
+            return [("type", "vde"), ("id", link.netdev_id),
+                    ("sock", sock.path.rstrip("[]"))]
+        elif link.mode == "sock":
+            return [("type", "vde"), ("id", link.netdev_id),
+                    ("sock", link.path)]
+        return [("type", "user"), ("id", link.netdev_id)]
+
+    def _is_live(self, link):
+        """True if the changes to the link must be applied to the process."""
+
+        return self.proc is not None and (link.mode == "sock" or
+                                          link.configured())
+
+    def hotplug(self, link):
+        """
+        Add the network card of the link to the running virtual machine.
+
+        The link keeps its id if it already has one, otherwise a new id, never
+        used before by the process, is assigned. If the card cannot be added,
+        the backend is removed too.
+
+        @return: a deferred that fires when the card is added.
+        """
+
+        if link.netdev_id is None:
+            link.netdev_id = "vx{0}".format(self._netdev_counter)
+            self._netdev_counter += 1
+        device = self._device_options(link)
+        netdev = self._netdev_options(link)
+
+        def add_netdev(_):
+            return self.monitor_command("netdev_add", dict(netdev),
+                                        "netdev_add " +
+                                        _format_options(netdev))
+
+        def add_device(_):
+            d = self.monitor_command("device_add", dict(device),
+                                     "device_add " + _format_options(device))
+            d.addErrback(remove_netdev)
+            return d
+
+        def remove_netdev(failure):
+            d = self.monitor_command("netdev_del", {"id": link.netdev_id},
+                                     "netdev_del " + link.netdev_id)
+            d.addBoth(lambda _: failure)
+            return d
+
+        if link.mode == "sock":
+            d = defer.succeed(None)
+        else:
+            # start the switch if needed
+            d = link.connected()
+        d.addCallback(add_netdev)
+        d.addCallback(add_device)
+        return d
+
+    def hotunplug(self, link, timeout=DEVICE_TIMEOUT, clock=reactor):
+        """
+        Remove the network card of the link from the running virtual
+        machine.
+
+        The removal of the device is asynchronous, the backend is removed,
+        and the id can be used again, only when the guest released the
+        device.
+
+        @return: a deferred that fires with C{True} when the card and its
+            backend are removed or with C{False} if the virtual machine
+            exited meanwhile. It fails only if the card is not removed, errors
+            removing the backend are only logged.
+        """
+
+        netdev_id = link.netdev_id
+
+        def remove_netdev(removed):
+            if not removed:
+                return False
+            d = self.monitor_command("netdev_del", {"id": netdev_id},
+                                     "netdev_del " + netdev_id)
+            d.addErrback(self.logger.failure_eb, monitor_error,
+                         command="netdev_del", vm=self)
+            return d.addCallback(lambda _: True)
+
+        d = self._delete_device(netdev_id, timeout, clock)
+        d.addCallback(remove_netdev)
+        return d
+
+    def _delete_device(self, device_id, timeout, clock):
+        """
+        Remove the device C{device_id} and wait for the guest to release it.
+
+        @return: a deferred that fires with C{True} when the device is
+            removed or with C{False} if the virtual machine exited meanwhile.
+            It fails with L{errors.DeviceTimeoutError} if the guest does not
+            release the device within C{timeout} seconds.
+        """
+
+        if self.qmp is None:
+            d = self.monitor_command("device_del", {"id": device_id},
+                                     "device_del " + device_id)
+            return d.addCallback(lambda _: True)
+        # the event can be sent before the reply to device_del
+        deleted = self.wait_qmp_event("DEVICE_DELETED", device=device_id)
+
+        def wait(_):
+            deleted.addTimeout(timeout, clock)
+            deleted.addCallbacks(lambda _: True, timed_out)
+            return deleted
+
+        def timed_out(failure):
+            failure.trap(defer.TimeoutError)
+            raise errors.DeviceTimeoutError(device_id)
+
+        def exited(failure):
+            # the process exited, the device is gone with it
+            failure.trap(error.ConnectionClosed)
+            return False
+
+        def discard(failure):
+            deleted.addErrback(lambda _: None)
+            deleted.cancel()
+            return failure
+
+        d = self.monitor_command("device_del", {"id": device_id},
+                                 "device_del " + device_id)
+        d.addCallbacks(wait, discard)
+        d.addErrback(exited)
+        return d
+
+    def _revert_on_error(self, deferred, rollback, *args):
+
+        def revert(failure):
+            self.logger.failure(hotplug_error, failure, vm=self)
+            rollback(*args)
+            self.notify_changed()
+
+        return deferred.addErrback(revert)
+
+    def _rollback_add(self, links, link):
+        links.remove(link)
+        if link.mode != "sock" and link.configured():
+            link.disconnect()
+
     def add_sock(self, mac=None, model=None):
         s = self.factory.new_sock(self)
         sock = VMSock(s)
@@ -809,6 +1515,9 @@ class VirtualMachine(bricks.Brick):
             sock.mac = mac
         if model:
             sock.model = model
+        if self._is_live(sock):
+            self._revert_on_error(self.hotplug(sock), self._rollback_add,
+                                  self.socks, sock)
         return sock
 
     def add_plug(self, sock, mac=None, model=None):
@@ -820,23 +1529,300 @@ class VirtualMachine(bricks.Brick):
             plug.mac = mac
         if model:
             plug.model = model
+        if self._is_live(plug):
+            self._revert_on_error(self.hotplug(plug), self._rollback_add,
+                                  self.plugs, plug)
         return plug
 
     def connect(self, sock, *args):
         self.add_plug(sock, *args)
 
     def remove_plug(self, plug):
+        links = self.socks if plug.mode == "sock" else self.plugs
         try:
-            if plug.mode == "sock":
-                self.socks.remove(plug)
-            else:
-                self.plugs.remove(plug)
+            index = links.index(plug)
         except ValueError:
             self.logger.error(own_err, plug=plug, brick=self)
+            return
+        del links[index]
+        if self._is_live(plug) and plug.netdev_id is not None:
+            self._revert_on_error(self.hotunplug(plug), links.insert, index,
+                                  plug)
+
+    def replug(self, plug, sock, mac=None, model=None):
+        """
+        Connect the plug to another sock and change its mac address and
+        model. If the virtual machine is running, the network card is
+        replaced keeping its id, the new card is added when the guest
+        released the old one.
+        """
+
+        old = plug.sock, plug.mac, plug.model
+        live = self._is_live(plug) and plug.netdev_id is not None
+
+        def configure(sock, mac, model):
+            if plug.configured():
+                plug.disconnect()
+            if sock is not None:
+                plug.connect(sock)
+            if mac:
+                plug.mac = mac
+            if model:
+                plug.model = model
+
+        def plug_new(removed):
+            if not removed:
+                # the virtual machine exited
+                return None
+            return self.hotplug(plug).addErrback(plug_old)
+
+        def plug_old(failure):
+            configure(*old)
+            d = self.hotplug(plug)
+            d.addErrback(self.logger.failure_eb, monitor_error,
+                         command="device_add", vm=self)
+            return d.addCallback(lambda _: failure)
+
+        def restore(failure):
+            configure(*old)
+            return failure
+
+        configure(sock, mac, model)
+        self.notify_changed()
+        if live:
+            d = self.hotunplug(plug)
+            d.addCallbacks(plug_new, restore)
+            self._revert_on_error(d, lambda: None)
+
+    # Disks
+
+    def _assign_drive_ids(self):
+        virtio = itertools.count()
+        for disk in self.disks():
+            disk.hotplugged = False
+            if disk.image is None:
+                disk.drive_id = None
+            elif self.config["use_virtio"]:
+                disk.drive_id = "virtio{0}".format(next(virtio))
+            else:
+                disk.drive_id = LEGACY_DRIVE_IDS[disk.device]
+
+    def wait_qmp_event(self, name, **match):
+        """
+        Wait for the QMP event C{name} whose data contain C{match}.
+
+        @return: a deferred that fires with the data of the event or fails if
+            the QMP channel is closed. If the deferred is cancelled, the
+            event is not waited anymore.
+        """
+
+        def cancel(d):
+            self._event_waiters = [waiter for waiter in self._event_waiters
+                                   if waiter[2] is not d]
+
+        d = defer.Deferred(cancel)
+        self._event_waiters.append((name, match, d))
+        return d
+
+    def _fire_waiters(self, name, data):
+        waiters = []
+        for waiter in self._event_waiters:
+            ename, match, d = waiter
+            if ename == name and all(data.get(k) == v
+                                     for k, v in match.items()):
+                d.callback(data)
+            else:
+                waiters.append(waiter)
+        self._event_waiters = waiters
+
+    def attach_disk(self, disk):
+        """
+        Attach the image of the disk to the running virtual machine.
+
+        The image is added as a new drive, with format probing, and exposed
+        to the guest as a virtio block device: the legacy IDE and floppy
+        controllers do not support hot-plug.
+
+        @return: a deferred that fires when the device is added.
+        """
+
+        drive_id = "vb-" + disk.device
+        device = [("driver", "virtio-blk-pci"), ("drive", drive_id),
+                  ("id", drive_id)]
+
+        def add_drive(path):
+            options = "if=none,id={0},file={1}".format(drive_id, path)
+            if disk.readonly():
+                options += ",snapshot=on"
+            return self.human_monitor_command("drive_add 0 " + options)
+
+        def add_device(_):
+            d = self.monitor_command("device_add", dict(device),
+                                     "device_add " + _format_options(device))
+            d.addErrback(remove_drive)
+            return d
+
+        def remove_drive(failure):
+            d = self.human_monitor_command("drive_del " + drive_id)
+            d.addBoth(lambda _: failure)
+            return d
+
+        def attached(_):
+            disk.drive_id = drive_id
+            disk.hotplugged = True
 
-    def commit_disks(self, args):
-        # XXX: fixme
-        self.send("commit all\n")
+        d = disk.get_real_disk_name()
+        d.addCallback(add_drive)
+        d.addCallback(add_device)
+        d.addCallback(attached)
+        return d
+
+    def detach_disk(self, disk, timeout=DEVICE_TIMEOUT, clock=reactor):
+        """
+        Detach a disk previously attached with L{attach_disk}. The drive is
+        removed by QEMU together with the device.
+
+        @return: a deferred that fires with C{True} when the guest released
+            the device or with C{False} if the virtual machine exited
+            meanwhile. It fails with L{errors.DeviceTimeoutError} if the
+            guest does not release the device within C{timeout} seconds.
+        """
+
+        if not disk.hotplugged:
+            return defer.fail(errors.InvalidActionError(
+                "{0} cannot be removed from a running virtual machine".format(
+                    disk.device)))
+
+        def detached(removed):
+            disk.drive_id = None
+            disk.hotplugged = False
+            return removed
+
+        d = self._delete_device(disk.drive_id, timeout, clock)
+        d.addCallback(detached)
+        return d
+
+    def _release_image(self, disk, image):
+        if image is not None and not disk.cow and not disk.readonly():
+            image.release(disk)
+
+    def _change_disk_live(self, disk, old):
+
+        def detach(_):
+            self._release_image(disk, old)
+            return self.detach_disk(disk)
+
+        def attach(removed):
+            if removed is False:
+                # the virtual machine exited
+                return None
+            disk.acquire()
+            d = self.attach_disk(disk)
+            d.addErrback(release)
+            return d
+
+        def release(failure):
+            self._release_image(disk, disk.image)
+            return failure
+
+        if disk.drive_id is not None and not disk.hotplugged:
+            self.logger.warn(disk_pending, disk=disk.device, vm=self)
+            return defer.succeed(None)
+        d = defer.succeed(None)
+        if disk.hotplugged:
+            d.addCallback(detach)
+        if disk.image is not None:
+            d.addCallback(attach)
+        d.addErrback(self.logger.failure_eb, disk_hotplug_error,
+                     disk=disk.device, vm=self)
+        return d
+
+    def commit_disk(self, disk, progress=None, interval=1.0):
+        """
+        Merge the private COW of the disk into its base image while the
+        virtual machine is running. The COW remains in use.
+
+        @param progress: a callable that is called with the number of bytes
+            committed and the total bytes.
+        @return: a deferred that fires when the data are committed.
+        """
+
+        if not disk.cow or disk.drive_id is None:
+            return defer.fail(errors.InvalidActionError(
+                "{0} has not an active private COW".format(disk.device)))
+        if self.qmp is None:
+            # the commit command of the human monitor is synchronous
+            return self.human_monitor_command("commit " + disk.drive_id)
+        job_id = "commit-" + disk.device
+        job = self._block_jobs[job_id] = qmp.BlockJob(
+            self.qmp_execute, job_id, pivot=False, progress=progress)
+        job.done.addBoth(self._block_job_done, job_id)
+        d = self.qmp.execute("block-commit", {"device": disk.drive_id,
+                                              "job-id": job_id})
+        d.addCallbacks(lambda _: job.poll(interval), job.fail)
+        return job.done
+
+    def _block_job_done(self, passthru, job_id):
+        self._block_jobs.pop(job_id, None)
+        return passthru
+
+    def persist_disk(self, disk, progress=None, interval=1.0):
+        """
+        Move the disposable private COW of the disk in the project directory,
+        from now on the COW of the disk, and only of this disk, is placed in
+        the project. If the virtual machine is running the COW is mirrored
+        and the guest switches to the new COW when the data are
+        synchronized.
+
+        @param progress: a callable that is called with the number of bytes
+            copied and the total bytes.
+        @return: a deferred that fires with the new path of the COW.
+        """
+
+        if not disk.cow or disk.image is None or not disk.is_scratch():
+            return defer.fail(errors.InvalidActionError(
+                "{0} has not a disposable private COW".format(disk.device)))
+        source = disk.get_cow_path()
+        target = os.path.join(project.manager.current.path,
+                              os.path.basename(source))
+        self.logger.info(persist_cow, disk=disk.device, vm=self)
+
+        def placed(_):
+            self.set({"cowplace" + disk.device: PLACE_PROJECT})
+            imageinfo.cache.invalidate(source)
+            _unreserve(source)
+            return target
+
+        if self.proc is None:
+            if not os.path.exists(source):
+                return defer.succeed(None).addCallback(placed)
+            d = threads.deferToThread(importer.relocate, source, target)
+            return d.addCallback(placed)
+        if self.qmp is None or disk.drive_id is None:
+            return defer.fail(errors.InvalidActionError(
+                "{0} cannot be moved without the QMP channel".format(
+                    disk.device)))
+        job_id = "persist-" + disk.device
+        job = self._block_jobs[job_id] = qmp.BlockJob(
+            self.qmp_execute, job_id, pivot=True, progress=progress)
+        job.done.addBoth(self._block_job_done, job_id)
+        fmt = imageinfo.cache.get(source).format.name.lower()
+        # only the data of the COW are copied, the new COW has the same base
+        d = self.qmp.execute("drive-mirror", {
+            "device": disk.drive_id, "job-id": job_id, "target": target,
+            "format": fmt, "sync": "top", "mode": "absolute-paths"})
+        d.addCallbacks(lambda _: job.poll(interval), job.fail)
+        job.done.addCallback(lambda _: os.remove(source))
+        job.done.addCallback(placed)
+        return job.done
+
+    def commit_disks(self, progress=None):
+        """Commit all the private COWs of the running virtual machine."""
+
+        deferreds = [self.commit_disk(disk, progress)
+                     for disk in self.disks()
+                     if disk.cow and disk.drive_id is not None]
+        return defer.gatherResults(deferreds, consumeErrors=True)
 
     def acquire(self):
         """Acquire locks on images if needed."""
@@ -862,9 +1848,14 @@ class VirtualMachine(bricks.Brick):
             yield self.config[hd]
 
     def set_image(self, disk, image):
-        self.config[disk].image = image
+        disk = self.config[disk]
+        old, disk.image = disk.image, image
+        if image is not None:
+            disk.provision()
         if not self._restore:
             self._observable.notify("image-changed", (self, image))
+        if old is not image and self.proc is not None:
+            self._change_disk_live(disk, old)
 
     def set_vm(self, disk):
         disk.VM = self
@@ -872,6 +1863,23 @@ class VirtualMachine(bricks.Brick):
     cbset_hda = cbset_hdb = cbset_hdc = cbset_hdd = cbset_fda = cbset_fdb = \
             cbset_mtblock = set_vm
 
+    def _provision_private(device):
+
+        def cbset_private(self, value):
+            if value and self.config[device].image is not None:
+                self.config[device].provision()
+
+        return cbset_private
+
+    cbset_privatehda = _provision_private("hda")
+    cbset_privatehdb = _provision_private("hdb")
+    cbset_privatehdc = _provision_private("hdc")
+    cbset_privatehdd = _provision_private("hdd")
+    cbset_privatefda = _provision_private("fda")
+    cbset_privatefdb = _provision_private("fdb")
+    cbset_privatemtdblock = _provision_private("mtdblock")
+    del _provision_private
+
 
 def is_virtualmachine(brick):
     return brick.get_type() == "Qemu"